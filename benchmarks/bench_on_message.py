@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+SoraBot.on_message のスループット計測
+
+合成メッセージ（キーワード、なう/わず/うぃる、備品の質問、Webhook支出、
+メンションによるサマリー、雑談）を一定の比率で on_message に流し込み、
+messages/sec・ハンドラ遅延の p50/p99・メッセージあたりのDB呼び出し数を出力する。
+Discord の HTTP 層はフェイクに差し替えるため、実際の API には一切触れない。
+
+使い方（リポジトリのルートで実行）:
+    python -m benchmarks.bench_on_message                  # インメモリのSQLite
+    python -m benchmarks.bench_on_message --sqlite-path bench.db
+    python -m benchmarks.bench_on_message --dsn postgresql://localhost/sora_bench
+
+--dsn を指定すると init_db() が走るため、必ずベンチマーク専用のDBを使うこと。
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import statistics
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Tuple
+
+from config import Config
+from discord_client import SoraBot, WALLET_ORDER
+from storage import DuplicateStorageError
+from storage.postgres import PostgresStorage
+from storage.sqlite import SQLiteStorage
+from benchmarks.fakes import FakeChannel, FakeGuild, FakeMessage, FakeUser
+
+BOT_USER_ID = 1_000_000_000_000_000_001
+
+# (種類, 重み)
+DEFAULT_MIX = [
+    ("chatter", 30),
+    ("keyword", 20),
+    ("activity_doing", 12),
+    ("activity_done", 10),
+    ("activity_todo", 6),
+    ("item_find", 8),
+    ("item_list", 4),
+    ("webhook_spend", 5),
+    ("mention_summary", 5),
+]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Workload:
+    """種類ごとの合成メッセージを生成する"""
+
+    def __init__(self, rng: random.Random, bot_user: FakeUser, users: List[FakeUser], channels: List[FakeChannel]):
+        self.rng = rng
+        self.bot_user = bot_user
+        self.users = users
+        self.channels = channels
+        self.builders: Dict[str, Callable[[], FakeMessage]] = {
+            "chatter": lambda: self._message("今日はいい天気ですね"),
+            "keyword": lambda: self._message(self.rng.choice(["わずかに遅れます", "なうい服を買った", "うぃるすに注意"])),
+            "activity_doing": lambda: self._message(self.rng.choice(["作業なう", "読書なう", "移動なう"])),
+            "activity_done": lambda: self._message(f"{self.rng.randint(0, 23)}:{self.rng.randint(0, 59):02d} ランチわず"),
+            "activity_todo": lambda: self._message(f"{self.rng.randint(0, 23)}:{self.rng.randint(0, 59):02d} ジムうぃる"),
+            "item_find": lambda: self._message(f"{self.rng.choice(['ハサミ', 'テープ', '電池'])}どこ？"),
+            "item_list": lambda: self._message("棚Aの中身は？"),
+            "webhook_spend": lambda: self._message(self.rng.choice([
+                "spend_webhook: ぽて財布で食費に500円",
+                "spend_webhook: 日用品に300円、ぬし財布から",
+                "spend_webhook: 1200円を交通費として",
+            ])),
+            "mention_summary": self._mention,
+        }
+
+    def _message(self, content: str, mentions=None) -> FakeMessage:
+        return FakeMessage(self.rng.choice(self.users), self.rng.choice(self.channels), content, mentions)
+
+    def _mention(self) -> FakeMessage:
+        target = self.rng.choice(self.users)
+        return self._message(f"{self.bot_user.mention} {target.mention}", mentions=[self.bot_user, target])
+
+    def generate(self, count: int, mix: List[Tuple[str, int]]) -> List[Tuple[str, FakeMessage]]:
+        kinds = [kind for kind, _ in mix]
+        weights = [weight for _, weight in mix]
+        return [(kind, self.builders[kind]()) for kind in self.rng.choices(kinds, weights=weights, k=count)]
+
+
+async def dispatch(bot: SoraBot, message: FakeMessage):
+    """on_message と同じくディスパッチャーに投入し、そのメッセージの処理完了まで待つ"""
+    await bot.dispatcher.submit(message.author.id, bot.handle_message, message)
+
+
+async def seed(bot: SoraBot, guild: FakeGuild):
+    """Webhook支出と備品の質問が成功パスを通るよう初期データを入れる"""
+    for wallet in WALLET_ORDER:
+        await bot.storage.reset_balance(Config.OWNER_ID, wallet, 10 ** 12)
+    try:
+        await bot.storage.add_storage(guild.id, guild.name, "棚A")
+    except DuplicateStorageError:
+        pass
+    storage_id = await bot.storage.get_storage_id(guild.id, "棚A")
+    for item in ("ハサミ", "テープ", "電池"):
+        await bot.storage.upsert_item(storage_id, item)
+
+
+def build_bot(bot_user: FakeUser, users: List[FakeUser], channels: List[FakeChannel]) -> SoraBot:
+    """Discord に接続せずに on_message を呼べる SoraBot を組み立てる"""
+    bot = SoraBot()
+    bot._connection.user = bot_user
+    Config.TARGET_CHANNEL_IDS = [channel.id for channel in channels]
+    bot.apply_config()
+
+    user_map = {user.id: user for user in users}
+    channel_map = {channel.id: channel for channel in channels}
+
+    async def fetch_user(user_id: int):
+        return user_map.get(user_id)
+
+    async def process_commands(message):
+        # プレフィックスコマンドはベンチマーク対象外
+        return None
+
+    bot.get_user = user_map.get
+    bot.get_channel = channel_map.get
+    bot.fetch_user = fetch_user
+    bot.process_commands = process_commands
+    return bot
+
+
+async def run_benchmark(args) -> dict:
+    rng = random.Random(args.seed)
+    guild = FakeGuild(900_000_000_000_000_001, "ベンチマーク")
+    channels = [FakeChannel(910_000_000_000_000_000 + i, f"bench-{i}", guild) for i in range(args.channels)]
+    users = [FakeUser(920_000_000_000_000_000 + i, f"隊員{i}") for i in range(args.users)]
+    bot_user = FakeUser(BOT_USER_ID, "Sora", bot=True)
+
+    if Config.OWNER_ID is None:
+        Config.OWNER_ID = users[0].id
+
+    bot = build_bot(bot_user, users, channels)
+    if args.dsn:
+        bot.storage = PostgresStorage(args.dsn, bot.query_stats)
+    else:
+        bot.storage = SQLiteStorage(args.sqlite_path, bot.query_stats)
+    await bot.init_db()
+    await seed(bot, guild)
+
+    workload = Workload(rng, bot_user, users, channels)
+    warmup = workload.generate(args.warmup, DEFAULT_MIX)
+    messages = workload.generate(args.messages, DEFAULT_MIX)
+
+    for _, message in warmup:
+        await dispatch(bot, message)
+    await bot.dispatcher.drain()
+    await bot.outbound.drain()
+    bot.query_stats.reset()
+    for channel in channels:
+        channel.sent = 0
+
+    latencies: List[float] = []
+    by_kind: Dict[str, List[float]] = defaultdict(list)
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in messages:
+        queue.put_nowait(item)
+
+    async def worker():
+        while not queue.empty():
+            kind, message = queue.get_nowait()
+            started = time.perf_counter()
+            await dispatch(bot, message)
+            elapsed = time.perf_counter() - started
+            latencies.append(elapsed)
+            by_kind[kind].append(elapsed)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    await bot.dispatcher.drain()
+    await bot.outbound.drain()
+    wall = time.perf_counter() - started
+
+    count = len(messages)
+    result = {
+        "messages": count,
+        "concurrency": args.concurrency,
+        "backend": bot.storage.backend,
+        "dispatcher": bot.dispatcher.stats(),
+        "outbound": bot.outbound.stats(),
+        "wall_seconds": round(wall, 4),
+        "messages_per_sec": round(count / wall, 1) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "db_calls_per_message": round(bot.query_stats.total_calls / count, 3),
+        "sends_per_message": round(sum(channel.sent for channel in channels) / count, 3),
+        "reactions_per_message": round(sum(message.reactions_added for _, message in messages) / count, 3),
+        "by_kind": {
+            kind: {"count": len(values), "p50_ms": round(percentile(values, 50) * 1000, 3), "mean_ms": round(statistics.fmean(values) * 1000, 3)}
+            for kind, values in sorted(by_kind.items())
+        },
+    }
+
+    await bot.storage.close()
+    return result
+
+
+def print_report(result: dict):
+    print(f"backend={result['backend']} messages={result['messages']} concurrency={result['concurrency']}")
+    print(f"throughput : {result['messages_per_sec']:,.1f} msg/s ({result['wall_seconds']}s)")
+    print(f"latency    : p50 {result['p50_ms']}ms / p99 {result['p99_ms']}ms")
+    print(f"db calls   : {result['db_calls_per_message']} / message")
+    print(f"discord    : sends {result['sends_per_message']} / reactions {result['reactions_per_message']} per message")
+    print(f"dispatcher : {result['dispatcher']}")
+    print(f"outbound   : {result['outbound']}")
+    print("by kind:")
+    for kind, stats in result["by_kind"].items():
+        print(f"  {kind:<16} n={stats['count']:<6} p50 {stats['p50_ms']}ms  mean {stats['mean_ms']}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SoraBot.on_message replay benchmark")
+    parser.add_argument("--messages", type=int, default=5000, help="計測するメッセージ数")
+    parser.add_argument("--warmup", type=int, default=200, help="計測前に流すメッセージ数")
+    parser.add_argument("--concurrency", type=int, default=1, help="同時に処理するメッセージ数")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--channels", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--sqlite-path", default=":memory:", help="--dsn 未指定時に使うSQLiteのパス")
+    parser.add_argument("--dsn", help="ローカルPostgreSQLの接続URL（ベンチマーク専用DBを指定すること）")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    result = asyncio.run(run_benchmark(args))
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main()
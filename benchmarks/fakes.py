@@ -0,0 +1,102 @@
+"""
+ベンチマーク用のフェイク実装
+
+Discord の HTTP 層を一切呼ばないように、on_message やスラッシュコマンドが触る
+属性だけを持つ軽量なメッセージ/チャンネル/ユーザー/Interaction を提供する。
+"""
+
+from datetime import datetime, timezone
+from typing import List, Optional
+
+
+class FakeUser:
+    def __init__(self, user_id: int, name: str, bot: bool = False):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.mention = f"<@{user_id}>"
+        self.dm_count = 0
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    async def send(self, *args, **kwargs):
+        self.dm_count += 1
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, name: str):
+        self.id = guild_id
+        self.name = name
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int, name: str, guild: FakeGuild):
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+        self.sent = 0
+
+    async def send(self, *args, **kwargs):
+        self.sent += 1
+
+
+class FakeMessage:
+    """on_message が参照する discord.Message の属性だけを持つ代用品"""
+    _next_id = 1_300_000_000_000_000_000
+
+    def __init__(self, author: FakeUser, channel: FakeChannel, content: str, mentions: Optional[List[FakeUser]] = None):
+        FakeMessage._next_id += 1
+        self.id = FakeMessage._next_id
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.mentions = mentions or []
+        self.created_at = datetime.now(timezone.utc)
+        self.jump_url = f"https://discord.com/channels/{channel.guild.id}/{channel.id}/{self.id}"
+        self._state = None
+        self.reactions_added = 0
+        self.last_reaction = None
+
+    async def add_reaction(self, emoji):
+        self.reactions_added += 1
+        self.last_reaction = emoji
+
+
+class FakeInteractionResponse:
+    def __init__(self, interaction: 'FakeInteraction'):
+        self._interaction = interaction
+
+    async def send_message(self, content=None, *, embed=None, ephemeral=False, **kwargs):
+        self._interaction.replies.append((content, ephemeral))
+
+    async def defer(self, *, ephemeral=False, **kwargs):
+        self._interaction.deferred = True
+
+
+class FakeFollowup:
+    def __init__(self, interaction: 'FakeInteraction'):
+        self._interaction = interaction
+
+    async def send(self, content=None, *, embed=None, ephemeral=False, **kwargs):
+        self._interaction.replies.append((content, ephemeral))
+
+
+class FakeInteraction:
+    """スラッシュコマンドのコールバックに渡す discord.Interaction の代用品"""
+
+    def __init__(self, user: FakeUser):
+        self.user = user
+        self.replies = []
+        self.deferred = False
+        self.response = FakeInteractionResponse(self)
+        self.followup = FakeFollowup(self)
+
+    @property
+    def last_reply(self) -> str:
+        return (self.replies[-1][0] or "") if self.replies else ""
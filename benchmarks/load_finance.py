@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+FinanceCog スラッシュコマンドの同時実行負荷テスト
+
+/spend・/transfer・/salary・/reset・/edit_spend のコールバックと Webhook 支出を、
+フェイクの Interaction を使ってローカル PostgreSQL に対して指定の並列度で実行する。
+スループット・遅延パーセンタイル・ロック待ち・デッドロックを計測し、
+最後に transactions を再生した結果と user_balances が一致するかを検証する。
+
+使い方（リポジトリのルートで実行、必ず負荷テスト専用のDBを使うこと）:
+    python -m benchmarks.load_finance --dsn postgresql://localhost/sora_load --concurrency 16 --ops 2000
+
+/reset は残高を絶対値で上書きするため、他の操作と並行すると「コミット順」と
+「取引ID順」がずれて再生結果が食い違うことがある。これも並行時の実際の挙動として報告する。
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import re
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+import asyncpg
+from discord import app_commands
+
+from config import Config
+from storage.postgres import PostgresStorage
+from discord_client import SoraBot, FinanceCog, WALLET_ORDER, allocate_salary
+from benchmarks.fakes import FakeChannel, FakeGuild, FakeInteraction, FakeMessage, FakeUser
+from benchmarks.bench_on_message import percentile
+
+SPEND_WALLETS = ["ぽて財布", "ぬし財布", "探検隊予算"]
+CATEGORIES = ["食費", "日用品", "交通費", "趣味", "交際費", "自己投資", "特別な支出", "その他"]
+TRANSFER_PATTERN = re.compile(r"(.+)から(.+)へ")
+DEFAULT_MIX = "spend=40,transfer=15,salary=5,reset=2,edit_spend=13,webhook_spend=25"
+USER_ID_BASE = 990_000_000_000_000_000
+
+
+def choice(value) -> app_commands.Choice:
+    return app_commands.Choice(name=str(value), value=value)
+
+
+def parse_mix(text: str) -> Dict[str, int]:
+    mix = {}
+    for item in text.split(','):
+        name, weight = item.split('=')
+        mix[name.strip()] = int(weight)
+    return mix
+
+
+class LoadRunner:
+    def __init__(self, args, bot: SoraBot, cog: FinanceCog, users: List[FakeUser]):
+        self.args = args
+        self.bot = bot
+        self.cog = cog
+        self.users = users
+        self.rng = random.Random(args.seed)
+        self.channel = FakeChannel(980_000_000_000_000_001, "load", FakeGuild(980_000_000_000_000_000, "負荷テスト"))
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.outcomes: Counter = Counter()
+        self.deadlocks = 0
+        self.errors: Counter = Counter()
+        self.webhook_messages: List[FakeMessage] = []
+
+    async def _call(self, name: str, interaction: FakeInteraction, **kwargs):
+        command = getattr(self.cog, name)
+        await command.callback(self.cog, interaction, **kwargs)
+
+    async def op_spend(self, user: FakeUser) -> str:
+        interaction = FakeInteraction(user)
+        reflect = choice(0) if self.rng.random() < 0.1 else None
+        await self._call("spend", interaction, amount=self.rng.randint(100, 5000), category=choice(self.rng.choice(CATEGORIES)),
+                         from_wallet=choice(self.rng.choice(SPEND_WALLETS)), reflect_balance=reflect, date=None)
+        return self._classify(interaction)
+
+    async def op_transfer(self, user: FakeUser) -> str:
+        interaction = FakeInteraction(user)
+        source, destination = self.rng.sample(WALLET_ORDER, 2)
+        await self._call("transfer", interaction, amount=self.rng.randint(100, 20000), from_wallet=choice(source), to_wallet=choice(destination))
+        return self._classify(interaction)
+
+    async def op_salary(self, user: FakeUser) -> str:
+        interaction = FakeInteraction(user)
+        await self._call("salary", interaction, amount=self.rng.randint(100_000, 300_000))
+        return self._classify(interaction)
+
+    async def op_reset(self, user: FakeUser) -> str:
+        interaction = FakeInteraction(user)
+        await self._call("reset_balance", interaction, amount=self.rng.randint(10_000, 100_000), wallet=choice(self.rng.choice(WALLET_ORDER)))
+        return self._classify(interaction)
+
+    async def op_edit_spend(self, user: FakeUser) -> str:
+        transaction_id = await self.bot.storage.pool.fetchval(
+            "SELECT id FROM transactions WHERE user_id = $1 AND transaction_type = 'spend' ORDER BY id DESC LIMIT 1 OFFSET $2",
+            user.id, self.rng.randint(0, 20))
+        if transaction_id is None:
+            return "skipped"
+        interaction = FakeInteraction(user)
+        await self._call("edit_spend", interaction, transaction_id=transaction_id, amount=self.rng.randint(100, 5000),
+                         category=None, from_wallet=choice(self.rng.choice(SPEND_WALLETS)), date=None, reflect_balance=None)
+        return self._classify(interaction)
+
+    async def op_webhook_spend(self, user: FakeUser) -> str:
+        # Webhook支出は常に OWNER_ID（先頭の隊員）の財布に効く
+        wallet = self.rng.choice(SPEND_WALLETS)
+        message = FakeMessage(self.users[0], self.channel, f"spend_webhook: {wallet}で{self.rng.choice(CATEGORIES)}に{self.rng.randint(100, 5000)}円")
+        await self.bot.handle_spend_webhook(message)
+        # 結果のリアクションは送信キュー経由で付くので、全操作の後にまとめて判定する
+        self.webhook_messages.append(message)
+        return None
+
+    def classify_webhooks(self):
+        for message in self.webhook_messages:
+            if message.last_reaction == "✅":
+                outcome = "ok"
+            else:
+                outcome = "error" if message.last_reaction == "❌" else "rejected"
+            self.outcomes[("webhook_spend", outcome)] += 1
+
+    @staticmethod
+    def _classify(interaction: FakeInteraction) -> str:
+        if not interaction.replies:
+            return "no_reply"
+        content, ephemeral = interaction.replies[-1]
+        if content and "予期せぬエラー" in content:
+            return "error"
+        return "rejected" if ephemeral else "ok"
+
+    async def worker(self, ops: List[str]):
+        while ops:
+            name = ops.pop()
+            user = self.rng.choice(self.users)
+            started = time.perf_counter()
+            try:
+                outcome = await getattr(self, f"op_{name}")(user)
+            except asyncpg.exceptions.DeadlockDetectedError:
+                self.deadlocks += 1
+                outcome = "deadlock"
+            except Exception as e:
+                self.errors[type(e).__name__] += 1
+                outcome = "error"
+            self.latencies[name].append(time.perf_counter() - started)
+            if outcome is not None:
+                self.outcomes[(name, outcome)] += 1
+
+
+class LockSampler:
+    """別コネクションで pg_locks を定期的に覗き、ロック待ちの数を記録する"""
+
+    def __init__(self, dsn: str, interval: float):
+        self.dsn = dsn
+        self.interval = interval
+        self.samples: List[int] = []
+        self._stop = asyncio.Event()
+
+    async def run(self):
+        conn = await asyncpg.connect(self.dsn)
+        try:
+            while not self._stop.is_set():
+                waiting = await conn.fetchval("SELECT count(*) FROM pg_locks l JOIN pg_database d ON l.database = d.oid WHERE NOT l.granted AND d.datname = current_database()")
+                self.samples.append(waiting)
+                try:
+                    await asyncio.wait_for(self._stop.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await conn.close()
+
+    def stop(self):
+        self._stop.set()
+
+
+async def verify_ledger(conn, user_ids: List[int]) -> List[str]:
+    """transactions を取引ID順に再生し、user_balances と突き合わせる"""
+    expected: Dict[int, Dict[str, int]] = {user_id: defaultdict(int) for user_id in user_ids}
+    rows = await conn.fetch(
+        "SELECT user_id, transaction_type, category, amount, source_wallet, is_balance_reflected FROM transactions WHERE user_id = ANY($1) ORDER BY id",
+        user_ids)
+    for row in rows:
+        balances = expected[row['user_id']]
+        tx_type = row['transaction_type']
+        if tx_type == 'reset':
+            balances[row['category']] = row['amount']
+        elif tx_type == 'salary':
+            for wallet, amount in allocate_salary(row['amount']).items():
+                balances[wallet] += amount
+        elif tx_type == 'spend':
+            if row['is_balance_reflected'] and row['source_wallet']:
+                balances[row['source_wallet']] -= row['amount']
+        elif tx_type == 'transfer':
+            match = TRANSFER_PATTERN.fullmatch(row['category'])
+            if match:
+                balances[match.group(1)] -= row['amount']
+                balances[match.group(2)] += row['amount']
+
+    problems = []
+    actual_rows = await conn.fetch("SELECT user_id, category, balance FROM user_balances WHERE user_id = ANY($1)", user_ids)
+    actual: Dict[int, Dict[str, int]] = {user_id: defaultdict(int) for user_id in user_ids}
+    for row in actual_rows:
+        actual[row['user_id']][row['category']] = row['balance']
+        if row['balance'] < 0:
+            problems.append(f"user {row['user_id']} {row['category']}: 残高がマイナス ({row['balance']:,}円)")
+    for user_id in user_ids:
+        for wallet in sorted(set(expected[user_id]) | set(actual[user_id])):
+            if expected[user_id][wallet] != actual[user_id][wallet]:
+                problems.append(f"user {user_id} {wallet}: 台帳 {expected[user_id][wallet]:,}円 / 残高 {actual[user_id][wallet]:,}円")
+    return problems
+
+
+async def seed_users(bot: SoraBot, cog: FinanceCog, users: List[FakeUser], initial: int):
+    user_ids = [user.id for user in users]
+    async with bot.storage.pool.acquire() as conn:
+        await conn.execute("DELETE FROM transactions WHERE user_id = ANY($1)", user_ids)
+        await conn.execute("DELETE FROM user_balances WHERE user_id = ANY($1)", user_ids)
+        await conn.execute("DELETE FROM balance_check_state WHERE user_id = ANY($1)", user_ids)
+    for user in users:
+        for wallet in WALLET_ORDER:
+            await cog.reset_balance.callback(cog, FakeInteraction(user), amount=initial, wallet=choice(wallet))
+
+
+async def deadlock_count(conn) -> int:
+    return await conn.fetchval("SELECT deadlocks FROM pg_stat_database WHERE datname = current_database()") or 0
+
+
+async def run_load(args):
+    users = [FakeUser(USER_ID_BASE + i, f"隊員{i}") for i in range(args.users)]
+    Config.OWNER_ID = users[0].id
+
+    bot = SoraBot()
+    bot.storage = PostgresStorage(args.dsn, bot.query_stats, min_size=args.pool_size, max_size=args.pool_size)
+    await bot.init_db()
+    pool = bot.storage.pool
+    cog = FinanceCog(bot)
+
+    await seed_users(bot, cog, users, args.initial_balance)
+    bot.query_stats.reset()
+
+    mix = parse_mix(args.mix)
+    runner = LoadRunner(args, bot, cog, users)
+    ops = runner.rng.choices(list(mix), weights=list(mix.values()), k=args.ops)
+
+    async with pool.acquire() as conn:
+        deadlocks_before = await deadlock_count(conn)
+
+    sampler = LockSampler(args.dsn, args.lock_sample_ms / 1000)
+    sampler_task = asyncio.create_task(sampler.run())
+    started = time.perf_counter()
+    await asyncio.gather(*(runner.worker(ops) for _ in range(args.concurrency)))
+    wall = time.perf_counter() - started
+    sampler.stop()
+    await sampler_task
+    await bot.outbound.drain()
+    runner.classify_webhooks()
+
+    async with pool.acquire() as conn:
+        deadlocks_after = await deadlock_count(conn)
+        problems = await verify_ledger(conn, [user.id for user in users])
+    await bot.storage.close()
+
+    total = sum(len(values) for values in runner.latencies.values())
+    all_latencies = [value for values in runner.latencies.values() for value in values]
+    print(f"ops={total} concurrency={args.concurrency} pool={args.pool_size} users={args.users}")
+    print(f"throughput : {total / wall:,.1f} ops/s ({wall:.2f}s)")
+    print(f"latency    : p50 {percentile(all_latencies, 50) * 1000:.1f}ms / p95 {percentile(all_latencies, 95) * 1000:.1f}ms / p99 {percentile(all_latencies, 99) * 1000:.1f}ms")
+    print(f"db calls   : {bot.query_stats.total_calls:,} ({bot.query_stats.total_calls / max(total, 1):.2f} / op)")
+    waiting = [sample for sample in sampler.samples if sample]
+    print(f"lock waits : {len(waiting)}/{len(sampler.samples)} samples with waiters, max {max(sampler.samples, default=0)} waiting")
+    print(f"deadlocks  : {runner.deadlocks} raised to handlers / {deadlocks_after - deadlocks_before} reported by pg_stat_database")
+    print("by command:")
+    for name in sorted(runner.latencies):
+        values = runner.latencies[name]
+        outcomes = ", ".join(f"{outcome}={count}" for (op, outcome), count in sorted(runner.outcomes.items()) if op == name)
+        print(f"  {name:<14} n={len(values):<6} p50 {percentile(values, 50) * 1000:.1f}ms  p99 {percentile(values, 99) * 1000:.1f}ms  [{outcomes}]")
+    if runner.errors:
+        print("errors     : " + ", ".join(f"{name}={count}" for name, count in runner.errors.most_common()))
+    if problems:
+        print(f"LEDGER MISMATCH ({len(problems)}):")
+        for problem in problems:
+            print(f"  {problem}")
+    else:
+        print("ledger     : user_balances は transactions の再生結果と一致")
+    return 1 if problems else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FinanceCog concurrent load harness")
+    parser.add_argument("--dsn", required=True, help="ローカルPostgreSQLの接続URL（負荷テスト専用DBを指定すること）")
+    parser.add_argument("--ops", type=int, default=2000, help="実行する操作の総数")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時に実行する操作数")
+    parser.add_argument("--pool-size", type=int, default=10, help="asyncpg プールの最大接続数")
+    parser.add_argument("--users", type=int, default=2, help="財布を共有する隊員の数（少ないほど競合が増える）")
+    parser.add_argument("--initial-balance", type=int, default=1_000_000)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"コマンドの比率 (既定: {DEFAULT_MIX})")
+    parser.add_argument("--lock-sample-ms", type=float, default=50.0, help="pg_locks を覗く間隔")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    raise SystemExit(asyncio.run(run_load(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,68 @@
+import importlib.util
 import os
-from dotenv import load_dotenv
+from typing import Any, Dict, Tuple
+
+from dotenv import dotenv_values, find_dotenv, load_dotenv
+
+# 環境変数を読み込み。CONFIG_FILE を指定すると .env の代わりにそのファイルを読む
+CONFIG_FILE = os.getenv('CONFIG_FILE') or find_dotenv()
+# 設定ファイルを読む前の環境変数。再読み込みではこれに設定ファイルを足し直す
+BASE_ENVIRON = dict(os.environ)
+load_dotenv(CONFIG_FILE)
+
+# Config.reload() で再起動せずに入れ替えられる設定。それ以外は再起動するまで反映されない
+RELOADABLE_SETTINGS = (
+    'TARGET_CHANNEL_IDS', 'OWNER_ID', 'KEYWORD_REACTIONS', 'ACTIVITY_MAX_GAP_MIN',
+    'SLOW_QUERY_THRESHOLD_MS', 'DISPATCH_SHED_THRESHOLD', 'LOG_LEVELS', 'BUDGET_ALERT_THRESHOLDS',
+)
+
+
+def parse_shard_ids(text: str) -> list:
+    """'0-3,8' 形式のシャードIDの指定をリストにする"""
+    shard_ids = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            shard_ids.extend(range(int(first), int(last) + 1))
+        else:
+            shard_ids.append(int(part))
+    return sorted(set(shard_ids))
+
+
+def parse_keyword_reactions(text: str) -> Dict[str, str]:
+    """'キーワード:リアクション,...' 形式の指定を辞書にする"""
+    reactions = {}
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        keyword, sep, reaction = item.partition(':')
+        if not sep or not keyword.strip() or not reaction.strip():
+            raise ValueError(f"KEYWORD_REACTIONSのフォーマットが不正です: {item.strip()} ('key:value,key2:value2' の形式で設定してください)")
+        reactions[keyword.strip()] = reaction.strip()
+    return reactions
+
+
+def _load_fresh_config() -> type:
+    """設定ファイルと環境変数から Config をもう一つ作る（今の Config は変えない）
+
+    起動時の load_dotenv と同じく環境変数を優先し、設定ファイルから消えた項目は既定値に戻す。
+    """
+    values = {key: value for key, value in dotenv_values(CONFIG_FILE).items() if value is not None} if CONFIG_FILE else {}
+    saved = dict(os.environ)
+    os.environ.clear()
+    os.environ.update({**values, **BASE_ENVIRON})
+    try:
+        spec = importlib.util.spec_from_file_location('_config_snapshot', __file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module.Config
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
 
-# 環境変数を読み込み
-load_dotenv()
 
 class Config:
     # Discord設定
@@ -18,9 +78,111 @@ class Config:
 
     # キーワードとリアクションのマッピング
     KEYWORD_REACTIONS = os.getenv('KEYWORD_REACTIONS', 'なう:🕒,わず:✅,うぃる:🗓️')
+    # 活動の所要時間は次の記録までとし、この分数で打ち切る（寝る前の記録が翌朝まで続かないように）
+    ACTIVITY_MAX_GAP_MIN = int(os.getenv('ACTIVITY_MAX_GAP_MIN', '180'))
+
+    # シャーディング設定（未指定なら1プロセスで全シャードを自動で扱う）
+    SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+    # このプロセスが担当するシャード。'0-3,8' の形式
+    SHARD_IDS = parse_shard_ids(os.getenv('SHARD_IDS')) if os.getenv('SHARD_IDS') else None
+    # 会話状態の保存先。'memory' または 'storage'。未指定ならSHARD_IDSの有無で決める
+    DIALOG_STATE_BACKEND = os.getenv('DIALOG_STATE_BACKEND', '').lower()
+    DIALOG_STATE_TTL_SEC = int(os.getenv('DIALOG_STATE_TTL_SEC', '1800'))
+    DIALOG_STATE_CACHE_SIZE = int(os.getenv('DIALOG_STATE_CACHE_SIZE', '10000'))
+
+    # on_message の処理設定
+    # 全ユーザー合計の同時実行数（DBプールの接続数より少なくする）
+    DISPATCH_MAX_CONCURRENCY = int(os.getenv('DISPATCH_MAX_CONCURRENCY', '8'))
+    # 1ユーザーあたりの処理待ちの上限。超えた分は破棄する
+    DISPATCH_USER_QUEUE_LIMIT = int(os.getenv('DISPATCH_USER_QUEUE_LIMIT', '50'))
+    # 処理待ちがこの件数を超えたらリアクションを省く
+    DISPATCH_SHED_THRESHOLD = int(os.getenv('DISPATCH_SHED_THRESHOLD', '32'))
+    # メッセージ記録など低優先度の処理待ちの上限。超えたら古いものから破棄する
+    DISPATCH_LOW_QUEUE_LIMIT = int(os.getenv('DISPATCH_LOW_QUEUE_LIMIT', '1000'))
+
+    # 起動時に、停止中に対象チャンネルへ投稿されたメッセージを取り込む（何時間前まで遡るか。0で無効）
+    CATCH_UP_MAX_HOURS = float(os.getenv('CATCH_UP_MAX_HOURS', '24'))
+    # 1チャンネルあたりに取り込む上限
+    CATCH_UP_MAX_MESSAGES = int(os.getenv('CATCH_UP_MAX_MESSAGES', '2000'))
+    # 取り込んだメッセージのうち活動記録の書式のものを記録する（リアクションは付けない）
+    CATCH_UP_REPLAY_ACTIVITIES = os.getenv('CATCH_UP_REPLAY_ACTIVITIES', 'true').lower() == 'true'
+
+    # メッセージの編集・削除をためてまとめてDBに反映する間隔
+    MESSAGE_SYNC_INTERVAL_SEC = float(os.getenv('MESSAGE_SYNC_INTERVAL_SEC', '5'))
+
+    # DBに書けない間、メッセージ・活動記録・Webhookの支出を退避するファイル
+    SPOOL_PATH = os.getenv('SPOOL_PATH', 'sora_spool.jsonl')
+    SPOOL_REPLAY_INTERVAL_SEC = float(os.getenv('SPOOL_REPLAY_INTERVAL_SEC', '30'))
+    # 書き込みがこの回数続けて失敗したら、DB_BREAKER_RESET_SEC ごとの再試行に切り替える
+    DB_BREAKER_FAILURES = int(os.getenv('DB_BREAKER_FAILURES', '3'))
+    DB_BREAKER_RESET_SEC = float(os.getenv('DB_BREAKER_RESET_SEC', '30'))
+
+    # on_message のたびに読む残高チェックの状態をキャッシュする件数（0で無効）
+    CHECK_STATE_CACHE_SIZE = int(os.getenv('CHECK_STATE_CACHE_SIZE', '10000'))
+
+    # 月の予算の上限に対して、使用額がこの割合(%)に達したら支出の記録時に警告する
+    BUDGET_ALERT_THRESHOLDS = sorted(int(t) for t in os.getenv('BUDGET_ALERT_THRESHOLDS', '80,100').split(',') if t.strip())
+
+    # 実行日時を過ぎた定期取引（家賃・サブスクリプションなど）を記録する間隔
+    RECURRING_INTERVAL_MIN = float(os.getenv('RECURRING_INTERVAL_MIN', '15'))
+
+    # 定期タスクの実行権の有効期間。実行中のプロセスからの生存通知がこれだけ途絶えたら別のプロセスが引き継ぐ
+    JOB_LEASE_SEC = float(os.getenv('JOB_LEASE_SEC', '300'))
+
+    # デイリーノートの書き出し先（Obsidianの保管庫内のフォルダなど）。未指定なら書き出さない
+    NOTES_VAULT_DIR = os.getenv('NOTES_VAULT_DIR', '')
+    NOTES_EXPORT_INTERVAL_MIN = float(os.getenv('NOTES_EXPORT_INTERVAL_MIN', '30'))
+    NOTES_EXPORT_MESSAGES = os.getenv('NOTES_EXPORT_MESSAGES', 'true').lower() == 'true'
+
+    # Discordへの送信キュー設定
+    OUTBOUND_WORKERS = int(os.getenv('OUTBOUND_WORKERS', '4'))
+    # リアクションの送信待ちの上限。超えた分は破棄する（返信や通知は破棄しない）
+    OUTBOUND_LOW_QUEUE_LIMIT = int(os.getenv('OUTBOUND_LOW_QUEUE_LIMIT', '500'))
+
+    # ヘルスチェック(/healthz, /readyz)の待ち受け。未指定ならRender/Dockerの PORT を使い、どちらもなければ無効
+    HEALTH_HOST = os.getenv('HEALTH_HOST', '0.0.0.0')
+    HEALTH_PORT = int(os.getenv('HEALTH_PORT') or os.getenv('PORT') or '0')
+    # イベントループの遅れがこれを超えたら /healthz は 503 を返す
+    HEALTH_MAX_LOOP_DRIFT_MS = float(os.getenv('HEALTH_MAX_LOOP_DRIFT_MS', '1000'))
+
+    # イベントループのプロファイリング（main.py の引数や /profiling でも切り替えられる）
+    PROFILE_ASYNCIO_DEBUG = os.getenv('PROFILE_ASYNCIO_DEBUG', 'false').lower() == 'true'
+    # asyncioのデバッグモードで警告するコールバックの長さ
+    PROFILE_SLOW_CALLBACK_MS = float(os.getenv('PROFILE_SLOW_CALLBACK_MS', '100'))
+    PROFILE_SAMPLER = os.getenv('PROFILE_SAMPLER', 'false').lower() == 'true'
+    PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv('PROFILE_SAMPLE_INTERVAL_MS', '10'))
+    PROFILE_OUTPUT_DIR = os.getenv('PROFILE_OUTPUT_DIR', 'profiles')
+    PROFILE_HANDLERS = os.getenv('PROFILE_HANDLERS', 'false').lower() == 'true'
+
+    # メモリ設定。'default' は discord.py の既定どおり、'low' はキャッシュとインテントを最小限にする
+    MEMORY_PROFILE = os.getenv('MEMORY_PROFILE', 'default').lower()
+    # メッセージキャッシュの件数（0で無効）。未指定ならプロファイルに従う
+    MAX_MESSAGES = int(os.getenv('MAX_MESSAGES')) if os.getenv('MAX_MESSAGES') else None
+    # メモリ内訳をログに出す間隔（分）。0で無効
+    MEMORY_REPORT_INTERVAL_MIN = float(os.getenv('MEMORY_REPORT_INTERVAL_MIN', '60'))
 
     # データベース設定
     DATABASE_URL = os.getenv('DATABASE_URL')
+    # 'postgres' または 'sqlite'。未指定ならDATABASE_URLの有無で決める
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'postgres' if os.getenv('DATABASE_URL') else 'sqlite').lower()
+    SQLITE_PATH = os.getenv('SQLITE_PATH', 'sora.db')
+
+    # スロークエリ計測設定
+    SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '200'))
+    SLOW_QUERY_EXPLAIN = os.getenv('SLOW_QUERY_EXPLAIN', 'false').lower() == 'true'
+    SLOW_QUERY_TOP_N = int(os.getenv('SLOW_QUERY_TOP_N', '10'))
+
+    # ログ設定
+    LOG_FILE = os.getenv('LOG_FILE', 'discord_bot.log')
+    LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+    LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+    # 'midnight' などを指定するとサイズではなく時間でローテーションする
+    LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', '')
+    # ロガーごとのレベル。--debug でもゲートウェイのペイロードは出さない
+    LOG_LEVELS = os.getenv('LOG_LEVELS', 'discord.gateway:WARNING,discord.http:WARNING')
+    # 同じ箇所から出るWARNING以下のログを毎秒この件数までに抑える（0で無効）
+    LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '5'))
+    LOG_SAMPLE_BURST = int(os.getenv('LOG_SAMPLE_BURST', '20'))
     
     @classmethod
     def validate(cls):
@@ -33,5 +195,52 @@ class Config:
         
         if not cls.TARGET_CHANNEL_IDS or cls.TARGET_CHANNEL_IDS == [0]:
             raise ValueError("TARGET_CHANNEL_IDSが設定されていません")
+
+        if cls.STORAGE_BACKEND not in ('postgres', 'sqlite'):
+            raise ValueError(f"STORAGE_BACKENDが不正です: {cls.STORAGE_BACKEND} ('postgres' または 'sqlite' を指定してください)")
+
+        if cls.STORAGE_BACKEND == 'postgres' and not cls.DATABASE_URL:
+            raise ValueError("STORAGE_BACKEND=postgres ですが DATABASE_URL が設定されていません")
+
+        if cls.SHARD_IDS is not None:
+            if not cls.SHARD_COUNT:
+                raise ValueError("SHARD_IDS を指定する場合は SHARD_COUNT も設定してください")
+            if any(shard_id < 0 or shard_id >= cls.SHARD_COUNT for shard_id in cls.SHARD_IDS):
+                raise ValueError(f"SHARD_IDS は 0〜{cls.SHARD_COUNT - 1} の範囲で指定してください: {cls.SHARD_IDS}")
+            # SQLite の変更通知は同じプロセス内にしか届かないので、プロセスを分けると他のプロセスのキャッシュが古くなる
+            if cls.STORAGE_BACKEND == 'sqlite':
+                raise ValueError("STORAGE_BACKEND=sqlite は1プロセスでしか使えません。SHARD_IDS や --workers でシャードを分ける場合は postgres を使ってください")
+
+        if cls.MEMORY_PROFILE not in ('default', 'low'):
+            raise ValueError(f"MEMORY_PROFILEが不正です: {cls.MEMORY_PROFILE} ('default' または 'low' を指定してください)")
+
+        if cls.DIALOG_STATE_BACKEND not in ('', 'memory', 'storage'):
+            raise ValueError(f"DIALOG_STATE_BACKENDが不正です: {cls.DIALOG_STATE_BACKEND} ('memory' または 'storage' を指定してください)")
+
+        if cls.ACTIVITY_MAX_GAP_MIN <= 0:
+            raise ValueError(f"ACTIVITY_MAX_GAP_MINは1以上を指定してください: {cls.ACTIVITY_MAX_GAP_MIN}")
+
+        parse_keyword_reactions(cls.KEYWORD_REACTIONS)
         
         return True
+
+    @classmethod
+    def reload(cls) -> Dict[str, Tuple[Any, Any]]:
+        """設定ファイルを読み直し、RELOADABLE_SETTINGS の値を入れ替える
+
+        新しい設定の検証に失敗した場合は何も変えずに ValueError を送出する。
+        変わった設定を {名前: (旧, 新)} で返す。
+        """
+        fresh = _load_fresh_config()
+        # 入れ替えない設定は起動時の値（コマンドライン引数での上書きを含む）のまま検証する
+        for name, value in vars(cls).items():
+            if name.isupper() and name not in RELOADABLE_SETTINGS:
+                setattr(fresh, name, value)
+        fresh.validate()
+        changed = {
+            name: (getattr(cls, name), getattr(fresh, name))
+            for name in RELOADABLE_SETTINGS if getattr(cls, name) != getattr(fresh, name)
+        }
+        for name, (_, value) in changed.items():
+            setattr(cls, name, value)
+        return changed
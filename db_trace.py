@@ -0,0 +1,249 @@
+"""
+asyncpg プール/コネクションの計測ラッパー
+
+全ステートメントの実行時間を呼び出し元ハンドラ名付きで記録し、
+閾値を超えたものをログに出す。
+"""
+
+import asyncio
+import logging
+import re
+import sys
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 呼び出し元ハンドラを辿る際に読み飛ばすファイル
+_PASSTHROUGH_FILES = {__file__}
+
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+def register_passthrough_module(filename: str):
+    """ハンドラ名の判定で読み飛ばすモジュールを登録する"""
+    _PASSTHROUGH_FILES.add(filename)
+
+
+def calling_handler() -> str:
+    """登録済みモジュールを読み飛ばし、最初に見つかった呼び出し元の関数名を返す"""
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename in _PASSTHROUGH_FILES:
+        frame = frame.f_back
+    return frame.f_code.co_name if frame else '?'
+
+
+def _normalize_query(query: str) -> str:
+    return re.sub(r'\s+', ' ', query).strip()
+
+
+def param_shapes(args: tuple) -> str:
+    """パラメータの値ではなく型と長さだけを文字列にする"""
+    shapes = []
+    for arg in args:
+        name = type(arg).__name__
+        if isinstance(arg, (str, bytes, list, tuple)):
+            shapes.append(f"{name}[{len(arg)}]")
+        else:
+            shapes.append(name)
+    return ", ".join(shapes)
+
+
+class QueryStat:
+    __slots__ = ('query', 'handler', 'count', 'total', 'max', 'last_shapes')
+
+    def __init__(self, query: str, handler: str):
+        self.query = query
+        self.handler = handler
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last_shapes = ""
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class QueryStats:
+    """ステートメント毎の実行時間を集計する"""
+
+    def __init__(self, threshold_ms: float = 200.0, top_n: int = 10, max_entries: int = 500, recent_size: int = 50):
+        self.threshold = threshold_ms / 1000
+        self.top_n = top_n
+        self.max_entries = max_entries
+        self.total_calls = 0
+        self.total_time = 0.0
+        self._stats: Dict[Tuple[str, str], QueryStat] = {}
+        self.recent_slow: Deque[Tuple[float, str, str, float]] = deque(maxlen=recent_size)
+
+    def record(self, query: str, handler: str, duration: float, args: tuple) -> bool:
+        """実行結果を記録し、閾値超えならTrueを返す"""
+        self.total_calls += 1
+        self.total_time += duration
+        key = (query, handler)
+        stat = self._stats.get(key)
+        if stat is None:
+            if len(self._stats) >= self.max_entries:
+                # 最も軽いものを追い出して上限を保つ
+                lightest = min(self._stats, key=lambda k: self._stats[k].max)
+                del self._stats[lightest]
+            stat = self._stats[key] = QueryStat(query, handler)
+        stat.count += 1
+        stat.total += duration
+        if duration > stat.max:
+            stat.max = duration
+        is_slow = duration >= self.threshold
+        if is_slow:
+            stat.last_shapes = param_shapes(args)
+            self.recent_slow.append((time.time(), handler, query, duration))
+        return is_slow
+
+    def __len__(self) -> int:
+        return len(self._stats)
+
+    def top(self, n: Optional[int] = None) -> List[QueryStat]:
+        """最大実行時間の長い順に上位N件を返す"""
+        return sorted(self._stats.values(), key=lambda s: s.max, reverse=True)[:n or self.top_n]
+
+    def reset(self):
+        self.total_calls = 0
+        self.total_time = 0.0
+        self._stats.clear()
+        self.recent_slow.clear()
+
+
+class TracedConnection:
+    """asyncpg.Connection の計測ラッパー。未定義の属性は元のコネクションに委譲する"""
+
+    def __init__(self, conn, pool: 'TracedPool'):
+        self._conn = conn
+        self._pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    async def _run(self, method: str, query: str, args: tuple, **kwargs):
+        handler = calling_handler()
+        started = time.perf_counter()
+        try:
+            return await getattr(self._conn, method)(query, *args, **kwargs)
+        finally:
+            self._pool._observe(query, handler, time.perf_counter() - started, args)
+
+    async def execute(self, query: str, *args, **kwargs):
+        return await self._run('execute', query, args, **kwargs)
+
+    async def executemany(self, query: str, args, **kwargs):
+        handler = calling_handler()
+        started = time.perf_counter()
+        try:
+            return await self._conn.executemany(query, args, **kwargs)
+        finally:
+            self._pool._observe(query, handler, time.perf_counter() - started, (args,))
+
+    async def fetch(self, query: str, *args, **kwargs):
+        return await self._run('fetch', query, args, **kwargs)
+
+    async def fetchrow(self, query: str, *args, **kwargs):
+        return await self._run('fetchrow', query, args, **kwargs)
+
+    async def fetchval(self, query: str, *args, **kwargs):
+        return await self._run('fetchval', query, args, **kwargs)
+
+
+class _TracedAcquireContext:
+    def __init__(self, pool: 'TracedPool', ctx):
+        self._pool = pool
+        self._ctx = ctx
+
+    async def __aenter__(self) -> TracedConnection:
+        return TracedConnection(await self._ctx.__aenter__(), self._pool)
+
+    async def __aexit__(self, *exc):
+        return await self._ctx.__aexit__(*exc)
+
+    def __await__(self):
+        conn = yield from self._ctx.__await__()
+        return TracedConnection(conn, self._pool)
+
+
+class TracedPool:
+    """asyncpg.Pool の計測ラッパー"""
+
+    def __init__(self, pool, stats: QueryStats, explain: bool = False, explain_interval: float = 600.0):
+        self._pool = pool
+        self.stats = stats
+        self.explain = explain
+        self.explain_interval = explain_interval
+        self._explained: Dict[str, float] = {}
+        # ループは作ったタスクを弱参照でしか持たないので、終わるまでここで持つ
+        self._explain_tasks: Set[asyncio.Task] = set()
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    def acquire(self, **kwargs) -> _TracedAcquireContext:
+        return _TracedAcquireContext(self, self._pool.acquire(**kwargs))
+
+    async def close(self):
+        for task in self._explain_tasks:
+            task.cancel()
+        await self._pool.close()
+
+    async def release(self, conn, **kwargs):
+        if isinstance(conn, TracedConnection):
+            conn = conn._conn
+        return await self._pool.release(conn, **kwargs)
+
+    async def execute(self, query: str, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.execute(query, *args, **kwargs)
+
+    async def fetch(self, query: str, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.fetch(query, *args, **kwargs)
+
+    async def fetchrow(self, query: str, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.fetchrow(query, *args, **kwargs)
+
+    async def fetchval(self, query: str, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.fetchval(query, *args, **kwargs)
+
+    def _observe(self, query: str, handler: str, duration: float, args: tuple):
+        normalized = _normalize_query(query)
+        if not self.stats.record(normalized, handler, duration, args):
+            return
+        logger.warning(f"スロークエリ検出 ({duration * 1000:.1f}ms) [{handler}] {normalized[:300]} 引数: ({param_shapes(args)})")
+        if self.explain and self._should_explain(normalized):
+            task = asyncio.get_running_loop().create_task(self._log_explain(query, normalized, args))
+            self._explain_tasks.add(task)
+            task.add_done_callback(self._explain_tasks.discard)
+
+    def _should_explain(self, normalized: str) -> bool:
+        if not normalized.upper().startswith(_EXPLAINABLE):
+            return False
+        now = time.monotonic()
+        # 記録した順に並んでいるので、間隔を過ぎたものと QueryStats と同じ上限を超えた分を古い方から捨てる
+        while self._explained:
+            oldest = next(iter(self._explained))
+            if now - self._explained[oldest] < self.explain_interval and len(self._explained) < self.stats.max_entries:
+                break
+            del self._explained[oldest]
+        if normalized in self._explained:
+            return False
+        self._explained[normalized] = now
+        return True
+
+    async def _log_explain(self, query: str, normalized: str, args: tuple):
+        """実行計画を別コネクションで取得する（元のトランザクションを壊さないため）"""
+        try:
+            async with self._pool.acquire() as conn:
+                rows = await conn.fetch(f"EXPLAIN {query}", *args)
+            plan = "\n".join(r[0] for r in rows)
+            logger.warning(f"スロークエリの実行計画: {normalized[:200]}\n{plan}")
+        except Exception as e:
+            logger.debug(f"EXPLAINの取得に失敗: {e}")
@@ -0,0 +1,98 @@
+"""
+ユーザーごとの会話状態（「収納の名前は？」の返事待ちなど）の保存先
+
+1プロセスならメモリで十分だが、シャードを複数プロセスに分けると
+同じユーザーのメッセージが別プロセスに届くことがあるため、ストレージに置く。
+"""
+
+import json
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Set
+
+from storage import Storage
+
+State = Dict[str, Any]
+
+
+class DialogStateStore(ABC):
+    def __len__(self) -> int:
+        """プロセス内に保持している件数"""
+        return 0
+
+    @abstractmethod
+    async def get(self, user_id: int) -> Optional[State]:
+        """会話状態を返す（なければ None）"""
+
+    @abstractmethod
+    async def set(self, user_id: int, state: State):
+        """会話状態を保存する"""
+
+    @abstractmethod
+    async def clear(self, user_id: int):
+        """会話状態を削除する"""
+
+
+class MemoryDialogStateStore(DialogStateStore):
+    def __init__(self):
+        self._states: Dict[int, State] = {}
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    async def get(self, user_id: int) -> Optional[State]:
+        return self._states.get(user_id)
+
+    async def set(self, user_id: int, state: State):
+        self._states[user_id] = state
+
+    async def clear(self, user_id: int):
+        self._states.pop(user_id, None)
+
+
+class StorageDialogStateStore(DialogStateStore):
+    """ストレージ上の dialog_states テーブルに保存する。ttl を過ぎた状態は無視する
+
+    会話中のユーザーはごく一部なので、状態がないと分かったユーザーを覚えておき、
+    storage.changes で dialog_states の変更が届くまでは DB を読まずに None を返す。
+    """
+
+    def __init__(self, storage: Storage, ttl: timedelta, cache_size: int = 10000):
+        self.storage = storage
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._absent: Set[int] = set()
+        self._generation = 0
+        storage.changes.subscribe('dialog_states', self._evict)
+
+    def __len__(self) -> int:
+        return len(self._absent)
+
+    async def get(self, user_id: int) -> Optional[State]:
+        if user_id in self._absent:
+            self.hits += 1
+            return None
+        self.misses += 1
+        generation = self._generation
+        raw = await self.storage.get_dialog_state(user_id, datetime.now(timezone.utc) - self.ttl)
+        # 期限切れの状態も、書き直されるまでは期限切れのままなので「なし」として覚えてよい
+        if raw is None and self.cache_size > 0 and self.storage.changes.reliable and generation == self._generation:
+            if len(self._absent) >= self.cache_size:
+                self._absent.clear()
+            self._absent.add(user_id)
+        return json.loads(raw) if raw else None
+
+    async def set(self, user_id: int, state: State):
+        await self.storage.set_dialog_state(user_id, json.dumps(state, ensure_ascii=False))
+
+    async def clear(self, user_id: int):
+        await self.storage.clear_dialog_state(user_id)
+
+    def _evict(self, user_id: Optional[int]):
+        self._generation += 1
+        if user_id is None:
+            self._absent.clear()
+        else:
+            self._absent.discard(user_id)
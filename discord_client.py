@@ -9,13 +9,33 @@ except ImportError:
             return lambda *args, **kwargs: None
     sys.modules['audioop'] = DummyAudioop()
 
+import asyncio
 import discord
+import hashlib
+import itertools
+import json
 import logging
-import asyncpg
 import re
+import signal
+import sys
 from datetime import datetime, timedelta, timezone, time
-from typing import List, Dict, Any, Optional
-from config import Config
+from typing import List, Dict, Any, AsyncIterable, AsyncIterator, Optional, Tuple
+from config import Config, parse_keyword_reactions
+from db_trace import QueryStats
+from dialog_state import DialogStateStore, MemoryDialogStateStore, StorageDialogStateStore
+from dispatcher import UserDispatcher
+from health import HealthServer
+from invalidation import KeyedCache
+from jobs import JobRunner
+from logging_setup import apply_log_levels
+from notes_export import NotesExporter
+from outbound import NORMAL, OutboundQueue
+from profiling import LoopProfiler
+from recurring import Schedule
+from spool import CircuitBreaker, Spool
+from startup_profile import startup_profile
+from storage import BudgetUsage, DuplicateStorageError, InsufficientBalanceError, RecurringRun, TransactionNotFoundError, budget_month, create_storage
+from summary import JST, MAX_EMBED_LENGTH, MAX_EMBEDS_PER_MESSAGE, MAX_RECORDS_PER_EMBED, ChannelRef, MessageRecord, build_summary_embed, paginate_embeds
 
 from discord.ext import commands, tasks
 from discord import app_commands
@@ -24,50 +44,441 @@ logger = logging.getLogger(__name__)
 
 WALLET_ORDER = ["ぬし財布", "ぽて財布", "探検隊予算", "貯金"]
 
-class SoraBot(commands.Bot):
-    def __init__(self):
+# /summary で指定できるメンバーの数と期間の上限
+USER_MENTION_PATTERN = re.compile(r"<@!?(\d+)>")
+SUMMARY_MAX_USERS = 25
+SUMMARY_MAX_DAYS = 31
+
+# 活動記録（わず/なう/うぃる）の書式
+ACTIVITY_PATTERNS = [
+    (re.compile(r"(\d{1,2}):(\d{2})\s+(.+)わず"), 'done'),
+    (re.compile(r"(.+)なう"), 'doing'),
+    (re.compile(r"(\d{1,2}):(\d{2})\s+(.+)うぃる"), 'todo'),
+]
+
+
+def match_activity(content: str) -> Optional[Tuple[re.Match, str]]:
+    """活動記録の書式なら (マッチ, status) を返す"""
+    for pattern, status in ACTIVITY_PATTERNS:
+        if match := pattern.fullmatch(content):
+            return match, status
+    return None
+
+def gateway_options() -> Dict[str, Any]:
+    """MEMORY_PROFILE に応じたインテントとキャッシュの設定"""
+    if Config.MEMORY_PROFILE == 'low':
+        # ハンドラが使うのはギルド・チャンネルの情報とギルド内メッセージの本文だけ（DMはon_messageで無視している）
+        intents = discord.Intents.none()
+        intents.guilds = True
+        intents.guild_messages = True
+        intents.message_content = True
+        options = dict(intents=intents, max_messages=None, member_cache_flags=discord.MemberCacheFlags.none(), chunk_guilds_at_startup=False)
+    else:
         intents = discord.Intents.default()
         intents.message_content = True
-        super().__init__(command_prefix="!", intents=intents)
+        options = dict(intents=intents)
+    if Config.MAX_MESSAGES is not None:
+        options['max_messages'] = Config.MAX_MESSAGES or None
+    return options
+
+def current_rss_mb() -> Optional[float]:
+    """プロセスの常駐メモリ(MB)。取得できない環境では None"""
+    try:
+        with open('/proc/self/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # /proc がない環境ではピーク値で代用する（macOSはバイト、それ以外はKB）
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+class SoraBot(commands.AutoShardedBot):
+    def __init__(self):
+        super().__init__(command_prefix="!", shard_count=Config.SHARD_COUNT, shard_ids=Config.SHARD_IDS, **gateway_options())
         self.bot_token = Config.DISCORD_BOT_TOKEN
-        self.target_channel_ids = Config.TARGET_CHANNEL_IDS
-        self.user_states = {} # ユーザーごとの会話状態を保持
-        self.db_pool = None
-        
-        # キーワードとリアクションのマッピングを解析
-        self.keyword_reactions = {}
-        if Config.KEYWORD_REACTIONS:
-            try:
-                self.keyword_reactions = {
-                    item.split(':')[0].strip(): item.split(':')[1].strip()
-                    for item in Config.KEYWORD_REACTIONS.split(',')
-                }
-                logger.info(f"キーワードリアクションを読み込みました: {self.keyword_reactions}")
-            except IndexError:
-                logger.error("KEYWORD_REACTIONSのフォーマットが不正です。'key:value,key2:value2' の形式で設定してください。")
+        self.query_stats = QueryStats(threshold_ms=Config.SLOW_QUERY_THRESHOLD_MS, top_n=Config.SLOW_QUERY_TOP_N)
+        self.storage = create_storage(self.query_stats)
+        self.dialog_states = self._create_dialog_state_store() # ユーザーごとの会話状態を保持
+        # on_message のたびに読む残高チェックの状態。他のプロセスの変更も storage.changes で消える
+        self.check_state_cache = KeyedCache(self.storage.changes, 'balance_check_state', Config.CHECK_STATE_CACHE_SIZE)
+        self.dispatcher = UserDispatcher(
+            max_concurrency=Config.DISPATCH_MAX_CONCURRENCY,
+            user_queue_limit=Config.DISPATCH_USER_QUEUE_LIMIT,
+            shed_threshold=Config.DISPATCH_SHED_THRESHOLD,
+            low_queue_limit=Config.DISPATCH_LOW_QUEUE_LIMIT,
+        )
+        self.outbound = OutboundQueue(workers=Config.OUTBOUND_WORKERS, low_queue_limit=Config.OUTBOUND_LOW_QUEUE_LIMIT)
+        self.notes_exporter: Optional[NotesExporter] = None
+        self.spool = Spool(Config.SPOOL_PATH)
+        self.db_breaker = CircuitBreaker(Config.DB_BREAKER_FAILURES, Config.DB_BREAKER_RESET_SEC)
+        self.health: Optional[HealthServer] = None
+        self.jobs = JobRunner(self.storage, Config.JOB_LEASE_SEC)
+        self.profiler = LoopProfiler(Config.PROFILE_OUTPUT_DIR, Config.PROFILE_SAMPLE_INTERVAL_MS, Config.PROFILE_SLOW_CALLBACK_MS)
+        self.force_command_sync = False # Trueなら定義が変わっていなくても同期する
+        self._catch_up_from: Optional[Dict[int, int]] = None # 起動時点で記録済みの最新メッセージID
+        self._catch_up_task: Optional[asyncio.Task] = None
+        # 反映待ちのメッセージの編集・削除（メッセージIDごとに最後の1件だけ残す）
+        self._message_edits: Dict[int, tuple] = {}
+        self._message_deletes: Dict[int, tuple] = {}
+        self.apply_config()
+
+    def apply_config(self):
+        """Config から組み立てる値を作り直す。on_message から見て途中の状態が見えないよう、作ってから一度に差し替える"""
+        target_channel_ids = list(Config.TARGET_CHANNEL_IDS)
+        target_channels = frozenset(target_channel_ids)
+        keyword_reactions = parse_keyword_reactions(Config.KEYWORD_REACTIONS)
+        self.target_channel_ids, self.target_channels, self.keyword_reactions = target_channel_ids, target_channels, keyword_reactions
+        self.query_stats.threshold = Config.SLOW_QUERY_THRESHOLD_MS / 1000
+        self.dispatcher.shed_threshold = Config.DISPATCH_SHED_THRESHOLD
+        logger.info(f"キーワードリアクションを読み込みました: {self.keyword_reactions}")
+
+    def reload_config(self) -> Dict[str, Any]:
+        """設定ファイルを読み直して反映する。検証に失敗した場合は ValueError を送出し、何も変えない"""
+        changed = Config.reload()
+        self.apply_config()
+        if 'LOG_LEVELS' in changed:
+            apply_log_levels(*reversed(changed['LOG_LEVELS']))
+        if changed:
+            logger.info(f"設定を再読み込みしました: {', '.join(changed)}")
+        else:
+            logger.info("設定を再読み込みしました（変更なし）")
+        return changed
+
+    def _on_sighup(self):
+        try:
+            self.reload_config()
+        except ValueError as e:
+            logger.error(f"設定の再読み込みに失敗したため、今の設定のまま続けます: {e}")
+
+    def _create_dialog_state_store(self) -> DialogStateStore:
+        backend = Config.DIALOG_STATE_BACKEND or ('storage' if Config.SHARD_IDS is not None else 'memory')
+        if backend == 'storage':
+            return StorageDialogStateStore(self.storage, timedelta(seconds=Config.DIALOG_STATE_TTL_SEC), Config.DIALOG_STATE_CACHE_SIZE)
+        return MemoryDialogStateStore()
+
+    @property
+    def runs_scheduled_tasks(self) -> bool:
+        """定期タスクとコマンド同期を担当するプロセスか"""
+        # シャードを複数プロセスに分けた場合は GUILD_ID のギルド（未指定なら0番）を受け持つプロセスだけ
+        if Config.SHARD_IDS is None:
+            return True
+        owner_shard = (Config.GUILD_ID >> 22) % Config.SHARD_COUNT if Config.GUILD_ID else 0
+        return owner_shard in Config.SHARD_IDS
 
     async def setup_hook(self):
+        startup_profile.mark("login")
+        if hasattr(signal, 'SIGHUP'):
+            self.loop.add_signal_handler(signal.SIGHUP, self._on_sighup)
+        self.set_profiling('asyncio_debug', Config.PROFILE_ASYNCIO_DEBUG)
+        self.set_profiling('sampler', Config.PROFILE_SAMPLER)
+        self.set_profiling('handlers', Config.PROFILE_HANDLERS)
+        if Config.HEALTH_PORT:
+            # 起動途中でも /healthz に応答できるよう最初に立ち上げる（/readyz は準備が終わるまで503）
+            self.health = HealthServer(self, Config.HEALTH_HOST, Config.HEALTH_PORT, Config.HEALTH_MAX_LOOP_DRIFT_MS)
+            try:
+                await self.health.start()
+            except OSError as e:
+                logger.error(f"ヘルスチェックのポート {Config.HEALTH_PORT} を開けませんでした: {e}")
+                self.health = None
+        # DB初期化（on_readyは再接続のたびに呼ばれるのでここで一度だけ行う）
+        await self.spool.open()
+        try:
+            await self.init_db()
+        except self.storage.unavailable_errors as e:
+            # DBが落ちていても起動し、書き込みはスプールに退避する。接続は spool_replay で再試行する
+            self.db_breaker.record_failure()
+            logger.error(f"ストレージに接続できませんでした。復旧するまで記録はスプールに退避します: {e}")
+        self.spool_replay.change_interval(seconds=Config.SPOOL_REPLAY_INTERVAL_SEC)
+        self.spool_replay.start()
+        self.message_sync.change_interval(seconds=Config.MESSAGE_SYNC_INTERVAL_SEC)
+        self.message_sync.start()
+        if Config.CATCH_UP_MAX_HOURS > 0 and self.storage.is_ready:
+            # ゲートウェイから新しいメッセージが届いて記録される前に、どこまで記録済みかを控えておく
+            self._catch_up_from = await self.storage.last_message_ids(self.target_channel_ids)
+        startup_profile.mark("storage")
+
         # Cogのロード
         await self.add_cog(FinanceCog(self))
         logger.info("FinanceCogをロードしました。")
+        await self.add_cog(ActivityCog(self))
+        logger.info("ActivityCogをロードしました。")
+        await self.add_cog(SummaryCog(self))
+        logger.info("SummaryCogをロードしました。")
+        await self.add_cog(AdminCog(self))
+        logger.info("AdminCogをロードしました。")
+
+        if self.runs_scheduled_tasks:
+            await self.sync_commands_if_changed()
+        startup_profile.mark("command sync")
+
+        if Config.MEMORY_REPORT_INTERVAL_MIN > 0:
+            self.memory_report.change_interval(minutes=Config.MEMORY_REPORT_INTERVAL_MIN)
+            self.memory_report.start()
+
+        if Config.NOTES_VAULT_DIR and self.runs_scheduled_tasks:
+            self.notes_exporter = NotesExporter(self.storage, Config.NOTES_VAULT_DIR, Config.NOTES_EXPORT_MESSAGES, self._display_name)
+            self.notes_export.change_interval(minutes=Config.NOTES_EXPORT_INTERVAL_MIN)
+            self.notes_export.start()
+
+    def memory_breakdown(self) -> Dict[str, Any]:
+        """ゲートウェイのキャッシュとBot自身のキャッシュの件数"""
+        return {
+            "rss_mb": current_rss_mb(),
+            "guilds": len(self.guilds),
+            "channels": sum(len(guild.channels) for guild in self.guilds),
+            "members": sum(len(guild.members) for guild in self.guilds),
+            "users": len(self.users),
+            "messages": len(self.cached_messages),
+            "dialog_states": len(self.dialog_states),
+            "check_state_cache": len(self.check_state_cache),
+            "query_stats": len(self.query_stats),
+        }
+
+    @tasks.loop(minutes=60)
+    async def memory_report(self):
+        breakdown = self.memory_breakdown()
+        rss = f"{breakdown['rss_mb']:.1f}MB" if breakdown['rss_mb'] is not None else "不明"
+        logger.info(
+            f"メモリ内訳: RSS {rss} / ギルド {breakdown['guilds']} / チャンネル {breakdown['channels']} / "
+            f"メンバー {breakdown['members']} / ユーザー {breakdown['users']} / メッセージ {breakdown['messages']} / "
+            f"会話状態 {breakdown['dialog_states']} / 残高チェックのキャッシュ {breakdown['check_state_cache']} / クエリ統計 {breakdown['query_stats']}"
+        )
+
+    @memory_report.before_loop
+    async def before_memory_report(self):
+        await self.wait_until_ready()
+
+    async def write_durably(self, kind: str, key: str, payload: Dict[str, Any]) -> bool:
+        """DBに書く。DBに届かなければスプールに退避して False を返す（復旧後に spool_replay が書く）
+
+        残高不足などDBが返したエラーはそのまま送出する。未再生の退避分があるうちは順序を保つため新しい書き込みも退避する。
+        """
+        if not self.spool.pending and self.storage.is_ready and self.db_breaker.allow():
+            try:
+                await self._apply_spooled(kind, key, payload)
+            except self.storage.unavailable_errors as e:
+                self.db_breaker.record_failure()
+                logger.warning(f"DBに書き込めないためスプールに退避します ({kind} {key}): {e}")
+            except Exception:
+                self.db_breaker.record_success()
+                raise
+            else:
+                self.db_breaker.record_success()
+                return True
+        await self.spool.append(kind, key, payload)
+        return False
+
+    async def _apply_spooled(self, kind: str, key: str, payload: Dict[str, Any]):
+        if kind == 'message':
+            await self.storage.log_message(payload['id'], payload['guild_id'], payload['channel_id'], payload['user_id'],
+                                           payload['content'], datetime.fromisoformat(payload['created_at']))
+        elif kind == 'message_edits':
+            await self.storage.apply_message_edits([(*row[:5], datetime.fromisoformat(row[5]), datetime.fromisoformat(row[6])) for row in payload['rows']])
+        elif kind == 'message_deletes':
+            await self.storage.delete_messages([(*row[:3], datetime.fromisoformat(row[3]), datetime.fromisoformat(row[4])) for row in payload['rows']])
+        elif kind == 'activity':
+            await self.storage.add_activity(payload['user_id'], payload['channel_id'], payload['guild_id'], payload['content'],
+                                            datetime.fromisoformat(payload['activity_time']), payload['status'], payload['message_id'],
+                                            idempotency_key=key)
+        elif kind == 'spend':
+            result = await self.storage.record_spend(payload['user_id'], payload['category'], payload['amount'], payload['source_wallet'],
+                                                     created_at=datetime.fromisoformat(payload['created_at']), idempotency_key=key)
+            alerts = format_budget_alerts(result.budgets) if result else ""
+            channel = self.get_channel(payload['channel_id']) if alerts else None
+            if channel:
+                self.outbound.send(channel, alerts)
+        else:
+            raise ValueError(f"不明なスプールの種類です: {kind}")
+
+    @tasks.loop(seconds=30)
+    async def spool_replay(self):
+        if self.storage.is_ready and not self.spool.pending:
+            return
+        if not self.db_breaker.allow():
+            return
+        try:
+            await self.init_db()
+            await self._drain_spool()
+        except self.storage.unavailable_errors as e:
+            self.db_breaker.record_failure()
+            logger.warning(f"スプールの再生を中断しました（未再生 {self.spool.pending}件）: {e}")
+        except Exception:
+            self.db_breaker.record_success()
+            logger.error("スプールの再生中にエラーが発生しました", exc_info=True)
+        else:
+            self.db_breaker.record_success()
+
+    async def _drain_spool(self):
+        """スプールを先頭から順に再生する。DBに届かなくなったら再生済みの位置まで記録して例外を送出する"""
+        replayed = 0
+        while records := await self.spool.read(100):
+            offset, count = None, 0
+            try:
+                for end, record in records:
+                    if record is not None:
+                        await self._replay_record(record)
+                    offset, count = end, count + 1
+            finally:
+                if offset is not None:
+                    await self.spool.commit(offset, count)
+                    replayed += count
+        if replayed:
+            logger.info(f"スプールから{replayed}件を再生しました")
+
+    async def _replay_record(self, record: Dict[str, Any]):
+        kind, key, payload = record['kind'], record['key'], record['payload']
+        try:
+            await self._apply_spooled(kind, key, payload)
+        except self.storage.unavailable_errors:
+            raise
+        except InsufficientBalanceError as e:
+            logger.error(f"スプールの支出を残高不足のため破棄します ({key}): {e}")
+            channel = self.get_channel(payload['channel_id'])
+            if channel:
+                self.outbound.send(channel, f"⚠️ 一時保存していた {payload['category']} {payload['amount']}円の支出は、{e.wallet} の残高不足で記録できなかったぞ。(現在: {e.balance}円)")
+        except Exception as e:
+            logger.error(f"スプールの記録を再生できないため破棄します ({kind} {key}): {e}", exc_info=True)
+
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        data = payload.data
+        # 埋め込みの展開などで届く、本文の編集ではない更新は無視する
+        if payload.channel_id not in self.target_channels or not data.get('edited_timestamp') or 'content' not in data or 'author' not in data:
+            return
+        user_id = int(data['author']['id'])
+        if user_id == self.user.id or payload.message_id in self._message_deletes:
+            return
+        edited_at = discord.utils.parse_time(data['edited_timestamp'])
+        pending = self._message_edits.get(payload.message_id)
+        if pending is None or pending[6] < edited_at:
+            self._message_edits[payload.message_id] = (payload.message_id, payload.guild_id, payload.channel_id, user_id, data['content'],
+                                                       discord.utils.snowflake_time(payload.message_id), edited_at)
+
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        self._queue_message_deletes(payload.channel_id, payload.guild_id, [payload.message_id])
+
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        self._queue_message_deletes(payload.channel_id, payload.guild_id, payload.message_ids)
+
+    def _queue_message_deletes(self, channel_id: int, guild_id: Optional[int], message_ids):
+        if channel_id not in self.target_channels:
+            return
+        deleted_at = datetime.now(timezone.utc)
+        for message_id in message_ids:
+            self._message_edits.pop(message_id, None)
+            self._message_deletes.setdefault(message_id, (message_id, guild_id, channel_id, discord.utils.snowflake_time(message_id), deleted_at))
+
+    async def flush_message_changes(self):
+        """ためておいたメッセージの編集・削除をまとめて反映する（DBに届かなければスプールに退避する）"""
+        # DBにもスプールにも書けなかった分はためておく側に戻し、次の周期で書き直す。その間に届いた変更を優先する
+        if self._message_edits:
+            rows, self._message_edits = list(self._message_edits.values()), {}
+            try:
+                await self.write_durably('message_edits', f"message_edits:{rows[0][0]}", {
+                    'rows': [[*row[:5], row[5].isoformat(), row[6].isoformat()] for row in rows],
+                })
+            except BaseException:
+                for row in rows:
+                    if row[0] not in self._message_deletes:
+                        self._message_edits.setdefault(row[0], row)
+                raise
+        if self._message_deletes:
+            rows, self._message_deletes = list(self._message_deletes.values()), {}
+            try:
+                await self.write_durably('message_deletes', f"message_deletes:{rows[0][0]}", {
+                    'rows': [[*row[:3], row[3].isoformat(), row[4].isoformat()] for row in rows],
+                })
+            except BaseException:
+                for row in rows:
+                    self._message_edits.pop(row[0], None)
+                    self._message_deletes.setdefault(row[0], row)
+                raise
+
+    @tasks.loop(seconds=5)
+    async def message_sync(self):
+        try:
+            await self.flush_message_changes()
+        except Exception as e:
+            logger.error(f"メッセージの編集・削除の反映に失敗: {e}", exc_info=True)
+
+    def set_profiling(self, mode: str, enabled: bool):
+        """プロファイリングを切り替える。mode は 'asyncio_debug' / 'sampler' / 'handlers'"""
+        if mode == 'asyncio_debug':
+            self.profiler.set_asyncio_debug(enabled)
+        elif mode == 'sampler':
+            self.profiler.set_sampler(enabled)
+        elif mode == 'handlers':
+            self.profiler.set_handler_timing(enabled)
+            self.dispatcher.timings = self.profiler.handler_timings if enabled else None
+        else:
+            raise ValueError(f"不明なプロファイリングの種類です: {mode}")
+
+    def _display_name(self, user_id: int) -> Optional[str]:
+        user = self.get_user(user_id)
+        return user.display_name if user else None
+
+    @tasks.loop(minutes=30)
+    async def notes_export(self):
+        try:
+            await self.notes_exporter.export()
+        except Exception as e:
+            logger.error(f"デイリーノートの書き出しに失敗: {e}", exc_info=True)
+
+    @notes_export.before_loop
+    async def before_notes_export(self):
+        await self.wait_until_ready()
+
+    def command_tree_fingerprint(self, guild: Optional[discord.Object]) -> str:
+        """同期対象のコマンド定義から指紋を作る"""
+        payload = [command.to_dict() for command in self.tree.get_commands(guild=guild)]
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
 
-        # コマンドの同期
-        if Config.GUILD_ID:
-            guild = discord.Object(id=Config.GUILD_ID)
+    async def sync_commands_if_changed(self):
+        """コマンド定義が前回の同期から変わった場合だけ tree.sync を呼ぶ"""
+        guild = discord.Object(id=Config.GUILD_ID) if Config.GUILD_ID else None
+        if guild:
             self.tree.copy_global_to(guild=guild)
-            await self.tree.sync(guild=guild)
+        fingerprint = self.command_tree_fingerprint(guild)
+        meta_key = f"command_tree:{self.application_id}:{Config.GUILD_ID or 'global'}"
+
+        try:
+            synced_fingerprint = await self.storage.get_meta(meta_key)
+        except Exception as e:
+            logger.warning(f"前回のコマンド同期情報を取得できませんでした: {e}")
+            synced_fingerprint = None
+        if not self.force_command_sync and synced_fingerprint == fingerprint:
+            logger.info("コマンド定義に変更がないため同期をスキップしました。")
+            return
+
+        await self.tree.sync(guild=guild)
+        if guild:
             logger.info(f"コマンドをギルド {Config.GUILD_ID} に同期しました。")
         else:
-            await self.tree.sync()
             logger.info("グローバルコマンドを同期しました。")
+        try:
+            await self.storage.set_meta(meta_key, fingerprint)
+        except Exception as e:
+            logger.warning(f"コマンド同期情報の保存に失敗しました: {e}")
 
     async def on_ready(self):
         try:
             logger.info(">>>>>> 新バージョンのコードが正常に起動しました！<<<<<<")
             logger.info(f'{self.user} として監視を開始')
-            await self.init_db() # DB初期化
-            logger.info("データベースの初期化が完了しました。")
             logger.info("Botの準備完了です！")
+            if startup_profile.enabled and not startup_profile.reported:
+                startup_profile.mark("gateway ready")
+                logger.info(startup_profile.report())
+            # 再接続でも on_ready は呼ばれるので、取り込みは起動後の最初の1回だけにする
+            if self._catch_up_from is not None and self._catch_up_task is None:
+                last_ids, self._catch_up_from = self._catch_up_from, None
+                # ここから先のメッセージはゲートウェイから届くので、取り込むのはそれより前まで
+                self._catch_up_task = asyncio.create_task(self.catch_up(last_ids, datetime.now(timezone.utc)))
+                self._catch_up_task.add_done_callback(self._on_catch_up_done)
 
         except Exception as e:
             logger.error("on_readyで致命的なエラーが発生しました。", exc_info=True)
@@ -75,7 +486,15 @@ class SoraBot(commands.Bot):
     async def on_message(self, message: discord.Message):
         if message.author.id == self.user.id or not message.guild:
             return
-
+        # 記録はユーザーごとの上限で返事の処理が捨てられても残るよう、先に低優先度レーンに回す
+        # （停止中の取り込みと同じく、対象チャンネルのメッセージはすべて記録する）
+        if message.channel.id in self.target_channels:
+            self.dispatcher.submit_low(self._log_message_to_db, message)
+        # 同じユーザーのメッセージは届いた順に、別のユーザーは並行して処理する
+        self.dispatcher.submit(message.author.id, self.handle_message, message)
+
+    async def handle_message(self, message: discord.Message):
+        """1件のメッセージを処理する（ディスパッチャーからユーザーごとに順番に呼ばれる）"""
         user_id = message.author.id
         content = message.content.strip()
 
@@ -84,115 +503,113 @@ class SoraBot(commands.Bot):
             return
 
         # --- Step-by-step Weekly Balance Check ---
-        async with self.db_pool.acquire() as conn:
-            check_state_record = await conn.fetchrow("SELECT * FROM balance_check_state WHERE user_id = $1", user_id)
+        # DBに届かない間も記録系の処理は続けられるよう、残高チェックの状態は読めなければ無いものとして扱う
+        check_state_record = None
+        if self.storage.is_ready:
+            try:
+                check_state_record = await self.check_state_cache.get(user_id, self.storage.get_check_state)
+            except self.storage.unavailable_errors as e:
+                logger.warning(f"残高チェックの状態を取得できませんでした: {e}")
 
         if check_state_record and check_state_record['state'] and check_state_record['state'].startswith('waiting_for_balance_'):
             wallet_name = check_state_record['state'].replace('waiting_for_balance_', '')
             current_wallet_index = WALLET_ORDER.index(wallet_name)
 
             if not content.isdigit():
-                await message.channel.send(f"おい隊員！有効な残高を半角数字で入力せよ！")
+                self.outbound.send(message.channel, "おい隊員！有効な残高を半角数字で入力せよ！")
                 return
 
             input_balance = int(content)
-            column_map = {"ぬし財布": "input_nushi", "ぽて財布": "input_pote", "探検隊予算": "input_budget", "貯金": "input_savings"}
-            db_column_name = column_map[wallet_name]
 
-            async with self.db_pool.acquire() as conn:
-                await conn.execute(f"UPDATE balance_check_state SET {db_column_name} = $1 WHERE user_id = $2", input_balance, user_id)
+            if current_wallet_index < len(WALLET_ORDER) - 1:
+                next_wallet_name = WALLET_ORDER[current_wallet_index + 1]
+                await self.storage.save_check_input(user_id, wallet_name, input_balance, f"waiting_for_balance_{next_wallet_name}")
+                self.outbound.send(message.channel, f"了解した。次に【{next_wallet_name}】の残高を入力せよ！")
+            else:
+                # Final step, calculate differences
+                final_inputs = await self.storage.save_check_input(user_id, wallet_name, input_balance, 'waiting_for_reconciliation')
+                db_balances = await self.storage.get_balances(user_id)
+
+                input_balances = {
+                    "ぬし財布": final_inputs['input_nushi'] or 0,
+                    "ぽて財布": final_inputs['input_pote'] or 0,
+                    "探検隊予算": final_inputs['input_budget'] or 0,
+                    "貯金": final_inputs['input_savings'] or 0,
+                }
 
-                if current_wallet_index < len(WALLET_ORDER) - 1:
-                    next_wallet_name = WALLET_ORDER[current_wallet_index + 1]
-                    next_state = f"waiting_for_balance_{next_wallet_name}"
-                    await conn.execute("UPDATE balance_check_state SET state = $1 WHERE user_id = $2", next_state, user_id)
-                    await message.channel.send(f"了解した。次に【{next_wallet_name}】の残高を入力せよ！")
+                diff_messages = []
+                total_diff = 0
+                for wallet in WALLET_ORDER:
+                    db_val = db_balances.get(wallet, 0)
+                    input_val = input_balances.get(wallet, 0)
+                    diff = input_val - db_val
+                    total_diff += diff
+                    if diff != 0:
+                        diff_messages.append(f"【{wallet}】: {diff:+}円")
+
+                if total_diff == 0:
+                    self.outbound.send(message.channel, "✅ 全ての残高が一致した！完璧だ！今週のチェックを完了とする。")
+                    await self.storage.complete_balance_check(user_id)
                 else:
-                    # Final step, calculate differences
-                    await conn.execute("UPDATE balance_check_state SET state = 'waiting_for_reconciliation' WHERE user_id = $1", user_id)
-                    final_inputs = await conn.fetchrow("SELECT * FROM balance_check_state WHERE user_id = $1", user_id)
-                    db_balances_records = await conn.fetch("SELECT category, balance FROM user_balances WHERE user_id = $1", user_id)
-                    db_balances = {r['category']: r['balance'] for r in db_balances_records}
-
-                    input_balances = {
-                        "ぬし財布": final_inputs['input_nushi'] or 0,
-                        "ぽて財布": final_inputs['input_pote'] or 0,
-                        "探検隊予算": final_inputs['input_budget'] or 0,
-                        "貯金": final_inputs['input_savings'] or 0,
-                    }
-
-                    diff_messages = []
-                    total_diff = 0
-                    for wallet in WALLET_ORDER:
-                        db_val = db_balances.get(wallet, 0)
-                        input_val = input_balances.get(wallet, 0)
-                        diff = input_val - db_val
-                        total_diff += diff
-                        if diff != 0:
-                            diff_messages.append(f"【{wallet}】: {diff:+}円")
-
-                    if total_diff == 0:
-                        await message.channel.send("✅ 全ての残高が一致した！完璧だ！今週のチェックを完了とする。")
-                        await conn.execute("UPDATE balance_check_state SET state = NULL, last_checked_at = CURRENT_TIMESTAMP WHERE user_id = $1", user_id)
-                    else:
-                        response = f"⚠️ 合計で **{total_diff:+}円** の差異があるぞ。\n**内訳:**\n" + "\n".join(diff_messages)
-                        response += "\n\n問題なければ `!更新` を、最初からやり直す場合は `!再入力` を実行せよ。"
-                        await message.channel.send(response)
+                    response = f"⚠️ 合計で **{total_diff:+}円** の差異があるぞ。\n**内訳:**\n" + "\n".join(diff_messages)
+                    response += "\n\n問題なければ `!更新` を、最初からやり直す場合は `!再入力` を実行せよ。"
+                    self.outbound.send(message.channel, response)
             return
 
         elif check_state_record and check_state_record['state'] == 'waiting_for_reconciliation':
             if content == '!更新':
-                async with self.db_pool.acquire() as conn:
-                    inputs = await conn.fetchrow("SELECT * FROM balance_check_state WHERE user_id = $1", user_id)
-                    input_balances = {
-                        "ぬし財布": inputs['input_nushi'],
-                        "ぽて財布": inputs['input_pote'],
-                        "探検隊予算": inputs['input_budget'],
-                        "貯金": inputs['input_savings'],
-                    }
-                    async with conn.transaction():
-                        for wallet, new_balance in input_balances.items():
-                            if new_balance is not None:
-                                await conn.execute("INSERT INTO user_balances (user_id, category, balance) VALUES ($1, $2, $3) ON CONFLICT (user_id, category) DO UPDATE SET balance = $3", user_id, wallet, new_balance)
-                        await conn.execute("UPDATE balance_check_state SET state = NULL, last_checked_at = CURRENT_TIMESTAMP WHERE user_id = $1", user_id)
-                await message.channel.send("✅ 全ての財布の残高を更新した。これで記録は現実と一致したはずだ。")
+                input_balances = {
+                    "ぬし財布": check_state_record['input_nushi'],
+                    "ぽて財布": check_state_record['input_pote'],
+                    "探検隊予算": check_state_record['input_budget'],
+                    "貯金": check_state_record['input_savings'],
+                }
+                await self.storage.apply_reconciliation(user_id, input_balances)
+                self.outbound.send(message.channel, "✅ 全ての財布の残高を更新した。これで記録は現実と一致したはずだ。")
             elif content == '!再入力':
-                async with self.db_pool.acquire() as conn:
-                    await conn.execute("UPDATE balance_check_state SET state = 'waiting_for_balance_ぬし財布' WHERE user_id = $1", user_id)
-                await message.channel.send("了解した。最初からやり直す。まず【ぬし財布】の残高を入力せよ！")
+                await self.storage.set_check_state(user_id, 'waiting_for_balance_ぬし財布')
+                self.outbound.send(message.channel, "了解した。最初からやり直す。まず【ぬし財布】の残高を入力せよ！")
             else:
-                await message.channel.send("`!更新` または `!再入力` の形式でコマンドを実行してくれ。")
+                self.outbound.send(message.channel, "`!更新` または `!再入力` の形式でコマンドを実行してくれ。")
             return
 
         # --- End of Balance Check ---
 
-        if message.channel.id not in self.target_channel_ids:
+        if message.channel.id not in self.target_channels:
             return
 
-        await self._log_message_to_db(message)
-
-        for keyword, reaction in self.keyword_reactions.items():
-            if keyword in message.content:
-                try:
-                    await message.add_reaction(reaction)
-                except discord.HTTPException as e:
-                    logger.warning(f"リアクションの追加に失敗しました: {reaction} ({e})")
+        # リアクションは後回しにできるので混雑時に省く
+        reactions = [reaction for keyword, reaction in self.keyword_reactions.items() if keyword in message.content]
+        if reactions and self.dispatcher.admit_sheddable():
+            for reaction in reactions:
+                self.outbound.add_reaction(message, reaction)
 
         if self.user in message.mentions:
             mentioned_users = [user for user in message.mentions if user != self.user]
             if mentioned_users:
-                target_user = mentioned_users[0]
-                logger.info(f"ユーザー {target_user.display_name} のサマリーリクエストを受信")
-                user_messages = await self.collect_messages_from_user_for_day(user_id=target_user.id, channel_id=message.channel.id)
-                if user_messages:
-                    summary_embed = self._format_summary_embed(user_messages)
-                    await message.channel.send(f"{target_user.display_name}さんの本日のまとめです:", embed=summary_embed)
-                else:
-                    await message.channel.send(f"{target_user.display_name}さんの本日のメッセージは見つかりませんでした。")
+                users = {user.id: user.display_name for user in mentioned_users}
+                names = "さん、".join(users.values())
+                logger.info(f"ユーザー {', '.join(users.values())} のサマリーリクエストを受信")
+                start = datetime.combine(datetime.now(JST).date(), time(0), JST)
+                try:
+                    pages = await self.build_user_summaries(users, start, start + timedelta(days=1), channel_id=message.channel.id)
+                except Exception as e:
+                    logger.error(f"サマリー用のメッセージ収集に失敗(DB): {e}", exc_info=True)
+                    self.outbound.send(message.channel, "メッセージの収集中にエラーが発生した。")
+                    return
+                if not pages:
+                    self.outbound.send(message.channel, f"{names}さんの本日のメッセージは見つかりませんでした。")
+                    return
+                for index, page in enumerate(pages):
+                    self.outbound.send(message.channel, f"{names}さんの本日のまとめです:" if index == 0 else None, embeds=page)
                 return
 
-        if user_id in self.user_states:
-            state = self.user_states[user_id]
+        try:
+            state = await self.dialog_states.get(user_id)
+        except Exception as e:
+            logger.warning(f"会話状態を取得できませんでした: {e}")
+            state = None
+        if state:
             state_type = state.get("type")
             if state_type == "add_storage":
                 await self.handle_add_storage_name(message, state)
@@ -200,23 +617,17 @@ class SoraBot(commands.Bot):
                 await self.handle_add_item_storage_name(message, state)
             return
 
-        if (match := re.fullmatch(r"(\d{1,2}):(\d{2})\s+(.+)わず", content)):
-            await self.handle_activity(message, match, 'done')
-            return
-        elif (match := re.fullmatch(r"(.+)なう", content)):
-            await self.handle_activity(message, match, 'doing')
-            return
-        elif (match := re.fullmatch(r"(\d{1,2}):(\d{2})\s+(.+)うぃる", content)):
-            await self.handle_activity(message, match, 'todo')
+        if activity := match_activity(content):
+            await self.handle_activity(message, *activity)
             return
 
         if re.fullmatch(r"新しい収納を追加したい", content):
-            self.user_states[user_id] = {"type": "add_storage"}
-            await message.channel.send("いいよ！収納の名前は？")
+            await self.dialog_states.set(user_id, {"type": "add_storage"})
+            self.outbound.send(message.channel, "いいよ！収納の名前は？")
         elif match := re.fullmatch(r"(.+)を登録したい", content):
             item_name = match.group(1)
-            self.user_states[user_id] = {"type": "add_item_storage", "item_name": item_name}
-            await message.channel.send("どの収納に入れる？")
+            await self.dialog_states.set(user_id, {"type": "add_item_storage", "item_name": item_name})
+            self.outbound.send(message.channel, "どの収納に入れる？")
         elif match := re.fullmatch(r"(.+)どこ？", content):
             item_name = match.group(1)
             await self.handle_find_item(message, item_name)
@@ -228,111 +639,171 @@ class SoraBot(commands.Bot):
 
     def run_bot(self):
         self.run(self.bot_token)
+
+    @staticmethod
+    def _on_catch_up_done(task: asyncio.Task):
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            logger.error("停止中のメッセージの取り込みに失敗しました。", exc_info=error)
+
+    async def catch_up(self, last_ids: Dict[int, int], until: datetime):
+        """停止中(記録済みの最新メッセージ〜until)に対象チャンネルへ投稿されたメッセージを取り込む"""
+        channels = [channel for channel in map(self.get_channel, self.target_channel_ids) if channel is not None]
+        if not channels:
+            return
+        floor = discord.utils.time_snowflake(datetime.now(timezone.utc) - timedelta(hours=Config.CATCH_UP_MAX_HOURS))
+        results = await asyncio.gather(
+            *(self._catch_up_channel(channel, max(last_ids.get(channel.id, 0), floor), until) for channel in channels),
+            return_exceptions=True,
+        )
+        stored = replayed = 0
+        for channel, result in zip(channels, results):
+            if isinstance(result, Exception):
+                logger.error(f"チャンネル {channel.id} の取り込みに失敗: {result}")
+                continue
+            stored += result[0]
+            replayed += result[1]
+        if stored:
+            logger.info(f"停止中のメッセージを{stored}件取り込みました（活動記録 {replayed}件）")
+
+    async def _catch_up_channel(self, channel, after_id: int, until: datetime) -> Tuple[int, int]:
+        stored = replayed = 0
+        batch: List[discord.Message] = []
+        async for message in channel.history(after=discord.Object(id=after_id), before=until, limit=Config.CATCH_UP_MAX_MESSAGES, oldest_first=True):
+            if message.author.id == self.user.id:
+                continue
+            batch.append(message)
+            if len(batch) >= 100:
+                counts = await self._store_caught_up(batch)
+                stored, replayed, batch = stored + counts[0], replayed + counts[1], []
+        if batch:
+            counts = await self._store_caught_up(batch)
+            stored, replayed = stored + counts[0], replayed + counts[1]
+        return stored, replayed
+
+    async def _store_caught_up(self, messages: List[discord.Message]) -> Tuple[int, int]:
+        """まとめて記録し、新たに記録したものだけ活動記録として処理する"""
+        inserted = set(await self.storage.log_messages(
+            [(m.id, m.guild.id, m.channel.id, m.author.id, m.content, m.created_at) for m in messages]
+        ))
+        replayed = 0
+        if Config.CATCH_UP_REPLAY_ACTIVITIES:
+            for message in messages:
+                if message.id in inserted and (activity := match_activity(message.content.strip())):
+                    await self.handle_activity(message, *activity, react=False)
+                    replayed += 1
+        return len(inserted), replayed
         
-    async def collect_messages_from_channel(self, channel_id: int, days_back: int = 1) -> List[Dict[str, Any]]:
-        """指定されたチャンネルからメッセージを収集"""
-        collected_messages = []
+    def _channel_ref(self, channel_id: int) -> ChannelRef:
+        channel = self.get_channel(channel_id)
+        guild = getattr(channel, 'guild', None)
+        return ChannelRef(channel_id, channel.name if channel else 'Unknown Channel',
+                          guild.id if guild else None, guild.name if guild else None)
+
+    async def iter_channel_messages(self, channel_id: int, days_back: int = 1) -> AsyncIterator[MessageRecord]:
+        """指定されたチャンネルのメッセージを古い順に1件ずつ返す"""
+        channel = self.get_channel(channel_id)
+        if not channel:
+            logger.error(f"チャンネル {channel_id} が見つかりません")
+            return
+        ref = self._channel_ref(channel_id)
+        # 同じ投稿者の名前は1つの文字列を使い回す
+        usernames: Dict[int, str] = {}
+        after_date = datetime.now(timezone.utc) - timedelta(days=days_back)
         try:
-            channel = self.get_channel(channel_id)
-            if not channel:
-                logger.error(f"チャンネル {channel_id} が見つかりません")
-                return collected_messages
-            after_date = datetime.now() - timedelta(days=days_back)
             async for message in channel.history(after=after_date, limit=1000):
-                collected_messages.append({
-                    'channel_id': channel_id, 'channel_name': channel.name, 'user_id': message.author.id,
-                    'username': message.author.display_name or message.author.name, 'content': message.content,
-                    'timestamp': message.created_at.timestamp(), 'message_id': message.id, 'jump_url': message.jump_url,
-                    'guild_id': message.guild.id if message.guild else None, 'guild_name': message.guild.name if message.guild else None
-                })
-        except Exception as e:
+                author = message.author
+                username = usernames.get(author.id)
+                if username is None:
+                    username = usernames[author.id] = author.display_name or author.name
+                yield MessageRecord(message.id, ref, author.id, username, message.content, message.created_at)
+        except discord.HTTPException as e:
             logger.error(f"チャンネル {channel_id} からのメッセージ取得に失敗: {e}")
-        return collected_messages
-    
-    async def collect_all_messages(self, guild_id: int = None, days_back: int = 1) -> List[Dict[str, Any]]:
-        """指定チャンネルからメッセージを収集"""
-        all_messages = []
-        try:
-            logger.info(f"チャンネル '{self.target_channel_id}' からメッセージを収集中...")
-            messages = await self.collect_messages_from_channel(self.target_channel_id, days_back)
-            all_messages.extend(messages)
-            logger.info(f"チャンネル '{self.target_channel_id}' から {len(messages)} 件のメッセージを収集")
-        except Exception as e:
-            logger.error(f"メッセージ収集中にエラーが発生: {e}")
-        return all_messages
 
-    async def collect_messages_from_user_for_day(self, user_id: int, channel_id: int) -> List[Dict[str, Any]]:
-        """指定されたユーザーのその日のメッセージをDBから収集"""
-        collected_messages = []
-        try:
-            jst = timezone(timedelta(hours=9))
-            today_jst = datetime.now(jst).date()
-            start_of_day_jst = datetime.combine(today_jst, time.min, tzinfo=jst)
-            async with self.db_pool.acquire() as conn:
-                records = await conn.fetch("""
-                    SELECT content, created_at, id FROM messages
-                    WHERE user_id = $1 AND channel_id = $2 AND created_at >= $3 ORDER BY created_at ASC
-                """, user_id, channel_id, start_of_day_jst)
-            channel = self.get_channel(channel_id)
-            guild = channel.guild if channel else None
-            author = await self.fetch_user(user_id) if self.get_user(user_id) is None else self.get_user(user_id)
-            bot_mention_pattern = f"<@{self.user.id}>"
-            for record in records:
-                if bot_mention_pattern in record['content']: continue
-                created_at_aware = record['created_at'].astimezone(jst)
-                if created_at_aware.date() != today_jst: continue
-                collected_messages.append({
-                    'channel_id': channel_id, 'channel_name': channel.name if channel else 'Unknown Channel',
-                    'user_id': user_id, 'username': author.display_name if author else 'Unknown User',
-                    'content': record['content'], 'datetime_obj': created_at_aware, 'message_id': record['id'],
-                    'jump_url': f"https://discord.com/channels/{guild.id if guild else '@me'}/{channel_id}/{record['id']}",
-                    'guild_id': guild.id if guild else None, 'guild_name': guild.name if guild else None
-                })
-        except Exception as e:
-            logger.error(f"ユーザー {user_id} のメッセージ収集に失敗(DB): {e}", exc_info=True)
-        return collected_messages
-
-    async def post_summary(self, messages: List[Dict[str, Any]], channel_id: int = None) -> bool:
-        """収集したメッセージのサマリーをDiscordに投稿"""
-        if not messages:
-            logger.info("投稿するメッセージがありません")
-            return True
-        target_channel_id = channel_id or self.target_channel_id
+    async def iter_all_messages(self, days_back: int = 1) -> AsyncIterator[MessageRecord]:
+        """監視対象の全チャンネルのメッセージを順に返す"""
+        for channel_id in self.target_channel_ids:
+            logger.info(f"チャンネル {channel_id} からメッセージを収集中...")
+            async for record in self.iter_channel_messages(channel_id, days_back):
+                yield record
+
+    async def resolve_display_names(self, user_ids: List[int], guild: Optional[discord.Guild] = None) -> Dict[int, str]:
+        """ユーザーの表示名を返す。キャッシュにないユーザーはまとめて並行に取得する"""
+        names: Dict[int, str] = {}
+        missing = []
+        for user_id in user_ids:
+            user = (guild.get_member(user_id) if guild else None) or self.get_user(user_id)
+            if user:
+                names[user_id] = user.display_name
+            else:
+                missing.append(user_id)
+        fetched = await asyncio.gather(*(self.fetch_user(user_id) for user_id in missing), return_exceptions=True)
+        for user_id, user in zip(missing, fetched):
+            if isinstance(user, Exception):
+                logger.warning(f"ユーザー {user_id} の情報を取得できませんでした: {user}")
+                names[user_id] = 'Unknown User'
+            else:
+                names[user_id] = user.display_name
+        return names
+
+    async def build_user_summaries(self, users: Dict[int, str], start: datetime, end: datetime,
+                                   channel_id: Optional[int] = None) -> List[List[discord.Embed]]:
+        """users（ID: 表示名）の start〜end のメッセージを1回の問い合わせで読み、1人1つの Embed を1通ずつのページに分けて返す
+
+        誰のメッセージもなければ空のリストを返す。人数が多いほど1人あたりの Embed を短くし、なるべく少ない通数に収める。
+        """
+        # 1人分の Embed に並べきれない分まで読まないよう、1人あたりの件数に上限をかける
+        rows = await self.storage.fetch_users_messages(list(users), start, end, channel_id, limit_per_user=MAX_RECORDS_PER_EMBED)
+        channels: Dict[int, ChannelRef] = {}
+        max_length = max(MAX_EMBED_LENGTH // min(len(users), MAX_EMBEDS_PER_MESSAGE), 1000)
+        time_format = "%m/%d %H:%M" if end - start > timedelta(days=1) else "%H:%M"
+        embeds: Dict[int, discord.Embed] = {}
+        total = 0
+        # 行はユーザーごとにまとまって届くので、1人分ずつ流して Embed にする
+        for user_id, user_rows in itertools.groupby(rows, key=lambda row: row['user_id']):
+            user_rows = list(user_rows)
+            records = self._summary_records(user_rows, users[user_id], channels)
+            embeds[user_id], count = await build_summary_embed(records, f"📝 {users[user_id]}さんのまとめ", max_length, time_format,
+                                                               complete=len(user_rows) < MAX_RECORDS_PER_EMBED)
+            total += count
+        if not total:
+            return []
+        for user_id, name in users.items():
+            if user_id not in embeds:
+                embeds[user_id], _ = await build_summary_embed(self._summary_records((), name, channels), f"📝 {name}さんのまとめ")
+        return paginate_embeds([embeds[user_id] for user_id in users])
+
+    async def _summary_records(self, rows, username: str, channels: Dict[int, ChannelRef]) -> AsyncIterator[MessageRecord]:
+        bot_mention_pattern = f"<@{self.user.id}>"
+        for row in rows:
+            if bot_mention_pattern in row['content']:
+                continue
+            ref = channels.get(row['channel_id'])
+            if ref is None:
+                ref = channels[row['channel_id']] = self._channel_ref(row['channel_id'])
+            yield MessageRecord(row['id'], ref, row['user_id'], username, row['content'], row['created_at'])
+
+    async def post_summary(self, records: AsyncIterable[MessageRecord], channel_id: int = None) -> bool:
+        """メッセージを読みながらサマリーを組み立ててDiscordに投稿"""
+        target_channel_id = channel_id or self.target_channel_ids[0]
         try:
-            channel = self.client.get_channel(target_channel_id)
+            channel = self.get_channel(target_channel_id)
             if not channel:
                 logger.error(f"投稿先チャンネル {target_channel_id} が見つかりません")
                 return False
-            summary_embed = self._format_summary_embed(messages)
+            summary_embed, count = await build_summary_embed(records)
+            if not count:
+                logger.info("投稿するメッセージがありません")
+                return True
             await channel.send(embed=summary_embed)
-            logger.info(f"サマリーを #{channel.name} に投稿しました")
+            logger.info(f"{count}件のメッセージのサマリーを #{channel.name} に投稿しました")
             return True
         except Exception as e:
             logger.error(f"サマリーの投稿に失敗: {e}")
             return False
     
-    def _format_summary_embed(self, messages: List[Dict[str, Any]]) -> discord.Embed:
-        """メッセージサマリーをDiscord Embedでフォーマット"""
-        if not messages:
-            return discord.Embed(title="📝 収集サマリー", description="メッセージは見つかりませんでした。", color=0x00ff00, timestamp=datetime.now())
-        channel_groups = {}
-        for message in messages:
-            channel_name = message['channel_name']
-            if channel_name not in channel_groups: channel_groups[channel_name] = []
-            channel_groups[channel_name].append(message)
-        embed = discord.Embed(title="📝 収集サマリー", description=f"**収集件数**: {len(messages)}件", color=0x00ff00, timestamp=datetime.now())
-        for channel_name, channel_messages in channel_groups.items():
-            field_value = ""
-            for message in channel_messages[:10]:
-                time_str = message['datetime_obj'].strftime('%H:%M')
-                content = re.sub(r'(なう|わず|うぃる)', '', message['content']).strip()
-                if len(content) > 100: content = content[:100] + "..."
-                field_value += f"**{time_str}** {message['username']}: {content}\n"
-            if len(channel_messages) > 10: field_value += f"...他{len(channel_messages) - 10}件"
-            if field_value:
-                embed.add_field(name=f"#{channel_name} ({len(channel_messages)}件)", value=field_value, inline=False)
-        return embed
-    
     async def start_bot(self):
         """Discord Botを開始（常駐）"""
         @self.event
@@ -346,9 +817,22 @@ class SoraBot(commands.Bot):
     
     async def close(self):
         """Botを終了し、DB接続を閉じる"""
-        if self.db_pool:
-            await self.db_pool.close()
-            logger.info("データベース接続プールを閉じました。")
+        if self._catch_up_task is not None:
+            self._catch_up_task.cancel()
+        await self.dispatcher.close()
+        await self.outbound.close()
+        self.message_sync.cancel()
+        try:
+            await self.flush_message_changes()
+        except Exception as e:
+            logger.error(f"終了時にメッセージの編集・削除を反映できませんでした: {e}")
+        self.spool.close()
+        self.profiler.close()
+        if self.health is not None:
+            await self.health.stop()
+        if self.storage.is_ready:
+            await self.storage.close()
+            logger.info("データベース接続を閉じました。")
         await super().close()
 
     async def run_once_collect_and_post(self, days_back: int = 1) -> bool:
@@ -358,11 +842,8 @@ class SoraBot(commands.Bot):
         async def on_ready():
             logger.info(f'{self.user} としてログインしました')
             try:
-                messages = await self.collect_all_messages(guild_id=Config.GUILD_ID, days_back=days_back)
-                if not messages: logger.info("収集されたメッセージがありません")
-                else:
-                    logger.info(f"{len(messages)}件のメッセージを収集しました")
-                    await self.post_summary(messages)
+                if not await self.post_summary(self.iter_all_messages(days_back=days_back)):
+                    done_flag['success'] = False
                 done_flag['ran'] = True
             except Exception as e:
                 done_flag['success'] = False
@@ -380,7 +861,6 @@ class SoraBot(commands.Bot):
         @self.event
         async def on_ready():
             logger.info(f'{self.user} として監視を開始')
-            await self.init_db()
         # on_message is now handled by the main class listener
         try:
             await self.start(self.bot_token)
@@ -389,62 +869,25 @@ class SoraBot(commands.Bot):
         finally: await self.close()
 
     async def init_db(self):
-        """データベースを初期化し、テーブルを作成する"""
-        self.db_pool = await asyncpg.create_pool(Config.DATABASE_URL)
-        async with self.db_pool.acquire() as conn:
-            await conn.execute('''CREATE TABLE IF NOT EXISTS guilds (id BIGINT PRIMARY KEY, name TEXT NOT NULL);''')
-            await conn.execute('''CREATE TABLE IF NOT EXISTS storages (id SERIAL PRIMARY KEY, guild_id BIGINT REFERENCES guilds(id) ON DELETE CASCADE, name TEXT NOT NULL, UNIQUE(guild_id, name));''')
-            await conn.execute('''CREATE TABLE IF NOT EXISTS items (id SERIAL PRIMARY KEY, storage_id INT REFERENCES storages(id) ON DELETE CASCADE, name TEXT NOT NULL, updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, UNIQUE(storage_id, name));''')
-            await conn.execute('''CREATE TABLE IF NOT EXISTS messages (id BIGINT PRIMARY KEY, guild_id BIGINT, channel_id BIGINT, user_id BIGINT, content TEXT, created_at TIMESTAMP WITH TIME ZONE);''')
-            await conn.execute('''CREATE TABLE IF NOT EXISTS user_balances (user_id BIGINT NOT NULL, category TEXT NOT NULL, balance BIGINT NOT NULL, PRIMARY KEY (user_id, category));''')
-            await conn.execute('''CREATE TABLE IF NOT EXISTS transactions (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, transaction_type TEXT NOT NULL, category TEXT, amount BIGINT NOT NULL, created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP);''')
-
-            # transactionsテーブルにカラムが存在するか確認し、なければ追加
-            table_name = 'transactions'
-            columns_to_add = {
-                'source_wallet': 'TEXT',
-                'is_balance_reflected': 'BOOLEAN'
-            }
-            for column_name, column_type in columns_to_add.items():
-                column_exists = await conn.fetchval(f'''
-                    SELECT EXISTS (
-                        SELECT 1
-                        FROM pg_catalog.pg_attribute
-                        WHERE attrelid = '{table_name}'::regclass
-                        AND attname = '{column_name}'
-                        AND NOT attisdropped
-                    );
-                ''')
-                if not column_exists:
-                    await conn.execute(f'ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type};')
-                    logger.info(f"{table_name}テーブルに{column_name}カラムを追加しました。")
-
-            
-            # balance_check_stateテーブルを再作成
-            await conn.execute('''DROP TABLE IF EXISTS balance_check_state;''')
-            await conn.execute('''CREATE TABLE IF NOT EXISTS balance_check_state (
-                                user_id BIGINT PRIMARY KEY,
-                                state TEXT,
-                                input_nushi BIGINT,
-                                input_pote BIGINT,
-                                input_budget BIGINT,
-                                input_savings BIGINT,
-                                last_checked_at TIMESTAMP WITH TIME ZONE
-                            );''')
-            logger.info("家計簿・残高チェック機能のテーブルを初期化しました。")
-
-            await conn.execute('''DROP TABLE IF EXISTS past_activities;''')
-            await conn.execute('''CREATE TABLE IF NOT EXISTS activities (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, channel_id BIGINT NOT NULL, guild_id BIGINT NOT NULL, content TEXT NOT NULL, activity_time TIMESTAMP WITH TIME ZONE NOT NULL, status TEXT NOT NULL, original_message_id BIGINT);''')
-        logger.info("活動記録テーブル(activities)を初期化しました。")
+        """データベースに接続し、テーブルを作成する"""
+        if self.storage.is_ready:
+            return
+        await self.storage.connect()
+        try:
+            await self.storage.init_schema()
+        except BaseException:
+            await self.storage.close()
+            raise
+        await self.storage.start_change_listener()
+        logger.info(f"ストレージ({self.storage.backend})の初期化が完了しました。")
 
     async def _log_message_to_db(self, message: discord.Message):
         """メッセージをデータベースに記録する"""
         try:
-            async with self.db_pool.acquire() as conn:
-                await conn.execute(
-                    "INSERT INTO messages (id, guild_id, channel_id, user_id, content, created_at) VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (id) DO NOTHING",
-                    message.id, message.guild.id, message.channel.id, message.author.id, message.content, message.created_at,
-                )
+            await self.write_durably('message', str(message.id), {
+                'id': message.id, 'guild_id': message.guild.id, 'channel_id': message.channel.id, 'user_id': message.author.id,
+                'content': message.content, 'created_at': message.created_at.isoformat(),
+            })
         except Exception as e:
             logger.error(f"メッセージのデータベースへの記録に失敗: {e}")
 
@@ -455,17 +898,15 @@ class SoraBot(commands.Bot):
         guild_id = message.guild.id
         guild_name = message.guild.name
         try:
-            async with self.db_pool.acquire() as conn:
-                await conn.execute("INSERT INTO guilds (id, name) VALUES ($1, $2) ON CONFLICT (id) DO UPDATE SET name = $2", guild_id, guild_name)
-                await conn.execute("INSERT INTO storages (guild_id, name) VALUES ($1, $2)", guild_id, storage_name)
-            await message.channel.send(f"『{storage_name}』を登録したよ！")
-        except asyncpg.UniqueViolationError:
-            await message.channel.send(f"『{storage_name}』はもうあるみたい。")
+            await self.storage.add_storage(guild_id, guild_name, storage_name)
+            self.outbound.send(message.channel, f"『{storage_name}』を登録したよ！")
+        except DuplicateStorageError:
+            self.outbound.send(message.channel, f"『{storage_name}』はもうあるみたい。")
         except Exception as e:
             logger.error(f"収納の追加に失敗: {e}")
-            await message.channel.send("ごめん、登録に失敗しちゃった。")
+            self.outbound.send(message.channel, "ごめん、登録に失敗しちゃった。")
         finally:
-            if user_id in self.user_states: del self.user_states[user_id]
+            await self.dialog_states.clear(user_id)
 
     async def handle_add_item_storage_name(self, message: discord.Message, state: dict):
         """アイテムを入れる収納名の入力を処理"""
@@ -474,51 +915,50 @@ class SoraBot(commands.Bot):
         item_name = state["item_name"]
         guild_id = message.guild.id
         try:
-            async with self.db_pool.acquire() as conn:
-                storage_record = await conn.fetchrow("SELECT id FROM storages WHERE guild_id = $1 AND name = $2", guild_id, storage_name)
-                if not storage_record:
-                    await message.channel.send(f"『{storage_name}』っていう収納はないみたい。")
-                    return
-                storage_id = storage_record['id']
-                await conn.execute("INSERT INTO items (storage_id, name) VALUES ($1, $2) ON CONFLICT (storage_id, name) DO UPDATE SET updated_at = CURRENT_TIMESTAMP", storage_id, item_name)
-            await message.channel.send(f"『{item_name}』を『{storage_name}』に登録したよ！")
+            storage_id = await self.storage.get_storage_id(guild_id, storage_name)
+            if storage_id is None:
+                self.outbound.send(message.channel, f"『{storage_name}』っていう収納はないみたい。")
+                return
+            await self.storage.upsert_item(storage_id, item_name)
+            self.outbound.send(message.channel, f"『{item_name}』を『{storage_name}』に登録したよ！")
         except Exception as e:
             logger.error(f"アイテムの登録に失敗: {e}")
-            await message.channel.send("ごめん、登録に失敗しちゃった。")
+            self.outbound.send(message.channel, "ごめん、登録に失敗しちゃった。")
         finally:
-            if user_id in self.user_states: del self.user_states[user_id]
+            await self.dialog_states.clear(user_id)
 
     async def handle_find_item(self, message: discord.Message, item_name: str):
         """アイテムの場所を検索して返信"""
         guild_id = message.guild.id
         try:
-            async with self.db_pool.acquire() as conn:
-                result = await conn.fetchrow("SELECT s.name FROM items i JOIN storages s ON i.storage_id = s.id WHERE i.name = $1 AND s.guild_id = $2", item_name, guild_id)
-            if result:
-                await message.channel.send(f"『{item_name}』は『{result['name']}』にあるよ！")
+            storage_name = await self.storage.find_item_storage(guild_id, item_name)
+            if storage_name:
+                self.outbound.send(message.channel, f"『{item_name}』は『{storage_name}』にあるよ！")
             else:
-                await message.channel.send(f"『{item_name}』は見つからないみたい。")
+                self.outbound.send(message.channel, f"『{item_name}』は見つからないみたい。")
         except Exception as e:
             logger.error(f"アイテムの検索に失敗: {e}")
-            await message.channel.send("ごめん、検索中にエラーが起きちゃった。")
+            self.outbound.send(message.channel, "ごめん、検索中にエラーが起きちゃった。")
 
     async def handle_list_items_in_storage(self, message: discord.Message, storage_name: str):
         """収納の中身を一覧表示"""
         guild_id = message.guild.id
         try:
-            async with self.db_pool.acquire() as conn:
-                results = await conn.fetch("SELECT i.name FROM items i JOIN storages s ON i.storage_id = s.id WHERE s.name = $1 AND s.guild_id = $2 ORDER BY i.name", storage_name, guild_id)
+            results = await self.storage.list_storage_items(guild_id, storage_name)
             if results:
-                item_names = [f"『{r['name']}』" for r in results]
-                await message.channel.send("、".join(item_names) + "が入ってるよ！")
+                item_names = [f"『{name}』" for name in results]
+                self.outbound.send(message.channel, "、".join(item_names) + "が入ってるよ！")
             else:
-                await message.channel.send(f"『{storage_name}』には何もないみたい。")
+                self.outbound.send(message.channel, f"『{storage_name}』には何もないみたい。")
         except Exception as e:
             logger.error(f"収納アイテムのリスト取得に失敗: {e}")
-            await message.channel.send("ごめん、中身を確認中にエラーが起きちゃった。")
+            self.outbound.send(message.channel, "ごめん、中身を確認中にエラーが起きちゃった。")
 
-    async def handle_activity(self, message: discord.Message, match: re.Match, status: str):
-        """活動記録を処理する (わず, なう, うぃる)"""
+    async def handle_activity(self, message: discord.Message, match: re.Match, status: str, react: bool = True):
+        """活動記録を処理する (わず, なう, うぃる)。react=False なら結果のリアクションを付けない"""
+        def reply(emoji: str):
+            if react:
+                self.outbound.add_reaction(message, emoji)
         try:
             activity_time, content = None, ""
             if status == 'done' or status == 'todo':
@@ -530,16 +970,17 @@ class SoraBot(commands.Bot):
             elif status == 'doing':
                 content, activity_time = match.group(1).strip(), message.created_at
             if activity_time is None:
-                await message.add_reaction("🤔")
+                reply("🤔")
                 return
-            async with self.db_pool.acquire() as conn:
-                await conn.execute("INSERT INTO activities (user_id, channel_id, guild_id, content, activity_time, status, original_message_id) VALUES ($1, $2, $3, $4, $5, $6, $7)",
-                                   message.author.id, message.channel.id, message.guild.id, content, activity_time, status, message.id)
-            await message.add_reaction("✅")
-        except ValueError: await message.add_reaction("🤔")
+            await self.write_durably('activity', f"activity:{message.id}", {
+                'user_id': message.author.id, 'channel_id': message.channel.id, 'guild_id': message.guild.id, 'content': content,
+                'activity_time': activity_time.isoformat(), 'status': status, 'message_id': message.id,
+            })
+            reply("✅")
+        except ValueError: reply("🤔")
         except Exception as e:
             logger.error(f"活動の記録に失敗: {e}")
-            await message.add_reaction("❌")
+            reply("❌")
 
     async def handle_spend_webhook(self, message: discord.Message):
         """Webhookからの支出記録メッセージを自然言語で処理する"""
@@ -596,49 +1037,42 @@ class SoraBot(commands.Bot):
                     source_wallet_name = "ぽて財布" # デフォルト
 
             if not all([source_wallet_name, category_name, amount]):
-                await message.channel.send("うーむ、支出の内容がうまく聞き取れなかった。もう一度試してみてくれ。\\n例: 「ぽて財布で食費に500円」")
+                self.outbound.send(message.channel, "うーむ、支出の内容がうまく聞き取れなかった。もう一度試してみてくれ。\\n例: 「ぽて財布で食費に500円」")
                 return
 
             if amount <= 0:
-                await message.channel.send("支出額は正の数値を指定しろ！")
+                self.outbound.send(message.channel, "支出額は正の数値を指定しろ！")
                 return
 
             if not Config.OWNER_ID:
-                await message.channel.send("エラー: `OWNER_ID`が設定されていません。")
+                self.outbound.send(message.channel, "エラー: `OWNER_ID`が設定されていません。")
                 return
             user_id = Config.OWNER_ID
 
-            async with self.db_pool.acquire() as conn:
-                async with conn.transaction():
-                    current_balance_record = await conn.fetchrow("SELECT balance FROM user_balances WHERE user_id = $1 AND category = $2", user_id, source_wallet_name)
-                    current_balance = current_balance_record['balance'] if current_balance_record else 0
-
-                    if current_balance < amount:
-                        await message.channel.send(f"おい隊員！ {source_wallet_name} の残高が足りないぞ！ (現在: {current_balance}円)")
-                        return
-
-                    await conn.execute(
-                        'UPDATE user_balances SET balance = balance - $1 WHERE user_id = $2 AND category = $3',
-                        amount, user_id, source_wallet_name
-                    )
-
-                    await conn.execute(
-                        "INSERT INTO transactions (user_id, transaction_type, category, amount) VALUES ($1, 'spend', $2, $3);",
-                        user_id, category_name, amount
-                    )
+            try:
+                stored = await self.write_durably('spend', f"spend:{message.id}", {
+                    'user_id': user_id, 'category': category_name, 'amount': amount, 'source_wallet': source_wallet_name,
+                    'created_at': message.created_at.isoformat(), 'channel_id': message.channel.id,
+                })
+            except InsufficientBalanceError as e:
+                self.outbound.send(message.channel, f"おい隊員！ {e.wallet} の残高が足りないぞ！ (現在: {e.balance}円)")
+                return
+            if not stored:
+                self.outbound.send(message.channel, f"💾 DBに接続できないため、{category_name} に {amount}円の支出を一時保存したぞ。復旧したら記録する。")
+                return
             
             response_message = (
                 f"💸 {category_name} に {amount}円の支出を記録したぞ！ (Webhook経由)\\n"
                 f"💳 支払元: {source_wallet_name}\\n"
                 f"🫡 {get_captain_quote('spend')}"
             )
-            await message.channel.send(response_message)
-            await message.add_reaction("✅")
+            self.outbound.send(message.channel, response_message)
+            self.outbound.add_reaction(message, "✅")
 
         except Exception as e:
             logger.error(f"Webhook支出記録の処理中にエラーが発生: {e}", exc_info=True)
-            await message.channel.send("Webhookの処理中にエラーが発生した。")
-            await message.add_reaction("❌")
+            self.outbound.send(message.channel, "Webhookの処理中にエラーが発生した。")
+            self.outbound.add_reaction(message, "❌")
 
 import random
 
@@ -651,6 +1085,45 @@ def get_captain_quote(category: str) -> str:
     }
     return random.choice(quotes.get(category, ["よくやったな！その調子だ！"]))
 
+def allocate_salary(amount: int) -> Dict[str, int]:
+    """給料を各財布への振り分け額に分割する"""
+    # 新しいルールに基づいて金額を振り分け
+    nushi_wallet_amount = amount // 2
+    pote_wallet_amount = 0
+    savings_amount = (amount * 3) // 10
+    expedition_budget_amount = (amount * 2) // 10
+
+    # 残りを貯金に加算
+    remainder = amount - nushi_wallet_amount - pote_wallet_amount - savings_amount - expedition_budget_amount
+    savings_amount += remainder
+    return {
+        "ぽて財布": pote_wallet_amount,
+        "ぬし財布": nushi_wallet_amount,
+        "貯金": savings_amount,
+        "探検隊予算": expedition_budget_amount,
+    }
+
+
+def format_budget_alerts(budgets: List[BudgetUsage]) -> str:
+    """今回の支出で BUDGET_ALERT_THRESHOLDS を超えた予算の警告。なければ空文字"""
+    lines = []
+    for usage in budgets:
+        threshold = usage.crossed_threshold(Config.BUDGET_ALERT_THRESHOLDS)
+        if threshold is None:
+            continue
+        month = f"{int(usage.month[5:])}月"
+        if threshold >= 100:
+            lines.append(f"🚨 {usage.category} の{month}の予算 {usage.limit:,}円を超えたぞ！ (使用額: {usage.after:,}円)")
+        else:
+            lines.append(f"⚠️ {usage.category} の{month}の予算 {usage.limit:,}円の{threshold}%に達したぞ。 (使用額: {usage.after:,}円、残り {usage.limit - usage.after:,}円)")
+    return "\n".join(lines)
+
+
+def describe_recurring(rule) -> str:
+    if rule['kind'] == 'transfer':
+        return f"🔄 {rule['source_wallet']}から{rule['destination_wallet']}へ {rule['amount']:,}円"
+    return f"💸 {rule['category']} {rule['amount']:,}円（{rule['source_wallet']}から）"
+
 class FinanceCog(commands.Cog):
     def __init__(self, bot: SoraBot):
         self.bot = bot
@@ -659,52 +1132,75 @@ class FinanceCog(commands.Cog):
     @commands.Cog.listener()
     async def on_ready(self):
         logger.info("FinanceCog is ready.")
-        self.weekly_balance_check.start()
-        self.daily_balance_report.start()
+        if not self.bot.runs_scheduled_tasks:
+            return
+        # on_ready は再接続のたびに呼ばれる
+        if not self.weekly_balance_check.is_running():
+            self.weekly_balance_check.start()
+        if not self.daily_balance_report.is_running():
+            self.daily_balance_report.start()
+        if not self.balance_snapshot.is_running():
+            self.balance_snapshot.start()
+        if not self.recurring_transactions.is_running():
+            self.recurring_transactions.change_interval(minutes=Config.RECURRING_INTERVAL_MIN)
+            self.recurring_transactions.start()
 
     def cog_unload(self):
         self.weekly_balance_check.cancel()
+        self.daily_balance_report.cancel()
+        self.balance_snapshot.cancel()
+        self.recurring_transactions.cancel()
+
+    async def _run_job(self, job: str, period: str, fn):
+        # 例外で定期タスク自体が止まらないようにする
+        try:
+            await self.bot.jobs.run(job, period, fn)
+        except Exception as e:
+            logger.error(f"定期タスク {job} ({period}) でエラーが発生: {e}", exc_info=True)
 
     @tasks.loop(time=time(20, 0, tzinfo=timezone(timedelta(hours=9))))
     async def weekly_balance_check(self):
         today = datetime.now(self.jst)
         if today.weekday() != 4: return # 4:金曜日
-        
+        year, week, _ = today.isocalendar()
+        await self._run_job('weekly_balance_check', f"{year}-W{week:02d}", lambda: self._send_weekly_balance_check(today))
+
+    async def _send_weekly_balance_check(self, today: datetime):
         channel_id = self.bot.target_channel_ids[0]
         channel = self.bot.get_channel(channel_id)
         if not channel: return logger.error(f"残高チェック用のチャンネル {channel_id} が見つからん！")
 
         start_of_week = (today - timedelta(days=today.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
 
-        async with self.bot.db_pool.acquire() as conn:
-            user_records = await conn.fetch("SELECT DISTINCT user_id FROM user_balances")
-            prompt_sent = False
-            for record in user_records:
-                user_id = record['user_id']
-                check_state = await conn.fetchrow("SELECT last_checked_at FROM balance_check_state WHERE user_id = $1", user_id)
-                
-                if check_state and check_state['last_checked_at'] and check_state['last_checked_at'] >= start_of_week:
-                    logger.info(f"ユーザー {user_id} は今週既にチェック済みのためスキップする。")
-                    continue
+        prompt_sent = False
+        deliveries = []
+        for user_id in await self.bot.storage.get_balance_user_ids():
+            check_state = await self.bot.storage.get_check_state(user_id)
 
-                if not prompt_sent:
-                    await channel.send("🚨 毎週の残高チェックの時間だ！これより各財布の残高を順番に確認する。")
-                    prompt_sent = True
-                
-                await conn.execute("INSERT INTO balance_check_state (user_id, state) VALUES ($1, 'waiting_for_balance_ぬし財布') ON CONFLICT (user_id) DO UPDATE SET state = 'waiting_for_balance_ぬし財布', input_nushi=NULL, input_pote=NULL, input_budget=NULL, input_savings=NULL;", user_id)
-                try:
-                    user = await self.bot.fetch_user(user_id)
-                    await user.send("まず【ぬし財布】の現在の残高を半角数字で入力せよ！")
-                except (discord.NotFound, discord.Forbidden):
-                    await channel.send(f"<@{user_id}>、DMが送信できん！まず【ぬし財布】の現在の残高を半角数字で入力せよ！")
+            if check_state and check_state['last_checked_at'] and check_state['last_checked_at'] >= start_of_week:
+                logger.info(f"ユーザー {user_id} は今週既にチェック済みのためスキップする。")
+                continue
+
+            if not prompt_sent:
+                self.bot.outbound.send(channel, "🚨 毎週の残高チェックの時間だ！これより各財布の残高を順番に確認する。", lane=NORMAL)
+                prompt_sent = True
+
+            await self.bot.storage.start_balance_check(user_id)
+            fallback = f"<@{user_id}>、DMが送信できん！まず【ぬし財布】の現在の残高を半角数字で入力せよ！"
+            try:
+                user = await self.bot.fetch_user(user_id)
+                deliveries.append(self.bot.outbound.send(user, "まず【ぬし財布】の現在の残高を半角数字で入力せよ！", lane=NORMAL, fallback=(channel, fallback)))
+            except discord.NotFound:
+                deliveries.append(self.bot.outbound.send(channel, fallback, lane=NORMAL))
 
+        # 送信キューに積んだだけで終わると、届く前に停止したときに完了扱いのまま通知が消えるので届くまで待つ
+        await self._await_deliveries(deliveries, "残高チェックの通知")
         if prompt_sent: logger.info("残高チェックが必要な隊員への通知を完了した。")
 
     @app_commands.command(name="check_balance_manual", description="Starts the weekly balance check manually.")
     async def check_balance_manual(self, interaction: discord.Interaction):
         user_id = interaction.user.id
-        async with self.bot.db_pool.acquire() as conn:
-            await conn.execute("INSERT INTO balance_check_state (user_id, state) VALUES ($1, 'waiting_for_balance_ぬし財布') ON CONFLICT (user_id) DO UPDATE SET state = 'waiting_for_balance_ぬし財布', input_nushi=NULL, input_pote=NULL, input_budget=NULL, input_savings=NULL;", user_id)
+        await self.bot.storage.start_balance_check(user_id)
         await interaction.response.send_message("🚨 残高チェックを開始する！まず【ぬし財布】の現在の残高を半角数字で入力せよ！", ephemeral=True)
 
     @app_commands.command(name="reset", description="指定した財布の残高を、指定した金額に再設定するぞ。")
@@ -726,24 +1222,8 @@ class FinanceCog(commands.Cog):
             await interaction.response.send_message("おい隊員！リセットする金額は正の数値を指定しろ！", ephemeral=True)
             return
         
-        async with self.bot.db_pool.acquire() as conn:
-            async with conn.transaction():
-                # 指定された財布の残高を更新または挿入
-                await conn.execute("""
-                    INSERT INTO user_balances (user_id, category, balance)
-                    VALUES ($1, $2, $3)
-                    ON CONFLICT (user_id, category) DO UPDATE SET balance = $3
-                    """, user_id, target_wallet, amount)
-
-                # 取引履歴を記録
-                await conn.execute("""
-                    INSERT INTO transactions (user_id, transaction_type, category, amount)
-                    VALUES ($1, 'reset', $2, $3)
-                    """, user_id, target_wallet, amount)
-                
-                # 残高チェックの状態もリセット
-                await conn.execute("UPDATE balance_check_state SET state = NULL, input_nushi=NULL, input_pote=NULL, input_budget=NULL, input_savings=NULL, last_checked_at = NULL WHERE user_id = $1", user_id)
-        
+        await self.bot.storage.reset_balance(user_id, target_wallet, amount)
+
         await interaction.response.send_message(f"よし！ **{target_wallet}** の残高を **{amount}** 円に再設定した。")
 
     @app_commands.command(name="salary", description="給料を受け取り、ルールに基づいて各財布に自動で振り分けるぞ。")
@@ -755,38 +1235,13 @@ class FinanceCog(commands.Cog):
 
         user_id = interaction.user.id
 
-        # 新しいルールに基づいて金額を振り分け
-        nushi_wallet_amount = amount // 2
-        pote_wallet_amount = 0
-        savings_amount = (amount * 3) // 10
-        expedition_budget_amount = (amount * 2) // 10
-        
-        # 残りを貯金に加算
-        remainder = amount - nushi_wallet_amount - pote_wallet_amount - savings_amount - expedition_budget_amount
-        savings_amount += remainder
-
-        async with self.bot.db_pool.acquire() as conn:
-            async with conn.transaction():
-                # 各カテゴリの残高を更新
-                for category, cat_amount in [
-                    ("ぽて財布", pote_wallet_amount),
-                    ("ぬし財布", nushi_wallet_amount),
-                    ("貯金", savings_amount),
-                    ("探検隊予算", expedition_budget_amount)
-                ]:
-                    if cat_amount > 0:
-                        await conn.execute("""
-                            INSERT INTO user_balances (user_id, category, balance)
-                            VALUES ($1, $2, $3)
-                            ON CONFLICT (user_id, category) DO UPDATE
-                            SET balance = user_balances.balance + $3;
-                            """, user_id, category, cat_amount)
-
-                # 取引履歴を記録
-                await conn.execute("""
-                    INSERT INTO transactions (user_id, transaction_type, category, amount)
-                    VALUES ($1, 'salary', '給与収入', $2);
-                    """, user_id, amount)
+        allocations = allocate_salary(amount)
+        nushi_wallet_amount = allocations["ぬし財布"]
+        pote_wallet_amount = allocations["ぽて財布"]
+        savings_amount = allocations["貯金"]
+        expedition_budget_amount = allocations["探検隊予算"]
+
+        await self.bot.storage.add_salary(user_id, amount, allocations)
 
         message = (
             f"💰 給料 {amount}円を受け取り、各財布に振り分けたぞ！\n"
@@ -849,25 +1304,11 @@ class FinanceCog(commands.Cog):
                 await interaction.response.send_message("日付の形式が正しくないようだ。`YYYY-MM-DD`の形式で入力してくれ。", ephemeral=True)
                 return
 
-        async with self.bot.db_pool.acquire() as conn:
-            async with conn.transaction():
-                if should_reflect:
-                    current_balance_record = await conn.fetchrow("SELECT balance FROM user_balances WHERE user_id = $1 AND category = $2", user_id, source_wallet_name)
-                    current_balance = current_balance_record['balance'] if current_balance_record else 0
-
-                    if current_balance < amount:
-                        await interaction.response.send_message(f"おい隊員！ {source_wallet_name} の残高が足りないぞ！ (現在: {current_balance}円)", ephemeral=True)
-                        return
-
-                    await conn.execute('''
-                        UPDATE user_balances SET balance = balance - $1 WHERE user_id = $2 AND category = $3
-                        ''', amount, user_id, source_wallet_name)
-
-                # 取引履歴を記録
-                await conn.execute('''
-                    INSERT INTO transactions (user_id, transaction_type, category, amount, created_at, source_wallet, is_balance_reflected)
-                    VALUES ($1, 'spend', $2, $3, $4, $5, $6);
-                    ''', user_id, category_name, amount, transaction_time, source_wallet_name, should_reflect)
+        try:
+            result = await self.bot.storage.record_spend(user_id, category_name, amount, source_wallet_name, transaction_time, should_reflect)
+        except InsufficientBalanceError as e:
+            await interaction.response.send_message(f"おい隊員！ {e.wallet} の残高が足りないぞ！ (現在: {e.balance}円)", ephemeral=True)
+            return
 
         message = (
             f"💸 {category_name} に {amount}円の支出を記録したぞ！\n"
@@ -876,6 +1317,9 @@ class FinanceCog(commands.Cog):
         )
         if not should_reflect:
             message += "過去の記録として登録したため、残高は変更されていない。\n"
+        alerts = format_budget_alerts(result.budgets)
+        if alerts:
+            message += f"{alerts}\n"
         
         message += f"🫡 {get_captain_quote('spend')}"
 
@@ -914,32 +1358,11 @@ class FinanceCog(commands.Cog):
             await interaction.response.send_message("おい隊員！同じ財布の間では資金を移動できん！", ephemeral=True)
             return
 
-        async with self.bot.db_pool.acquire() as conn:
-            async with conn.transaction():
-                # 移動元の残高を取得
-                source_balance_record = await conn.fetchrow("SELECT balance FROM user_balances WHERE user_id = $1 AND category = $2", user_id, source_wallet)
-                source_balance = source_balance_record['balance'] if source_balance_record else 0
-
-                if source_balance < amount:
-                    await interaction.response.send_message(f"おい隊員！ {source_wallet} の残高が足りないぞ！ (現在: {source_balance}円)", ephemeral=True)
-                    return
-
-                # 移動元の残高を減らす
-                await conn.execute("UPDATE user_balances SET balance = balance - $1 WHERE user_id = $2 AND category = $3", amount, user_id, source_wallet)
-                
-                # 移動先の残高を増やす
-                await conn.execute("""
-                    INSERT INTO user_balances (user_id, category, balance)
-                    VALUES ($1, $2, $3)
-                    ON CONFLICT (user_id, category) DO UPDATE
-                    SET balance = user_balances.balance + $3;
-                    """, user_id, destination_wallet, amount)
-
-                # 取引履歴を記録
-                await conn.execute("""
-                    INSERT INTO transactions (user_id, transaction_type, category, amount)
-                    VALUES ($1, 'transfer', $2, $3);
-                    """, user_id, f"{source_wallet}から{destination_wallet}へ", amount)
+        try:
+            await self.bot.storage.transfer(user_id, source_wallet, destination_wallet, amount)
+        except InsufficientBalanceError as e:
+            await interaction.response.send_message(f"おい隊員！ {e.wallet} の残高が足りないぞ！ (現在: {e.balance}円)", ephemeral=True)
+            return
 
         message = (
             f"🔄 {source_wallet} から {destination_wallet} へ {amount}円を移動したぞ。\n"
@@ -951,10 +1374,9 @@ class FinanceCog(commands.Cog):
     async def balance(self, interaction: discord.Interaction):
         user_id = interaction.user.id
         
-        async with self.bot.db_pool.acquire() as conn:
-            records = await conn.fetch("SELECT category, balance FROM user_balances WHERE user_id = $1 ORDER BY category", user_id)
+        balances = await self.bot.storage.get_balances(user_id)
 
-        if not records:
+        if not balances:
             await interaction.response.send_message("まだ財布の残高記録がないようだ。まずは `/salary` などで収入を記録しよう！", ephemeral=True)
             return
 
@@ -967,9 +1389,6 @@ class FinanceCog(commands.Cog):
         total_balance = 0
         wallet_order = ["ぬし財布", "ぽて財布", "探検隊予算", "貯金"] # 表示順を定義
         
-        # 順序通りに表示するために一度辞書化
-        balances = {record['category']: record['balance'] for record in records}
-        
         # 定義した順序で財布情報を追加
         for wallet_name in wallet_order:
             if wallet_name in balances:
@@ -987,16 +1406,87 @@ class FinanceCog(commands.Cog):
         
         await interaction.response.send_message(embed=embed)
 
+    @app_commands.command(name="balance_at", description="指定した日の終わり時点の各財布の残高を表示するぞ。")
+    @app_commands.describe(date="日付をYYYY-MM-DD形式で指定")
+    async def balance_at(self, interaction: discord.Interaction, date: str):
+        try:
+            day = datetime.strptime(date, "%Y-%m-%d").date()
+        except ValueError:
+            await interaction.response.send_message("日付の形式が正しくないようだ。`YYYY-MM-DD`の形式で入力してくれ。", ephemeral=True)
+            return
+
+        # その日の 23:59:59.999999 (JST) の時点
+        at = datetime.combine(day + timedelta(days=1), time(0), self.jst) - timedelta(microseconds=1)
+        balances = await self.bot.storage.balance_at(interaction.user.id, at)
+        if not balances:
+            await interaction.response.send_message(f"{day.strftime('%Y/%m/%d')} 時点の残高の記録はないようだ。", ephemeral=True)
+            return
+
+        embed = discord.Embed(title=f"{day.strftime('%Y/%m/%d')} 終了時点の財産状況", color=discord.Color.blue())
+        for wallet_name in sorted(balances, key=lambda name: WALLET_ORDER.index(name) if name in WALLET_ORDER else len(WALLET_ORDER)):
+            embed.add_field(name=wallet_name, value=f"{balances[wallet_name]:,} 円", inline=False)
+        embed.set_footer(text=f"合計資産: {sum(balances.values()):,} 円")
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    @app_commands.command(name="balance_trend", description="日ごとの残高の推移を表示するぞ。")
+    @app_commands.describe(days="さかのぼる日数（2〜90日）", wallet="【任意】財布を指定。未指定の場合は合計となる。")
+    @app_commands.choices(wallet=[
+        app_commands.Choice(name="ぬし財布", value="ぬし財布"),
+        app_commands.Choice(name="ぽて財布", value="ぽて財布"),
+        app_commands.Choice(name="探検隊予算", value="探検隊予算"),
+        app_commands.Choice(name="貯金", value="貯金"),
+    ])
+    async def balance_trend(self, interaction: discord.Interaction, days: app_commands.Range[int, 2, 90] = 30, wallet: Optional[app_commands.Choice[str]] = None):
+        user_id = interaction.user.id
+        today = datetime.now(self.jst).date()
+        first_day = today - timedelta(days=days - 1)
+        start = datetime.combine(first_day, time(0), self.jst)
+
+        # 期間の始めの残高と、期間中に残高が変わった日のその日の終わりの残高から、毎日の残高を埋める
+        balances = await self.bot.storage.balance_at(user_id, start)
+        changes: Dict[Any, list] = {}
+        # 台帳を始める前からあった財布は、記録が始まった日より前の残高がわからないので、そこから表示する
+        known_from = first_day
+        for row in await self.bot.storage.balance_history(user_id, start, datetime.now(timezone.utc)):
+            changes.setdefault(row['day'], []).append(row)
+            if row['starts'] and (wallet is None or row['wallet'] == wallet.value):
+                known_from = max(known_from, row['day'])
+        if not balances and not changes:
+            await interaction.response.send_message("この期間の残高の記録はないようだ。", ephemeral=True)
+            return
+
+        series = []
+        for offset in range(days):
+            day = first_day + timedelta(days=offset)
+            for row in changes.get(day, []):
+                balances[row['wallet']] = row['balance']
+            if day >= known_from:
+                series.append((day, balances.get(wallet.value, 0) if wallet else sum(balances.values())))
+
+        low, high = min(amount for _, amount in series), max(amount for _, amount in series)
+        bars = "▁▂▃▄▅▆▇█"
+        sparkline = "".join(bars[(amount - low) * (len(bars) - 1) // (high - low)] if high > low else bars[0] for _, amount in series)
+        lines = []
+        previous = None
+        for day, amount in series:
+            diff = f"（{amount - previous:+,}）" if previous is not None and amount != previous else ""
+            lines.append(f"`{day.strftime('%m/%d')}` {amount:,} 円{diff}")
+            previous = amount
+
+        embed = discord.Embed(title=f"📈 {wallet.value if wallet else '合計資産'} の推移（{days}日間）", color=discord.Color.blue())
+        embed.description = f"{sparkline}\n\n" + "\n".join(lines)
+        footer = f"最小 {low:,} 円 / 最大 {high:,} 円"
+        if known_from > first_day:
+            footer += f" / 残高の記録は {known_from.strftime('%m/%d')} から"
+        embed.set_footer(text=footer)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
     @app_commands.command(name="history", description="最近のお金の動きの履歴を表示するぞ。")
     @app_commands.describe(limit="表示する履歴の件数（1〜25件）")
     async def history(self, interaction: discord.Interaction, limit: app_commands.Range[int, 1, 25] = 10):
         user_id = interaction.user.id
         
-        async with self.bot.db_pool.acquire() as conn:
-            records = await conn.fetch(
-                "SELECT id, transaction_type, category, amount, created_at, source_wallet, is_balance_reflected FROM transactions WHERE user_id = $1 ORDER BY created_at DESC LIMIT $2",
-                user_id, limit
-            )
+        records = await self.bot.storage.recent_transactions(user_id, limit)
 
         if not records:
             await interaction.response.send_message("まだ取引履歴がないようだ。", ephemeral=True)
@@ -1083,56 +1573,32 @@ class FinanceCog(commands.Cog):
         user_id = interaction.user.id
 
         try:
-            async with self.bot.db_pool.acquire() as conn:
-                async with conn.transaction():
-                    # 1. 元の取引情報を取得
-                    old_tx = await conn.fetchrow("SELECT * FROM transactions WHERE id = $1 AND user_id = $2 AND transaction_type = 'spend'", transaction_id, user_id)
-
-                    if not old_tx:
-                        raise ValueError("指定されたIDの支出取引が見つからないか、権限がないぞ。")
-
-                    # 2. 新しい取引情報を準備
-                    new_amount = amount if amount is not None else old_tx['amount']
-                    if new_amount <= 0:
-                        raise ValueError("支出額は正の数値を指定しろ！")
-
-                    new_category = category.value if category is not None else old_tx['category']
-                    new_wallet = from_wallet.value if from_wallet is not None else old_tx['source_wallet']
-                    
-                    if reflect_balance is None:
-                        new_reflect_balance = old_tx['is_balance_reflected']
-                    else:
-                        new_reflect_balance = True if reflect_balance.value == 1 else False
-
-                    new_time = old_tx['created_at']
-                    if date:
-                        try:
-                            original_time = old_tx['created_at'].astimezone(self.jst).time()
-                            new_time = datetime.strptime(date, "%Y-%m-%d").replace(hour=original_time.hour, minute=original_time.minute, second=original_time.second, tzinfo=self.jst)
-                        except ValueError:
-                            raise ValueError("日付の形式が正しくないようだ。`YYYY-MM-DD`の形式で入力してくれ。")
-
-                    # 3. 残高の巻き戻し
-                    if old_tx['is_balance_reflected'] and old_tx['source_wallet']:
-                         await conn.execute("UPDATE user_balances SET balance = balance + $1 WHERE user_id = $2 AND category = $3", old_tx['amount'], user_id, old_tx['source_wallet'])
-
-                    # 4. 残高の再適用
-                    if new_reflect_balance and new_wallet:
-                        current_balance_record = await conn.fetchrow("SELECT balance FROM user_balances WHERE user_id = $1 AND category = $2", user_id, new_wallet)
-                        current_balance = current_balance_record['balance'] if current_balance_record else 0
-                        if current_balance < new_amount:
-                            raise ValueError(f"新しい支払元 {new_wallet} の残高が足りない。")
-
-                        await conn.execute("UPDATE user_balances SET balance = balance - $1 WHERE user_id = $2 AND category = $3", new_amount, user_id, new_wallet)
-
-                    # 5. 取引記録の更新
-                    await conn.execute("""
-                        UPDATE transactions
-                        SET amount = $1, category = $2, source_wallet = $3, created_at = $4, is_balance_reflected = $5
-                        WHERE id = $6
-                    """, new_amount, new_category, new_wallet, new_time, new_reflect_balance, transaction_id)
-            
-            await interaction.followup.send(f"✅ 取引ID: {transaction_id} の支出記録を修正したぞ！")
+            if amount is not None and amount <= 0:
+                raise ValueError("支出額は正の数値を指定しろ！")
+
+            spend_date = None
+            if date:
+                try:
+                    spend_date = datetime.strptime(date, "%Y-%m-%d").date()
+                except ValueError:
+                    raise ValueError("日付の形式が正しくないようだ。`YYYY-MM-DD`の形式で入力してくれ。")
+
+            try:
+                budgets = await self.bot.storage.edit_spend(
+                    user_id, transaction_id, self.jst,
+                    amount=amount,
+                    category=category.value if category is not None else None,
+                    source_wallet=from_wallet.value if from_wallet is not None else None,
+                    spend_date=spend_date,
+                    reflect_balance=reflect_balance.value == 1 if reflect_balance is not None else None,
+                )
+            except TransactionNotFoundError:
+                raise ValueError("指定されたIDの支出取引が見つからないか、権限がないぞ。")
+            except InsufficientBalanceError as e:
+                raise ValueError(f"新しい支払元 {e.wallet} の残高が足りない。")
+
+            alerts = format_budget_alerts(budgets)
+            await interaction.followup.send(f"✅ 取引ID: {transaction_id} の支出記録を修正したぞ！" + (f"\n{alerts}" if alerts else ""))
 
         except ValueError as e:
             await interaction.followup.send(f"⚠️ {e}", ephemeral=True)
@@ -1140,8 +1606,197 @@ class FinanceCog(commands.Cog):
             logger.error(f"取引修正(ID: {transaction_id})中に予期せぬエラー: {e}", exc_info=True)
             await interaction.followup.send("予期せぬエラーにより、修正に失敗した。変更は取り消された。", ephemeral=True)
 
+    @app_commands.command(name="budget", description="支出カテゴリか財布の毎月の予算を設定するぞ。0を指定すると予算を外す。")
+    @app_commands.describe(target="予算を決める支出カテゴリか財布", amount="1か月の予算（0で解除）")
+    @app_commands.choices(target=[
+        app_commands.Choice(name="食費", value="食費"),
+        app_commands.Choice(name="日用品", value="日用品"),
+        app_commands.Choice(name="交通費", value="交通費"),
+        app_commands.Choice(name="趣味", value="趣味"),
+        app_commands.Choice(name="交際費", value="交際費"),
+        app_commands.Choice(name="自己投資", value="自己投資"),
+        app_commands.Choice(name="特別な支出", value="特別な支出"),
+        app_commands.Choice(name="その他", value="その他"),
+        app_commands.Choice(name="ぽて財布", value="ぽて財布"),
+        app_commands.Choice(name="ぬし財布", value="ぬし財布"),
+        app_commands.Choice(name="探検隊予算", value="探検隊予算"),
+    ])
+    async def budget(self, interaction: discord.Interaction, target: app_commands.Choice[str], amount: int):
+        if amount < 0:
+            await interaction.response.send_message("おい隊員！予算は0以上の数値を指定しろ！", ephemeral=True)
+            return
+        await self.bot.storage.set_budget(interaction.user.id, target.value, amount or None)
+        if not amount:
+            await interaction.response.send_message(f"🗑️ {target.value} の予算を外したぞ。")
+            return
+        await interaction.response.send_message(f"📋 {target.value} の予算を毎月 {amount:,}円 に設定したぞ！使いすぎたら知らせる。")
+
+    @app_commands.command(name="recurring_spend", description="家賃やサブスクリプションなど、決まった日に繰り返す支出を登録するぞ。")
+    @app_commands.describe(
+        amount="毎回の支出額",
+        category="支出のカテゴリ",
+        schedule="`monthly:25`（毎月25日）・`weekly:mon`（毎週月曜）・cron形式 `0 9 1 * *`（いずれも日本時間）",
+        from_wallet="どの財布から支払うか（未指定なら「ぽて財布」）",
+    )
+    @app_commands.choices(
+        category=[
+            app_commands.Choice(name="食費", value="食費"),
+            app_commands.Choice(name="日用品", value="日用品"),
+            app_commands.Choice(name="交通費", value="交通費"),
+            app_commands.Choice(name="趣味", value="趣味"),
+            app_commands.Choice(name="交際費", value="交際費"),
+            app_commands.Choice(name="自己投資", value="自己投資"),
+            app_commands.Choice(name="特別な支出", value="特別な支出"),
+            app_commands.Choice(name="その他", value="その他"),
+        ],
+        from_wallet=[
+            app_commands.Choice(name="ぽて財布", value="ぽて財布"),
+            app_commands.Choice(name="ぬし財布", value="ぬし財布"),
+            app_commands.Choice(name="探検隊予算", value="探検隊予算"),
+        ]
+    )
+    async def recurring_spend(self, interaction: discord.Interaction, amount: int, category: app_commands.Choice[str], schedule: str, from_wallet: app_commands.Choice[str] = None):
+        await self._add_recurring(interaction, 'spend', amount, from_wallet.value if from_wallet else "ぽて財布", schedule, category=category.value)
+
+    @app_commands.command(name="recurring_transfer", description="貯金への積み立てなど、決まった日に繰り返す資金移動を登録するぞ。")
+    @app_commands.describe(
+        amount="毎回移動する金額",
+        from_wallet="移動元の財布",
+        to_wallet="移動先の財布",
+        schedule="`monthly:25`（毎月25日）・`weekly:mon`（毎週月曜）・cron形式 `0 9 1 * *`（いずれも日本時間）",
+    )
+    @app_commands.choices(
+        from_wallet=[
+            app_commands.Choice(name="ぽて財布", value="ぽて財布"),
+            app_commands.Choice(name="ぬし財布", value="ぬし財布"),
+            app_commands.Choice(name="探検隊予算", value="探検隊予算"),
+            app_commands.Choice(name="貯金", value="貯金"),
+        ],
+        to_wallet=[
+            app_commands.Choice(name="ぽて財布", value="ぽて財布"),
+            app_commands.Choice(name="ぬし財布", value="ぬし財布"),
+            app_commands.Choice(name="探検隊予算", value="探検隊予算"),
+            app_commands.Choice(name="貯金", value="貯金"),
+        ]
+    )
+    async def recurring_transfer(self, interaction: discord.Interaction, amount: int, from_wallet: app_commands.Choice[str], to_wallet: app_commands.Choice[str], schedule: str):
+        if from_wallet.value == to_wallet.value:
+            await interaction.response.send_message("移動元と移動先が同じだぞ！", ephemeral=True)
+            return
+        await self._add_recurring(interaction, 'transfer', amount, from_wallet.value, schedule, destination_wallet=to_wallet.value)
+
+    async def _add_recurring(self, interaction: discord.Interaction, kind: str, amount: int, source_wallet: str, schedule: str,
+                             category: Optional[str] = None, destination_wallet: Optional[str] = None):
+        if amount <= 0:
+            await interaction.response.send_message("おい隊員！金額は正の数値を指定しろ！", ephemeral=True)
+            return
+        try:
+            next_run_at = Schedule(schedule).next_after(datetime.now(self.jst))
+        except ValueError as e:
+            await interaction.response.send_message(f"⚠️ {e}\n例: `monthly:25`・`weekly:mon`・`0 9 1 * *`", ephemeral=True)
+            return
+
+        rule_id = await self.bot.storage.add_recurring_rule(interaction.user.id, kind, amount, source_wallet, schedule.strip(), next_run_at,
+                                                             category=category, destination_wallet=destination_wallet)
+        rule = {'kind': kind, 'amount': amount, 'source_wallet': source_wallet, 'category': category, 'destination_wallet': destination_wallet}
+        await interaction.response.send_message(
+            f"🔁 定期取引を登録したぞ！ `ID:{rule_id}`\n"
+            f"{describe_recurring(rule)}\n"
+            f"🗓️ 次回: {next_run_at.strftime('%Y-%m-%d %H:%M')}"
+        )
+
+    @app_commands.command(name="recurring", description="登録した定期取引の一覧を表示するぞ。")
+    async def recurring(self, interaction: discord.Interaction):
+        rules = await self.bot.storage.list_recurring_rules(interaction.user.id)
+        if not rules:
+            await interaction.response.send_message("定期取引はまだ登録されていないようだ。", ephemeral=True)
+            return
+
+        lines = []
+        for rule in rules:
+            line = f"`ID:{rule['id']}` {describe_recurring(rule)} `{rule['schedule']}` 次回 {rule['next_run_at'].astimezone(self.jst):%Y-%m-%d %H:%M}"
+            if rule['last_error']:
+                line += f"\n　⚠️ {rule['last_error']}"
+            lines.append(line)
+        embed = discord.Embed(title="🔁 定期取引", description="\n".join(lines), color=discord.Color.blue())
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    @app_commands.command(name="recurring_delete", description="定期取引の登録を削除するぞ。")
+    @app_commands.describe(rule_id="削除する定期取引のID (`/recurring`で確認しろ)")
+    async def recurring_delete(self, interaction: discord.Interaction, rule_id: int):
+        if not await self.bot.storage.delete_recurring_rule(interaction.user.id, rule_id):
+            await interaction.response.send_message("指定されたIDの定期取引が見つからないか、権限がないぞ。", ephemeral=True)
+            return
+        await interaction.response.send_message(f"🗑️ 定期取引 `ID:{rule_id}` を削除したぞ。")
+
+    @app_commands.command(name="budgets", description="今月の予算と使用額を表示するぞ。")
+    async def budgets(self, interaction: discord.Interaction):
+        month = budget_month(datetime.now(self.jst))
+        rows = await self.bot.storage.budget_status(interaction.user.id, month)
+        if not rows:
+            await interaction.response.send_message("予算はまだ設定されていないようだ。`/budget` で設定しろ。", ephemeral=True)
+            return
+
+        embed = discord.Embed(title=f"📋 {int(month[5:])}月の予算", color=discord.Color.blue())
+        for row in rows:
+            spent, limit = row['spent'], row['amount']
+            percent = spent * 100 // limit
+            filled = min(10, percent // 10)
+            status = "🚨" if spent > limit else "⚠️" if percent >= min(Config.BUDGET_ALERT_THRESHOLDS, default=100) else "✅"
+            embed.add_field(
+                name=f"{status} {row['category']}",
+                value=f"`{'█' * filled}{'░' * (10 - filled)}` {spent:,} / {limit:,} 円 ({percent}%)",
+                inline=False,
+            )
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    @tasks.loop(minutes=15)
+    async def recurring_transactions(self):
+        # 記録は回ごとに一度きりなので、複数のプロセスが同時に実行しても二重には記録されない
+        try:
+            runs = await self.bot.storage.apply_due_recurring(datetime.now(timezone.utc))
+        except Exception as e:
+            logger.error(f"定期取引の記録中にエラーが発生: {e}", exc_info=True)
+            return
+        if not runs:
+            return
+        logger.info(f"定期取引を{sum(run.error is None for run in runs)}件記録した。（失敗 {sum(run.error is not None for run in runs)}件）")
+
+        channel_id = self.bot.target_channel_ids[0]
+        channel = self.bot.get_channel(channel_id)
+        if not channel:
+            return logger.error(f"定期取引の通知用のチャンネル {channel_id} が見つからん！")
+        runs_by_user: Dict[int, List[RecurringRun]] = {}
+        for run in runs:
+            runs_by_user.setdefault(run.rule['user_id'], []).append(run)
+        for user_id, user_runs in runs_by_user.items():
+            lines = []
+            for run in user_runs:
+                if run.error is not None:
+                    lines.append(f"⚠️ `ID:{run.rule['id']}` {describe_recurring(run.rule)} は {run.error.wallet} の残高不足で記録できなかったぞ。(現在: {run.error.balance:,}円) 足りるようになったら記録する。")
+                    continue
+                lines.append(f"`{run.due_at.astimezone(self.jst):%m/%d}` {describe_recurring(run.rule)}")
+                alerts = format_budget_alerts(run.budgets)
+                if alerts:
+                    lines.append(alerts)
+            if len(lines) > 20:
+                lines = lines[:20] + [f"...他{len(lines) - 20}件"]
+            self.bot.outbound.send(channel, f"<@{user_id}> 🔁 定期取引を記録したぞ！\n" + "\n".join(lines), lane=NORMAL)
+
+    @tasks.loop(time=time(0, 5, tzinfo=timezone(timedelta(hours=9))))
+    async def balance_snapshot(self):
+        # 過去の残高は直近のスナップショットから台帳を足して求めるので、毎日取って足す量を1日分に抑える
+        await self._run_job('balance_snapshot', datetime.now(self.jst).date().isoformat(), self._take_balance_snapshots)
+
+    async def _take_balance_snapshots(self):
+        count = await self.bot.storage.take_balance_snapshots()
+        logger.info(f"残高のスナップショットを{count}件記録した。")
+
     @tasks.loop(time=time(12, 0, tzinfo=timezone(timedelta(hours=9))))
     async def daily_balance_report(self):
+        await self._run_job('daily_balance_report', datetime.now(self.jst).date().isoformat(), self._send_daily_balance_report)
+
+    async def _send_daily_balance_report(self):
         logger.info("正午の残高レポートタスクを開始する。")
         
         try:
@@ -1154,57 +1809,360 @@ class FinanceCog(commands.Cog):
             logger.error("残高レポート用のチャンネルIDが設定されていない！")
             return
 
-        async with self.bot.db_pool.acquire() as conn:
-            user_records = await conn.fetch("SELECT DISTINCT user_id FROM user_balances")
-            
-            if not user_records:
-                logger.info("残高レポート対象のユーザーが見つからなかった。")
-                return
+        user_ids = await self.bot.storage.get_balance_user_ids()
 
-            for record in user_records:
-                user_id = record['user_id']
-                
-                try:
-                    user = await self.bot.fetch_user(user_id)
-                except discord.NotFound:
-                    logger.warning(f"ユーザーID {user_id} が見つからなかったため、残高レポートをスキップする。")
-                    continue
+        if not user_ids:
+            logger.info("残高レポート対象のユーザーが見つからなかった。")
+            return
 
-                balance_records = await conn.fetch("SELECT category, balance FROM user_balances WHERE user_id = $1 ORDER BY category", user_id)
+        deliveries = []
+        for user_id in user_ids:
+            try:
+                user = await self.bot.fetch_user(user_id)
+            except discord.NotFound:
+                logger.warning(f"ユーザーID {user_id} が見つからなかったため、残高レポートをスキップする。")
+                continue
 
-                if not balance_records:
-                    continue
+            balances = await self.bot.storage.get_balances(user_id)
 
-                embed = discord.Embed(
-                    title=f"正午の財産状況レポートだ！",
-                    color=discord.Color.blue(),
-                    timestamp=datetime.now(self.jst)
-                )
+            if not balances:
+                continue
 
-                total_balance = 0
-                wallet_order = ["ぬし財布", "ぽて財布", "探検隊予算", "貯金"]
-                balances = {r['category']: r['balance'] for r in balance_records}
-                
-                for wallet_name in wallet_order:
-                    if wallet_name in balances:
-                        balance = balances[wallet_name]
-                        embed.add_field(name=wallet_name, value=f"{balance:,} 円", inline=False)
-                        total_balance += balance
-                
-                other_wallets = {k: v for k, v in balances.items() if k not in wallet_order}
-                for wallet_name, balance in other_wallets.items():
+            embed = discord.Embed(
+                title="正午の財産状況レポートだ！",
+                color=discord.Color.blue(),
+                timestamp=datetime.now(self.jst)
+            )
+
+            total_balance = 0
+            wallet_order = ["ぬし財布", "ぽて財布", "探検隊予算", "貯金"]
+            
+            for wallet_name in wallet_order:
+                if wallet_name in balances:
+                    balance = balances[wallet_name]
                     embed.add_field(name=wallet_name, value=f"{balance:,} 円", inline=False)
                     total_balance += balance
+            
+            other_wallets = {k: v for k, v in balances.items() if k not in wallet_order}
+            for wallet_name, balance in other_wallets.items():
+                embed.add_field(name=wallet_name, value=f"{balance:,} 円", inline=False)
+                total_balance += balance
 
-                embed.set_footer(text=f"合計資産: {total_balance:,} 円")
-                
-                try:
-                    await user.send(embed=embed)
-                    logger.info(f"ユーザー {user.display_name} ({user_id}) に残高レポートをDMで送信した。")
-                except discord.Forbidden:
-                    logger.warning(f"ユーザー {user.display_name} ({user_id}) へのDM送信に失敗。チャンネルに投稿する。")
-                    await channel.send(content=f"<@{user_id}>、DMが送れなかったため、ここに正午の財産状況を報告する！", embed=embed)
-                except Exception as e:
-                    logger.error(f"ユーザー {user.display_name} ({user_id}) への残高レポート送信中に予期せぬエラーが発生: {e}")
+            embed.set_footer(text=f"合計資産: {total_balance:,} 円")
+            
+            # DMが送れなければ送信キューが同じEmbedをチャンネルに投稿する
+            deliveries.append(self.bot.outbound.send(user, embed=embed, lane=NORMAL,
+                                                     fallback=(channel, f"<@{user_id}>、DMが送れなかったため、ここに正午の財産状況を報告する！")))
+            logger.info(f"ユーザー {user.display_name} ({user_id}) への残高レポートを送信キューに積んだ。")
 
+        # ジョブを完了にするのはレポートが届いてから
+        await self._await_deliveries(deliveries, "残高レポート")
         logger.info("正午の残高レポートタスクを完了した。")
+
+    async def _await_deliveries(self, deliveries: list, label: str):
+        """送信キューに積んだ送信が終わるまで待ち、届かなかった件数を記録する"""
+        if not deliveries:
+            return
+        results = await asyncio.gather(*deliveries)
+        failed = results.count(False)
+        if failed:
+            logger.warning(f"{label} {len(results)}件のうち {failed}件を送れなかった。")
+
+
+def format_duration(seconds: int) -> str:
+    hours, minutes = divmod(round(seconds / 60), 60)
+    return f"{hours}時間{minutes:02d}分" if hours else f"{minutes}分"
+
+
+class ActivityCog(commands.Cog):
+    """なう/わずの記録から活動時間を集計するコマンド"""
+    def __init__(self, bot: SoraBot):
+        self.bot = bot
+        self.jst = timezone(timedelta(hours=9))
+
+    @property
+    def max_gap(self) -> timedelta:
+        return timedelta(minutes=Config.ACTIVITY_MAX_GAP_MIN)
+
+    def _parse_day(self, text: Optional[str]):
+        if not text:
+            return datetime.now(self.jst).date()
+        return datetime.strptime(text, "%Y-%m-%d").date()
+
+    @app_commands.command(name="timeline", description="1日の活動を時系列で表示するぞ。")
+    @app_commands.describe(date="【任意】日付をYYYY-MM-DD形式で指定。未指定の場合は本日となる。")
+    async def timeline(self, interaction: discord.Interaction, date: Optional[str] = None):
+        try:
+            day = self._parse_day(date)
+        except ValueError:
+            await interaction.response.send_message("日付の形式が正しくないようだ。`YYYY-MM-DD`の形式で入力してくれ。", ephemeral=True)
+            return
+
+        start = datetime.combine(day, time(0), self.jst)
+        rows = await self.bot.storage.activity_timeline(interaction.user.id, start, start + timedelta(days=1), self.max_gap, datetime.now(timezone.utc))
+        embed = discord.Embed(title=f"🕒 {day.strftime('%Y/%m/%d')} のタイムライン", color=discord.Color.blue())
+        if not rows:
+            embed.description = "この日の活動記録はないようだ。"
+        else:
+            lines = [f"`{row['activity_time'].astimezone(self.jst).strftime('%H:%M')}` {row['content']}（{format_duration(row['seconds'])}）" for row in rows]
+            description = "\n".join(lines)
+            if len(description) > 4000:
+                description = description[:4000] + "\n..."
+            embed.description = description
+            embed.set_footer(text=f"合計 {format_duration(sum(row['seconds'] for row in rows))} / {len(rows)}件")
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    @app_commands.command(name="activity_report", description="活動ごとの合計時間を表示するぞ。")
+    @app_commands.describe(period="集計する期間", date="【任意】期間に含まれる日付をYYYY-MM-DD形式で指定。未指定の場合は本日となる。")
+    @app_commands.choices(period=[
+        app_commands.Choice(name="日", value="day"),
+        app_commands.Choice(name="週", value="week"),
+        app_commands.Choice(name="月", value="month"),
+    ])
+    async def activity_report(self, interaction: discord.Interaction, period: app_commands.Choice[str], date: Optional[str] = None):
+        try:
+            day = self._parse_day(date)
+        except ValueError:
+            await interaction.response.send_message("日付の形式が正しくないようだ。`YYYY-MM-DD`の形式で入力してくれ。", ephemeral=True)
+            return
+
+        if period.value == "week":
+            start_day = day - timedelta(days=day.weekday())
+            end_day = start_day + timedelta(days=7)
+            title = f"{start_day.strftime('%m/%d')}〜{(end_day - timedelta(days=1)).strftime('%m/%d')} の活動"
+        elif period.value == "month":
+            start_day = day.replace(day=1)
+            end_day = (start_day + timedelta(days=32)).replace(day=1)
+            title = f"{start_day.strftime('%Y年%m月')} の活動"
+        else:
+            start_day, end_day = day, day + timedelta(days=1)
+            title = f"{day.strftime('%Y/%m/%d')} の活動"
+
+        rows = await self.bot.storage.activity_totals(interaction.user.id, start_day, end_day, self.max_gap, datetime.now(timezone.utc))
+        embed = discord.Embed(title=f"📊 {title}", color=discord.Color.blue())
+        if not rows:
+            embed.description = "この期間の活動記録はないようだ。"
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+            return
+
+        by_content: Dict[str, List[int]] = {}
+        by_day: Dict[Any, int] = {}
+        for row in rows:
+            totals = by_content.setdefault(row['content'], [0, 0])
+            totals[0] += row['seconds']
+            totals[1] += row['entries']
+            by_day[row['day']] = by_day.get(row['day'], 0) + row['seconds']
+
+        ranking = sorted(by_content.items(), key=lambda item: item[1][0], reverse=True)
+        lines = [f"**{content}** {format_duration(seconds)}（{entries}回）" for content, (seconds, entries) in ranking[:20]]
+        if len(ranking) > 20:
+            lines.append(f"ほか {len(ranking) - 20} 件")
+        embed.add_field(name="活動別", value="\n".join(lines)[:1024], inline=False)
+        if period.value != "day":
+            daily = [f"`{d.strftime('%m/%d')}` {format_duration(seconds)}" for d, seconds in sorted(by_day.items())]
+            embed.add_field(name="日別", value="\n".join(daily)[:1024], inline=False)
+        embed.set_footer(text=f"合計 {format_duration(sum(by_day.values()))}")
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
+class SummaryCog(commands.Cog):
+    """複数のメンバーのメッセージをまとめて表示するコマンド"""
+    def __init__(self, bot: SoraBot):
+        self.bot = bot
+
+    @app_commands.command(name="summary", description="指定したメンバーの期間中のメッセージをまとめて表示するぞ。")
+    @app_commands.describe(
+        users="まとめるメンバーをメンションで並べる（例: @a @b @c）",
+        start="【任意】開始日をYYYY-MM-DD形式で指定。未指定の場合は本日となる。",
+        end="【任意】終了日をYYYY-MM-DD形式で指定。未指定の場合は開始日と同じ日となる。",
+    )
+    async def summary(self, interaction: discord.Interaction, users: str, start: Optional[str] = None, end: Optional[str] = None):
+        user_ids = list(dict.fromkeys(int(user_id) for user_id in USER_MENTION_PATTERN.findall(users)))
+        if not user_ids:
+            await interaction.response.send_message("まとめるメンバーをメンションで指定してくれ。", ephemeral=True)
+            return
+        if len(user_ids) > SUMMARY_MAX_USERS:
+            await interaction.response.send_message(f"一度にまとめられるのは{SUMMARY_MAX_USERS}人までだ。", ephemeral=True)
+            return
+        try:
+            first_day = datetime.strptime(start, "%Y-%m-%d").date() if start else datetime.now(JST).date()
+            last_day = datetime.strptime(end, "%Y-%m-%d").date() if end else first_day
+        except ValueError:
+            await interaction.response.send_message("日付の形式が正しくないようだ。`YYYY-MM-DD`の形式で入力してくれ。", ephemeral=True)
+            return
+        if not 0 <= (last_day - first_day).days < SUMMARY_MAX_DAYS:
+            await interaction.response.send_message(f"期間は開始日から{SUMMARY_MAX_DAYS}日以内で指定してくれ。", ephemeral=True)
+            return
+
+        await interaction.response.defer()
+        names = await self.bot.resolve_display_names(user_ids, interaction.guild)
+        pages = await self.bot.build_user_summaries(
+            names, datetime.combine(first_day, time(0), JST), datetime.combine(last_day + timedelta(days=1), time(0), JST))
+        period = first_day.strftime('%Y/%m/%d') + (f"〜{last_day.strftime('%Y/%m/%d')}" if last_day != first_day else "")
+        if not pages:
+            await interaction.followup.send(f"{period} のメッセージは見つからなかったぞ。")
+            return
+        for index, page in enumerate(pages):
+            await interaction.followup.send(f"📝 {period} のまとめ（{len(names)}人）" if index == 0 else None, embeds=page)
+
+
+class AdminCog(commands.Cog):
+    """隊長(OWNER_ID)専用の運用コマンド"""
+    def __init__(self, bot: SoraBot):
+        self.bot = bot
+
+    async def _ensure_owner(self, interaction: discord.Interaction) -> bool:
+        if Config.OWNER_ID and interaction.user.id == Config.OWNER_ID:
+            return True
+        await interaction.response.send_message("このコマンドは隊長専用だ！", ephemeral=True)
+        return False
+
+    @app_commands.command(name="slow_queries", description="【隊長専用】実行時間の長いSQLの上位を表示するぞ。")
+    @app_commands.describe(limit="表示する件数（1〜20件）", reset="表示後に統計をリセットするか")
+    async def slow_queries(self, interaction: discord.Interaction, limit: app_commands.Range[int, 1, 20] = 10, reset: bool = False):
+        if not await self._ensure_owner(interaction):
+            return
+
+        stats = self.bot.query_stats
+        top = stats.top(limit)
+        embed = discord.Embed(
+            title="🐢 スロークエリ上位",
+            description=f"総実行数: {stats.total_calls:,}件 / 合計: {stats.total_time * 1000:,.0f}ms / 閾値: {stats.threshold * 1000:.0f}ms",
+            color=discord.Color.orange(),
+            timestamp=datetime.now(timezone(timedelta(hours=9)))
+        )
+        for stat in top:
+            query = stat.query if len(stat.query) <= 300 else stat.query[:300] + "..."
+            value = f"```sql\n{query}\n```max {stat.max * 1000:.1f}ms / avg {stat.mean * 1000:.1f}ms / {stat.count}回"
+            if stat.last_shapes:
+                value += f"\n引数: ({stat.last_shapes})"
+            embed.add_field(name=f"[{stat.handler}]", value=value[:1024], inline=False)
+        if not top:
+            embed.description += "\n\nまだ記録がないようだ。"
+
+        if reset:
+            stats.reset()
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    @app_commands.command(name="reload_config", description="【隊長専用】再起動せずに設定ファイルを読み直すぞ。")
+    async def reload_config(self, interaction: discord.Interaction):
+        if not await self._ensure_owner(interaction):
+            return
+
+        try:
+            changed = self.bot.reload_config()
+        except ValueError as e:
+            await interaction.response.send_message(f"新しい設定に問題があるため、今の設定のままにしたぞ。\n```{e}```", ephemeral=True)
+            return
+
+        embed = discord.Embed(title="🔄 設定を再読み込みしたぞ", color=discord.Color.green(), timestamp=datetime.now(timezone(timedelta(hours=9))))
+        for name, (old, new) in changed.items():
+            embed.add_field(name=name, value=f"`{old}` → `{new}`"[:1024], inline=False)
+        if not changed:
+            embed.description = "変わった設定はなかったようだ。"
+        if Config.SHARD_IDS is not None:
+            embed.set_footer(text="このプロセスだけに反映した。全プロセスに反映するにはスーパーバイザーに SIGHUP を送ってくれ。")
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    @app_commands.command(name="profiling", description="【隊長専用】イベントループのプロファイリングを切り替えるぞ。")
+    @app_commands.describe(mode="切り替えるプロファイリング", enabled="有効にするか")
+    @app_commands.choices(mode=[
+        app_commands.Choice(name="遅いコールバックの警告 (asyncio debug)", value="asyncio_debug"),
+        app_commands.Choice(name="スタックのサンプリング", value="sampler"),
+        app_commands.Choice(name="ハンドラの所要時間", value="handlers"),
+    ])
+    async def profiling(self, interaction: discord.Interaction, mode: app_commands.Choice[str], enabled: bool):
+        if not await self._ensure_owner(interaction):
+            return
+
+        self.bot.set_profiling(mode.value, enabled)
+        await interaction.response.send_message(embed=self._profiling_embed(), ephemeral=True)
+
+    @app_commands.command(name="profiling_report", description="【隊長専用】プロファイリングの結果を表示するぞ。")
+    @app_commands.describe(limit="表示する件数（1〜20件）")
+    async def profiling_report(self, interaction: discord.Interaction, limit: app_commands.Range[int, 1, 20] = 10):
+        if not await self._ensure_owner(interaction):
+            return
+
+        embed = self._profiling_embed()
+        profiler = self.bot.profiler
+        if profiler.handler_timing_enabled:
+            lines = [f"`{name}` {count}回 / 合計 {total * 1000:,.0f}ms / max {peak * 1000:,.1f}ms"
+                     for name, count, total, peak in profiler.handler_timings.top(limit)]
+            embed.add_field(name="ハンドラ別の実時間", value="\n".join(lines)[:1024] or "まだ記録がないようだ。", inline=False)
+        if profiler.sampler is not None:
+            samples = profiler.sampler.samples or 1
+            lines = [f"{count * 100 / samples:5.1f}% `{frame}`" for frame, count in profiler.sampler.top_frames(limit)]
+            embed.add_field(name=f"サンプリング上位 ({profiler.sampler.samples}サンプル)", value="\n".join(lines)[:1024] or "まだ採取していないようだ。", inline=False)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    def _profiling_embed(self) -> discord.Embed:
+        profiler = self.bot.profiler
+        def status(enabled: bool) -> str:
+            return "🟢 有効" if enabled else "⚪ 無効"
+        embed = discord.Embed(title="🔬 プロファイリング", color=discord.Color.dark_teal(), timestamp=datetime.now(timezone(timedelta(hours=9))))
+        embed.add_field(name="遅いコールバックの警告", value=f"{status(profiler.asyncio_debug)}（{profiler.slow_callback_ms:.0f}ms以上）", inline=False)
+        sampler = profiler.sampler
+        embed.add_field(name="スタックのサンプリング", value=f"{status(sampler is not None)}" + (f"\n`{sampler.output_path}`" if sampler else ""), inline=False)
+        embed.add_field(name="ハンドラの所要時間", value=status(profiler.handler_timing_enabled), inline=False)
+        return embed
+
+    @app_commands.command(name="queues", description="【隊長専用】メッセージ処理と送信キューの混み具合を表示するぞ。")
+    async def queues(self, interaction: discord.Interaction):
+        if not await self._ensure_owner(interaction):
+            return
+
+        dispatcher = self.bot.dispatcher.stats()
+        outbound = self.bot.outbound.stats()
+        embed = discord.Embed(title="📬 キューの状況", color=discord.Color.teal(), timestamp=datetime.now(timezone(timedelta(hours=9))))
+        embed.add_field(
+            name="メッセージ処理",
+            value=(f"待ち {dispatcher['pending']} / 実行中 {dispatcher['in_flight']} / ユーザー {dispatcher['users']}\n"
+                   f"低優先度待ち {dispatcher['low_pending']} / 省略 {dispatcher['shed']} / 破棄 {dispatcher['rejected'] + dispatcher['dropped']}"),
+            inline=False,
+        )
+        for name, lane in outbound['lanes'].items():
+            embed.add_field(
+                name=f"送信 ({name})",
+                value=f"待ち {lane['depth']} / 待ち時間 avg {lane['wait_avg_ms']}ms・p95 {lane['wait_p95_ms']}ms・max {lane['wait_max_ms']}ms",
+                inline=False,
+            )
+        embed.add_field(name="スプール", value=f"未再生 {self.bot.spool.pending} / DB {self.bot.db_breaker.state}", inline=False)
+        embed.set_footer(text=f"送信 {outbound['sent']} / まとめ {outbound['merged']} / 失敗 {outbound['failed']} / 破棄 {outbound['dropped']}")
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    @app_commands.command(name="jobs", description="【隊長専用】定期タスクの実行記録を表示するぞ。")
+    @app_commands.describe(limit="表示する件数（1〜25件）")
+    async def jobs(self, interaction: discord.Interaction, limit: app_commands.Range[int, 1, 25] = 10):
+        if not await self._ensure_owner(interaction):
+            return
+
+        jst = timezone(timedelta(hours=9))
+        icons = {'done': '✅', 'running': '⏳', 'failed': '❌'}
+        runs = await self.bot.storage.recent_job_runs(limit)
+        lines = []
+        for run in runs:
+            finished = f" → {run['finished_at'].astimezone(jst):%m/%d %H:%M}" if run['finished_at'] else ""
+            lines.append(f"{icons.get(run['status'], '❔')} `{run['job']}` {run['period']} / {run['started_at'].astimezone(jst):%m/%d %H:%M}{finished}"
+                         f" / {run['attempts']}回目 / `{run['owner']}`")
+        embed = discord.Embed(title="🗓️ 定期タスクの実行記録", description="\n".join(lines)[:4096] or "まだ記録がないようだ。",
+                              color=discord.Color.dark_green(), timestamp=datetime.now(jst))
+        embed.set_footer(text=f"このプロセス: {self.bot.jobs.owner}")
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    @app_commands.command(name="memory", description="【隊長専用】メモリ使用量とキャッシュの内訳を表示するぞ。")
+    async def memory(self, interaction: discord.Interaction):
+        if not await self._ensure_owner(interaction):
+            return
+
+        breakdown = self.bot.memory_breakdown()
+        rss = f"{breakdown['rss_mb']:.1f}MB" if breakdown['rss_mb'] is not None else "不明"
+        embed = discord.Embed(
+            title="🧠 メモリ内訳",
+            description=f"RSS: {rss} / プロファイル: {Config.MEMORY_PROFILE}",
+            color=discord.Color.blue(),
+            timestamp=datetime.now(timezone(timedelta(hours=9)))
+        )
+        embed.add_field(name="ゲートウェイ", value=f"ギルド {breakdown['guilds']:,} / チャンネル {breakdown['channels']:,}\nメンバー {breakdown['members']:,} / ユーザー {breakdown['users']:,}\nメッセージ {breakdown['messages']:,}", inline=False)
+        embed.add_field(name="Bot", value=f"会話状態 {breakdown['dialog_states']:,} / 残高チェックのキャッシュ {breakdown['check_state_cache']:,} / クエリ統計 {breakdown['query_stats']:,}", inline=False)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -0,0 +1,173 @@
+"""
+ユーザー単位で順序を保つイベントディスパッチャー
+
+discord.py はイベントごとにタスクを作るため、同じユーザーの連続したメッセージが
+並行して走り、残高チェックや会話状態の更新が入れ替わることがある。
+ここではユーザーごとのキューで順番に処理し、全体の同時実行数はセマフォで抑える。
+メッセージの記録やリアクションのような優先度の低い処理は別レーンに回し、
+混雑時は後回し（記録）または破棄（リアクション）する。記録は低優先度レーンが
+上限に達しても捨てず、上限で古い方から捨てるのは破棄してよい処理だけにする。
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Job = Tuple[Callable[..., Awaitable[Any]], tuple, asyncio.Future]
+
+
+class UserDispatcher:
+    def __init__(self, max_concurrency: int, user_queue_limit: int, shed_threshold: int, low_queue_limit: int):
+        self.max_concurrency = max_concurrency
+        self.user_queue_limit = user_queue_limit
+        self.shed_threshold = shed_threshold
+        self.low_queue_limit = low_queue_limit
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._queues: Dict[int, Deque[Job]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._low_queue: Deque[Tuple[Callable[..., Awaitable[Any]], tuple, bool]] = deque()
+        self._low_worker: Optional[asyncio.Task] = None
+        self._low_running = False
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.pending = 0 # 待ち＋実行中の通常ジョブ数
+        self.in_flight = 0
+        self.rejected = 0
+        self.shed = 0
+        self.dropped = 0
+        self.timings = None # HandlerTimings を設定するとハンドラごとの実時間を集計する
+
+    @property
+    def busy(self) -> bool:
+        return self.pending >= self.shed_threshold
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": self.pending,
+            "in_flight": self.in_flight,
+            "users": len(self._queues),
+            "low_pending": len(self._low_queue),
+            "rejected": self.rejected,
+            "shed": self.shed,
+            "dropped": self.dropped,
+        }
+
+    def submit(self, key: int, handler: Callable[..., Awaitable[Any]], *args) -> asyncio.Future:
+        """key（ユーザーID）ごとに投入順で handler(*args) を実行する。完了すると返り値の Future が解決する"""
+        future = asyncio.get_running_loop().create_future()
+        # 捨てるときに空のキューを残すと、ワーカーのいないキューが残って drain が終わらない
+        if len(self._queues.get(key, ())) >= self.user_queue_limit:
+            self.rejected += 1
+            logger.warning(f"ユーザー {key} の処理待ちが上限({self.user_queue_limit}件)に達したため破棄しました")
+            future.set_result(None)
+            return future
+
+        self._queues.setdefault(key, deque()).append((handler, args, future))
+        self.pending += 1
+        self._idle.clear()
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._drain_user(key))
+        return future
+
+    def admit_sheddable(self) -> bool:
+        """混雑時に省いてよい処理を今行うか。省く場合は件数を数えて False を返す"""
+        if self.busy:
+            self.shed += 1
+            return False
+        return True
+
+    def submit_low(self, handler: Callable[..., Awaitable[Any]], *args, sheddable: bool = False):
+        """優先度の低い処理を投入する。sheddable なら混雑時は実行せずに捨てる
+
+        キューが上限に達したときは、sheddable の処理を古い方から捨てる。sheddable でない処理（メッセージの記録など）は上限を超えても捨てない。
+        """
+        if sheddable and not self.admit_sheddable():
+            return
+        if len(self._low_queue) >= self.low_queue_limit and not self._make_room(sheddable):
+            return
+        self._low_queue.append((handler, args, sheddable))
+        self._idle.clear()
+        if self._low_worker is None or self._low_worker.done():
+            self._low_worker = asyncio.create_task(self._drain_low())
+
+    def _make_room(self, incoming_sheddable: bool) -> bool:
+        """上限に達したキューに投入してよいかを返す。古い sheddable の処理があれば1件捨てて空ける"""
+        for index, (_, _, sheddable) in enumerate(self._low_queue):
+            if sheddable:
+                del self._low_queue[index]
+                admitted = True
+                break
+        else:
+            if not incoming_sheddable:
+                # 捨ててよい処理がないので、上限を超えて積む
+                return True
+            admitted = False
+        self.dropped += 1
+        if self.dropped % 100 == 1:
+            logger.warning(f"低優先度キューが上限({self.low_queue_limit}件)に達したため破棄してよい処理を捨てています（累計{self.dropped}件）")
+        return admitted
+
+    async def _run(self, handler, args):
+        async with self._semaphore:
+            self.in_flight += 1
+            started = time.perf_counter()
+            try:
+                return await handler(*args)
+            except Exception:
+                logger.error(f"{getattr(handler, '__name__', handler)} の処理中にエラーが発生しました", exc_info=True)
+            finally:
+                self.in_flight -= 1
+                if self.timings is not None:
+                    self.timings.record(getattr(handler, '__name__', str(handler)), time.perf_counter() - started)
+
+    async def _drain_user(self, key: int):
+        queue = self._queues[key]
+        try:
+            while queue:
+                handler, args, future = queue[0]
+                try:
+                    result = await self._run(handler, args)
+                finally:
+                    queue.popleft()
+                    self.pending -= 1
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            del self._queues[key]
+            del self._workers[key]
+            self._check_idle()
+
+    async def _drain_low(self):
+        self._low_running = True
+        try:
+            while self._low_queue:
+                # 通常の処理が詰まっている間は後回しにする
+                while self.pending >= self.max_concurrency:
+                    await asyncio.sleep(0.05)
+                handler, args, _ = self._low_queue.popleft()
+                await self._run(handler, args)
+        finally:
+            self._low_running = False
+            self._check_idle()
+
+    def _check_idle(self):
+        if not self._queues and not self._low_queue and not self._low_running:
+            self._idle.set()
+
+    async def drain(self):
+        """投入済みの処理がすべて終わるまで待つ"""
+        await self._idle.wait()
+
+    async def close(self, timeout: float = 10.0):
+        """残った処理を最大 timeout 秒待ってから打ち切る"""
+        try:
+            await asyncio.wait_for(self.drain(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"終了時に未処理のイベントが残っていました: {self.stats()}")
+            for task in [*self._workers.values(), self._low_worker]:
+                if task is not None:
+                    task.cancel()
@@ -0,0 +1,121 @@
+"""
+ヘルスチェック用のHTTPサーバー
+
+ボットと同じイベントループで動かし、次の2つを返す。
+
+- /healthz: イベントループが詰まっていないか。一定間隔のタイマーが遅れて起きた時間(ドリフト)で測る。
+  ループが完全に止まっていればこのサーバー自体が応答しないので、監視側はタイムアウトで検知できる。
+- /readyz: ゲートウェイに接続済みで、ストレージの接続とスキーマの初期化が終わっているか。
+
+どちらもゲートウェイのレイテンシとDBプールの状態をJSONで返す。
+"""
+
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class LoopMonitor:
+    """interval 秒ごとに眠り、予定より遅れて起きた時間を記録する"""
+
+    def __init__(self, interval: float = 0.5, window: int = 20):
+        self.interval = interval
+        self.drifts: Deque[float] = deque(maxlen=window)
+        self.last_tick = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.last_tick = time.monotonic()
+            self.drifts.append(max(0.0, self.last_tick - started - self.interval))
+
+    def stats(self) -> Dict[str, Any]:
+        drifts = self.drifts or [0.0]
+        return {
+            "drift_ms": round(drifts[-1] * 1000, 1),
+            "drift_max_ms": round(max(drifts) * 1000, 1),
+            "since_last_tick_ms": round((time.monotonic() - self.last_tick) * 1000, 1),
+        }
+
+
+def _latency_ms(latency: float) -> Optional[float]:
+    # 未接続のシャードは inf / nan になり、JSONにできない
+    return round(latency * 1000, 1) if math.isfinite(latency) else None
+
+
+class HealthServer:
+    def __init__(self, bot, host: str, port: int, max_drift_ms: float):
+        self.bot = bot
+        self.host = host
+        self.port = port
+        self.max_drift_ms = max_drift_ms
+        self.monitor = LoopMonitor()
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/healthz', self.healthz)
+        app.router.add_get('/readyz', self.readyz)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.monitor.start()
+        logger.info(f"ヘルスチェックを http://{self.host}:{self.port}/healthz で待ち受けます")
+
+    async def stop(self):
+        self.monitor.stop()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _gateway_stats(self) -> Dict[str, Any]:
+        return {
+            "ready": self.bot.is_ready(),
+            "closed": self.bot.is_closed(),
+            "latency_ms": _latency_ms(self.bot.latency),
+            "shards": {str(shard_id): _latency_ms(latency) for shard_id, latency in self.bot.latencies},
+        }
+
+    def _storage_stats(self) -> Dict[str, Any]:
+        storage = self.bot.storage
+        return {
+            "backend": storage.backend,
+            "ready": storage.is_ready,
+            "pool": storage.pool_stats(),
+            "breaker": self.bot.db_breaker.state,
+            "spool_pending": self.bot.spool.pending,
+        }
+
+    def _body(self, ok: bool) -> Dict[str, Any]:
+        return {
+            "status": "ok" if ok else "unavailable",
+            "loop": self.monitor.stats(),
+            "gateway": self._gateway_stats(),
+            "storage": self._storage_stats(),
+        }
+
+    async def healthz(self, request: web.Request) -> web.Response:
+        ok = self.monitor.stats()["drift_max_ms"] < self.max_drift_ms
+        return web.json_response(self._body(ok), status=200 if ok else 503)
+
+    async def readyz(self, request: web.Request) -> web.Response:
+        ok = self.bot.is_ready() and not self.bot.is_closed() and self.bot.storage.is_ready
+        return web.json_response(self._body(ok), status=200 if ok else 503)
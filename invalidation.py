@@ -0,0 +1,76 @@
+"""
+プロセス内キャッシュの無効化
+
+ストレージはテーブルの変更を ChangeFeed に流す。自プロセスの書き込みはその場で、
+PostgreSQL では他のプロセスや外部スクリプトの書き込みも LISTEN/NOTIFY 経由で届く。
+KeyedCache はこれを購読し、変更されたキーを捨てる。
+"""
+
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from db_trace import register_passthrough_module
+
+# スロークエリのハンドラ名はキャッシュではなく呼び出し元から取る
+register_passthrough_module(__file__)
+
+Handler = Callable[[Optional[int]], None]
+
+
+class ChangeFeed:
+    """テーブルごとの変更通知を購読者に配る。キーが None の通知は「すべて変わったかもしれない」を表す"""
+
+    def __init__(self, reliable: bool = True):
+        # 他プロセスの変更も取りこぼさず届いている間だけ True。False の間はキャッシュを使わない
+        self.reliable = reliable
+        self._handlers: Dict[str, List[Handler]] = {}
+
+    def subscribe(self, table: str, handler: Handler):
+        self._handlers.setdefault(table, []).append(handler)
+
+    def publish(self, table: str, key: Optional[int]):
+        for handler in self._handlers.get(table, ()):
+            handler(key)
+
+    def reset(self):
+        """通知を取りこぼした可能性があるときに、すべての購読者に全件の破棄を伝えて再開する"""
+        for handlers in self._handlers.values():
+            for handler in handlers:
+                handler(None)
+        self.reliable = True
+
+
+class KeyedCache:
+    """キーごとに読み込んだ値を保持し、feed から table の変更が届いたら捨てる"""
+
+    def __init__(self, feed: ChangeFeed, table: str, max_size: int):
+        self.feed = feed
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._values: Dict[Any, Any] = {}
+        self._generation = 0
+        feed.subscribe(table, self.evict)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    async def get(self, key: Any, loader: Callable[[Any], Awaitable[Any]]) -> Any:
+        if key in self._values:
+            self.hits += 1
+            return self._values[key]
+        self.misses += 1
+        generation = self._generation
+        value = await loader(key)
+        # 読み込み中に変更が届いた値は古いかもしれないので保持しない
+        if self.max_size > 0 and self.feed.reliable and generation == self._generation:
+            if len(self._values) >= self.max_size:
+                self._values.clear()
+            self._values[key] = value
+        return value
+
+    def evict(self, key: Optional[int]):
+        self._generation += 1
+        if key is None:
+            self._values.clear()
+        else:
+            self._values.pop(key, None)
@@ -0,0 +1,63 @@
+"""
+定期タスクの多重実行の防止
+
+同じ定期タスクを複数のプロセス・レプリカが同時刻に起動しても、期間（日付や週）ごとに
+1回だけ実行されるようにする。実行権は job_runs テーブルの行で取り合い、実行中は
+生存通知(ハートビート)を送り続ける。通知が途絶えた実行は落ちたものとみなし、別の
+プロセスが引き継げる。成功した期間は記録が残るので、再起動しても二度実行しない。
+"""
+
+import asyncio
+import logging
+import os
+import socket
+from datetime import timedelta
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def default_owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobRunner:
+    def __init__(self, storage, lease: float, owner: Optional[str] = None):
+        self.storage = storage
+        self.lease = timedelta(seconds=lease)
+        self.owner = owner or default_owner()
+
+    async def run(self, job: str, period: str, fn: Callable[[], Awaitable[None]]) -> bool:
+        """実行権を取れたら fn を実行する。実行しなかった場合は False。fn の例外は失敗を記録してから送出する"""
+        if not await self.storage.claim_job_run(job, period, self.owner, self.lease):
+            logger.info(f"定期タスク {job} ({period}) は実行済みか他のプロセスが実行中のためスキップします")
+            return False
+        logger.info(f"定期タスク {job} ({period}) を開始します")
+        heartbeat = asyncio.create_task(self._heartbeat(job, period))
+        try:
+            await fn()
+        except BaseException:
+            heartbeat.cancel()
+            await self._finish(job, period, False)
+            raise
+        heartbeat.cancel()
+        await self._finish(job, period, True)
+        logger.info(f"定期タスク {job} ({period}) が完了しました")
+        return True
+
+    async def _heartbeat(self, job: str, period: str):
+        while True:
+            await asyncio.sleep(self.lease.total_seconds() / 3)
+            try:
+                if not await self.storage.heartbeat_job_run(job, period, self.owner):
+                    logger.warning(f"定期タスク {job} ({period}) の実行権が他のプロセスに移りました")
+                    return
+            except Exception as e:
+                logger.warning(f"定期タスク {job} ({period}) の生存通知に失敗: {e}")
+
+    async def _finish(self, job: str, period: str, succeeded: bool):
+        try:
+            await self.storage.finish_job_run(job, period, self.owner, succeeded)
+        except Exception as e:
+            # 記録できなくても、生存通知が途絶えれば lease の経過後に再実行できる
+            logger.error(f"定期タスク {job} ({period}) の結果を記録できませんでした: {e}")
@@ -0,0 +1,137 @@
+"""
+ログ設定
+
+ハンドラーへの書き込み（ファイル・標準出力）は QueueListener の専用スレッドで行い、
+イベントループ側は QueueHandler でキューに積むだけにする。
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from typing import Dict, Optional, Tuple
+
+from config import Config
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class SamplingFilter(logging.Filter):
+    """
+    呼び出し箇所ごとのトークンバケットで高頻度ログを間引く
+
+    ERROR 以上は常に通す。間引いた件数は次に通ったレコードの末尾に付ける。
+    """
+
+    def __init__(self, rate: float, burst: int):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        # (logger名, ファイル, 行) -> [トークン, 最終更新時刻, 抑制件数]
+        self._buckets: Dict[Tuple[str, str, int], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate <= 0 or record.levelno >= logging.ERROR:
+            return True
+
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(self.burst), now, 0]
+        else:
+            bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+
+        bucket[0] -= 1
+        if bucket[2]:
+            record.msg = f"{record.getMessage()} (同じ箇所のログを{bucket[2]}件抑制)"
+            record.args = None
+            bucket[2] = 0
+        return True
+
+
+def parse_log_levels(text: str) -> Dict[str, int]:
+    """'logger:LEVEL,logger2:LEVEL' 形式をパースする"""
+    levels = {}
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        name, _, level = item.rpartition(':')
+        value = logging.getLevelName(level.strip().upper())
+        if not name.strip() or not isinstance(value, int):
+            print(f"LOG_LEVELS の指定が不正なため無視します: {item.strip()}", file=sys.stderr)
+            continue
+        levels[name.strip()] = value
+    return levels
+
+
+def apply_log_levels(text: str, previous: str = ''):
+    """LOG_LEVELS の指定をロガーに反映する。previous にしかないロガーは親のレベルに戻す"""
+    levels = parse_log_levels(text)
+    for name in parse_log_levels(previous):
+        if name not in levels:
+            logging.getLogger(name).setLevel(logging.NOTSET)
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+
+
+def _file_handler() -> logging.Handler:
+    if Config.LOG_ROTATE_WHEN:
+        return logging.handlers.TimedRotatingFileHandler(
+            Config.LOG_FILE, when=Config.LOG_ROTATE_WHEN, backupCount=Config.LOG_BACKUP_COUNT, encoding='utf-8')
+    return logging.handlers.RotatingFileHandler(
+        Config.LOG_FILE, maxBytes=Config.LOG_MAX_BYTES, backupCount=Config.LOG_BACKUP_COUNT, encoding='utf-8')
+
+
+def setup_logging(debug: bool = False):
+    """ログ設定を初期化"""
+    global _listener
+    if _listener is not None:
+        return
+
+    level = logging.DEBUG if debug else logging.INFO
+    formatter = logging.Formatter(LOG_FORMAT)
+
+    # コンソールのコードページに関係なくUTF-8で出し、表示できない文字は置き換える
+    if hasattr(sys.stdout, 'reconfigure'):
+        sys.stdout.reconfigure(encoding='utf-8', errors='replace')
+    stream_handler = logging.StreamHandler(sys.stdout)
+    file_handler = _file_handler()
+    for handler in (stream_handler, file_handler):
+        handler.setFormatter(formatter)
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(Config.LOG_SAMPLE_RATE, Config.LOG_SAMPLE_BURST))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    apply_log_levels(Config.LOG_LEVELS)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, file_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """キューに残ったログを書き出してリスナーを止める"""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
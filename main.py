@@ -3,46 +3,43 @@
 Discord Bot Runner
 """
 
+from startup_profile import startup_profile
+
+import asyncio
 import logging
+import os
 import sys
 import argparse
-from config import Config
-from discord_client import SoraBot
-
-# ログ設定
-def setup_logging(debug=False):
-    """ログ設定を初期化"""
-    level = logging.DEBUG if debug else logging.INFO
-    # UTF-8エンコーディングを指定
-    stream_handler = logging.StreamHandler(sys.stdout)
-    stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-    
-    logging.basicConfig(
-        level=level,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler('discord_bot.log', encoding='utf-8'),
-            stream_handler
-        ]
-    )
+from config import Config, parse_shard_ids
+from logging_setup import setup_logging, shutdown_logging
+from supervisor import ShardSupervisor
 
-def main():
-    """メイン関数"""
-    parser = argparse.ArgumentParser(description="Sora Bot Runner")
-    parser.add_argument("--monitor", action="store_true", help="Run the bot in persistent monitoring mode.")
-    parser.add_argument("--schedule", action="store_true", help="Run the bot in scheduled (persistent) mode.")
-    parser.add_argument("--once", action="store_true", help="Run the daily task once and exit.")
-    parser.add_argument("--debug", action="store_true", help="Enable debug logging.")
-    args = parser.parse_args()
 
+def run(args):
+    """ボットを1プロセスで起動する"""
+    startup_profile.enabled = args.profile_startup
+    startup_profile.mark("config")
     setup_logging(args.debug)
     logger = logging.getLogger(__name__)
+    startup_profile.mark("logging")
     
     try:
         Config.validate()
         logger.info("設定の検証が完了しました")
-        
+
+        if args.export_notes:
+            if not Config.NOTES_VAULT_DIR:
+                raise ValueError("--export-notes には NOTES_VAULT_DIR の設定が必要です")
+            from notes_export import export_once
+            asyncio.run(export_once())
+            return
+
+        # discord.py の import は重いので設定の検証が通ってから読み込む
+        from discord_client import SoraBot
+        startup_profile.mark("import")
         bot = SoraBot()
+        bot.force_command_sync = args.sync_commands
+        startup_profile.mark("bot init")
 
         if args.monitor or args.schedule:
             logger.info("常時監視モードで起動します...")
@@ -60,6 +57,71 @@ def main():
     except Exception as e:
         logger.error(f"予期しないエラーが発生しました: {e}", exc_info=True)
         sys.exit(1)
+    finally:
+        shutdown_logging()
+
+def run_shard_worker(args, shard_count, shard_ids):
+    """スーパーバイザーから起動されるワーカープロセスの入口"""
+    Config.SHARD_COUNT = shard_count
+    Config.SHARD_IDS = shard_ids
+    # 同じファイルを複数プロセスでローテーションすると壊れるのでワーカーごとに分ける
+    base, ext = os.path.splitext(Config.LOG_FILE)
+    Config.LOG_FILE = f"{base}.shard{shard_ids[0]}-{shard_ids[-1]}{ext}"
+    if Config.HEALTH_PORT:
+        Config.HEALTH_PORT += shard_ids[0]
+    base, ext = os.path.splitext(Config.SPOOL_PATH)
+    Config.SPOOL_PATH = f"{base}.shard{shard_ids[0]}-{shard_ids[-1]}{ext}"
+    run(args)
+
+def main():
+    """メイン関数"""
+    parser = argparse.ArgumentParser(description="Sora Bot Runner")
+    parser.add_argument("--monitor", action="store_true", help="Run the bot in persistent monitoring mode.")
+    parser.add_argument("--schedule", action="store_true", help="Run the bot in scheduled (persistent) mode.")
+    parser.add_argument("--once", action="store_true", help="Run the daily task once and exit.")
+    parser.add_argument("--export-notes", action="store_true", help="Append new activities and messages to the daily notes in NOTES_VAULT_DIR and exit.")
+    parser.add_argument("--debug", action="store_true", help="Enable debug logging.")
+    parser.add_argument("--sync-commands", action="store_true", help="Sync the command tree even if it has not changed.")
+    parser.add_argument("--asyncio-debug", action="store_true", help="Enable asyncio debug mode and log callbacks slower than --slow-callback-ms.")
+    parser.add_argument("--slow-callback-ms", type=float, help="Threshold for slow callback warnings in asyncio debug mode (overrides PROFILE_SLOW_CALLBACK_MS).")
+    parser.add_argument("--profile-sampler", action="store_true", help="Sample event loop stacks and write them in folded (flame graph) format to PROFILE_OUTPUT_DIR.")
+    parser.add_argument("--profile-handlers", action="store_true", help="Record wall time per message handler (see /profiling_report).")
+    parser.add_argument("--profile-startup", action="store_true", help="Log how long each startup phase took once the bot is ready.")
+    parser.add_argument("--shards", type=int, help="Total number of shards (overrides SHARD_COUNT).")
+    parser.add_argument("--shard-ids", help="Shards handled on this host, e.g. '0-7' (overrides SHARD_IDS). Defaults to all shards.")
+    parser.add_argument("--workers", type=int, default=1, help="Split this host's shards across this many processes.")
+    args = parser.parse_args()
+
+    if args.shards:
+        Config.SHARD_COUNT = args.shards
+    if args.shard_ids:
+        Config.SHARD_IDS = parse_shard_ids(args.shard_ids)
+    if args.asyncio_debug:
+        Config.PROFILE_ASYNCIO_DEBUG = True
+    if args.slow_callback_ms:
+        Config.PROFILE_SLOW_CALLBACK_MS = args.slow_callback_ms
+    if args.profile_sampler:
+        Config.PROFILE_SAMPLER = True
+    if args.profile_handlers:
+        Config.PROFILE_HANDLERS = True
+
+    if args.workers <= 1:
+        run(args)
+        return
+
+    if not Config.SHARD_COUNT:
+        parser.error("--workers を使うには --shards (または SHARD_COUNT) が必要です")
+    setup_logging(args.debug)
+    try:
+        # ワーカーはそれぞれ SHARD_IDS を持つので、その前提で検証する
+        Config.SHARD_IDS = Config.SHARD_IDS or list(range(Config.SHARD_COUNT))
+        Config.validate()
+        ShardSupervisor(run_shard_worker, (args,), Config.SHARD_COUNT, Config.SHARD_IDS, args.workers).run()
+    except Exception as e:
+        logging.getLogger(__name__).error(f"スーパーバイザーの起動に失敗しました: {e}", exc_info=True)
+        sys.exit(1)
+    finally:
+        shutdown_logging()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,129 @@
+"""
+Obsidian などのMarkdown保管庫へのデイリーノート書き出し
+
+activities と messages を日ごと（JST）の `YYYY-MM-DD.md` に追記する。
+前回どこまで書き出したかは保管庫の `.sora-export.json` にIDで残し、
+毎回新しい行だけを末尾に足すので、ノートに手で書き足した内容は消さない。
+
+ファイルへの追記のあとでチェックポイントを保存するため、途中で落ちた場合は
+同じ行が二重に書かれることはあっても、書き漏れることはない。
+"""
+
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import Config
+from db_trace import QueryStats
+from storage import Storage, create_storage
+
+logger = logging.getLogger(__name__)
+
+JST = timezone(timedelta(hours=9))
+CHECKPOINT_FILE = ".sora-export.json"
+BATCH_SIZE = 1000
+# メッセージの記録は低優先度キューで遅れて届くので、少し前のものまでに留める
+MESSAGE_SETTLE = timedelta(minutes=2)
+
+STATUS_LABELS = {"doing": "なう", "done": "わず"}
+
+
+class NotesExporter:
+    def __init__(self, storage: Storage, vault_dir: str, include_messages: bool = True,
+                 user_name: Optional[Callable[[int], Optional[str]]] = None):
+        self.storage = storage
+        self.vault_dir = vault_dir
+        self.include_messages = include_messages
+        self.user_name = user_name or (lambda user_id: None)
+
+    # --- チェックポイント ---
+    def _checkpoint_path(self) -> str:
+        return os.path.join(self.vault_dir, CHECKPOINT_FILE)
+
+    def _load_checkpoint(self) -> Dict[str, int]:
+        try:
+            with open(self._checkpoint_path(), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_checkpoint(self, checkpoint: Dict[str, int]):
+        path = self._checkpoint_path()
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f)
+        os.replace(f"{path}.tmp", path)
+
+    # --- 書き出し ---
+    def _format_activity(self, row) -> Tuple[str, datetime, str]:
+        local = row['activity_time'].astimezone(JST)
+        if row['status'] == 'todo':
+            line = f"- [ ] {local:%H:%M} {row['content']}"
+        else:
+            line = f"- {local:%H:%M} {row['content']}（{STATUS_LABELS.get(row['status'], row['status'])}）"
+        return local.strftime('%Y-%m-%d'), local, line
+
+    def _format_message(self, row) -> Tuple[str, datetime, str]:
+        local = row['created_at'].astimezone(JST)
+        author = self.user_name(row['user_id']) or f"user:{row['user_id']}"
+        content = " ".join(row['content'].split())
+        return local.strftime('%Y-%m-%d'), local, f"- {local:%H:%M} **{author}** {content}"
+
+    def _append(self, entries: List[Tuple[str, datetime, str]]) -> int:
+        by_day: Dict[str, List[Tuple[datetime, str]]] = {}
+        for day, at, line in entries:
+            by_day.setdefault(day, []).append((at, line))
+
+        os.makedirs(self.vault_dir, exist_ok=True)
+        for day, lines in by_day.items():
+            path = os.path.join(self.vault_dir, f"{day}.md")
+            is_new = not os.path.exists(path)
+            with open(path, 'a', encoding='utf-8') as f:
+                if is_new:
+                    f.write(f"# {day}\n\n")
+                f.write("".join(f"{line}\n" for _, line in sorted(lines, key=lambda item: item[0])))
+        return len(by_day)
+
+    async def export(self) -> int:
+        """前回のチェックポイント以降の記録を書き出し、書き出した行数を返す"""
+        checkpoint = await asyncio.to_thread(self._load_checkpoint)
+        total = 0
+        while True:
+            entries: List[Tuple[str, datetime, str]] = []
+            activities = await self.storage.fetch_activities_after(checkpoint.get('activities', 0), BATCH_SIZE)
+            entries.extend(self._format_activity(row) for row in activities)
+            messages = []
+            if self.include_messages:
+                before = datetime.now(timezone.utc) - MESSAGE_SETTLE
+                messages = await self.storage.fetch_messages_after(checkpoint.get('messages', 0), before, BATCH_SIZE)
+                entries.extend(self._format_message(row) for row in messages if row['content'])
+            if not activities and not messages:
+                break
+
+            days = await asyncio.to_thread(self._append, entries)
+            if activities:
+                checkpoint['activities'] = activities[-1]['id']
+            if messages:
+                checkpoint['messages'] = messages[-1]['id']
+            await asyncio.to_thread(self._save_checkpoint, checkpoint)
+            total += len(entries)
+            logger.debug(f"ノートに{len(entries)}行を書き出しました（{days}日分）")
+            if len(activities) < BATCH_SIZE and len(messages) < BATCH_SIZE:
+                break
+
+        if total:
+            logger.info(f"{self.vault_dir} に{total}行を書き出しました")
+        return total
+
+
+async def export_once() -> int:
+    """Discordに接続せず、設定の保管庫へ一度だけ書き出す（main.py --export-notes）"""
+    storage = create_storage(QueryStats())
+    await storage.connect()
+    try:
+        await storage.init_schema()
+        return await NotesExporter(storage, Config.NOTES_VAULT_DIR, Config.NOTES_EXPORT_MESSAGES).export()
+    finally:
+        await storage.close()
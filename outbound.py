@@ -0,0 +1,239 @@
+"""
+Discord への送信キュー
+
+ハンドラやタスクから直接 channel.send / add_reaction / user.send を呼ぶと、
+discord.py のルートごとのレート制限で待たされる間ハンドラも止まる。
+ここでは送信をキューに積んで専用のワーカーで送る。
+
+- 優先度レーン: HIGH（会話の返信）> NORMAL（定期タスクの通知・DM）> LOW（リアクション）
+- 同じ宛先への送信は積んだ順に1件ずつ送る
+- まだ送っていない同じ宛先・同じレーンの短いテキストは1通にまとめる
+- 同じメッセージへのリアクションは1つのジョブにまとめ、重複を除く
+- send は送れたかどうかで解決する Future を返すので、届くまで待ちたい定期タスクは await する
+
+スラッシュコマンドの応答は3秒以内に返す必要があるので、ここを通さずに直接返す。
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+import discord
+
+logger = logging.getLogger(__name__)
+
+HIGH, NORMAL, LOW = 0, 1, 2
+LANE_NAMES = ("high", "normal", "low")
+
+# Discord のメッセージ本文の上限
+MAX_CONTENT_LENGTH = 2000
+
+
+class _Job:
+    __slots__ = ('lane', 'target', 'content', 'embeds', 'fallback', 'message', 'reactions', 'enqueued_at', 'delivered')
+
+    def __init__(self, lane: int, target: Any = None, content: Optional[str] = None, embeds: Optional[List[discord.Embed]] = None,
+                 fallback: Optional[Tuple[Any, str]] = None, message: Any = None, reactions: Optional[List[str]] = None):
+        self.lane = lane
+        self.target = target
+        self.content = content
+        self.embeds = embeds
+        self.fallback = fallback
+        self.message = message
+        self.reactions = reactions
+        self.enqueued_at = time.monotonic()
+        self.delivered: Optional[asyncio.Future] = None
+
+
+class OutboundQueue:
+    def __init__(self, workers: int, low_queue_limit: int, wait_samples: int = 500):
+        self.worker_count = workers
+        self.low_queue_limit = low_queue_limit
+        self._jobs: Dict[Tuple[str, int], Deque[_Job]] = {}
+        self._ready: Tuple[Deque[Tuple[str, int]], ...] = (deque(), deque(), deque())
+        self._busy: Set[Tuple[str, int]] = set()
+        self._workers: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.depth = [0, 0, 0]
+        self._waits: Tuple[Deque[float], ...] = tuple(deque(maxlen=wait_samples) for _ in LANE_NAMES)
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+        self.dropped = 0
+
+    # --- 投入 ---
+    def send(self, target, content: Optional[str] = None, *, embed: Optional[discord.Embed] = None,
+             embeds: Optional[List[discord.Embed]] = None, lane: int = HIGH, fallback: Optional[Tuple[Any, str]] = None) -> asyncio.Future:
+        """target（チャンネルまたはユーザー）に送る。embeds は1通に10個まで。DMが届かなければ fallback=(チャンネル, 本文) に同じEmbedで送る
+
+        送れたら True（fallback で送れた場合を含む）、送れなければ False で解決する Future を返す。
+        """
+        if embed is not None:
+            embeds = [embed]
+        key = ('send', target.id)
+        jobs = self._jobs.get(key)
+        if not embeds and fallback is None and content and jobs:
+            last = jobs[-1]
+            if (last.lane == lane and not last.embeds and last.fallback is None and last.content
+                    and len(last.content) + 1 + len(content) <= MAX_CONTENT_LENGTH):
+                last.content = f"{last.content}\n{content}"
+                self.merged += 1
+                return last.delivered
+        job = _Job(lane, target=target, content=content, embeds=embeds, fallback=fallback)
+        job.delivered = asyncio.get_running_loop().create_future()
+        self._enqueue(key, job)
+        return job.delivered
+
+    def add_reaction(self, message, emoji: str, lane: int = LOW):
+        """message にリアクションを付ける。同じメッセージへの未送信のリアクションはまとめる"""
+        key = ('reaction', message.channel.id)
+        jobs = self._jobs.get(key)
+        if jobs:
+            for job in jobs:
+                if job.message is message:
+                    if emoji not in job.reactions:
+                        job.reactions.append(emoji)
+                    self.merged += 1
+                    return
+        self._enqueue(key, _Job(lane, message=message, reactions=[emoji]))
+
+    def _enqueue(self, key: Tuple[str, int], job: _Job):
+        # 返信や通知は捨てず、溢れたらリアクションから諦める
+        if job.lane == LOW and self.depth[LOW] >= self.low_queue_limit:
+            self.dropped += 1
+            self._resolve(job, False)
+            if self.dropped % 100 == 1:
+                logger.warning(f"リアクションの送信待ちが上限({self.low_queue_limit}件)に達したため破棄しています（累計{self.dropped}件）")
+            return
+        self._ensure_workers()
+        jobs = self._jobs.setdefault(key, deque())
+        jobs.append(job)
+        self.depth[job.lane] += 1
+        self._idle.clear()
+        if len(jobs) == 1 and key not in self._busy:
+            self._ready[job.lane].append(key)
+            self._wakeup.set()
+
+    def _ensure_workers(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    # --- 送信 ---
+    def _next_ready(self) -> Optional[Tuple[str, int]]:
+        for lane in self._ready:
+            if lane:
+                return lane.popleft()
+        return None
+
+    async def _worker(self):
+        while True:
+            key = self._next_ready()
+            if key is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            jobs = self._jobs[key]
+            job = jobs.popleft()
+            if not jobs:
+                del self._jobs[key]
+            self.depth[job.lane] -= 1
+            self._waits[job.lane].append(time.monotonic() - job.enqueued_at)
+            self._busy.add(key)
+            try:
+                await self._execute(job)
+            except asyncio.CancelledError:
+                if job.delivered is not None:
+                    job.delivered.cancel()
+                raise
+            finally:
+                self._busy.discard(key)
+                if key in self._jobs:
+                    self._ready[self._jobs[key][0].lane].append(key)
+                    self._wakeup.set()
+                elif not self._jobs and not self._busy:
+                    self._idle.set()
+
+    async def _execute(self, job: _Job):
+        if job.reactions is not None:
+            for emoji in job.reactions:
+                try:
+                    await job.message.add_reaction(emoji)
+                    self.sent += 1
+                except discord.HTTPException as e:
+                    self.failed += 1
+                    logger.warning(f"リアクションの追加に失敗しました: {emoji} ({e})")
+            return
+
+        delivered = False
+        try:
+            if job.embeds:
+                await job.target.send(content=job.content, embeds=job.embeds)
+            else:
+                await job.target.send(content=job.content)
+            self.sent += 1
+            delivered = True
+        except (discord.Forbidden, discord.NotFound) as e:
+            if job.fallback:
+                channel, content = job.fallback
+                # 代わりの送信の結果を、元の送信の結果にする
+                fallback = self.send(channel, content, embeds=job.embeds, lane=job.lane)
+                fallback.add_done_callback(lambda future: self._chain(future, job))
+                return
+            self.failed += 1
+            logger.warning(f"{job.target} への送信に失敗しました: {e}")
+        except discord.HTTPException as e:
+            self.failed += 1
+            logger.warning(f"{job.target} への送信に失敗しました: {e}")
+        except Exception:
+            self.failed += 1
+            logger.error(f"{job.target} への送信中に予期せぬエラーが発生しました", exc_info=True)
+        self._resolve(job, delivered)
+
+    @staticmethod
+    def _resolve(job: _Job, delivered: bool):
+        if job.delivered is not None and not job.delivered.done():
+            job.delivered.set_result(delivered)
+
+    @classmethod
+    def _chain(cls, future: asyncio.Future, job: _Job):
+        if future.cancelled():
+            job.delivered.cancel()
+        else:
+            cls._resolve(job, future.result())
+
+    # --- 状態 ---
+    def stats(self) -> Dict[str, Any]:
+        lanes = {}
+        for index, name in enumerate(LANE_NAMES):
+            waits = sorted(self._waits[index])
+            lanes[name] = {
+                "depth": self.depth[index],
+                "wait_avg_ms": round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0,
+                "wait_p95_ms": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1) if waits else 0.0,
+                "wait_max_ms": round(waits[-1] * 1000, 1) if waits else 0.0,
+            }
+        return {"lanes": lanes, "sent": self.sent, "merged": self.merged, "failed": self.failed, "dropped": self.dropped}
+
+    async def drain(self):
+        """積まれた送信がすべて終わるまで待つ"""
+        await self._idle.wait()
+
+    async def close(self, timeout: float = 10.0):
+        """残った送信を最大 timeout 秒待ってからワーカーを止める"""
+        try:
+            await asyncio.wait_for(self.drain(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"終了時に未送信のメッセージが残っていました: {self.stats()}")
+        for task in self._workers:
+            task.cancel()
+        self._workers = []
+        # 送れずに残った送信を待っている側には、届いていないことを知らせる
+        for jobs in self._jobs.values():
+            for job in jobs:
+                if job.delivered is not None:
+                    job.delivered.cancel()
@@ -0,0 +1,155 @@
+"""
+イベントループのプロファイリング
+
+本番で起きるループの詰まりを調べるための仕組み。どれも既定では無効で、
+main.py の引数か /profiling コマンドで実行中に切り替える。
+
+- asyncio のデバッグモード: slow_callback_duration より長く走ったコールバックを asyncio ロガーに警告する
+- サンプリングプロファイラ: 別スレッドからイベントループのスタックを一定間隔で採取し、
+  flamegraph.pl / speedscope で読める folded 形式 (`a;b;c 回数`) でファイルに書き出す
+- ハンドラの所要時間: ディスパッチャーが実行したハンドラごとの実時間を集計する
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class HandlerTimings:
+    """ハンドラ名ごとの実行回数・合計・最大の実時間"""
+
+    def __init__(self):
+        self._stats: Dict[str, List[float]] = {}
+
+    def record(self, name: str, duration: float):
+        stat = self._stats.get(name)
+        if stat is None:
+            self._stats[name] = [1, duration, duration]
+        else:
+            stat[0] += 1
+            stat[1] += duration
+            stat[2] = max(stat[2], duration)
+
+    def top(self, limit: int) -> List[Tuple[str, int, float, float]]:
+        """(名前, 回数, 合計秒, 最大秒) を合計の長い順に返す"""
+        rows = [(name, int(count), total, peak) for name, (count, total, peak) in self._stats.items()]
+        return sorted(rows, key=lambda row: row[2], reverse=True)[:limit]
+
+    def reset(self):
+        self._stats.clear()
+
+
+def _fold(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """thread_id のスレッドのスタックを interval 秒ごとに採取し、flush_interval 秒ごとに output_path を書き直す"""
+
+    def __init__(self, thread_id: int, interval: float, output_path: str, flush_interval: float = 30.0):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.output_path = output_path
+        self.flush_interval = flush_interval
+        self.samples = 0
+        self._counts: Counter = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        next_flush = time.monotonic() + self.flush_interval
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = _fold(frame)
+                with self._lock:
+                    self._counts[stack] += 1
+                    self.samples += 1
+            if time.monotonic() >= next_flush:
+                self._flush()
+                next_flush = time.monotonic() + self.flush_interval
+        self._flush()
+
+    def _flush(self):
+        with self._lock:
+            lines = [f"{stack} {count}\n" for stack, count in self._counts.items()]
+        try:
+            os.makedirs(os.path.dirname(self.output_path) or '.', exist_ok=True)
+            with open(f"{self.output_path}.tmp", 'w', encoding='utf-8') as f:
+                f.writelines(lines)
+            os.replace(f"{self.output_path}.tmp", self.output_path)
+        except OSError as e:
+            logger.error(f"プロファイルの書き出しに失敗しました: {e}")
+
+    def top_frames(self, limit: int) -> List[Tuple[str, int]]:
+        """最も内側の関数ごとの採取回数を多い順に返す"""
+        leaves: Counter = Counter()
+        with self._lock:
+            for stack, count in self._counts.items():
+                leaves[stack.rsplit(";", 1)[-1]] += count
+        return leaves.most_common(limit)
+
+
+class LoopProfiler:
+    """実行中のイベントループに対するプロファイリングの切り替え"""
+
+    def __init__(self, output_dir: str, sample_interval_ms: float, slow_callback_ms: float):
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval_ms / 1000
+        self.slow_callback_ms = slow_callback_ms
+        self.handler_timings = HandlerTimings()
+        self.handler_timing_enabled = False
+        self.sampler: Optional[SamplingProfiler] = None
+
+    @property
+    def asyncio_debug(self) -> bool:
+        return asyncio.get_running_loop().get_debug()
+
+    def set_asyncio_debug(self, enabled: bool):
+        loop = asyncio.get_running_loop()
+        loop.slow_callback_duration = self.slow_callback_ms / 1000
+        loop.set_debug(enabled)
+        if enabled:
+            logger.info(f"asyncioのデバッグモードを有効にしました（{self.slow_callback_ms:.0f}ms以上のコールバックを警告）")
+
+    def set_sampler(self, enabled: bool):
+        if enabled and self.sampler is None:
+            path = os.path.join(self.output_dir, f"sora-{os.getpid()}-{int(time.time())}.folded")
+            self.sampler = SamplingProfiler(threading.get_ident(), self.sample_interval, path)
+            self.sampler.start()
+            logger.info(f"サンプリングプロファイラを開始しました: {path}")
+        elif not enabled and self.sampler is not None:
+            self.sampler.stop()
+            logger.info(f"サンプリングプロファイラを停止しました（{self.sampler.samples}サンプル）: {self.sampler.output_path}")
+            self.sampler = None
+
+    def set_handler_timing(self, enabled: bool):
+        if enabled and not self.handler_timing_enabled:
+            self.handler_timings.reset()
+        self.handler_timing_enabled = enabled
+
+    def close(self):
+        self.set_sampler(False)
@@ -0,0 +1,116 @@
+"""
+定期取引のスケジュール
+
+家賃やサブスクリプションなど、決まった日に繰り返す支出・資金移動のルールの実行日時を計算する。
+スケジュールは次のいずれかの文字列で書き、時刻はすべて日本時間で数える。
+
+- `monthly:25` 毎月25日の0時。月末より後の日は月末にする（`monthly:31` は2月なら28日か29日）
+- `weekly:mon` 毎週月曜の0時（mon/tue/wed/thu/fri/sat/sun）
+- `0 9 1 * *` cron 形式の「分 時 日 月 曜日」。`*`・数値・`a-b`・`*/n`・カンマ区切りが使える。
+  曜日は0か7が日曜。日と曜日の両方を指定した場合はどちらかに合えば実行する（cron と同じ）。
+  止まっていた間の分をまとめて実行するので、1日に2回以上になる指定（`*/5 * * * *` など）は受け付けない
+"""
+
+import calendar
+from datetime import date, datetime, time, timedelta, timezone
+from typing import FrozenSet, Optional
+
+JST = timezone(timedelta(hours=9))
+
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+# cron の日付で次の実行を探す範囲（2月29日だけ、のような指定でも見つかるよう閏年をまたぐ）
+CRON_SEARCH_DAYS = 366 * 8
+
+
+def _parse_field(text: str, low: int, high: int) -> Optional[FrozenSet[int]]:
+    """cron の1項目を値の集合にする。`*` は None（制限なし）"""
+    if text == '*':
+        return None
+    values = set()
+    for part in text.split(','):
+        step = 1
+        if '/' in part:
+            part, step_text = part.split('/', 1)
+            step = int(step_text)
+            if step <= 0:
+                raise ValueError
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (int(v) for v in part.split('-', 1))
+        else:
+            start = end = int(part)
+        if not low <= start <= end <= high:
+            raise ValueError
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class Schedule:
+    """実行日時を after より後に進めるルール"""
+
+    def __init__(self, text: str):
+        self.text = text.strip()
+        self.monthly_day: Optional[int] = None
+        self.weekday: Optional[int] = None
+        try:
+            kind, _, arg = self.text.partition(':')
+            if kind == 'monthly':
+                self.monthly_day = int(arg)
+                if not 1 <= self.monthly_day <= 31:
+                    raise ValueError
+            elif kind == 'weekly':
+                self.weekday = WEEKDAYS.index(arg.lower())
+            else:
+                fields = self.text.split()
+                if len(fields) != 5:
+                    raise ValueError
+                self.minutes = _parse_field(fields[0], 0, 59) or frozenset(range(60))
+                self.hours = _parse_field(fields[1], 0, 23) or frozenset(range(24))
+                self.days = _parse_field(fields[2], 1, 31)
+                self.months = _parse_field(fields[3], 1, 12)
+                dows = _parse_field(fields[4], 0, 7)
+                self.dows = None if dows is None else frozenset(d % 7 for d in dows)
+        except ValueError:
+            raise ValueError(f"スケジュールの書式が正しくありません: {text}")
+        if self.monthly_day is None and self.weekday is None and len(self.minutes) * len(self.hours) > 1:
+            raise ValueError(f"定期取引は1日に1回までです: {text}")
+
+    def next_after(self, after: datetime) -> datetime:
+        """after より後の最初の実行日時"""
+        after = after.astimezone(JST)
+        if self.monthly_day is not None:
+            year, month = after.year, after.month
+            while True:
+                day = min(self.monthly_day, calendar.monthrange(year, month)[1])
+                run_at = datetime.combine(date(year, month, day), time(0), JST)
+                if run_at > after:
+                    return run_at
+                year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        if self.weekday is not None:
+            day = after.date() + timedelta(days=(self.weekday - after.weekday()) % 7)
+            run_at = datetime.combine(day, time(0), JST)
+            return run_at if run_at > after else run_at + timedelta(days=7)
+        return self._next_cron(after)
+
+    def _matches_day(self, day: date) -> bool:
+        if self.months is not None and day.month not in self.months:
+            return False
+        dom = self.days is None or day.day in self.days
+        dow = self.dows is None or (day.weekday() + 1) % 7 in self.dows
+        if self.days is not None and self.dows is not None:
+            return dom or dow
+        return dom and dow
+
+    def _next_cron(self, after: datetime) -> datetime:
+        start = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        for offset in range(CRON_SEARCH_DAYS):
+            day = start.date() + timedelta(days=offset)
+            if not self._matches_day(day):
+                continue
+            for hour in sorted(self.hours):
+                for minute in sorted(self.minutes):
+                    run_at = datetime.combine(day, time(hour, minute), JST)
+                    if run_at >= start:
+                        return run_at
+        raise ValueError(f"スケジュールに合う日時が見つかりません: {self.text}")
@@ -34,13 +34,11 @@ class MessageScheduler:
     
     async def _async_daily_task(self):
         """非同期日次タスク"""
-        # ターゲットチャンネルから全件収集
-        messages = await self.discord_collector.collect_messages_from_channel(
+        # ターゲットチャンネルのメッセージを読みながらDiscordにサマリーを投稿
+        messages = self.discord_collector.iter_channel_messages(
             channel_id=Config.TARGET_CHANNEL_ID, 
             days_back=1
         )
-
-        # Discordにサマリーを投稿
         post_success = await self.discord_collector.post_summary(messages)
         if not post_success:
             logger.error("Discordでの収集/投稿に失敗しました")
@@ -0,0 +1,150 @@
+"""
+DBに書けないときの退避先（スプール）とサーキットブレーカー
+
+メッセージの記録・活動記録・Webhookの支出は、DBが落ちている間もローカルの
+追記専用ファイル(JSON Lines)に fsync して残し、復旧後に先頭から順に再生する。
+再生した位置は `<スプール>.offset` に保存し、すべて再生し終えたらファイルを空にする。
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Record = Dict[str, Any]
+
+
+class CircuitBreaker:
+    """失敗が続いたら呼び出しを止め、reset_timeout 秒ごとに1回だけ試す"""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self._probing else "open"
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if not self._probing and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("DBへの接続が回復しました")
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probing or (self.opened_at is None and self.failures >= self.failure_threshold):
+            if self.opened_at is None:
+                logger.warning(f"DBへの書き込みが{self.failures}回続けて失敗したため、{self.reset_timeout:.0f}秒ごとの再試行に切り替えます")
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+
+class Spool:
+    def __init__(self, path: str):
+        self.path = path
+        self.offset_path = f"{path}.offset"
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="spool")
+
+    async def _call(self, fn, *args):
+        # ファイル操作はすべて同じスレッドで順に行う
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    # --- 起動時 ---
+    async def open(self):
+        self.pending = await self._call(self._open)
+        if self.pending:
+            logger.warning(f"未再生のスプールが{self.pending}件あります: {self.path}")
+
+    def _open(self) -> int:
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, 'rb+') as f:
+            data = f.read()
+            # 書き込み途中で落ちた最後の行は捨てる
+            if data and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+                data = data[:data.rfind(b'\n') + 1]
+        return data[self._read_offset():].count(b'\n')
+
+    def _read_offset(self) -> int:
+        try:
+            with open(self.offset_path, encoding='utf-8') as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    # --- 追記 ---
+    async def append(self, kind: str, key: str, payload: Dict[str, Any]):
+        line = json.dumps({"kind": kind, "key": key, "payload": payload}, ensure_ascii=False)
+        await self._call(self._append, line)
+        self.pending += 1
+
+    def _append(self, line: str):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    # --- 再生 ---
+    async def read(self, limit: int) -> List[Tuple[int, Optional[Record]]]:
+        """未再生の記録を最大 limit 件、(その行の終わりの位置, 記録) で返す。壊れた行の記録は None"""
+        return await self._call(self._read, limit)
+
+    def _read(self, limit: int) -> List[Tuple[int, Optional[Record]]]:
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path, 'rb') as f:
+            f.seek(self._read_offset())
+            while len(records) < limit:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.error(f"スプールの壊れた行を読み飛ばします: {line[:200]!r}")
+                    record = None
+                records.append((f.tell(), record))
+        return records
+
+    async def commit(self, offset: int, count: int):
+        """offset までを再生済みにする。すべて再生し終えていればファイルを空にする"""
+        await self._call(self._commit, offset)
+        self.pending = max(0, self.pending - count)
+
+    def _commit(self, offset: int):
+        if offset >= os.path.getsize(self.path):
+            # 追記も同じスレッドで行うので、ここで空にしても取りこぼさない
+            os.truncate(self.path, 0)
+            offset = 0
+        tmp_path = f"{self.offset_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.offset_path)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,36 @@
+"""
+起動フェーズの計測
+
+main.py の --profile-startup で有効にすると、import・ログイン・DB接続・
+コマンド同期・ゲートウェイ接続にかかった時間を on_ready でまとめて出力する。
+"""
+
+import time
+from typing import List, Tuple
+
+
+class StartupProfile:
+    def __init__(self):
+        self.enabled = False
+        self.reported = False
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.phases: List[Tuple[str, float]] = []
+
+    def mark(self, phase: str):
+        """直前のマークからここまでを1フェーズとして記録する"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def report(self) -> str:
+        self.reported = True
+        total = self._last - self.started
+        lines = [f"起動プロファイル (合計 {total * 1000:.0f}ms):"]
+        for phase, duration in self.phases:
+            lines.append(f"  {phase:<16} {duration * 1000:8.1f}ms")
+        return "\n".join(lines)
+
+
+# プロセス全体で1つ。main.py が最初に import するので started はほぼ起動時刻になる
+startup_profile = StartupProfile()
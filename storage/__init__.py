@@ -0,0 +1,28 @@
+"""
+永続化レイヤー
+
+バックエンドは Config.STORAGE_BACKEND で選ぶ。使わないバックエンドの
+ドライバ(asyncpg など)は読み込まない。
+"""
+
+from config import Config
+from db_trace import QueryStats
+from storage.base import (
+    CHECK_INPUT_COLUMNS, BudgetUsage, DuplicateStorageError, InsufficientBalanceError, RecurringRun, SpendResult, Storage,
+    StorageError, TransactionNotFoundError, budget_month,
+)
+
+
+def create_storage(query_stats: QueryStats) -> Storage:
+    """設定に応じたストレージを生成する（接続はまだ行わない）"""
+    if Config.STORAGE_BACKEND == 'sqlite':
+        from storage.sqlite import SQLiteStorage
+        return SQLiteStorage(Config.SQLITE_PATH, query_stats)
+    from storage.postgres import PostgresStorage
+    return PostgresStorage(Config.DATABASE_URL, query_stats, explain=Config.SLOW_QUERY_EXPLAIN)
+
+
+__all__ = [
+    "CHECK_INPUT_COLUMNS", "BudgetUsage", "DuplicateStorageError", "InsufficientBalanceError", "RecurringRun", "SpendResult",
+    "Storage", "StorageError", "TransactionNotFoundError", "budget_month", "create_storage",
+]
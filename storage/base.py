@@ -0,0 +1,391 @@
+"""
+ストレージのリポジトリインターフェース
+
+ハンドラはSQLを直接書かず、このインターフェース経由で永続化を行う。
+"""
+
+import asyncio
+import functools
+from abc import ABC, abstractmethod
+from datetime import date, datetime, time, timedelta, timezone, tzinfo
+from typing import Any, Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple, Type
+
+from db_trace import register_passthrough_module
+from invalidation import ChangeFeed
+
+register_passthrough_module(__file__)
+
+# 残高チェックの入力値を保存するカラム
+CHECK_INPUT_COLUMNS = {
+    "ぬし財布": "input_nushi",
+    "ぽて財布": "input_pote",
+    "探検隊予算": "input_budget",
+    "貯金": "input_savings",
+}
+
+Row = Mapping[str, Any]
+
+# 活動レポートの日付の区切り
+REPORT_TZ = timezone(timedelta(hours=9))
+
+
+def day_start(day: date) -> datetime:
+    """REPORT_TZ でのその日の0時"""
+    return datetime.combine(day, time(0), REPORT_TZ)
+
+
+class BudgetUsage(NamedTuple):
+    """支出で増えた月の予算の使用額。category は支出カテゴリか財布の名前、month は 'YYYY-MM'"""
+    category: str
+    month: str
+    before: int
+    after: int
+    limit: int
+
+    def crossed_threshold(self, thresholds: Iterable[int]) -> Optional[int]:
+        """before から after に増えたことで新たに達した最も高い閾値(上限に対する%)。なければ None"""
+        return max((t for t in thresholds if self.before * 100 < self.limit * t <= self.after * 100), default=None)
+
+
+class SpendResult(NamedTuple):
+    transaction_id: int
+    # 使用額が増えた予算のうち、上限を設定しているもの
+    budgets: List[BudgetUsage]
+
+
+def recurring_key(rule_id: int, due_at: datetime) -> str:
+    """定期取引の1回分を一度しか記録しないための冪等性キー"""
+    return f"recurring:{rule_id}:{due_at.astimezone(timezone.utc).isoformat()}"
+
+
+def budget_month(at: datetime) -> str:
+    """予算を数える月 (REPORT_TZ の 'YYYY-MM')"""
+    return at.astimezone(REPORT_TZ).strftime('%Y-%m')
+
+
+def budget_deltas(*spends: Tuple[str, Optional[str], datetime, int]) -> Dict[Tuple[str, str], int]:
+    """支出 (カテゴリ, 財布, 日時, 金額) を予算の (カテゴリか財布, 月) ごとの使用額の増減にまとめる。取り消す支出は金額を負にする"""
+    deltas: Dict[Tuple[str, str], int] = {}
+    for category, wallet, created_at, amount in spends:
+        month = budget_month(created_at)
+        for name in (category, wallet):
+            if name:
+                deltas[(name, month)] = deltas.get((name, month), 0) + amount
+    return deltas
+
+
+def publishes_change(table: str):
+    """書き込みのあと、第1引数の user_id をキーに table の変更を自プロセスの購読者へ通知する
+
+    キャッシュしているテーブルに書くメソッドに付ける。他プロセスへは PostgreSQL のトリガーが通知する。
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, user_id, *args, **kwargs):
+            try:
+                return await method(self, user_id, *args, **kwargs)
+            finally:
+                self.changes.publish(table, user_id)
+        return wrapper
+    return decorator
+
+
+class StorageError(Exception):
+    """ストレージ操作の失敗"""
+
+
+class DuplicateStorageError(StorageError):
+    """同名の収納が既に存在する"""
+
+
+class InsufficientBalanceError(StorageError):
+    """財布の残高が不足している"""
+
+    def __init__(self, wallet: str, balance: int):
+        super().__init__(f"{wallet} の残高が不足しています (現在: {balance}円)")
+        self.wallet = wallet
+        self.balance = balance
+
+
+class TransactionNotFoundError(StorageError):
+    """指定した取引が見つからない、または権限がない"""
+
+
+class RecurringRun(NamedTuple):
+    """定期取引のルール1件の1回分の適用結果。error があれば適用していない"""
+    rule: Row
+    due_at: datetime
+    budgets: List[BudgetUsage]
+    error: Optional[InsufficientBalanceError] = None
+
+
+class Storage(ABC):
+    """メッセージ・備品・活動記録・家計簿・残高チェック状態の永続化"""
+
+    backend = "abstract"
+    # DBに届かなかったことを表す例外。これらで失敗した書き込みはスプールに退避してよい
+    unavailable_errors: Tuple[Type[BaseException], ...] = (OSError, asyncio.TimeoutError)
+    # テーブルの変更通知。キャッシュはここを購読する
+    changes: ChangeFeed
+
+    async def start_change_listener(self):
+        """他のプロセスによる変更の通知を受け取り始める（1プロセスで完結するバックエンドでは何もしない）"""
+
+    @property
+    @abstractmethod
+    def is_ready(self) -> bool:
+        """接続とスキーマの初期化が完了しているか"""
+
+    def pool_stats(self) -> Dict[str, Any]:
+        """接続(プール)の状態。ヘルスチェックで返す"""
+        return {}
+
+    @abstractmethod
+    async def connect(self):
+        """接続を確立する"""
+
+    @abstractmethod
+    async def init_schema(self):
+        """テーブルを作成・移行する"""
+
+    @abstractmethod
+    async def close(self):
+        """接続を閉じる"""
+
+    # --- メッセージ ---
+    @abstractmethod
+    async def log_message(self, message_id: int, guild_id: int, channel_id: int, user_id: int, content: str, created_at: datetime):
+        """メッセージを記録する（既存IDは無視）"""
+
+    @abstractmethod
+    async def log_messages(self, rows: List[tuple]) -> List[int]:
+        """(id, guild_id, channel_id, user_id, content, created_at) をまとめて記録し、新たに記録したIDを返す"""
+
+    @abstractmethod
+    async def apply_message_edits(self, rows: List[tuple]) -> int:
+        """(id, guild_id, channel_id, user_id, content, created_at, edited_at) の編集をまとめて反映し、反映した件数を返す
+
+        未記録のメッセージは編集後の内容で記録する。削除済みのものと、より新しい編集を反映済みのものは変えない。
+        """
+
+    @abstractmethod
+    async def delete_messages(self, rows: List[tuple]) -> int:
+        """(id, guild_id, channel_id, created_at, deleted_at) のメッセージをまとめて削除済みにし、新たに削除済みにした件数を返す
+
+        未記録のメッセージも削除済みとして残し、後から届いた記録で復活しないようにする。
+        """
+
+    @abstractmethod
+    async def last_message_ids(self, channel_ids: List[int]) -> Dict[int, int]:
+        """チャンネルごとに記録済みの最新のメッセージIDを返す（記録のないチャンネルは含まない）"""
+
+    @abstractmethod
+    async def fetch_users_messages(self, user_ids: List[int], start: datetime, end: datetime, channel_id: Optional[int] = None,
+                                   limit_per_user: Optional[int] = None) -> List[Row]:
+        """複数ユーザーの start 以降 end より前の削除されていないメッセージ (id, user_id, channel_id, content, created_at) を
+        ユーザーごとに古い順で返す。channel_id を指定するとそのチャンネルだけにし、limit_per_user を指定すると1人あたり古い方からその件数までにする"""
+
+    @abstractmethod
+    async def fetch_messages_after(self, after_id: int, before: datetime, limit: int) -> List[Row]:
+        """after_id より後で before より前に投稿された、削除されていないメッセージ (id, user_id, channel_id, content, created_at) をID順に返す"""
+
+    # --- 収納・備品 ---
+    @abstractmethod
+    async def add_storage(self, guild_id: int, guild_name: str, name: str):
+        """収納を登録する。既にあれば DuplicateStorageError"""
+
+    @abstractmethod
+    async def get_storage_id(self, guild_id: int, name: str) -> Optional[int]:
+        """収納IDを返す"""
+
+    @abstractmethod
+    async def upsert_item(self, storage_id: int, name: str):
+        """備品を登録する（既存なら更新日時を更新）"""
+
+    @abstractmethod
+    async def find_item_storage(self, guild_id: int, item_name: str) -> Optional[str]:
+        """備品が入っている収納名を返す"""
+
+    @abstractmethod
+    async def list_storage_items(self, guild_id: int, storage_name: str) -> List[str]:
+        """収納に入っている備品名を名前順に返す"""
+
+    # --- 活動記録 ---
+    @abstractmethod
+    async def add_activity(self, user_id: int, channel_id: int, guild_id: int, content: str, activity_time: datetime, status: str, original_message_id: Optional[int],
+                           idempotency_key: Optional[str] = None) -> bool:
+        """活動記録(なう/わず/うぃる)を追加する。その日と前日のロールアップは作り直すため破棄する
+
+        idempotency_key が記録済みなら何もせず False を返す。
+        """
+
+    @abstractmethod
+    async def fetch_activities_after(self, after_id: int, limit: int) -> List[Row]:
+        """after_id より後の活動記録 (id, user_id, content, activity_time, status) をID順に返す"""
+
+    @abstractmethod
+    async def activity_timeline(self, user_id: int, start: datetime, end: datetime, max_gap: timedelta, now: datetime) -> List[Row]:
+        """期間内の活動(うぃるを除く)を時刻順に返す
+
+        各行の seconds は次の記録までの秒数（max_gap で打ち切り、次がなければ now まで）。
+        """
+
+    @abstractmethod
+    async def activity_totals(self, user_id: int, start_day: date, end_day: date, max_gap: timedelta, now: datetime) -> List[Row]:
+        """日(day)・活動(content)ごとの合計秒数(seconds)と件数(entries)を返す。end_day は含まない
+
+        今日より前の日はロールアップ(activity_daily)から読み、未作成の日はここで作る。
+        """
+
+    # --- 残高・取引 ---
+    @abstractmethod
+    async def get_balances(self, user_id: int) -> Dict[str, int]:
+        """財布ごとの残高をカテゴリ名順で返す"""
+
+    @abstractmethod
+    async def get_balance_user_ids(self) -> List[int]:
+        """残高記録のあるユーザーIDを返す"""
+
+    @abstractmethod
+    async def reset_balance(self, user_id: int, wallet: str, amount: int):
+        """財布の残高を再設定し、残高チェックの状態も初期化する"""
+
+    @abstractmethod
+    async def add_salary(self, user_id: int, amount: int, allocations: Dict[str, int]):
+        """給料を振り分けて各財布に加算する"""
+
+    @abstractmethod
+    async def record_spend(self, user_id: int, category: str, amount: int, source_wallet: str,
+                           created_at: Optional[datetime] = None, reflect_balance: bool = True, idempotency_key: Optional[str] = None) -> Optional[SpendResult]:
+        """支出を記録し、取引IDと使用額が増えた予算を返す。残高不足なら InsufficientBalanceError。idempotency_key が記録済みなら None
+
+        残高に反映しない支出も、その月のカテゴリと支払元の財布の予算の使用額に数える。
+        """
+
+    @abstractmethod
+    async def transfer(self, user_id: int, source_wallet: str, destination_wallet: str, amount: int):
+        """財布間で資金を移動する。残高不足なら InsufficientBalanceError"""
+
+    @abstractmethod
+    async def take_balance_snapshots(self) -> int:
+        """全員の全財布の今の残高をスナップショットとして残し、件数を返す。過去の残高を求めるときの起点になる"""
+
+    @abstractmethod
+    async def balance_at(self, user_id: int, at: datetime) -> Dict[str, int]:
+        """at 時点の財布ごとの残高を返す（台帳を始める前で分からない財布は含めない）"""
+
+    @abstractmethod
+    async def balance_history(self, user_id: int, start: datetime, end: datetime) -> List[Row]:
+        """start より後 end 以前に残高が変わった日ごとの、その日の終わりの残高 (day, wallet, balance, starts) を日付順に返す
+
+        starts は台帳を始める前からあった財布の記録がその日から始まることを表す。start 時点の残高がわからない財布は、
+        その日の行で初めて現れる
+        """
+
+    @abstractmethod
+    async def recent_transactions(self, user_id: int, limit: int) -> List[Row]:
+        """新しい順に取引履歴を返す"""
+
+    @abstractmethod
+    async def edit_spend(self, user_id: int, transaction_id: int, tz: tzinfo, amount: Optional[int] = None,
+                         category: Optional[str] = None, source_wallet: Optional[str] = None,
+                         spend_date: Optional[date] = None, reflect_balance: Optional[bool] = None) -> List[BudgetUsage]:
+        """支出記録を修正し、残高と予算の使用額の巻き戻しと再適用を行う。使用額が増えた予算を返す"""
+
+    # --- 予算 ---
+    @abstractmethod
+    async def set_budget(self, user_id: int, category: str, amount: Optional[int]):
+        """カテゴリか財布の毎月の予算の上限を設定する。None なら予算を外す"""
+
+    @abstractmethod
+    async def budget_status(self, user_id: int, month: str) -> List[Row]:
+        """予算を設定しているカテゴリ・財布ごとの month の (category, amount, spent) を返す"""
+
+    # --- 定期取引 ---
+    @abstractmethod
+    async def add_recurring_rule(self, user_id: int, kind: str, amount: int, source_wallet: str, schedule: str, next_run_at: datetime,
+                                 category: Optional[str] = None, destination_wallet: Optional[str] = None) -> int:
+        """定期取引のルールを登録してIDを返す。kind は 'spend'（category が必要）か 'transfer'（destination_wallet が必要）"""
+
+    @abstractmethod
+    async def list_recurring_rules(self, user_id: int) -> List[Row]:
+        """ユーザーの定期取引のルールを次の実行日時の順に返す"""
+
+    @abstractmethod
+    async def delete_recurring_rule(self, user_id: int, rule_id: int) -> bool:
+        """ユーザーの定期取引のルールを消す。なければ False"""
+
+    @abstractmethod
+    async def apply_due_recurring(self, now: datetime) -> List[RecurringRun]:
+        """next_run_at が now 以前のルールを、止まっていた間の分も含めて実行日時の順に記録し、結果を返す
+
+        ユーザーごとに1トランザクションで記録し、各回は recurring_key で一度だけ記録する。残高不足の回で
+        そのルールは止め（次の呼び出しで再試行する）、失敗は続けて失敗している間は最初の1回だけ返す。
+        """
+
+    # --- 残高チェック ---
+    @abstractmethod
+    async def get_check_state(self, user_id: int) -> Optional[Row]:
+        """残高チェックの状態を返す"""
+
+    @abstractmethod
+    async def start_balance_check(self, user_id: int):
+        """残高チェックを最初の財布から開始する"""
+
+    @abstractmethod
+    async def save_check_input(self, user_id: int, wallet: str, amount: int, next_state: str) -> Row:
+        """入力された残高を保存して次の状態に進め、更新後の状態を返す"""
+
+    @abstractmethod
+    async def set_check_state(self, user_id: int, state: Optional[str]):
+        """残高チェックの状態だけを変更する"""
+
+    @abstractmethod
+    async def complete_balance_check(self, user_id: int):
+        """残高チェックを完了として記録する"""
+
+    @abstractmethod
+    async def apply_reconciliation(self, user_id: int, balances: Dict[str, Optional[int]]):
+        """入力された残高で財布を上書きし、残高チェックを完了する"""
+
+    # --- 会話の状態 ---
+    @abstractmethod
+    async def get_dialog_state(self, user_id: int, since: datetime) -> Optional[str]:
+        """since 以降に更新された会話状態(JSON文字列)を返す"""
+
+    @abstractmethod
+    async def set_dialog_state(self, user_id: int, state: str):
+        """会話状態(JSON文字列)を保存する"""
+
+    @abstractmethod
+    async def clear_dialog_state(self, user_id: int):
+        """会話状態を削除する"""
+
+    # --- Bot自身の状態 ---
+    @abstractmethod
+    async def get_meta(self, key: str) -> Optional[str]:
+        """キーに対応する値を返す（なければ None）"""
+
+    @abstractmethod
+    async def set_meta(self, key: str, value: str):
+        """キーに値を保存する"""
+
+    # --- 定期タスクの実行記録 ---
+    @abstractmethod
+    async def claim_job_run(self, job: str, period: str, owner: str, lease: timedelta) -> bool:
+        """job の period 回目の実行権を owner として取る
+
+        未実行か、前回が失敗したか、実行中のまま lease より長く生存通知が途絶えていれば取れる。成功済みなら取れない。
+        """
+
+    @abstractmethod
+    async def heartbeat_job_run(self, job: str, period: str, owner: str) -> bool:
+        """実行中であることを通知する。実行権を他に取られていれば False"""
+
+    @abstractmethod
+    async def finish_job_run(self, job: str, period: str, owner: str, succeeded: bool):
+        """実行結果を記録する"""
+
+    @abstractmethod
+    async def recent_job_runs(self, limit: int) -> List[Row]:
+        """実行記録 (job, period, owner, status, attempts, started_at, finished_at) を新しい順に返す"""
@@ -0,0 +1,825 @@
+"""
+PostgreSQL (asyncpg) によるストレージ実装
+"""
+
+import asyncio
+import itertools
+import logging
+from datetime import date, datetime, timedelta, timezone, tzinfo
+from typing import Any, Dict, List, Optional
+
+import asyncpg
+
+from db_trace import QueryStats, TracedPool, register_passthrough_module
+from invalidation import ChangeFeed
+from recurring import Schedule
+from storage.base import (
+    CHECK_INPUT_COLUMNS, REPORT_TZ, BudgetUsage, DuplicateStorageError, InsufficientBalanceError, RecurringRun, Row, SpendResult,
+    Storage, TransactionNotFoundError, budget_deltas, day_start, publishes_change, recurring_key,
+)
+
+logger = logging.getLogger(__name__)
+
+# スロークエリのハンドラ名はこのモジュールではなく呼び出し元から取る
+register_passthrough_module(__file__)
+
+# 次の記録までを1つの活動の所要時間とみなす。LEAD が範囲の外の記録も見られるよう max_gap だけ先まで読む
+# $1=user_id, $2=範囲の開始, $3=範囲の終了, $4=max_gap, $5=now
+ACTIVITY_SPANS_SQL = """
+    SELECT day, activity_time, content, status,
+           GREATEST(0, EXTRACT(EPOCH FROM LEAST(COALESCE(next_time, $5::timestamptz), activity_time + $4::interval) - activity_time))::bigint AS seconds
+    FROM (
+        SELECT (activity_time AT TIME ZONE 'Asia/Tokyo')::date AS day, activity_time, content, status,
+               LEAD(activity_time) OVER (ORDER BY activity_time, id) AS next_time
+        FROM activities
+        WHERE user_id = $1 AND status <> 'todo' AND activity_time >= $2 AND activity_time < $3::timestamptz + $4::interval
+    ) spans
+    WHERE activity_time < $3
+"""
+
+# 各財布の at 以前で最新のスナップショットに、それ以降の台帳の増減を足して at 時点の残高を出す
+# スナップショットは取った時点の台帳の最後のIDを持つので、足すのはそれより後の記録だけでよい
+# スナップショットがなく増減もない財布（台帳を始める前の時点）は含めない
+# $1=user_id, $2=at
+BALANCE_AT_SQL = """
+    SELECT b.category AS wallet, (COALESCE(s.balance, 0) + COALESCE(SUM(l.delta), 0))::bigint AS balance
+    FROM user_balances b
+    LEFT JOIN LATERAL (
+        SELECT balance, last_entry_id FROM balance_snapshots
+        WHERE user_id = b.user_id AND wallet = b.category AND taken_at <= $2 ORDER BY taken_at DESC LIMIT 1
+    ) s ON true
+    LEFT JOIN ledger_entries l
+        ON l.user_id = b.user_id AND l.wallet = b.category AND l.id > COALESCE(s.last_entry_id, 0) AND l.created_at <= $2
+    WHERE b.user_id = $1
+    GROUP BY b.category, s.balance, s.last_entry_id
+    HAVING s.last_entry_id IS NOT NULL OR COUNT(l.id) > 0
+"""
+
+# 予算の使用額を増減し、その予算の上限（未設定なら NULL）と一緒に返す。$1=user_id, $2=カテゴリか財布, $3=月, $4=増減
+BUDGET_SPEND_SQL = """
+    WITH spend AS (
+        INSERT INTO budget_spend (user_id, category, month, spent) VALUES ($1, $2, $3, $4)
+        ON CONFLICT (user_id, category, month) DO UPDATE SET spent = budget_spend.spent + EXCLUDED.spent
+        RETURNING spent
+    )
+    SELECT spend.spent, b.amount FROM spend LEFT JOIN budgets b ON b.user_id = $1 AND b.category = $2
+"""
+
+# 予算の使用額を始める前の支出を、カテゴリと支払元の財布の両方の月ごとの使用額に数える
+BUDGET_SPEND_BACKFILL_SQL = """
+    INSERT INTO budget_spend (user_id, category, month, spent)
+    SELECT user_id, name, month, SUM(amount) FROM (
+        SELECT user_id, category AS name, to_char(created_at AT TIME ZONE 'Asia/Tokyo', 'YYYY-MM') AS month, amount FROM transactions
+        WHERE transaction_type = 'spend' AND category IS NOT NULL AND created_at IS NOT NULL
+        UNION ALL
+        SELECT user_id, source_wallet, to_char(created_at AT TIME ZONE 'Asia/Tokyo', 'YYYY-MM'), amount FROM transactions
+        WHERE transaction_type = 'spend' AND source_wallet IS NOT NULL AND created_at IS NOT NULL
+    ) spends
+    GROUP BY user_id, name, month
+"""
+
+# 変更を通知するテーブルと、通知のキーにするカラム。通知は `テーブル名:キー` の形で CHANGE_CHANNEL に送る
+CHANGE_CHANNEL = 'sora_changes'
+CHANGE_NOTIFY_TABLES = {
+    'user_balances': 'user_id',
+    'balance_check_state': 'user_id',
+    'dialog_states': 'user_id',
+    'transactions': 'user_id',
+    'items': 'storage_id',
+    'storages': 'guild_id',
+}
+# 変更通知用の接続が生きているかを確かめる間隔と、切れたときにつなぎ直すまでの待ち時間
+CHANGE_LISTENER_PING_SEC = 30
+CHANGE_LISTENER_RETRY_SEC = 5
+
+
+class PostgresStorage(Storage):
+    backend = "postgres"
+    unavailable_errors = Storage.unavailable_errors + (
+        asyncpg.PostgresConnectionError, asyncpg.InterfaceError, asyncpg.CannotConnectNowError, asyncpg.TooManyConnectionsError,
+    )
+
+    def __init__(self, dsn: str, query_stats: QueryStats, explain: bool = False, **pool_kwargs):
+        self.dsn = dsn
+        self.query_stats = query_stats
+        self.explain = explain
+        self.pool_kwargs = pool_kwargs
+        self.pool: Optional[TracedPool] = None
+        self._schema_ready = False
+        # LISTEN が張れるまでは他プロセスの変更が届かない
+        self.changes = ChangeFeed(reliable=False)
+        self._change_listener: Optional[asyncio.Task] = None
+
+    @property
+    def is_ready(self) -> bool:
+        return self.pool is not None and self._schema_ready
+
+    def pool_stats(self) -> Dict[str, Any]:
+        if self.pool is None:
+            return {"connected": False}
+        size, idle = self.pool.get_size(), self.pool.get_idle_size()
+        return {
+            "connected": True, "size": size, "idle": idle, "in_use": size - idle,
+            "min_size": self.pool.get_min_size(), "max_size": self.pool.get_max_size(),
+        }
+
+    async def connect(self):
+        pool = await asyncpg.create_pool(self.dsn, **self.pool_kwargs)
+        self.pool = TracedPool(pool, self.query_stats, explain=self.explain)
+
+    async def close(self):
+        if self._change_listener is not None:
+            self._change_listener.cancel()
+            try:
+                await self._change_listener
+            except asyncio.CancelledError:
+                pass
+            self._change_listener = None
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+        self._schema_ready = False
+
+    async def init_schema(self):
+        async with self.pool.acquire() as conn:
+            # 複数のワーカーが同時に起動してもDDLが競合しないよう直列化する
+            await conn.execute("SELECT pg_advisory_lock(hashtext('sora:init_schema'))")
+            try:
+                await self._create_tables(conn)
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock(hashtext('sora:init_schema'))")
+        self._schema_ready = True
+
+    async def start_change_listener(self):
+        if self._change_listener is None:
+            self._change_listener = asyncio.create_task(self._listen_for_changes())
+
+    async def _listen_for_changes(self):
+        """プールとは別の専用接続で変更通知を待ち受ける。切れたら取りこぼした通知があるものとしてキャッシュを捨ててつなぎ直す"""
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.dsn)
+                await conn.add_listener(CHANGE_CHANNEL, self._on_change_notification)
+                self.changes.reset()
+                logger.info("他のプロセスからの変更通知の待ち受けを開始しました。")
+                while True:
+                    await asyncio.sleep(CHANGE_LISTENER_PING_SEC)
+                    await conn.fetchval("SELECT 1", timeout=10)
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                logger.warning(f"変更通知の待ち受けが切れたため、{CHANGE_LISTENER_RETRY_SEC}秒後につなぎ直します（それまでキャッシュは使いません）: {e}")
+            finally:
+                self.changes.reliable = False
+                if conn is not None:
+                    conn.terminate()
+            await asyncio.sleep(CHANGE_LISTENER_RETRY_SEC)
+
+    def _on_change_notification(self, conn, pid, channel, payload: str):
+        table, _, key = payload.partition(':')
+        self.changes.publish(table, int(key) if key else None)
+
+    async def _create_tables(self, conn):
+        await conn.execute('''CREATE TABLE IF NOT EXISTS guilds (id BIGINT PRIMARY KEY, name TEXT NOT NULL);''')
+        await conn.execute('''CREATE TABLE IF NOT EXISTS storages (id SERIAL PRIMARY KEY, guild_id BIGINT REFERENCES guilds(id) ON DELETE CASCADE, name TEXT NOT NULL, UNIQUE(guild_id, name));''')
+        await conn.execute('''CREATE TABLE IF NOT EXISTS items (id SERIAL PRIMARY KEY, storage_id INT REFERENCES storages(id) ON DELETE CASCADE, name TEXT NOT NULL, updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, UNIQUE(storage_id, name));''')
+        await conn.execute('''CREATE TABLE IF NOT EXISTS messages (id BIGINT PRIMARY KEY, guild_id BIGINT, channel_id BIGINT, user_id BIGINT, content TEXT, created_at TIMESTAMP WITH TIME ZONE);''')
+        await conn.execute('''ALTER TABLE messages ADD COLUMN IF NOT EXISTS edited_at TIMESTAMP WITH TIME ZONE, ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP WITH TIME ZONE;''')
+        await conn.execute('''CREATE TABLE IF NOT EXISTS user_balances (user_id BIGINT NOT NULL, category TEXT NOT NULL, balance BIGINT NOT NULL, PRIMARY KEY (user_id, category));''')
+        await conn.execute('''CREATE TABLE IF NOT EXISTS transactions (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, transaction_type TEXT NOT NULL, category TEXT, amount BIGINT NOT NULL, created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP);''')
+
+        # transactionsテーブルにカラムが存在するか確認し、なければ追加
+        table_name = 'transactions'
+        columns_to_add = {
+            'source_wallet': 'TEXT',
+            'is_balance_reflected': 'BOOLEAN'
+        }
+        for column_name, column_type in columns_to_add.items():
+            column_exists = await conn.fetchval(f'''
+                SELECT EXISTS (
+                    SELECT 1
+                    FROM pg_catalog.pg_attribute
+                    WHERE attrelid = '{table_name}'::regclass
+                    AND attname = '{column_name}'
+                    AND NOT attisdropped
+                );
+            ''')
+            if not column_exists:
+                await conn.execute(f'ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type};')
+                logger.info(f"{table_name}テーブルに{column_name}カラムを追加しました。")
+
+        # 作り直すとワーカーの再起動やスプールの再生のたびに途中の残高チェックが消えるので、なければ作るだけにする
+        await conn.execute('''CREATE TABLE IF NOT EXISTS balance_check_state (
+                            user_id BIGINT PRIMARY KEY,
+                            state TEXT,
+                            input_nushi BIGINT,
+                            input_pote BIGINT,
+                            input_budget BIGINT,
+                            input_savings BIGINT,
+                            last_checked_at TIMESTAMP WITH TIME ZONE
+                        );''')
+        # 財布が増えたときなど、列の変更は既存の行を残したまま足す
+        for column_name in CHECK_INPUT_COLUMNS.values():
+            await conn.execute(f'''ALTER TABLE balance_check_state ADD COLUMN IF NOT EXISTS {column_name} BIGINT;''')
+        await conn.execute('''ALTER TABLE balance_check_state ADD COLUMN IF NOT EXISTS last_checked_at TIMESTAMP WITH TIME ZONE;''')
+        logger.info("家計簿・残高チェック機能のテーブルを初期化しました。")
+
+        await conn.execute('''DROP TABLE IF EXISTS past_activities;''')
+        await conn.execute('''CREATE TABLE IF NOT EXISTS activities (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, channel_id BIGINT NOT NULL, guild_id BIGINT NOT NULL, content TEXT NOT NULL, activity_time TIMESTAMP WITH TIME ZONE NOT NULL, status TEXT NOT NULL, original_message_id BIGINT);''')
+        await conn.execute('''CREATE INDEX IF NOT EXISTS idx_messages_channel_id ON messages (channel_id, id);''')
+        await conn.execute('''CREATE INDEX IF NOT EXISTS idx_messages_user_time ON messages (user_id, created_at);''')
+        await conn.execute('''CREATE INDEX IF NOT EXISTS idx_activities_user_time ON activities (user_id, activity_time);''')
+        await conn.execute('''CREATE TABLE IF NOT EXISTS activity_daily (user_id BIGINT NOT NULL, day DATE NOT NULL, content TEXT NOT NULL, seconds BIGINT NOT NULL, entries INT NOT NULL, PRIMARY KEY (user_id, day, content));''')
+        await conn.execute('''CREATE TABLE IF NOT EXISTS activity_rollup_days (user_id BIGINT NOT NULL, day DATE NOT NULL, PRIMARY KEY (user_id, day));''')
+        await conn.execute('''CREATE TABLE IF NOT EXISTS idempotency_keys (key TEXT PRIMARY KEY, created_at TIMESTAMP WITH TIME ZONE NOT NULL);''')
+        await conn.execute('''CREATE TABLE IF NOT EXISTS dialog_states (user_id BIGINT PRIMARY KEY, state TEXT NOT NULL, updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP);''')
+        await conn.execute('''CREATE TABLE IF NOT EXISTS ledger_entries (id BIGSERIAL PRIMARY KEY, user_id BIGINT NOT NULL, wallet TEXT NOT NULL, delta BIGINT NOT NULL, created_at TIMESTAMP WITH TIME ZONE NOT NULL);''')
+        await conn.execute('''CREATE INDEX IF NOT EXISTS idx_ledger_entries_wallet_id ON ledger_entries (user_id, wallet, id);''')
+        await conn.execute('''CREATE INDEX IF NOT EXISTS idx_ledger_entries_user_time ON ledger_entries (user_id, created_at);''')
+        await conn.execute('''CREATE TABLE IF NOT EXISTS balance_snapshots (id BIGSERIAL PRIMARY KEY, user_id BIGINT NOT NULL, wallet TEXT NOT NULL, balance BIGINT NOT NULL, last_entry_id BIGINT NOT NULL, taken_at TIMESTAMP WITH TIME ZONE NOT NULL);''')
+        await conn.execute('''CREATE INDEX IF NOT EXISTS idx_balance_snapshots_wallet_time ON balance_snapshots (user_id, wallet, taken_at);''')
+        await conn.execute('''CREATE TABLE IF NOT EXISTS budgets (user_id BIGINT NOT NULL, category TEXT NOT NULL, amount BIGINT NOT NULL, PRIMARY KEY (user_id, category));''')
+        if await conn.fetchval("SELECT to_regclass('budget_spend') IS NULL"):
+            async with conn.transaction():
+                await conn.execute('''CREATE TABLE budget_spend (user_id BIGINT NOT NULL, category TEXT NOT NULL, month TEXT NOT NULL, spent BIGINT NOT NULL, PRIMARY KEY (user_id, category, month));''')
+                await conn.execute(BUDGET_SPEND_BACKFILL_SQL)
+        await conn.execute('''CREATE TABLE IF NOT EXISTS recurring_rules (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, kind TEXT NOT NULL, category TEXT, source_wallet TEXT NOT NULL, destination_wallet TEXT, amount BIGINT NOT NULL, schedule TEXT NOT NULL, next_run_at TIMESTAMP WITH TIME ZONE NOT NULL, last_error TEXT, created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP);''')
+        await conn.execute('''CREATE INDEX IF NOT EXISTS idx_recurring_rules_next_run ON recurring_rules (next_run_at);''')
+        await conn.execute('''CREATE TABLE IF NOT EXISTS job_runs (job TEXT NOT NULL, period TEXT NOT NULL, owner TEXT NOT NULL, status TEXT NOT NULL, attempts INT NOT NULL, started_at TIMESTAMP WITH TIME ZONE NOT NULL, heartbeat_at TIMESTAMP WITH TIME ZONE NOT NULL, finished_at TIMESTAMP WITH TIME ZONE, PRIMARY KEY (job, period));''')
+        await conn.execute('''CREATE TABLE IF NOT EXISTS bot_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP);''')
+        await self._create_change_triggers(conn)
+        await self._create_ledger_trigger(conn)
+        logger.info("活動記録テーブル(activities)を初期化しました。")
+
+    async def _create_change_triggers(self, conn):
+        # 他のプロセスや外部スクリプトの書き込みもキャッシュから消せるよう、トリガーで通知する（コミット時に届く）
+        await conn.execute(f'''
+            CREATE OR REPLACE FUNCTION sora_notify_change() RETURNS trigger AS $$
+            DECLARE
+                changed jsonb := CASE WHEN TG_OP = 'DELETE' THEN to_jsonb(OLD) ELSE to_jsonb(NEW) END;
+            BEGIN
+                PERFORM pg_notify('{CHANGE_CHANNEL}', TG_TABLE_NAME || ':' || COALESCE(changed ->> TG_ARGV[0], ''));
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        ''')
+        for table, key_column in CHANGE_NOTIFY_TABLES.items():
+            await conn.execute(f"DROP TRIGGER IF EXISTS sora_notify_change ON {table};")
+            await conn.execute(f"CREATE TRIGGER sora_notify_change AFTER INSERT OR UPDATE OR DELETE ON {table} FOR EACH ROW EXECUTE PROCEDURE sora_notify_change('{key_column}');")
+
+    async def _create_ledger_trigger(self, conn):
+        # どの経路で残高が変わっても（リセットや外部スクリプトも）増減を台帳に残す
+        await conn.execute('''
+            CREATE OR REPLACE FUNCTION sora_ledger_entry() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    INSERT INTO ledger_entries (user_id, wallet, delta, created_at) VALUES (NEW.user_id, NEW.category, NEW.balance, clock_timestamp());
+                ELSIF NEW.balance <> OLD.balance THEN
+                    INSERT INTO ledger_entries (user_id, wallet, delta, created_at) VALUES (NEW.user_id, NEW.category, NEW.balance - OLD.balance, clock_timestamp());
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        ''')
+        await conn.execute("DROP TRIGGER IF EXISTS sora_ledger_entry ON user_balances;")
+        await conn.execute("CREATE TRIGGER sora_ledger_entry AFTER INSERT OR UPDATE OF balance ON user_balances FOR EACH ROW EXECUTE PROCEDURE sora_ledger_entry();")
+        # 台帳を始める前からある財布は、今の残高を起点にする
+        await self._take_balance_snapshots(conn, only_missing=True)
+
+    # --- メッセージ ---
+    async def log_message(self, message_id, guild_id, channel_id, user_id, content, created_at):
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                "INSERT INTO messages (id, guild_id, channel_id, user_id, content, created_at) VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (id) DO NOTHING",
+                message_id, guild_id, channel_id, user_id, content, created_at,
+            )
+
+    async def log_messages(self, rows) -> List[int]:
+        if not rows:
+            return []
+        async with self.pool.acquire() as conn:
+            inserted = await conn.fetch("""
+                INSERT INTO messages (id, guild_id, channel_id, user_id, content, created_at)
+                SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::bigint[], $5::text[], $6::timestamptz[])
+                ON CONFLICT (id) DO NOTHING RETURNING id
+            """, *(list(column) for column in zip(*rows)))
+            return [row['id'] for row in inserted]
+
+    async def apply_message_edits(self, rows) -> int:
+        if not rows:
+            return 0
+        async with self.pool.acquire() as conn:
+            updated = await conn.fetch("""
+                INSERT INTO messages (id, guild_id, channel_id, user_id, content, created_at, edited_at)
+                SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::bigint[], $5::text[], $6::timestamptz[], $7::timestamptz[])
+                ON CONFLICT (id) DO UPDATE SET content = EXCLUDED.content, edited_at = EXCLUDED.edited_at
+                WHERE messages.deleted_at IS NULL AND (messages.edited_at IS NULL OR messages.edited_at < EXCLUDED.edited_at)
+                RETURNING id
+            """, *(list(column) for column in zip(*rows)))
+            return len(updated)
+
+    async def delete_messages(self, rows) -> int:
+        if not rows:
+            return 0
+        async with self.pool.acquire() as conn:
+            deleted = await conn.fetch("""
+                INSERT INTO messages (id, guild_id, channel_id, created_at, deleted_at)
+                SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::timestamptz[], $5::timestamptz[])
+                ON CONFLICT (id) DO UPDATE SET deleted_at = EXCLUDED.deleted_at WHERE messages.deleted_at IS NULL
+                RETURNING id
+            """, *(list(column) for column in zip(*rows)))
+            return len(deleted)
+
+    async def last_message_ids(self, channel_ids) -> Dict[int, int]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT c.id AS channel_id, (SELECT MAX(id) FROM messages WHERE channel_id = c.id) AS last_id
+                FROM unnest($1::bigint[]) AS c(id)
+            """, channel_ids)
+            return {row['channel_id']: row['last_id'] for row in rows if row['last_id'] is not None}
+
+    async def fetch_users_messages(self, user_ids, start, end, channel_id=None, limit_per_user=None) -> List[Row]:
+        async with self.pool.acquire() as conn:
+            # ユーザーごとに (user_id, created_at) の索引を上限の件数まで読む。LIMIT NULL は上限なし
+            return await conn.fetch("""
+                SELECT m.id, m.user_id, m.channel_id, m.content, m.created_at
+                FROM (SELECT DISTINCT unnest($1::bigint[]) AS user_id) u
+                CROSS JOIN LATERAL (
+                    SELECT id, user_id, channel_id, content, created_at FROM messages
+                    WHERE user_id = u.user_id AND created_at >= $2 AND created_at < $3 AND deleted_at IS NULL
+                      AND ($4::bigint IS NULL OR channel_id = $4)
+                    ORDER BY created_at LIMIT $5
+                ) m
+                ORDER BY m.user_id, m.created_at
+            """, user_ids, start, end, channel_id, limit_per_user)
+
+    async def fetch_messages_after(self, after_id, before, limit) -> List[Row]:
+        async with self.pool.acquire() as conn:
+            return await conn.fetch("""
+                SELECT id, user_id, channel_id, content, created_at FROM messages
+                WHERE id > $1 AND created_at < $2 AND deleted_at IS NULL ORDER BY id LIMIT $3
+            """, after_id, before, limit)
+
+    # --- 収納・備品 ---
+    async def add_storage(self, guild_id, guild_name, name):
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.execute("INSERT INTO guilds (id, name) VALUES ($1, $2) ON CONFLICT (id) DO UPDATE SET name = $2", guild_id, guild_name)
+                await conn.execute("INSERT INTO storages (guild_id, name) VALUES ($1, $2)", guild_id, name)
+        except asyncpg.UniqueViolationError:
+            raise DuplicateStorageError(name)
+
+    async def get_storage_id(self, guild_id, name) -> Optional[int]:
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval("SELECT id FROM storages WHERE guild_id = $1 AND name = $2", guild_id, name)
+
+    async def upsert_item(self, storage_id, name):
+        async with self.pool.acquire() as conn:
+            await conn.execute("INSERT INTO items (storage_id, name) VALUES ($1, $2) ON CONFLICT (storage_id, name) DO UPDATE SET updated_at = CURRENT_TIMESTAMP", storage_id, name)
+
+    async def find_item_storage(self, guild_id, item_name) -> Optional[str]:
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval("SELECT s.name FROM items i JOIN storages s ON i.storage_id = s.id WHERE i.name = $1 AND s.guild_id = $2", item_name, guild_id)
+
+    async def list_storage_items(self, guild_id, storage_name) -> List[str]:
+        async with self.pool.acquire() as conn:
+            results = await conn.fetch("SELECT i.name FROM items i JOIN storages s ON i.storage_id = s.id WHERE s.name = $1 AND s.guild_id = $2 ORDER BY i.name", storage_name, guild_id)
+        return [r['name'] for r in results]
+
+    # --- 活動記録 ---
+    @staticmethod
+    async def _claim_idempotency_key(conn, key: Optional[str]) -> bool:
+        """key を記録する。未指定なら常に True、記録済みなら False"""
+        if key is None:
+            return True
+        return bool(await conn.fetchval("INSERT INTO idempotency_keys (key, created_at) VALUES ($1, CURRENT_TIMESTAMP) ON CONFLICT DO NOTHING RETURNING true", key))
+
+    async def add_activity(self, user_id, channel_id, guild_id, content, activity_time, status, original_message_id, idempotency_key=None) -> bool:
+        day = activity_time.astimezone(REPORT_TZ).date()
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if not await self._claim_idempotency_key(conn, idempotency_key):
+                    return False
+                await conn.execute("INSERT INTO activities (user_id, channel_id, guild_id, content, activity_time, status, original_message_id) VALUES ($1, $2, $3, $4, $5, $6, $7)",
+                                   user_id, channel_id, guild_id, content, activity_time, status, original_message_id)
+                # 前日の最後の活動の所要時間も変わるので、前日と当日のロールアップを作り直させる
+                await conn.execute("DELETE FROM activity_rollup_days WHERE user_id = $1 AND day BETWEEN $2::date - 1 AND $2", user_id, day)
+                await conn.execute("DELETE FROM activity_daily WHERE user_id = $1 AND day BETWEEN $2::date - 1 AND $2", user_id, day)
+        return True
+
+    async def fetch_activities_after(self, after_id, limit) -> List[Row]:
+        async with self.pool.acquire() as conn:
+            return await conn.fetch("SELECT id, user_id, content, activity_time, status FROM activities WHERE id > $1 ORDER BY id LIMIT $2", after_id, limit)
+
+    async def activity_timeline(self, user_id, start, end, max_gap, now) -> List[Row]:
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(ACTIVITY_SPANS_SQL + " ORDER BY activity_time", user_id, start, end, max_gap, now)
+
+    async def activity_totals(self, user_id, start_day, end_day, max_gap, now) -> List[Row]:
+        today = now.astimezone(REPORT_TZ).date()
+        rollup_end = max(start_day, min(end_day, today))
+        live_start = day_start(max(start_day, today))
+        live_end = max(live_start, day_start(end_day))
+        async with self.pool.acquire() as conn:
+            if start_day < rollup_end:
+                await self._ensure_activity_rollup(conn, user_id, start_day, rollup_end, max_gap, now)
+            # 過去の日はロールアップ、今日は activities から、を1回の問い合わせで読む
+            return await conn.fetch(
+                f"""SELECT day, content, seconds, entries FROM activity_daily WHERE user_id = $1 AND day >= $6 AND day < $7
+                    UNION ALL
+                    SELECT day, content, SUM(seconds)::bigint, COUNT(*)::int FROM ({ACTIVITY_SPANS_SQL}) live GROUP BY day, content
+                    ORDER BY day, seconds DESC""",
+                user_id, live_start, live_end, max_gap, now, start_day, rollup_end)
+
+    async def _ensure_activity_rollup(self, conn, user_id, start_day, end_day, max_gap, now):
+        """[start_day, end_day) のうちロールアップがまだない日を作る"""
+        rows = await conn.fetch(
+            "SELECT d::date AS day FROM generate_series($2::date, $3::date - 1, interval '1 day') AS d "
+            "WHERE NOT EXISTS (SELECT 1 FROM activity_rollup_days r WHERE r.user_id = $1 AND r.day = d::date)",
+            user_id, start_day, end_day)
+        if not rows:
+            return
+        days = [row['day'] for row in rows]
+        async with conn.transaction():
+            await conn.execute(
+                f"""INSERT INTO activity_daily (user_id, day, content, seconds, entries)
+                    SELECT $1, day, content, SUM(seconds), COUNT(*) FROM ({ACTIVITY_SPANS_SQL}) spans WHERE day = ANY($6::date[]) GROUP BY day, content
+                    ON CONFLICT (user_id, day, content) DO UPDATE SET seconds = EXCLUDED.seconds, entries = EXCLUDED.entries""",
+                user_id, day_start(days[0]), day_start(days[-1] + timedelta(days=1)), max_gap, now, days)
+            await conn.execute("INSERT INTO activity_rollup_days (user_id, day) SELECT $1, unnest($2::date[]) ON CONFLICT DO NOTHING", user_id, days)
+
+    # --- 残高・取引 ---
+    async def get_balances(self, user_id) -> Dict[str, int]:
+        async with self.pool.acquire() as conn:
+            records = await conn.fetch("SELECT category, balance FROM user_balances WHERE user_id = $1 ORDER BY category", user_id)
+        return {r['category']: r['balance'] for r in records}
+
+    async def get_balance_user_ids(self) -> List[int]:
+        async with self.pool.acquire() as conn:
+            records = await conn.fetch("SELECT DISTINCT user_id FROM user_balances")
+        return [r['user_id'] for r in records]
+
+    @publishes_change('balance_check_state')
+    async def reset_balance(self, user_id, wallet, amount):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # 指定された財布の残高を更新または挿入
+                await conn.execute("""
+                    INSERT INTO user_balances (user_id, category, balance)
+                    VALUES ($1, $2, $3)
+                    ON CONFLICT (user_id, category) DO UPDATE SET balance = $3
+                    """, user_id, wallet, amount)
+
+                # 取引履歴を記録
+                await conn.execute("""
+                    INSERT INTO transactions (user_id, transaction_type, category, amount)
+                    VALUES ($1, 'reset', $2, $3)
+                    """, user_id, wallet, amount)
+
+                # 残高チェックの状態もリセット
+                await conn.execute("UPDATE balance_check_state SET state = NULL, input_nushi=NULL, input_pote=NULL, input_budget=NULL, input_savings=NULL, last_checked_at = NULL WHERE user_id = $1", user_id)
+
+    async def add_salary(self, user_id, amount, allocations):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # 各カテゴリの残高を更新
+                for category, cat_amount in allocations.items():
+                    if cat_amount > 0:
+                        await conn.execute("""
+                            INSERT INTO user_balances (user_id, category, balance)
+                            VALUES ($1, $2, $3)
+                            ON CONFLICT (user_id, category) DO UPDATE
+                            SET balance = user_balances.balance + $3;
+                            """, user_id, category, cat_amount)
+
+                # 取引履歴を記録
+                await conn.execute("""
+                    INSERT INTO transactions (user_id, transaction_type, category, amount)
+                    VALUES ($1, 'salary', '給与収入', $2);
+                    """, user_id, amount)
+
+    async def record_spend(self, user_id, category, amount, source_wallet, created_at=None, reflect_balance=True, idempotency_key=None) -> Optional[SpendResult]:
+        created_at = created_at or datetime.now(timezone.utc)
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if not await self._claim_idempotency_key(conn, idempotency_key):
+                    return None
+                if reflect_balance:
+                    await self._debit(conn, user_id, source_wallet, amount)
+
+                # 取引履歴を記録
+                transaction_id = await conn.fetchval('''
+                    INSERT INTO transactions (user_id, transaction_type, category, amount, created_at, source_wallet, is_balance_reflected)
+                    VALUES ($1, 'spend', $2, $3, $4, $5, $6)
+                    RETURNING id;
+                    ''', user_id, category, amount, created_at, source_wallet, reflect_balance)
+
+                # 予算の使用額に数える
+                budgets = await self._add_budget_spend(conn, user_id, budget_deltas((category, source_wallet, created_at, amount)))
+                return SpendResult(transaction_id, budgets)
+
+    @staticmethod
+    async def _add_budget_spend(conn, user_id: int, deltas) -> List[BudgetUsage]:
+        """予算の使用額を増減し、増えたもののうち上限を設定している予算を返す。トランザクション内で呼ぶこと"""
+        budgets = []
+        for (category, month), delta in deltas.items():
+            if not delta:
+                continue
+            row = await conn.fetchrow(BUDGET_SPEND_SQL, user_id, category, month, delta)
+            if delta > 0 and row['amount'] is not None:
+                budgets.append(BudgetUsage(category, month, row['spent'] - delta, row['spent'], row['amount']))
+        return budgets
+
+    async def transfer(self, user_id, source_wallet, destination_wallet, amount):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # 移動元の残高を減らす
+                await self._debit(conn, user_id, source_wallet, amount)
+
+                # 移動先の残高を増やす
+                await conn.execute("""
+                    INSERT INTO user_balances (user_id, category, balance)
+                    VALUES ($1, $2, $3)
+                    ON CONFLICT (user_id, category) DO UPDATE
+                    SET balance = user_balances.balance + $3;
+                    """, user_id, destination_wallet, amount)
+
+                # 取引履歴を記録
+                await conn.execute("""
+                    INSERT INTO transactions (user_id, transaction_type, category, amount)
+                    VALUES ($1, 'transfer', $2, $3);
+                    """, user_id, f"{source_wallet}から{destination_wallet}へ", amount)
+
+    @staticmethod
+    async def _take_balance_snapshots(conn, only_missing: bool = False) -> int:
+        async with conn.transaction():
+            # 書き込み中のトランザクションの完了を待ち、残高と台帳の最後のIDが食い違わない状態で取る
+            await conn.execute("LOCK TABLE user_balances IN SHARE MODE")
+            status = await conn.execute(f"""
+                INSERT INTO balance_snapshots (user_id, wallet, balance, last_entry_id, taken_at)
+                SELECT user_id, category, balance, (SELECT COALESCE(MAX(id), 0) FROM ledger_entries), clock_timestamp() FROM user_balances b
+                {"WHERE NOT EXISTS (SELECT 1 FROM balance_snapshots s WHERE s.user_id = b.user_id AND s.wallet = b.category)" if only_missing else ""}
+            """)
+        return int(status.split()[-1])
+
+    async def take_balance_snapshots(self) -> int:
+        async with self.pool.acquire() as conn:
+            return await self._take_balance_snapshots(conn)
+
+    async def balance_at(self, user_id, at) -> Dict[str, int]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(BALANCE_AT_SQL + " ORDER BY b.category", user_id, at)
+        return {row['wallet']: row['balance'] for row in rows}
+
+    async def balance_history(self, user_id, start, end) -> List[Row]:
+        async with self.pool.acquire() as conn:
+            # start 時点の残高に、日ごとの増減の累積和を足していく
+            # start 時点で記録がなく台帳を始める前からあった財布は、期間中の最初のスナップショットを起点にし、
+            # その日を starts にする（それより前の日の残高はわからない）
+            return await conn.fetch(f"""
+                WITH opening AS ({BALANCE_AT_SQL}),
+                anchors AS (
+                    SELECT s.wallet, s.balance, s.last_entry_id, (s.taken_at AT TIME ZONE 'Asia/Tokyo')::date AS day
+                    FROM (
+                        SELECT DISTINCT ON (wallet) wallet, balance, last_entry_id, taken_at FROM balance_snapshots
+                        WHERE user_id = $1 AND taken_at > $2 AND taken_at <= $3 ORDER BY wallet, taken_at
+                    ) s
+                    WHERE s.wallet NOT IN (SELECT wallet FROM opening)
+                      AND NOT EXISTS (SELECT 1 FROM ledger_entries l WHERE l.user_id = $1 AND l.wallet = s.wallet AND l.id <= s.last_entry_id)
+                ),
+                changes AS (
+                    SELECT l.wallet, (l.created_at AT TIME ZONE 'Asia/Tokyo')::date AS day, l.delta FROM ledger_entries l
+                    LEFT JOIN anchors a ON a.wallet = l.wallet
+                    WHERE l.user_id = $1 AND l.created_at > $2 AND l.created_at <= $3 AND l.id > COALESCE(a.last_entry_id, 0)
+                    UNION ALL
+                    SELECT wallet, day, balance FROM anchors
+                ),
+                daily AS (SELECT wallet, day, SUM(delta) AS delta FROM changes GROUP BY wallet, day)
+                SELECT d.day, d.wallet, (COALESCE(o.balance, 0) + SUM(d.delta) OVER (PARTITION BY d.wallet ORDER BY d.day))::bigint AS balance,
+                       COALESCE(d.day = a.day, false) AS starts
+                FROM daily d LEFT JOIN opening o ON o.wallet = d.wallet LEFT JOIN anchors a ON a.wallet = d.wallet
+                ORDER BY d.day, d.wallet
+            """, user_id, start, end)
+
+    @staticmethod
+    async def _debit(conn, user_id: int, wallet: str, amount: int):
+        """残高が足りるときだけ財布を減らす。トランザクション内で呼ぶこと"""
+        # 確認と減算を1つの UPDATE にして、同時に引き落とす別のトランザクションと合わせて残高を超えないようにする
+        # （行ロックを待った UPDATE は、相手の確定後の残高で WHERE を評価し直す）
+        updated = await conn.fetchval(
+            "UPDATE user_balances SET balance = balance - $1 WHERE user_id = $2 AND category = $3 AND balance >= $1 RETURNING balance",
+            amount, user_id, wallet,
+        )
+        if updated is None:
+            current_balance = await conn.fetchval("SELECT balance FROM user_balances WHERE user_id = $1 AND category = $2", user_id, wallet)
+            raise InsufficientBalanceError(wallet, current_balance or 0)
+
+    async def recent_transactions(self, user_id, limit) -> List[Row]:
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(
+                "SELECT id, transaction_type, category, amount, created_at, source_wallet, is_balance_reflected FROM transactions WHERE user_id = $1 ORDER BY created_at DESC LIMIT $2",
+                user_id, limit
+            )
+
+    async def edit_spend(self, user_id, transaction_id, tz: tzinfo, amount=None, category=None, source_wallet=None,
+                         spend_date: Optional[date] = None, reflect_balance=None) -> List[BudgetUsage]:
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # 1. 元の取引情報を取得
+                old_tx = await conn.fetchrow("SELECT * FROM transactions WHERE id = $1 AND user_id = $2 AND transaction_type = 'spend'", transaction_id, user_id)
+                if not old_tx:
+                    raise TransactionNotFoundError(transaction_id)
+
+                # 2. 新しい取引情報を準備
+                new_amount = amount if amount is not None else old_tx['amount']
+                new_category = category if category is not None else old_tx['category']
+                new_wallet = source_wallet if source_wallet is not None else old_tx['source_wallet']
+                new_reflect_balance = reflect_balance if reflect_balance is not None else old_tx['is_balance_reflected']
+                new_time = old_tx['created_at']
+                if spend_date:
+                    original_time = old_tx['created_at'].astimezone(tz).time()
+                    new_time = datetime.combine(spend_date, original_time.replace(microsecond=0, tzinfo=None), tzinfo=tz)
+
+                # 3. 残高の巻き戻し
+                if old_tx['is_balance_reflected'] and old_tx['source_wallet']:
+                    await conn.execute("UPDATE user_balances SET balance = balance + $1 WHERE user_id = $2 AND category = $3", old_tx['amount'], user_id, old_tx['source_wallet'])
+
+                # 4. 残高の再適用
+                if new_reflect_balance and new_wallet:
+                    await self._debit(conn, user_id, new_wallet, new_amount)
+
+                # 5. 取引記録の更新
+                await conn.execute("""
+                    UPDATE transactions
+                    SET amount = $1, category = $2, source_wallet = $3, created_at = $4, is_balance_reflected = $5
+                    WHERE id = $6
+                """, new_amount, new_category, new_wallet, new_time, new_reflect_balance, transaction_id)
+
+                # 6. 予算の使用額の付け替え
+                return await self._add_budget_spend(conn, user_id, budget_deltas(
+                    (old_tx['category'], old_tx['source_wallet'], old_tx['created_at'], -old_tx['amount']),
+                    (new_category, new_wallet, new_time, new_amount)))
+
+    # --- 予算 ---
+    async def set_budget(self, user_id, category, amount):
+        async with self.pool.acquire() as conn:
+            if amount is None:
+                await conn.execute("DELETE FROM budgets WHERE user_id = $1 AND category = $2", user_id, category)
+            else:
+                await conn.execute("INSERT INTO budgets (user_id, category, amount) VALUES ($1, $2, $3) ON CONFLICT (user_id, category) DO UPDATE SET amount = EXCLUDED.amount",
+                                   user_id, category, amount)
+
+    async def budget_status(self, user_id, month) -> List[Row]:
+        async with self.pool.acquire() as conn:
+            return await conn.fetch("""
+                SELECT b.category, b.amount, COALESCE(s.spent, 0) AS spent FROM budgets b
+                LEFT JOIN budget_spend s ON s.user_id = b.user_id AND s.category = b.category AND s.month = $2
+                WHERE b.user_id = $1 ORDER BY b.category
+            """, user_id, month)
+
+    # --- 定期取引 ---
+    async def add_recurring_rule(self, user_id, kind, amount, source_wallet, schedule, next_run_at, category=None, destination_wallet=None) -> int:
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval("""
+                INSERT INTO recurring_rules (user_id, kind, category, source_wallet, destination_wallet, amount, schedule, next_run_at)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8) RETURNING id
+            """, user_id, kind, category, source_wallet, destination_wallet, amount, schedule, next_run_at)
+
+    async def list_recurring_rules(self, user_id) -> List[Row]:
+        async with self.pool.acquire() as conn:
+            return await conn.fetch("SELECT * FROM recurring_rules WHERE user_id = $1 ORDER BY next_run_at, id", user_id)
+
+    async def delete_recurring_rule(self, user_id, rule_id) -> bool:
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval("DELETE FROM recurring_rules WHERE id = $1 AND user_id = $2 RETURNING true", rule_id, user_id) is not None
+
+    async def apply_due_recurring(self, now) -> List[RecurringRun]:
+        async with self.pool.acquire() as conn:
+            rules = await conn.fetch("SELECT * FROM recurring_rules WHERE next_run_at <= $1 ORDER BY user_id, next_run_at, id", now)
+            runs = []
+            for _, user_rules in itertools.groupby(rules, key=lambda rule: rule['user_id']):
+                async with conn.transaction():
+                    for rule in user_rules:
+                        runs.extend(await self._apply_recurring_rule(conn, rule, now))
+            return runs
+
+    async def _apply_recurring_rule(self, conn, rule, now) -> List[RecurringRun]:
+        schedule = Schedule(rule['schedule'])
+        due_at, error, runs = rule['next_run_at'], None, []
+        while due_at <= now:
+            try:
+                # 入れ子のトランザクション（セーブポイント）で、残高不足の回だけを取り消す
+                async with conn.transaction():
+                    if await self._claim_idempotency_key(conn, recurring_key(rule['id'], due_at)):
+                        runs.append(RecurringRun(rule, due_at, await self._post_recurring(conn, rule, due_at)))
+            except InsufficientBalanceError as e:
+                error = e
+                break
+            due_at = schedule.next_after(due_at)
+        if error is not None and rule['last_error'] is None:
+            runs.append(RecurringRun(rule, due_at, [], error))
+        await conn.execute("UPDATE recurring_rules SET next_run_at = $1, last_error = $2 WHERE id = $3", due_at, str(error) if error else None, rule['id'])
+        return runs
+
+    async def _post_recurring(self, conn, rule, due_at) -> List[BudgetUsage]:
+        user_id, amount, source_wallet = rule['user_id'], rule['amount'], rule['source_wallet']
+        await self._debit(conn, user_id, source_wallet, amount)
+        if rule['kind'] == 'transfer':
+            await conn.execute("""
+                INSERT INTO user_balances (user_id, category, balance) VALUES ($1, $2, $3)
+                ON CONFLICT (user_id, category) DO UPDATE SET balance = user_balances.balance + $3
+            """, user_id, rule['destination_wallet'], amount)
+            await conn.execute("INSERT INTO transactions (user_id, transaction_type, category, amount, created_at) VALUES ($1, 'transfer', $2, $3, $4)",
+                               user_id, f"{source_wallet}から{rule['destination_wallet']}へ", amount, due_at)
+            return []
+        await conn.execute("""
+            INSERT INTO transactions (user_id, transaction_type, category, amount, created_at, source_wallet, is_balance_reflected)
+            VALUES ($1, 'spend', $2, $3, $4, $5, true)
+        """, user_id, rule['category'], amount, due_at, source_wallet)
+        return await self._add_budget_spend(conn, user_id, budget_deltas((rule['category'], source_wallet, due_at, amount)))
+
+    # --- 残高チェック ---
+    async def get_check_state(self, user_id) -> Optional[Row]:
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow("SELECT * FROM balance_check_state WHERE user_id = $1", user_id)
+
+    @publishes_change('balance_check_state')
+    async def start_balance_check(self, user_id):
+        async with self.pool.acquire() as conn:
+            await conn.execute("INSERT INTO balance_check_state (user_id, state) VALUES ($1, 'waiting_for_balance_ぬし財布') ON CONFLICT (user_id) DO UPDATE SET state = 'waiting_for_balance_ぬし財布', input_nushi=NULL, input_pote=NULL, input_budget=NULL, input_savings=NULL;", user_id)
+
+    @publishes_change('balance_check_state')
+    async def save_check_input(self, user_id, wallet, amount, next_state) -> Row:
+        column = CHECK_INPUT_COLUMNS[wallet]
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow(f"UPDATE balance_check_state SET {column} = $1, state = $2 WHERE user_id = $3 RETURNING *", amount, next_state, user_id)
+
+    @publishes_change('balance_check_state')
+    async def set_check_state(self, user_id, state):
+        async with self.pool.acquire() as conn:
+            await conn.execute("UPDATE balance_check_state SET state = $1 WHERE user_id = $2", state, user_id)
+
+    @publishes_change('balance_check_state')
+    async def complete_balance_check(self, user_id):
+        async with self.pool.acquire() as conn:
+            await conn.execute("UPDATE balance_check_state SET state = NULL, last_checked_at = CURRENT_TIMESTAMP WHERE user_id = $1", user_id)
+
+    @publishes_change('balance_check_state')
+    async def apply_reconciliation(self, user_id, balances):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                for wallet, new_balance in balances.items():
+                    if new_balance is not None:
+                        await conn.execute("INSERT INTO user_balances (user_id, category, balance) VALUES ($1, $2, $3) ON CONFLICT (user_id, category) DO UPDATE SET balance = $3", user_id, wallet, new_balance)
+                await conn.execute("UPDATE balance_check_state SET state = NULL, last_checked_at = CURRENT_TIMESTAMP WHERE user_id = $1", user_id)
+
+    # --- 会話の状態 ---
+    async def get_dialog_state(self, user_id, since) -> Optional[str]:
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval("SELECT state FROM dialog_states WHERE user_id = $1 AND updated_at >= $2", user_id, since)
+
+    @publishes_change('dialog_states')
+    async def set_dialog_state(self, user_id, state):
+        async with self.pool.acquire() as conn:
+            await conn.execute("INSERT INTO dialog_states (user_id, state) VALUES ($1, $2) ON CONFLICT (user_id) DO UPDATE SET state = $2, updated_at = CURRENT_TIMESTAMP", user_id, state)
+
+    @publishes_change('dialog_states')
+    async def clear_dialog_state(self, user_id):
+        async with self.pool.acquire() as conn:
+            await conn.execute("DELETE FROM dialog_states WHERE user_id = $1", user_id)
+
+    # --- Bot自身の状態 ---
+    async def get_meta(self, key) -> Optional[str]:
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval("SELECT value FROM bot_meta WHERE key = $1", key)
+
+    async def set_meta(self, key, value):
+        async with self.pool.acquire() as conn:
+            await conn.execute("INSERT INTO bot_meta (key, value) VALUES ($1, $2) ON CONFLICT (key) DO UPDATE SET value = $2, updated_at = CURRENT_TIMESTAMP", key, value)
+
+    # --- 定期タスクの実行記録 ---
+    async def claim_job_run(self, job, period, owner, lease) -> bool:
+        async with self.pool.acquire() as conn:
+            return bool(await conn.fetchval("""
+                INSERT INTO job_runs (job, period, owner, status, attempts, started_at, heartbeat_at)
+                VALUES ($1, $2, $3, 'running', 1, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                ON CONFLICT (job, period) DO UPDATE SET owner = EXCLUDED.owner, status = 'running', attempts = job_runs.attempts + 1,
+                    started_at = EXCLUDED.started_at, heartbeat_at = EXCLUDED.heartbeat_at, finished_at = NULL
+                WHERE job_runs.status = 'failed' OR (job_runs.status = 'running' AND job_runs.heartbeat_at < CURRENT_TIMESTAMP - $4::interval)
+                RETURNING true
+            """, job, period, owner, lease))
+
+    async def heartbeat_job_run(self, job, period, owner) -> bool:
+        async with self.pool.acquire() as conn:
+            return bool(await conn.fetchval(
+                "UPDATE job_runs SET heartbeat_at = CURRENT_TIMESTAMP WHERE job = $1 AND period = $2 AND owner = $3 AND status = 'running' RETURNING true",
+                job, period, owner))
+
+    async def finish_job_run(self, job, period, owner, succeeded):
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                "UPDATE job_runs SET status = $4, finished_at = CURRENT_TIMESTAMP WHERE job = $1 AND period = $2 AND owner = $3 AND status = 'running'",
+                job, period, owner, 'done' if succeeded else 'failed')
+
+    async def recent_job_runs(self, limit) -> List[Row]:
+        async with self.pool.acquire() as conn:
+            return await conn.fetch("SELECT job, period, owner, status, attempts, started_at, finished_at FROM job_runs ORDER BY started_at DESC LIMIT $1", limit)
@@ -0,0 +1,814 @@
+"""
+組み込み SQLite によるストレージ実装
+
+WAL モードで開き、全ての操作を専用スレッド1本で直列に実行する。
+イベントループは run_in_executor で結果を待つだけなので、ネットワーク越しの
+PostgreSQL が無い小規模な運用やベンチマークでもボットを起動できる。
+"""
+
+import asyncio
+import itertools
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone, tzinfo
+from typing import Any, Dict, List, Optional
+
+from db_trace import QueryStats, calling_handler, param_shapes, register_passthrough_module
+from invalidation import ChangeFeed
+from recurring import Schedule
+from storage.base import (
+    CHECK_INPUT_COLUMNS, REPORT_TZ, BudgetUsage, DuplicateStorageError, InsufficientBalanceError, RecurringRun, Row, SpendResult,
+    Storage, TransactionNotFoundError, budget_deltas, day_start, publishes_change, recurring_key,
+)
+
+logger = logging.getLogger(__name__)
+
+register_passthrough_module(__file__)
+
+
+def _adapt_datetime(value: datetime) -> str:
+    # 文字列比較で時系列順になるよう、UTCの固定長で保存する
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f+00:00')
+
+
+def _convert_timestamp(raw: bytes) -> datetime:
+    return datetime.fromisoformat(raw.decode())
+
+
+sqlite3.register_adapter(datetime, _adapt_datetime)
+sqlite3.register_converter("TIMESTAMPTZ", _convert_timestamp)
+sqlite3.register_converter("BOOLEAN", lambda raw: raw != b'0')
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+# 次の記録までを1つの活動の所要時間とみなす。LEAD が範囲の外の記録も見られるよう max_gap だけ先まで読む
+ACTIVITY_SPANS_SQL = """
+    SELECT day, activity_time, content, status,
+           CAST(ROUND(MAX(0, (MIN(julianday(COALESCE(next_time, :now)), julianday(activity_time) + :gap_days) - julianday(activity_time)) * 86400)) AS INTEGER) AS seconds
+    FROM (
+        SELECT date(activity_time, '+9 hours') AS day, activity_time, content, status,
+               LEAD(activity_time) OVER (ORDER BY activity_time, id) AS next_time
+        FROM activities
+        WHERE user_id = :user_id AND status <> 'todo' AND activity_time >= :start AND activity_time < :until
+    )
+    WHERE activity_time < :end
+"""
+
+# 各財布の at 以前で最新のスナップショットに、それ以降の台帳の増減を足して at 時点の残高を出す（Postgres版と同じ）
+BALANCE_AT_SQL = """
+    SELECT b.category AS wallet, COALESCE(s.balance, 0) + COALESCE(SUM(l.delta), 0) AS balance
+    FROM user_balances b
+    LEFT JOIN balance_snapshots s ON s.id = (
+        SELECT id FROM balance_snapshots
+        WHERE user_id = b.user_id AND wallet = b.category AND taken_at <= :at ORDER BY taken_at DESC LIMIT 1
+    )
+    LEFT JOIN ledger_entries l
+        ON l.user_id = b.user_id AND l.wallet = b.category AND l.id > COALESCE(s.last_entry_id, 0) AND l.created_at <= :at
+    WHERE b.user_id = :user_id
+    GROUP BY b.category
+    HAVING s.id IS NOT NULL OR COUNT(l.id) > 0
+"""
+
+# 予算の使用額を始める前の支出を、カテゴリと支払元の財布の両方の月ごとの使用額に数える
+BUDGET_SPEND_BACKFILL_SQL = """
+    INSERT INTO budget_spend (user_id, category, month, spent)
+    SELECT user_id, name, month, SUM(amount) FROM (
+        SELECT user_id, category AS name, strftime('%Y-%m', created_at, '+9 hours') AS month, amount FROM transactions
+        WHERE transaction_type = 'spend' AND category IS NOT NULL AND created_at IS NOT NULL
+        UNION ALL
+        SELECT user_id, source_wallet, strftime('%Y-%m', created_at, '+9 hours'), amount FROM transactions
+        WHERE transaction_type = 'spend' AND source_wallet IS NOT NULL AND created_at IS NOT NULL
+    )
+    GROUP BY user_id, name, month
+"""
+
+# トリガーの中で _adapt_datetime と同じ形式の現在時刻を作る（SQLiteはミリ秒までなので残りは0で埋める）
+_SQL_NOW = "strftime('%Y-%m-%dT%H:%M:%f000+00:00', 'now')"
+
+
+def _span_params(user_id: int, start: datetime, end: datetime, max_gap: timedelta, now: datetime) -> dict:
+    return {"user_id": user_id, "start": start, "end": end, "until": end + max_gap,
+            "gap_days": max_gap.total_seconds() / 86400, "now": now}
+
+
+class SQLiteStorage(Storage):
+    backend = "sqlite"
+    unavailable_errors = Storage.unavailable_errors + (sqlite3.OperationalError,)
+
+    def __init__(self, path: str, query_stats: QueryStats):
+        self.path = path
+        self.query_stats = query_stats
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._schema_ready = False
+        # 書き込むのはこのプロセスだけなので、変更はすべて publishes_change で届く
+        self.changes = ChangeFeed()
+
+    @property
+    def is_ready(self) -> bool:
+        return self._conn is not None and self._schema_ready
+
+    async def _run(self, fn, *args):
+        """同期関数をSQLite専用スレッドで実行し、所要時間を記録する"""
+        handler = calling_handler()
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            duration = time.perf_counter() - started
+            query = f"sqlite:{fn.__name__.lstrip('_')}"
+            if self.query_stats.record(query, handler, duration, args):
+                logger.warning(f"スロークエリ検出 ({duration * 1000:.1f}ms) [{handler}] {query} 引数: ({param_shapes(args)})")
+
+    @contextmanager
+    def _transaction(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._conn
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        else:
+            self._conn.execute("COMMIT")
+
+    def pool_stats(self) -> Dict[str, Any]:
+        return {"connected": self._conn is not None, "path": self.path}
+
+    async def connect(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-storage")
+        self._conn = await asyncio.get_running_loop().run_in_executor(self._executor, self._open)
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.execute("PRAGMA busy_timeout=5000")
+        logger.info(f"SQLiteデータベース {self.path} を開きました。")
+        return conn
+
+    async def close(self):
+        if self._conn is not None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._conn.close)
+            self._conn = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._schema_ready = False
+
+    async def init_schema(self):
+        await self._run(self._init_schema)
+        self._schema_ready = True
+
+    def _init_schema(self):
+        with self._transaction() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS guilds (id INTEGER PRIMARY KEY, name TEXT NOT NULL);''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS storages (id INTEGER PRIMARY KEY AUTOINCREMENT, guild_id INTEGER REFERENCES guilds(id) ON DELETE CASCADE, name TEXT NOT NULL, UNIQUE(guild_id, name));''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY AUTOINCREMENT, storage_id INTEGER REFERENCES storages(id) ON DELETE CASCADE, name TEXT NOT NULL, updated_at TIMESTAMPTZ NOT NULL, UNIQUE(storage_id, name));''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, guild_id INTEGER, channel_id INTEGER, user_id INTEGER, content TEXT, created_at TIMESTAMPTZ);''')
+            message_columns = {row['name'] for row in conn.execute("PRAGMA table_info(messages)")}
+            for column_name in ('edited_at', 'deleted_at'):
+                if column_name not in message_columns:
+                    conn.execute(f"ALTER TABLE messages ADD COLUMN {column_name} TIMESTAMPTZ")
+            conn.execute('''CREATE TABLE IF NOT EXISTS user_balances (user_id INTEGER NOT NULL, category TEXT NOT NULL, balance INTEGER NOT NULL, PRIMARY KEY (user_id, category));''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS transactions (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, transaction_type TEXT NOT NULL, category TEXT, amount INTEGER NOT NULL, created_at TIMESTAMPTZ, source_wallet TEXT, is_balance_reflected BOOLEAN);''')
+
+            # 途中の残高チェックを消さないよう、なければ作るだけにする（PostgreSQL版と同じ挙動）
+            conn.execute('''CREATE TABLE IF NOT EXISTS balance_check_state (
+                                user_id INTEGER PRIMARY KEY,
+                                state TEXT,
+                                input_nushi INTEGER,
+                                input_pote INTEGER,
+                                input_budget INTEGER,
+                                input_savings INTEGER,
+                                last_checked_at TIMESTAMPTZ
+                            );''')
+            # 財布が増えたときなど、列の変更は既存の行を残したまま足す
+            check_columns = {row['name'] for row in conn.execute("PRAGMA table_info(balance_check_state)")}
+            for column_name, column_type in [*((c, 'INTEGER') for c in CHECK_INPUT_COLUMNS.values()), ('last_checked_at', 'TIMESTAMPTZ')]:
+                if column_name not in check_columns:
+                    conn.execute(f"ALTER TABLE balance_check_state ADD COLUMN {column_name} {column_type}")
+            conn.execute('''CREATE TABLE IF NOT EXISTS activities (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, channel_id INTEGER NOT NULL, guild_id INTEGER NOT NULL, content TEXT NOT NULL, activity_time TIMESTAMPTZ NOT NULL, status TEXT NOT NULL, original_message_id INTEGER);''')
+            conn.execute('''CREATE INDEX IF NOT EXISTS idx_messages_channel_id ON messages (channel_id, id);''')
+            conn.execute('''CREATE INDEX IF NOT EXISTS idx_messages_user_time ON messages (user_id, created_at);''')
+            conn.execute('''CREATE INDEX IF NOT EXISTS idx_activities_user_time ON activities (user_id, activity_time);''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS activity_daily (user_id INTEGER NOT NULL, day TEXT NOT NULL, content TEXT NOT NULL, seconds INTEGER NOT NULL, entries INTEGER NOT NULL, PRIMARY KEY (user_id, day, content));''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS activity_rollup_days (user_id INTEGER NOT NULL, day TEXT NOT NULL, PRIMARY KEY (user_id, day));''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS idempotency_keys (key TEXT PRIMARY KEY, created_at TIMESTAMPTZ NOT NULL);''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS dialog_states (user_id INTEGER PRIMARY KEY, state TEXT NOT NULL, updated_at TIMESTAMPTZ NOT NULL);''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS ledger_entries (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, wallet TEXT NOT NULL, delta INTEGER NOT NULL, created_at TIMESTAMPTZ NOT NULL);''')
+            conn.execute('''CREATE INDEX IF NOT EXISTS idx_ledger_entries_wallet_id ON ledger_entries (user_id, wallet, id);''')
+            conn.execute('''CREATE INDEX IF NOT EXISTS idx_ledger_entries_user_time ON ledger_entries (user_id, created_at);''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS balance_snapshots (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, wallet TEXT NOT NULL, balance INTEGER NOT NULL, last_entry_id INTEGER NOT NULL, taken_at TIMESTAMPTZ NOT NULL);''')
+            conn.execute('''CREATE INDEX IF NOT EXISTS idx_balance_snapshots_wallet_time ON balance_snapshots (user_id, wallet, taken_at);''')
+            # どの経路で残高が変わっても（リセットや外部スクリプトも）増減を台帳に残す
+            conn.execute(f'''CREATE TRIGGER IF NOT EXISTS sora_ledger_insert AFTER INSERT ON user_balances BEGIN
+                                INSERT INTO ledger_entries (user_id, wallet, delta, created_at) VALUES (NEW.user_id, NEW.category, NEW.balance, {_SQL_NOW});
+                            END;''')
+            conn.execute(f'''CREATE TRIGGER IF NOT EXISTS sora_ledger_update AFTER UPDATE OF balance ON user_balances WHEN NEW.balance <> OLD.balance BEGIN
+                                INSERT INTO ledger_entries (user_id, wallet, delta, created_at) VALUES (NEW.user_id, NEW.category, NEW.balance - OLD.balance, {_SQL_NOW});
+                            END;''')
+            # 台帳を始める前からある財布は、今の残高を起点にする
+            self._insert_balance_snapshots(conn, only_missing=True)
+            conn.execute('''CREATE TABLE IF NOT EXISTS budgets (user_id INTEGER NOT NULL, category TEXT NOT NULL, amount INTEGER NOT NULL, PRIMARY KEY (user_id, category));''')
+            if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'budget_spend'").fetchone():
+                conn.execute('''CREATE TABLE budget_spend (user_id INTEGER NOT NULL, category TEXT NOT NULL, month TEXT NOT NULL, spent INTEGER NOT NULL, PRIMARY KEY (user_id, category, month));''')
+                conn.execute(BUDGET_SPEND_BACKFILL_SQL)
+            conn.execute('''CREATE TABLE IF NOT EXISTS recurring_rules (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, kind TEXT NOT NULL, category TEXT, source_wallet TEXT NOT NULL, destination_wallet TEXT, amount INTEGER NOT NULL, schedule TEXT NOT NULL, next_run_at TIMESTAMPTZ NOT NULL, last_error TEXT, created_at TIMESTAMPTZ NOT NULL);''')
+            conn.execute('''CREATE INDEX IF NOT EXISTS idx_recurring_rules_next_run ON recurring_rules (next_run_at);''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS job_runs (job TEXT NOT NULL, period TEXT NOT NULL, owner TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL, started_at TIMESTAMPTZ NOT NULL, heartbeat_at TIMESTAMPTZ NOT NULL, finished_at TIMESTAMPTZ, PRIMARY KEY (job, period));''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS bot_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at TIMESTAMPTZ NOT NULL);''')
+        logger.info("SQLiteのテーブルを初期化しました。")
+
+    # --- メッセージ ---
+    async def log_message(self, message_id, guild_id, channel_id, user_id, content, created_at):
+        await self._run(self._log_message, message_id, guild_id, channel_id, user_id, content, created_at)
+
+    def _log_message(self, message_id, guild_id, channel_id, user_id, content, created_at):
+        self._conn.execute(
+            "INSERT INTO messages (id, guild_id, channel_id, user_id, content, created_at) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO NOTHING",
+            (message_id, guild_id, channel_id, user_id, content, created_at))
+
+    async def log_messages(self, rows) -> List[int]:
+        return await self._run(self._log_messages, rows)
+
+    def _log_messages(self, rows):
+        inserted = []
+        with self._transaction() as conn:
+            for row in rows:
+                cursor = conn.execute("INSERT OR IGNORE INTO messages (id, guild_id, channel_id, user_id, content, created_at) VALUES (?, ?, ?, ?, ?, ?)", row)
+                if cursor.rowcount:
+                    inserted.append(row[0])
+        return inserted
+
+    async def apply_message_edits(self, rows) -> int:
+        return await self._run(self._apply_message_edits, rows)
+
+    def _apply_message_edits(self, rows):
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany("""
+                INSERT INTO messages (id, guild_id, channel_id, user_id, content, created_at, edited_at) VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET content = excluded.content, edited_at = excluded.edited_at
+                WHERE messages.deleted_at IS NULL AND (messages.edited_at IS NULL OR messages.edited_at < excluded.edited_at)
+            """, rows)
+            return conn.total_changes - before
+
+    async def delete_messages(self, rows) -> int:
+        return await self._run(self._delete_messages, rows)
+
+    def _delete_messages(self, rows):
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany("""
+                INSERT INTO messages (id, guild_id, channel_id, created_at, deleted_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET deleted_at = excluded.deleted_at WHERE messages.deleted_at IS NULL
+            """, rows)
+            return conn.total_changes - before
+
+    async def last_message_ids(self, channel_ids) -> Dict[int, int]:
+        return await self._run(self._last_message_ids, channel_ids)
+
+    def _last_message_ids(self, channel_ids):
+        last_ids = {}
+        for channel_id in channel_ids:
+            row = self._conn.execute("SELECT MAX(id) FROM messages WHERE channel_id = ?", (channel_id,)).fetchone()
+            if row[0] is not None:
+                last_ids[channel_id] = row[0]
+        return last_ids
+
+    async def fetch_users_messages(self, user_ids, start, end, channel_id=None, limit_per_user=None) -> List[Row]:
+        return await self._run(self._fetch_users_messages, user_ids, start, end, channel_id, limit_per_user)
+
+    def _fetch_users_messages(self, user_ids, start, end, channel_id, limit_per_user):
+        placeholders = ", ".join("?" * len(user_ids))
+        return self._conn.execute(f"""
+            SELECT id, user_id, channel_id, content, created_at FROM (
+                SELECT id, user_id, channel_id, content, created_at, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY created_at) AS n FROM messages
+                WHERE user_id IN ({placeholders}) AND created_at >= ? AND created_at < ? AND deleted_at IS NULL AND (? IS NULL OR channel_id = ?)
+            )
+            WHERE ? IS NULL OR n <= ?
+            ORDER BY user_id, created_at
+        """, (*user_ids, start, end, channel_id, channel_id, limit_per_user, limit_per_user)).fetchall()
+
+    async def fetch_messages_after(self, after_id, before, limit) -> List[Row]:
+        return await self._run(self._fetch_messages_after, after_id, before, limit)
+
+    def _fetch_messages_after(self, after_id, before, limit):
+        return self._conn.execute("""
+            SELECT id, user_id, channel_id, content, created_at FROM messages
+            WHERE id > ? AND created_at < ? AND deleted_at IS NULL ORDER BY id LIMIT ?
+        """, (after_id, before, limit)).fetchall()
+
+    # --- 収納・備品 ---
+    async def add_storage(self, guild_id, guild_name, name):
+        await self._run(self._add_storage, guild_id, guild_name, name)
+
+    def _add_storage(self, guild_id, guild_name, name):
+        try:
+            with self._transaction() as conn:
+                conn.execute("INSERT INTO guilds (id, name) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET name = excluded.name", (guild_id, guild_name))
+                conn.execute("INSERT INTO storages (guild_id, name) VALUES (?, ?)", (guild_id, name))
+        except sqlite3.IntegrityError:
+            raise DuplicateStorageError(name)
+
+    async def get_storage_id(self, guild_id, name) -> Optional[int]:
+        return await self._run(self._get_storage_id, guild_id, name)
+
+    def _get_storage_id(self, guild_id, name):
+        row = self._conn.execute("SELECT id FROM storages WHERE guild_id = ? AND name = ?", (guild_id, name)).fetchone()
+        return row['id'] if row else None
+
+    async def upsert_item(self, storage_id, name):
+        await self._run(self._upsert_item, storage_id, name)
+
+    def _upsert_item(self, storage_id, name):
+        self._conn.execute("INSERT INTO items (storage_id, name, updated_at) VALUES (?, ?, ?) ON CONFLICT (storage_id, name) DO UPDATE SET updated_at = excluded.updated_at", (storage_id, name, _now()))
+
+    async def find_item_storage(self, guild_id, item_name) -> Optional[str]:
+        return await self._run(self._find_item_storage, guild_id, item_name)
+
+    def _find_item_storage(self, guild_id, item_name):
+        row = self._conn.execute("SELECT s.name FROM items i JOIN storages s ON i.storage_id = s.id WHERE i.name = ? AND s.guild_id = ?", (item_name, guild_id)).fetchone()
+        return row['name'] if row else None
+
+    async def list_storage_items(self, guild_id, storage_name) -> List[str]:
+        return await self._run(self._list_storage_items, guild_id, storage_name)
+
+    def _list_storage_items(self, guild_id, storage_name):
+        rows = self._conn.execute("SELECT i.name FROM items i JOIN storages s ON i.storage_id = s.id WHERE s.name = ? AND s.guild_id = ? ORDER BY i.name", (storage_name, guild_id)).fetchall()
+        return [r['name'] for r in rows]
+
+    # --- 活動記録 ---
+    @staticmethod
+    def _claim_idempotency_key(conn, key: Optional[str]) -> bool:
+        """key を記録する。未指定なら常に True、記録済みなら False"""
+        if key is None:
+            return True
+        return conn.execute("INSERT OR IGNORE INTO idempotency_keys (key, created_at) VALUES (?, ?)", (key, _now())).rowcount > 0
+
+    async def add_activity(self, user_id, channel_id, guild_id, content, activity_time, status, original_message_id, idempotency_key=None) -> bool:
+        return await self._run(self._add_activity, user_id, channel_id, guild_id, content, activity_time, status, original_message_id, idempotency_key)
+
+    def _add_activity(self, user_id, channel_id, guild_id, content, activity_time, status, original_message_id, idempotency_key):
+        day = activity_time.astimezone(REPORT_TZ).date()
+        invalidated = ((day - timedelta(days=1)).isoformat(), day.isoformat())
+        with self._transaction() as conn:
+            if not self._claim_idempotency_key(conn, idempotency_key):
+                return False
+            conn.execute("INSERT INTO activities (user_id, channel_id, guild_id, content, activity_time, status, original_message_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (user_id, channel_id, guild_id, content, activity_time, status, original_message_id))
+            # 前日の最後の活動の所要時間も変わるので、前日と当日のロールアップを作り直させる
+            conn.execute("DELETE FROM activity_rollup_days WHERE user_id = ? AND day BETWEEN ? AND ?", (user_id, *invalidated))
+            conn.execute("DELETE FROM activity_daily WHERE user_id = ? AND day BETWEEN ? AND ?", (user_id, *invalidated))
+        return True
+
+    async def fetch_activities_after(self, after_id, limit) -> List[Row]:
+        return await self._run(self._fetch_activities_after, after_id, limit)
+
+    def _fetch_activities_after(self, after_id, limit):
+        return self._conn.execute("SELECT id, user_id, content, activity_time, status FROM activities WHERE id > ? ORDER BY id LIMIT ?",
+                                  (after_id, limit)).fetchall()
+
+    async def activity_timeline(self, user_id, start, end, max_gap, now) -> List[Row]:
+        return await self._run(self._activity_timeline, user_id, start, end, max_gap, now)
+
+    def _activity_timeline(self, user_id, start, end, max_gap, now):
+        rows = self._conn.execute(ACTIVITY_SPANS_SQL + " ORDER BY activity_time", _span_params(user_id, start, end, max_gap, now)).fetchall()
+        # day は date() の結果で文字列になるので、Postgres と同じ date に戻す
+        return [{**dict(row), "day": date.fromisoformat(row["day"])} for row in rows]
+
+    async def activity_totals(self, user_id, start_day, end_day, max_gap, now) -> List[Row]:
+        return await self._run(self._activity_totals, user_id, start_day, end_day, max_gap, now)
+
+    def _activity_totals(self, user_id, start_day, end_day, max_gap, now):
+        today = now.astimezone(REPORT_TZ).date()
+        rollup_end = max(start_day, min(end_day, today))
+        live_start = day_start(max(start_day, today))
+        live_end = max(live_start, day_start(end_day))
+        if start_day < rollup_end:
+            self._ensure_activity_rollup(user_id, start_day, rollup_end, max_gap, now)
+        # 過去の日はロールアップ、今日は activities から、を1回の問い合わせで読む
+        params = _span_params(user_id, live_start, live_end, max_gap, now)
+        params.update(rollup_start=start_day.isoformat(), rollup_end=rollup_end.isoformat())
+        rows = self._conn.execute(
+            f"""SELECT day, content, seconds, entries FROM activity_daily WHERE user_id = :user_id AND day >= :rollup_start AND day < :rollup_end
+                UNION ALL
+                SELECT day, content, SUM(seconds), COUNT(*) FROM ({ACTIVITY_SPANS_SQL}) GROUP BY day, content
+                ORDER BY day, seconds DESC""", params).fetchall()
+        return [{**dict(row), "day": date.fromisoformat(row["day"])} for row in rows]
+
+    def _ensure_activity_rollup(self, user_id, start_day, end_day, max_gap, now):
+        """[start_day, end_day) のうちロールアップがまだない日を作る"""
+        done = {row[0] for row in self._conn.execute(
+            "SELECT day FROM activity_rollup_days WHERE user_id = ? AND day >= ? AND day < ?",
+            (user_id, start_day.isoformat(), end_day.isoformat()))}
+        days = [start_day + timedelta(days=i) for i in range((end_day - start_day).days)]
+        missing = [day.isoformat() for day in days if day.isoformat() not in done]
+        if not missing:
+            return
+        params = _span_params(user_id, day_start(date.fromisoformat(missing[0])), day_start(date.fromisoformat(missing[-1]) + timedelta(days=1)), max_gap, now)
+        placeholders = ", ".join(f":day{i}" for i in range(len(missing)))
+        params.update({f"day{i}": day for i, day in enumerate(missing)})
+        with self._transaction() as conn:
+            conn.execute(
+                f"""INSERT OR REPLACE INTO activity_daily (user_id, day, content, seconds, entries)
+                    SELECT :user_id, day, content, SUM(seconds), COUNT(*) FROM ({ACTIVITY_SPANS_SQL}) WHERE day IN ({placeholders}) GROUP BY day, content""",
+                params)
+            conn.executemany("INSERT OR IGNORE INTO activity_rollup_days (user_id, day) VALUES (?, ?)", [(user_id, day) for day in missing])
+
+    # --- 残高・取引 ---
+    async def get_balances(self, user_id) -> Dict[str, int]:
+        return await self._run(self._get_balances, user_id)
+
+    def _get_balances(self, user_id):
+        rows = self._conn.execute("SELECT category, balance FROM user_balances WHERE user_id = ? ORDER BY category", (user_id,)).fetchall()
+        return {r['category']: r['balance'] for r in rows}
+
+    async def get_balance_user_ids(self) -> List[int]:
+        return await self._run(self._get_balance_user_ids)
+
+    def _get_balance_user_ids(self):
+        return [r['user_id'] for r in self._conn.execute("SELECT DISTINCT user_id FROM user_balances").fetchall()]
+
+    @publishes_change('balance_check_state')
+    async def reset_balance(self, user_id, wallet, amount):
+        await self._run(self._reset_balance, user_id, wallet, amount)
+
+    def _reset_balance(self, user_id, wallet, amount):
+        with self._transaction() as conn:
+            conn.execute("INSERT INTO user_balances (user_id, category, balance) VALUES (?, ?, ?) ON CONFLICT (user_id, category) DO UPDATE SET balance = excluded.balance", (user_id, wallet, amount))
+            conn.execute("INSERT INTO transactions (user_id, transaction_type, category, amount, created_at) VALUES (?, 'reset', ?, ?, ?)", (user_id, wallet, amount, _now()))
+            conn.execute("UPDATE balance_check_state SET state = NULL, input_nushi=NULL, input_pote=NULL, input_budget=NULL, input_savings=NULL, last_checked_at = NULL WHERE user_id = ?", (user_id,))
+
+    async def add_salary(self, user_id, amount, allocations):
+        await self._run(self._add_salary, user_id, amount, allocations)
+
+    def _add_salary(self, user_id, amount, allocations):
+        with self._transaction() as conn:
+            for category, cat_amount in allocations.items():
+                if cat_amount > 0:
+                    self._credit(conn, user_id, category, cat_amount)
+            conn.execute("INSERT INTO transactions (user_id, transaction_type, category, amount, created_at) VALUES (?, 'salary', '給与収入', ?, ?)", (user_id, amount, _now()))
+
+    async def record_spend(self, user_id, category, amount, source_wallet, created_at=None, reflect_balance=True, idempotency_key=None) -> Optional[SpendResult]:
+        return await self._run(self._record_spend, user_id, category, amount, source_wallet, created_at, reflect_balance, idempotency_key)
+
+    def _record_spend(self, user_id, category, amount, source_wallet, created_at, reflect_balance, idempotency_key):
+        created_at = created_at or _now()
+        with self._transaction() as conn:
+            if not self._claim_idempotency_key(conn, idempotency_key):
+                return None
+            if reflect_balance:
+                self._debit(conn, user_id, source_wallet, amount)
+            cursor = conn.execute(
+                "INSERT INTO transactions (user_id, transaction_type, category, amount, created_at, source_wallet, is_balance_reflected) VALUES (?, 'spend', ?, ?, ?, ?, ?)",
+                (user_id, category, amount, created_at, source_wallet, reflect_balance))
+            budgets = self._add_budget_spend(conn, user_id, budget_deltas((category, source_wallet, created_at, amount)))
+            return SpendResult(cursor.lastrowid, budgets)
+
+    @staticmethod
+    def _add_budget_spend(conn, user_id: int, deltas) -> List[BudgetUsage]:
+        """予算の使用額を増減し、増えたもののうち上限を設定している予算を返す。トランザクション内で呼ぶこと"""
+        budgets = []
+        for (category, month), delta in deltas.items():
+            if not delta:
+                continue
+            conn.execute("INSERT INTO budget_spend (user_id, category, month, spent) VALUES (?, ?, ?, ?) ON CONFLICT (user_id, category, month) DO UPDATE SET spent = budget_spend.spent + excluded.spent",
+                         (user_id, category, month, delta))
+            if delta < 0:
+                continue
+            row = conn.execute("SELECT s.spent, b.amount FROM budget_spend s JOIN budgets b ON b.user_id = s.user_id AND b.category = s.category WHERE s.user_id = ? AND s.category = ? AND s.month = ?",
+                               (user_id, category, month)).fetchone()
+            if row:
+                budgets.append(BudgetUsage(category, month, row['spent'] - delta, row['spent'], row['amount']))
+        return budgets
+
+    async def transfer(self, user_id, source_wallet, destination_wallet, amount):
+        await self._run(self._transfer, user_id, source_wallet, destination_wallet, amount)
+
+    def _transfer(self, user_id, source_wallet, destination_wallet, amount):
+        with self._transaction() as conn:
+            self._debit(conn, user_id, source_wallet, amount)
+            self._credit(conn, user_id, destination_wallet, amount)
+            conn.execute("INSERT INTO transactions (user_id, transaction_type, category, amount, created_at) VALUES (?, 'transfer', ?, ?, ?)",
+                         (user_id, f"{source_wallet}から{destination_wallet}へ", amount, _now()))
+
+    @staticmethod
+    def _insert_balance_snapshots(conn, only_missing: bool = False) -> int:
+        return conn.execute(f"""
+            INSERT INTO balance_snapshots (user_id, wallet, balance, last_entry_id, taken_at)
+            SELECT user_id, category, balance, (SELECT COALESCE(MAX(id), 0) FROM ledger_entries), ? FROM user_balances b
+            {"WHERE NOT EXISTS (SELECT 1 FROM balance_snapshots s WHERE s.user_id = b.user_id AND s.wallet = b.category)" if only_missing else ""}
+        """, (_now(),)).rowcount
+
+    async def take_balance_snapshots(self) -> int:
+        return await self._run(self._take_balance_snapshots)
+
+    def _take_balance_snapshots(self):
+        with self._transaction() as conn:
+            return self._insert_balance_snapshots(conn)
+
+    async def balance_at(self, user_id, at) -> Dict[str, int]:
+        return await self._run(self._balance_at, user_id, at)
+
+    def _balance_at(self, user_id, at):
+        rows = self._conn.execute(BALANCE_AT_SQL + " ORDER BY b.category", {"user_id": user_id, "at": at}).fetchall()
+        return {row['wallet']: row['balance'] for row in rows}
+
+    async def balance_history(self, user_id, start, end) -> List[Row]:
+        return await self._run(self._balance_history, user_id, start, end)
+
+    def _balance_history(self, user_id, start, end):
+        # 台帳を始める前からあった財布の扱いは Postgres 版と同じ
+        rows = self._conn.execute(f"""
+            WITH opening AS ({BALANCE_AT_SQL}),
+            anchors AS (
+                SELECT s.wallet, s.balance, s.last_entry_id, date(s.taken_at, '+9 hours') AS day FROM balance_snapshots s
+                WHERE s.user_id = :user_id AND s.taken_at > :at AND s.taken_at <= :end
+                  AND s.taken_at = (SELECT MIN(taken_at) FROM balance_snapshots WHERE user_id = :user_id AND wallet = s.wallet)
+                  AND s.wallet NOT IN (SELECT wallet FROM opening)
+                  AND NOT EXISTS (SELECT 1 FROM ledger_entries l WHERE l.user_id = :user_id AND l.wallet = s.wallet AND l.id <= s.last_entry_id)
+            ),
+            changes AS (
+                SELECT l.wallet, date(l.created_at, '+9 hours') AS day, l.delta FROM ledger_entries l
+                LEFT JOIN anchors a ON a.wallet = l.wallet
+                WHERE l.user_id = :user_id AND l.created_at > :at AND l.created_at <= :end AND l.id > COALESCE(a.last_entry_id, 0)
+                UNION ALL
+                SELECT wallet, day, balance FROM anchors
+            ),
+            daily AS (SELECT wallet, day, SUM(delta) AS delta FROM changes GROUP BY wallet, day)
+            SELECT d.day, d.wallet, COALESCE(o.balance, 0) + SUM(d.delta) OVER (PARTITION BY d.wallet ORDER BY d.day) AS balance,
+                   COALESCE(d.day = a.day, 0) AS starts
+            FROM daily d LEFT JOIN opening o ON o.wallet = d.wallet LEFT JOIN anchors a ON a.wallet = d.wallet
+            ORDER BY d.day, d.wallet
+        """, {"user_id": user_id, "at": start, "end": end}).fetchall()
+        # day は date() の結果で文字列になるので、Postgres と同じ date と bool に戻す
+        return [{**dict(row), "day": date.fromisoformat(row["day"]), "starts": bool(row["starts"])} for row in rows]
+
+    @staticmethod
+    def _credit(conn, user_id: int, wallet: str, amount: int):
+        conn.execute("INSERT INTO user_balances (user_id, category, balance) VALUES (?, ?, ?) ON CONFLICT (user_id, category) DO UPDATE SET balance = user_balances.balance + excluded.balance", (user_id, wallet, amount))
+
+    @staticmethod
+    def _debit(conn, user_id: int, wallet: str, amount: int):
+        # 書き込みは BEGIN IMMEDIATE で直列になるが、Postgres 版と同じく確認と減算を1つの UPDATE にする
+        if conn.execute("UPDATE user_balances SET balance = balance - :amount WHERE user_id = :user_id AND category = :wallet AND balance >= :amount",
+                        {"amount": amount, "user_id": user_id, "wallet": wallet}).rowcount == 0:
+            row = conn.execute("SELECT balance FROM user_balances WHERE user_id = ? AND category = ?", (user_id, wallet)).fetchone()
+            raise InsufficientBalanceError(wallet, row['balance'] if row else 0)
+
+    async def recent_transactions(self, user_id, limit) -> List[Row]:
+        return await self._run(self._recent_transactions, user_id, limit)
+
+    def _recent_transactions(self, user_id, limit):
+        return self._conn.execute(
+            "SELECT id, transaction_type, category, amount, created_at, source_wallet, is_balance_reflected FROM transactions WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+            (user_id, limit)).fetchall()
+
+    async def edit_spend(self, user_id, transaction_id, tz: tzinfo, amount=None, category=None, source_wallet=None,
+                         spend_date: Optional[date] = None, reflect_balance=None) -> List[BudgetUsage]:
+        return await self._run(self._edit_spend, user_id, transaction_id, tz, amount, category, source_wallet, spend_date, reflect_balance)
+
+    def _edit_spend(self, user_id, transaction_id, tz, amount, category, source_wallet, spend_date, reflect_balance):
+        with self._transaction() as conn:
+            old_tx = conn.execute("SELECT * FROM transactions WHERE id = ? AND user_id = ? AND transaction_type = 'spend'", (transaction_id, user_id)).fetchone()
+            if not old_tx:
+                raise TransactionNotFoundError(transaction_id)
+
+            new_amount = amount if amount is not None else old_tx['amount']
+            new_category = category if category is not None else old_tx['category']
+            new_wallet = source_wallet if source_wallet is not None else old_tx['source_wallet']
+            new_reflect_balance = reflect_balance if reflect_balance is not None else old_tx['is_balance_reflected']
+            new_time = old_tx['created_at']
+            if spend_date:
+                original_time = old_tx['created_at'].astimezone(tz).time()
+                new_time = datetime.combine(spend_date, original_time.replace(microsecond=0, tzinfo=None), tzinfo=tz)
+
+            if old_tx['is_balance_reflected'] and old_tx['source_wallet']:
+                conn.execute("UPDATE user_balances SET balance = balance + ? WHERE user_id = ? AND category = ?", (old_tx['amount'], user_id, old_tx['source_wallet']))
+            if new_reflect_balance and new_wallet:
+                self._debit(conn, user_id, new_wallet, new_amount)
+
+            conn.execute("UPDATE transactions SET amount = ?, category = ?, source_wallet = ?, created_at = ?, is_balance_reflected = ? WHERE id = ?",
+                         (new_amount, new_category, new_wallet, new_time, new_reflect_balance, transaction_id))
+            return self._add_budget_spend(conn, user_id, budget_deltas(
+                (old_tx['category'], old_tx['source_wallet'], old_tx['created_at'], -old_tx['amount']),
+                (new_category, new_wallet, new_time, new_amount)))
+
+    # --- 予算 ---
+    async def set_budget(self, user_id, category, amount):
+        await self._run(self._set_budget, user_id, category, amount)
+
+    def _set_budget(self, user_id, category, amount):
+        if amount is None:
+            self._conn.execute("DELETE FROM budgets WHERE user_id = ? AND category = ?", (user_id, category))
+        else:
+            self._conn.execute("INSERT INTO budgets (user_id, category, amount) VALUES (?, ?, ?) ON CONFLICT (user_id, category) DO UPDATE SET amount = excluded.amount",
+                               (user_id, category, amount))
+
+    async def budget_status(self, user_id, month) -> List[Row]:
+        return await self._run(self._budget_status, user_id, month)
+
+    def _budget_status(self, user_id, month):
+        return self._conn.execute("""
+            SELECT b.category, b.amount, COALESCE(s.spent, 0) AS spent FROM budgets b
+            LEFT JOIN budget_spend s ON s.user_id = b.user_id AND s.category = b.category AND s.month = ?
+            WHERE b.user_id = ? ORDER BY b.category
+        """, (month, user_id)).fetchall()
+
+    # --- 定期取引 ---
+    async def add_recurring_rule(self, user_id, kind, amount, source_wallet, schedule, next_run_at, category=None, destination_wallet=None) -> int:
+        return await self._run(self._add_recurring_rule, user_id, kind, amount, source_wallet, schedule, next_run_at, category, destination_wallet)
+
+    def _add_recurring_rule(self, user_id, kind, amount, source_wallet, schedule, next_run_at, category, destination_wallet):
+        return self._conn.execute(
+            "INSERT INTO recurring_rules (user_id, kind, category, source_wallet, destination_wallet, amount, schedule, next_run_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, kind, category, source_wallet, destination_wallet, amount, schedule, next_run_at, _now())).lastrowid
+
+    async def list_recurring_rules(self, user_id) -> List[Row]:
+        return await self._run(self._list_recurring_rules, user_id)
+
+    def _list_recurring_rules(self, user_id):
+        return self._conn.execute("SELECT * FROM recurring_rules WHERE user_id = ? ORDER BY next_run_at, id", (user_id,)).fetchall()
+
+    async def delete_recurring_rule(self, user_id, rule_id) -> bool:
+        return await self._run(self._delete_recurring_rule, user_id, rule_id)
+
+    def _delete_recurring_rule(self, user_id, rule_id):
+        return self._conn.execute("DELETE FROM recurring_rules WHERE id = ? AND user_id = ?", (rule_id, user_id)).rowcount > 0
+
+    async def apply_due_recurring(self, now) -> List[RecurringRun]:
+        return await self._run(self._apply_due_recurring, now)
+
+    def _apply_due_recurring(self, now):
+        rules = self._conn.execute("SELECT * FROM recurring_rules WHERE next_run_at <= ? ORDER BY user_id, next_run_at, id", (now,)).fetchall()
+        runs = []
+        for _, user_rules in itertools.groupby(rules, key=lambda rule: rule['user_id']):
+            with self._transaction() as conn:
+                for rule in user_rules:
+                    runs.extend(self._apply_recurring_rule(conn, rule, now))
+        return runs
+
+    def _apply_recurring_rule(self, conn, rule, now) -> List[RecurringRun]:
+        schedule = Schedule(rule['schedule'])
+        due_at, error, runs = rule['next_run_at'], None, []
+        while due_at <= now:
+            # 残高不足の回だけを取り消せるよう、1回ごとにセーブポイントを置く
+            conn.execute("SAVEPOINT recurring_run")
+            try:
+                if self._claim_idempotency_key(conn, recurring_key(rule['id'], due_at)):
+                    runs.append(RecurringRun(rule, due_at, self._post_recurring(conn, rule, due_at)))
+            except InsufficientBalanceError as e:
+                conn.execute("ROLLBACK TO recurring_run")
+                error = e
+            conn.execute("RELEASE recurring_run")
+            if error is not None:
+                break
+            due_at = schedule.next_after(due_at)
+        if error is not None and rule['last_error'] is None:
+            runs.append(RecurringRun(rule, due_at, [], error))
+        conn.execute("UPDATE recurring_rules SET next_run_at = ?, last_error = ? WHERE id = ?", (due_at, str(error) if error else None, rule['id']))
+        return runs
+
+    def _post_recurring(self, conn, rule, due_at) -> List[BudgetUsage]:
+        user_id, amount, source_wallet = rule['user_id'], rule['amount'], rule['source_wallet']
+        self._debit(conn, user_id, source_wallet, amount)
+        if rule['kind'] == 'transfer':
+            self._credit(conn, user_id, rule['destination_wallet'], amount)
+            conn.execute("INSERT INTO transactions (user_id, transaction_type, category, amount, created_at) VALUES (?, 'transfer', ?, ?, ?)",
+                         (user_id, f"{source_wallet}から{rule['destination_wallet']}へ", amount, due_at))
+            return []
+        conn.execute(
+            "INSERT INTO transactions (user_id, transaction_type, category, amount, created_at, source_wallet, is_balance_reflected) VALUES (?, 'spend', ?, ?, ?, ?, ?)",
+            (user_id, rule['category'], amount, due_at, source_wallet, True))
+        return self._add_budget_spend(conn, user_id, budget_deltas((rule['category'], source_wallet, due_at, amount)))
+
+    # --- 残高チェック ---
+    async def get_check_state(self, user_id) -> Optional[Row]:
+        return await self._run(self._get_check_state, user_id)
+
+    def _get_check_state(self, user_id):
+        return self._conn.execute("SELECT * FROM balance_check_state WHERE user_id = ?", (user_id,)).fetchone()
+
+    @publishes_change('balance_check_state')
+    async def start_balance_check(self, user_id):
+        await self._run(self._start_balance_check, user_id)
+
+    def _start_balance_check(self, user_id):
+        self._conn.execute("INSERT INTO balance_check_state (user_id, state) VALUES (?, 'waiting_for_balance_ぬし財布') ON CONFLICT (user_id) DO UPDATE SET state = 'waiting_for_balance_ぬし財布', input_nushi=NULL, input_pote=NULL, input_budget=NULL, input_savings=NULL", (user_id,))
+
+    @publishes_change('balance_check_state')
+    async def save_check_input(self, user_id, wallet, amount, next_state) -> Row:
+        return await self._run(self._save_check_input, user_id, wallet, amount, next_state)
+
+    def _save_check_input(self, user_id, wallet, amount, next_state):
+        column = CHECK_INPUT_COLUMNS[wallet]
+        with self._transaction() as conn:
+            conn.execute(f"UPDATE balance_check_state SET {column} = ?, state = ? WHERE user_id = ?", (amount, next_state, user_id))
+            return conn.execute("SELECT * FROM balance_check_state WHERE user_id = ?", (user_id,)).fetchone()
+
+    @publishes_change('balance_check_state')
+    async def set_check_state(self, user_id, state):
+        await self._run(self._set_check_state, user_id, state)
+
+    def _set_check_state(self, user_id, state):
+        self._conn.execute("UPDATE balance_check_state SET state = ? WHERE user_id = ?", (state, user_id))
+
+    @publishes_change('balance_check_state')
+    async def complete_balance_check(self, user_id):
+        await self._run(self._complete_balance_check, user_id)
+
+    def _complete_balance_check(self, user_id):
+        self._conn.execute("UPDATE balance_check_state SET state = NULL, last_checked_at = ? WHERE user_id = ?", (_now(), user_id))
+
+    @publishes_change('balance_check_state')
+    async def apply_reconciliation(self, user_id, balances):
+        await self._run(self._apply_reconciliation, user_id, balances)
+
+    def _apply_reconciliation(self, user_id, balances):
+        with self._transaction() as conn:
+            for wallet, new_balance in balances.items():
+                if new_balance is not None:
+                    conn.execute("INSERT INTO user_balances (user_id, category, balance) VALUES (?, ?, ?) ON CONFLICT (user_id, category) DO UPDATE SET balance = excluded.balance", (user_id, wallet, new_balance))
+            conn.execute("UPDATE balance_check_state SET state = NULL, last_checked_at = ? WHERE user_id = ?", (_now(), user_id))
+
+    # --- 会話の状態 ---
+    async def get_dialog_state(self, user_id, since) -> Optional[str]:
+        return await self._run(self._get_dialog_state, user_id, since)
+
+    def _get_dialog_state(self, user_id, since):
+        row = self._conn.execute("SELECT state FROM dialog_states WHERE user_id = ? AND updated_at >= ?", (user_id, since)).fetchone()
+        return row['state'] if row else None
+
+    @publishes_change('dialog_states')
+    async def set_dialog_state(self, user_id, state):
+        await self._run(self._set_dialog_state, user_id, state)
+
+    def _set_dialog_state(self, user_id, state):
+        self._conn.execute("INSERT INTO dialog_states (user_id, state, updated_at) VALUES (?, ?, ?) ON CONFLICT (user_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at", (user_id, state, _now()))
+
+    @publishes_change('dialog_states')
+    async def clear_dialog_state(self, user_id):
+        await self._run(self._clear_dialog_state, user_id)
+
+    def _clear_dialog_state(self, user_id):
+        self._conn.execute("DELETE FROM dialog_states WHERE user_id = ?", (user_id,))
+
+    # --- Bot自身の状態 ---
+    async def get_meta(self, key) -> Optional[str]:
+        return await self._run(self._get_meta, key)
+
+    def _get_meta(self, key):
+        row = self._conn.execute("SELECT value FROM bot_meta WHERE key = ?", (key,)).fetchone()
+        return row['value'] if row else None
+
+    async def set_meta(self, key, value):
+        await self._run(self._set_meta, key, value)
+
+    def _set_meta(self, key, value):
+        self._conn.execute("INSERT INTO bot_meta (key, value, updated_at) VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at", (key, value, _now()))
+
+    # --- 定期タスクの実行記録 ---
+    async def claim_job_run(self, job, period, owner, lease) -> bool:
+        return await self._run(self._claim_job_run, job, period, owner, lease)
+
+    def _claim_job_run(self, job, period, owner, lease):
+        now = _now()
+        return self._conn.execute("""
+            INSERT INTO job_runs (job, period, owner, status, attempts, started_at, heartbeat_at) VALUES (?, ?, ?, 'running', 1, ?, ?)
+            ON CONFLICT (job, period) DO UPDATE SET owner = excluded.owner, status = 'running', attempts = job_runs.attempts + 1,
+                started_at = excluded.started_at, heartbeat_at = excluded.heartbeat_at, finished_at = NULL
+            WHERE job_runs.status = 'failed' OR (job_runs.status = 'running' AND job_runs.heartbeat_at < ?)
+        """, (job, period, owner, now, now, now - lease)).rowcount > 0
+
+    async def heartbeat_job_run(self, job, period, owner) -> bool:
+        return await self._run(self._heartbeat_job_run, job, period, owner)
+
+    def _heartbeat_job_run(self, job, period, owner):
+        return self._conn.execute(
+            "UPDATE job_runs SET heartbeat_at = ? WHERE job = ? AND period = ? AND owner = ? AND status = 'running'",
+            (_now(), job, period, owner)).rowcount > 0
+
+    async def finish_job_run(self, job, period, owner, succeeded):
+        await self._run(self._finish_job_run, job, period, owner, succeeded)
+
+    def _finish_job_run(self, job, period, owner, succeeded):
+        self._conn.execute(
+            "UPDATE job_runs SET status = ?, finished_at = ? WHERE job = ? AND period = ? AND owner = ? AND status = 'running'",
+            ('done' if succeeded else 'failed', _now(), job, period, owner))
+
+    async def recent_job_runs(self, limit) -> List[Row]:
+        return await self._run(self._recent_job_runs, limit)
+
+    def _recent_job_runs(self, limit):
+        return self._conn.execute("SELECT job, period, owner, status, attempts, started_at, finished_at FROM job_runs ORDER BY started_at DESC LIMIT ?", (limit,)).fetchall()
@@ -0,0 +1,131 @@
+"""
+メッセージのまとめ(サマリー)の組み立て
+
+収集したメッセージを辞書のリストに溜めず、MessageRecord を1件ずつ流して
+チャンネルごとにまとめる。Embed の上限に達したらそこで読むのをやめる。
+複数人分のまとめは1人1つの Embed にし、paginate_embeds で1通に入る分ずつに分ける。
+"""
+
+import re
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterable, Dict, List, NamedTuple, Optional, Tuple
+
+import discord
+
+JST = timezone(timedelta(hours=9))
+
+# Embed の上限
+MAX_FIELDS = 25
+MAX_FIELD_VALUE = 1024
+MAX_EMBED_LENGTH = 6000
+# 1通のメッセージに付けられる Embed の数（文字数の上限 MAX_EMBED_LENGTH は1通の合計にかかる）
+MAX_EMBEDS_PER_MESSAGE = 10
+# タイトル・説明・「...他N件」の分として残しておく文字数
+RESERVED_LENGTH = 200
+LINES_PER_CHANNEL = 10
+# 1つの Embed に並べられる最大の行数。まとめのためにこれより多く読んでも件数を数えるだけになる
+MAX_RECORDS_PER_EMBED = MAX_FIELDS * LINES_PER_CHANNEL
+MAX_CONTENT_LENGTH = 100
+
+ACTIVITY_KEYWORDS = re.compile(r'(なう|わず|うぃる)')
+
+
+class ChannelRef(NamedTuple):
+    """チャンネルとギルド。同じチャンネルのレコードは同じインスタンスを共有する"""
+    id: int
+    name: str
+    guild_id: Optional[int]
+    guild_name: Optional[str]
+
+
+class MessageRecord(NamedTuple):
+    message_id: int
+    channel: ChannelRef
+    user_id: int
+    username: str
+    content: str
+    created_at: datetime
+
+    @property
+    def jump_url(self) -> str:
+        return f"https://discord.com/channels/{self.channel.guild_id or '@me'}/{self.channel.id}/{self.message_id}"
+
+
+class _ChannelSection:
+    __slots__ = ('name', 'lines', 'length', 'count', 'full')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lines: List[str] = []
+        self.length = 0
+        self.count = 0
+        self.full = False
+
+
+def _format_line(record: MessageRecord, time_format: str) -> str:
+    content = ACTIVITY_KEYWORDS.sub('', record.content).strip()
+    if len(content) > MAX_CONTENT_LENGTH:
+        content = content[:MAX_CONTENT_LENGTH] + "..."
+    return f"**{record.created_at.astimezone(JST).strftime(time_format)}** {record.username}: {content}\n"
+
+
+async def build_summary_embed(records: AsyncIterable[MessageRecord], title: str = "📝 収集サマリー",
+                              max_length: int = MAX_EMBED_LENGTH, time_format: str = "%H:%M", complete: bool = True) -> Tuple[discord.Embed, int]:
+    """チャンネルごとに最大 LINES_PER_CHANNEL 件を並べた Embed と、読んだ件数を返す。Embed は max_length 文字に収める
+
+    records が件数の上限で打ち切られているときは complete=False にすると、件数を「以上」と書く。
+    """
+    sections: Dict[int, _ChannelSection] = {}
+    budget = max_length - RESERVED_LENGTH
+    count = 0
+    truncated = not complete
+    async for record in records:
+        section = sections.get(record.channel.id)
+        if section is None:
+            if len(sections) >= MAX_FIELDS or budget < 100:
+                truncated = True
+                break
+            section = sections[record.channel.id] = _ChannelSection(record.channel.name)
+            budget -= len(section.name) + 20
+        count += 1
+        section.count += 1
+        if section.full:
+            continue
+
+        line = _format_line(record, time_format)
+        if len(section.lines) >= LINES_PER_CHANNEL or section.length + len(line) > MAX_FIELD_VALUE - 20:
+            section.full = True
+        elif len(line) > budget:
+            # Embed 全体の上限に達したので、これ以上は読まない
+            truncated = True
+            break
+        else:
+            section.lines.append(line)
+            section.length += len(line)
+            budget -= len(line)
+
+    if not count:
+        return discord.Embed(title=title, description="メッセージは見つかりませんでした。", color=0x00ff00, timestamp=datetime.now(JST)), 0
+
+    description = f"**収集件数**: {count}件" + ("以上（表示しきれない分は省略）" if truncated else "")
+    embed = discord.Embed(title=title, description=description, color=0x00ff00, timestamp=datetime.now(JST))
+    for section in sections.values():
+        value = "".join(section.lines)
+        if section.count > len(section.lines):
+            value += f"...他{section.count - len(section.lines)}件"
+        if value:
+            embed.add_field(name=f"#{section.name} ({section.count}件)", value=value, inline=False)
+    return embed, count
+
+
+def paginate_embeds(embeds: List[discord.Embed]) -> List[List[discord.Embed]]:
+    """Embed を、1通に付けられる数と合計の文字数に収まるまとまり（ページ）に分ける"""
+    pages: List[List[discord.Embed]] = []
+    length = 0
+    for embed in embeds:
+        if not pages or len(pages[-1]) >= MAX_EMBEDS_PER_MESSAGE or length + len(embed) > MAX_EMBED_LENGTH:
+            pages.append([])
+            length = 0
+        pages[-1].append(embed)
+        length += len(embed)
+    return pages
@@ -0,0 +1,118 @@
+"""
+シャードを複数のワーカープロセスに分けて動かすスーパーバイザー
+
+main.py --shards N --workers M で使う。異常終了したワーカーは間隔を空けて再起動する。
+SIGHUP を受けると全ワーカーに転送し、設定を再読み込みさせる。
+"""
+
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Discord の IDENTIFY は5秒に1回までなので、ワーカーの起動をシャード数に応じてずらす
+IDENTIFY_INTERVAL = 5.0
+RESTART_BACKOFF_MAX = 60.0
+# これだけ動き続けたら再起動の待ち時間をリセットする
+STABLE_AFTER = 600.0
+
+
+def split_shards(shard_ids: List[int], workers: int) -> List[List[int]]:
+    """シャードIDを連続した塊に分ける"""
+    workers = max(1, min(workers, len(shard_ids)))
+    size = len(shard_ids)
+    return [shard_ids[i * size // workers:(i + 1) * size // workers] for i in range(workers)]
+
+
+class _Worker:
+    def __init__(self, shard_ids: List[int]):
+        self.shard_ids = shard_ids
+        self.process: Optional[multiprocessing.Process] = None
+        self.started_at = 0.0
+        self.failures = 0
+        self.restart_at: Optional[float] = None
+        self.finished = False
+
+    @property
+    def label(self) -> str:
+        return f"shards {self.shard_ids[0]}-{self.shard_ids[-1]}"
+
+
+class ShardSupervisor:
+    def __init__(self, target: Callable, target_args: tuple, shard_count: int, shard_ids: List[int], workers: int):
+        self.target = target
+        self.target_args = target_args
+        self.shard_count = shard_count
+        self.workers = [_Worker(group) for group in split_shards(shard_ids, workers)]
+        self._context = multiprocessing.get_context('spawn')
+
+    def _start(self, worker: _Worker):
+        worker.process = self._context.Process(
+            target=self.target, args=(*self.target_args, self.shard_count, worker.shard_ids),
+            name=f"sora-{worker.label.replace(' ', '-')}",
+        )
+        worker.process.start()
+        worker.started_at = time.monotonic()
+        worker.restart_at = None
+        logger.info(f"ワーカーを起動しました: {worker.label} (pid {worker.process.pid})")
+
+    def _check(self, worker: _Worker):
+        if worker.finished or worker.process is None or worker.process.is_alive():
+            return
+        if worker.restart_at is not None:
+            if time.monotonic() >= worker.restart_at:
+                self._start(worker)
+            return
+
+        exitcode = worker.process.exitcode
+        if exitcode == 0:
+            logger.info(f"ワーカーが終了しました: {worker.label}")
+            worker.finished = True
+            return
+        if time.monotonic() - worker.started_at >= STABLE_AFTER:
+            worker.failures = 0
+        delay = min(RESTART_BACKOFF_MAX, IDENTIFY_INTERVAL * 2 ** worker.failures)
+        worker.failures += 1
+        worker.restart_at = time.monotonic() + delay
+        logger.error(f"ワーカーが異常終了しました: {worker.label} (exit {exitcode})。{delay:.0f}秒後に再起動します")
+
+    def _stop_all(self):
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(timeout=30)
+
+    def run(self):
+        """全ワーカーが正常終了するか、停止シグナルを受けるまで監視する"""
+        def _terminate(signum, frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, _terminate)
+
+        def _reload(signum, frame):
+            logger.info("設定の再読み込みを全ワーカーに指示します")
+            for worker in self.workers:
+                if worker.process is not None and worker.process.is_alive():
+                    os.kill(worker.process.pid, signal.SIGHUP)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, _reload)
+
+        logger.info(f"{self.shard_count}シャード中 {sum(len(w.shard_ids) for w in self.workers)} シャードを {len(self.workers)} プロセスで起動します")
+        try:
+            for index, worker in enumerate(self.workers):
+                if index:
+                    time.sleep(IDENTIFY_INTERVAL * len(self.workers[index - 1].shard_ids))
+                self._start(worker)
+            while not all(worker.finished for worker in self.workers):
+                for worker in self.workers:
+                    self._check(worker)
+                time.sleep(1)
+        except (KeyboardInterrupt, SystemExit):
+            logger.info("ワーカーを停止します")
+        finally:
+            self._stop_all()
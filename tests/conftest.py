@@ -0,0 +1,133 @@
+"""
+テスト共通のフィクスチャ
+
+ストレージのテストは SQLite で動かし、TEST_DATABASE_URL にテスト専用の Postgres を指定すると
+同じテストを Postgres でも動かす（指定がなければ Postgres の分は飛ばす）。
+Postgres は毎回 public スキーマを作り直すので、本番や開発のデータベースを指定しないこと。
+"""
+
+import asyncio
+import os
+import sqlite3
+
+import pytest
+
+from db_trace import QueryStats
+from storage.sqlite import SQLiteStorage
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+
+
+@pytest.fixture
+def run():
+    """テストごとのイベントループでコルーチンを最後まで実行する関数"""
+    loop = asyncio.new_event_loop()
+    try:
+        yield loop.run_until_complete
+    finally:
+        loop.close()
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def backend(request) -> str:
+    if request.param == "postgres" and not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL が設定されていません")
+    return request.param
+
+
+async def _reset_postgres():
+    import asyncpg
+    conn = await asyncpg.connect(TEST_DATABASE_URL)
+    try:
+        await conn.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public;")
+    finally:
+        await conn.close()
+
+
+async def _execute_before_init(backend: str, path: str, statements):
+    if backend == "sqlite":
+        conn = sqlite3.connect(path)
+        for statement in statements:
+            conn.execute(statement)
+        conn.commit()
+        conn.close()
+        return
+    import asyncpg
+    conn = await asyncpg.connect(TEST_DATABASE_URL)
+    try:
+        for statement in statements:
+            await conn.execute(statement)
+    finally:
+        await conn.close()
+
+
+@pytest.fixture
+def open_storage(backend, run, tmp_path):
+    """ストレージを開いてスキーマを初期化する関数。同じテストの中で何度呼んでも同じデータベースを開く
+
+    before_init に渡した SQL はスキーマの初期化より前に実行する（古いスキーマの再現用）。
+    """
+    opened = []
+    path = str(tmp_path / "sora.db")
+
+    async def open_(before_init):
+        if backend == "postgres" and not opened:
+            await _reset_postgres()
+        await _execute_before_init(backend, path, before_init)
+        if backend == "sqlite":
+            storage = SQLiteStorage(path, QueryStats())
+        else:
+            from storage.postgres import PostgresStorage
+            storage = PostgresStorage(TEST_DATABASE_URL, QueryStats())
+        await storage.connect()
+        await storage.init_schema()
+        return storage
+
+    def open_storage_(before_init=()):
+        storage = run(open_(before_init))
+        opened.append(storage)
+        return storage
+
+    yield open_storage_
+    for storage in opened:
+        run(storage.close())
+
+
+@pytest.fixture
+def storage(open_storage):
+    return open_storage()
+
+
+@pytest.fixture
+def listening_storage(storage, run):
+    """他のプロセスからの変更通知を受け取り始めた storage（SQLite はそのまま）"""
+    async def start():
+        await storage.start_change_listener()
+        while not storage.changes.reliable:
+            await asyncio.sleep(0.01)
+
+    run(asyncio.wait_for(start(), timeout=10))
+    return storage
+
+
+@pytest.fixture
+def bot(storage, run, monkeypatch, tmp_path):
+    """Discord に接続せずに on_message などを呼べる SoraBot。ストレージは storage フィクスチャのもの"""
+    from benchmarks.fakes import FakeChannel, FakeGuild, FakeUser
+    import discord_client
+    from config import Config
+    from discord_client import SoraBot
+
+    guild = FakeGuild(1, "テスト")
+    channel = FakeChannel(10, "general", guild)
+    monkeypatch.setattr(Config, "TARGET_CHANNEL_IDS", [channel.id])
+    monkeypatch.setattr(Config, "SPOOL_PATH", str(tmp_path / "spool.jsonl"))
+    # ジョブやキャッシュも同じストレージを使うよう、作る前に差し替える
+    monkeypatch.setattr(discord_client, "create_storage", lambda query_stats: storage)
+    sora = SoraBot()
+    sora._connection.user = FakeUser(2, "Sora", bot=True)
+    sora.get_channel = {channel.id: channel}.get
+    sora.test_channel = channel
+    yield sora
+    run(sora.dispatcher.close())
+    run(sora.outbound.close())
@@ -0,0 +1,53 @@
+"""活動のタイムラインと日ごとの合計（LEAD による経過時間とロールアップ）"""
+
+from datetime import date, datetime, timedelta
+
+from storage.base import REPORT_TZ, day_start
+
+DAY = date(2026, 1, 5)
+GAP = timedelta(hours=2)
+
+
+def _at(hour, minute=0, day=DAY):
+    return datetime(day.year, day.month, day.day, hour, minute, tzinfo=REPORT_TZ)
+
+
+def _add(storage, run, content, at, status="now"):
+    run(storage.add_activity(1, 10, 1, content, at, status, None))
+
+
+def _seed(storage, run):
+    _add(storage, run, "作業", _at(9))
+    _add(storage, run, "昼食", _at(10, 30))
+    _add(storage, run, "散歩", _at(11))
+    _add(storage, run, "買い物", _at(12), status="todo")
+
+
+def test_timeline_durations_until_next_entry(storage, run):
+    _seed(storage, run)
+    rows = run(storage.activity_timeline(1, day_start(DAY), day_start(DAY + timedelta(days=1)), GAP, _at(0, day=DAY + timedelta(days=2))))
+    assert [(row["content"], row["seconds"], row["day"]) for row in rows] == [
+        ("作業", 5400, DAY), ("昼食", 1800, DAY), ("散歩", 7200, DAY)]
+
+    # 今日の最後の記録は今までの時間
+    rows = run(storage.activity_timeline(1, day_start(DAY), day_start(DAY + timedelta(days=1)), GAP, _at(11, 45)))
+    assert rows[-1]["seconds"] == 2700
+
+
+def test_totals_use_rollup_and_rebuild_after_new_activity(storage, run):
+    _seed(storage, run)
+    now = _at(0, day=DAY + timedelta(days=2))
+
+    def totals():
+        rows = run(storage.activity_totals(1, DAY, DAY + timedelta(days=1), GAP, now))
+        return {row["content"]: (row["seconds"], row["entries"]) for row in rows}
+
+    assert totals() == {"作業": (5400, 1), "昼食": (1800, 1), "散歩": (7200, 1)}
+    _add(storage, run, "散歩", _at(11, 30))
+    assert totals() == {"作業": (5400, 1), "昼食": (1800, 1), "散歩": (1800 + 7200, 2)}
+
+
+def test_totals_for_today_are_live(storage, run):
+    _seed(storage, run)
+    rows = run(storage.activity_totals(1, DAY, DAY + timedelta(days=1), GAP, _at(11, 15)))
+    assert {row["content"]: row["seconds"] for row in rows} == {"作業": 5400, "昼食": 1800, "散歩": 900}
@@ -0,0 +1,69 @@
+"""台帳による過去の残高と、台帳を始める前からあった財布の残高推移"""
+
+import time
+from datetime import datetime, timedelta, timezone
+
+USER_ID = 1
+LEGACY_WALLET = [
+    "CREATE TABLE user_balances (user_id BIGINT NOT NULL, category TEXT NOT NULL, balance BIGINT NOT NULL, PRIMARY KEY (user_id, category))",
+    f"INSERT INTO user_balances VALUES ({USER_ID}, '貯金', 10000)",
+]
+
+
+def test_legacy_wallet_starts_from_first_snapshot(open_storage, run):
+    # 台帳のトリガーがない頃に作られた財布を用意してから、台帳を始める
+    storage = open_storage(before_init=LEGACY_WALLET)
+    run(storage.record_spend(USER_ID, "食費", 500, "貯金"))
+    now = datetime.now(timezone.utc)
+    start = now - timedelta(days=2)
+
+    assert run(storage.balance_at(USER_ID, start)) == {}
+    history = run(storage.balance_history(USER_ID, start, now + timedelta(seconds=1)))
+    assert [(row["wallet"], row["balance"], row["starts"]) for row in history] == [("貯金", 9500, True)]
+
+
+def test_wallet_created_in_window_counts_from_zero(storage, run):
+    run(storage.reset_balance(USER_ID, "財布", 3000))
+    run(storage.take_balance_snapshots())
+    run(storage.record_spend(USER_ID, "食費", 1000, "財布"))
+    now = datetime.now(timezone.utc)
+
+    history = run(storage.balance_history(USER_ID, now - timedelta(days=2), now + timedelta(seconds=1)))
+    assert [(row["wallet"], row["balance"], row["starts"]) for row in history] == [("財布", 2000, False)]
+
+
+def test_balance_at_adds_ledger_entries_after_snapshot(storage, run):
+    run(storage.reset_balance(USER_ID, "財布", 3000))
+    run(storage.take_balance_snapshots())
+    run(storage.record_spend(USER_ID, "食費", 1000, "財布"))
+    run(storage.record_spend(USER_ID, "食費", 500, "財布"))
+
+    assert run(storage.balance_at(USER_ID, datetime.now(timezone.utc) + timedelta(seconds=1))) == {"財布": 1500}
+
+
+def test_every_balance_change_is_written_to_the_ledger(storage, run):
+    # 残高を変える操作はどれも台帳のトリガーを通るので、どの時点でも balance_at が残高と一致する
+    def check():
+        time.sleep(0.01)
+        at = datetime.now(timezone.utc)
+        time.sleep(0.01)
+        balances = run(storage.get_balances(USER_ID))
+        assert run(storage.balance_at(USER_ID, at)) == balances
+        return at, balances
+
+    run(storage.reset_balance(USER_ID, "財布", 3000))
+    run(storage.reset_balance(USER_ID, "貯金", 0))
+    run(storage.add_salary(USER_ID, 2000, {"財布": 1500, "貯金": 500}))
+    before_transfer, balances = check()
+    assert balances == {"財布": 4500, "貯金": 500}
+
+    run(storage.transfer(USER_ID, "財布", "貯金", 1000))
+    run(storage.take_balance_snapshots())
+    spend = run(storage.record_spend(USER_ID, "食費", 700, "財布"))
+    check()
+    run(storage.edit_spend(USER_ID, spend.transaction_id, timezone.utc, amount=200, source_wallet="貯金"))
+    assert check()[1] == {"財布": 3500, "貯金": 1300}
+    run(storage.apply_reconciliation(USER_ID, {"財布": 3000, "貯金": None}))
+    assert check()[1] == {"財布": 3000, "貯金": 1300}
+
+    assert run(storage.balance_at(USER_ID, before_transfer)) == {"財布": 4500, "貯金": 500}
@@ -0,0 +1,57 @@
+"""月の予算の使用額と閾値の警告"""
+
+from datetime import datetime
+
+from storage.base import REPORT_TZ, BudgetUsage
+
+USER_ID = 1
+SPENT_AT = datetime(2026, 1, 15, 12, 0, tzinfo=REPORT_TZ)
+
+
+def _usage(result):
+    return sorted((usage.category, usage.before, usage.after, usage.limit) for usage in result.budgets)
+
+
+def _status(storage, run):
+    return {row["category"]: (row["amount"], row["spent"]) for row in run(storage.budget_status(USER_ID, "2026-01"))}
+
+
+def test_spends_add_to_category_and_wallet_budgets(storage, run):
+    run(storage.reset_balance(USER_ID, "財布", 10000))
+    run(storage.set_budget(USER_ID, "食費", 1000))
+    run(storage.set_budget(USER_ID, "財布", 5000))
+
+    first = run(storage.record_spend(USER_ID, "食費", 700, "財布", created_at=SPENT_AT))
+    assert _usage(first) == [("財布", 0, 700, 5000), ("食費", 0, 700, 1000)]
+    second = run(storage.record_spend(USER_ID, "日用品", 400, "財布", created_at=SPENT_AT))
+    assert _usage(second) == [("財布", 700, 1100, 5000)]
+    # 翌月の支出は別の月に数える
+    run(storage.record_spend(USER_ID, "食費", 300, "財布", created_at=datetime(2026, 2, 1, 0, 30, tzinfo=REPORT_TZ)))
+    assert _status(storage, run) == {"食費": (1000, 700), "財布": (5000, 1100)}
+
+    # 修正すると前の分を戻してから数え直す
+    run(storage.edit_spend(USER_ID, first.transaction_id, REPORT_TZ, amount=200))
+    assert _status(storage, run) == {"食費": (1000, 200), "財布": (5000, 600)}
+
+    run(storage.set_budget(USER_ID, "財布", None))
+    assert _status(storage, run) == {"食費": (1000, 200)}
+
+
+def test_alert_reports_highest_newly_crossed_threshold(monkeypatch):
+    from config import Config
+    from discord_client import format_budget_alerts
+
+    monkeypatch.setattr(Config, "BUDGET_ALERT_THRESHOLDS", [80, 100])
+    assert BudgetUsage("食費", "2026-01", 700, 900, 1000).crossed_threshold([80, 100]) == 80
+    assert BudgetUsage("食費", "2026-01", 700, 1200, 1000).crossed_threshold([80, 100]) == 100
+    assert BudgetUsage("食費", "2026-01", 850, 900, 1000).crossed_threshold([80, 100]) is None
+
+    alerts = format_budget_alerts([
+        BudgetUsage("食費", "2026-01", 700, 900, 1000),
+        BudgetUsage("財布", "2026-01", 4000, 5200, 5000),
+        BudgetUsage("日用品", "2026-01", 0, 10, 1000),
+    ])
+    assert alerts.splitlines() == [
+        "⚠️ 食費 の1月の予算 1,000円の80%に達したぞ。 (使用額: 900円、残り 100円)",
+        "🚨 財布 の1月の予算 5,000円を超えたぞ！ (使用額: 5,200円)",
+    ]
@@ -0,0 +1,48 @@
+"""停止中に投稿されたメッセージの取り込み"""
+
+from datetime import datetime, timedelta, timezone
+
+import discord
+
+from benchmarks.fakes import FakeMessage, FakeUser
+
+
+def _message(channel, author, content, at):
+    message = FakeMessage(author, channel, content)
+    message.id = discord.utils.time_snowflake(at)
+    message.created_at = at
+    return message
+
+
+def test_catch_up_stores_missed_messages_and_replays_activities(bot, run):
+    channel = bot.test_channel
+    user = FakeUser(1, "ぬし")
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    logged = _message(channel, user, "寝る前", now - timedelta(hours=3))
+    history = [
+        logged,
+        _message(channel, user, "作業なう", now - timedelta(hours=2)),
+        _message(channel, bot.user, "了解した", now - timedelta(hours=2, minutes=-1)),
+        _message(channel, user, "おはよう", now - timedelta(hours=1)),
+    ]
+
+    async def channel_history(*, after, before, limit, oldest_first):
+        for message in history:
+            if after.id < message.id and message.created_at < before:
+                yield message
+
+    channel.history = channel_history
+    run(bot.storage.log_message(logged.id, 1, channel.id, user.id, logged.content, logged.created_at))
+
+    run(bot.catch_up({channel.id: logged.id}, now))
+
+    stored = run(bot.storage.fetch_messages_after(0, now, 10))
+    assert [row["content"] for row in stored] == ["寝る前", "作業なう", "おはよう"]
+    activities = run(bot.storage.fetch_activities_after(0, 10))
+    assert [(row["content"], row["status"]) for row in activities] == [("作業", "doing")]
+    assert history[1].reactions_added == 0
+
+    # 同じ範囲をもう一度取り込んでも増えない
+    run(bot.catch_up({channel.id: 0}, now))
+    assert len(run(bot.storage.fetch_messages_after(0, now, 10))) == 3
+    assert len(run(bot.storage.fetch_activities_after(0, 10))) == 1
@@ -0,0 +1,41 @@
+"""コマンド定義が変わったときだけ同期する"""
+
+from discord import app_commands
+
+from config import Config
+
+
+def test_sync_only_when_commands_change(bot, run, monkeypatch):
+    monkeypatch.setattr(Config, "GUILD_ID", 0)
+    synced = []
+
+    async def sync(guild=None):
+        synced.append(guild)
+
+    bot.tree.sync = sync
+    run(bot.sync_commands_if_changed())
+    run(bot.sync_commands_if_changed())
+    assert len(synced) == 1
+
+    @app_commands.command(name="ping", description="Ping")
+    async def ping(interaction):
+        pass
+
+    bot.tree.add_command(ping)
+    run(bot.sync_commands_if_changed())
+    assert len(synced) == 2
+
+    bot.force_command_sync = True
+    run(bot.sync_commands_if_changed())
+    assert len(synced) == 3
+
+
+def test_startup_profile_reports_phases():
+    from startup_profile import StartupProfile
+
+    profile = StartupProfile()
+    profile.mark("config")
+    profile.mark("login")
+    report = profile.report()
+    assert [phase for phase, _ in profile.phases] == ["config", "login"]
+    assert "config" in report and "login" in report and profile.reported
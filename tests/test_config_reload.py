@@ -0,0 +1,57 @@
+"""設定の再読み込みで環境変数と設定ファイルを重ねる順序と、Botへの反映"""
+
+import pytest
+
+import config
+
+
+def _use_config_file(monkeypatch, tmp_path, text, environ):
+    path = tmp_path / "sora.env"
+    path.write_text(text, encoding="utf-8")
+    monkeypatch.setattr(config, "CONFIG_FILE", str(path))
+    monkeypatch.setattr(config, "BASE_ENVIRON", {**environ, "CONFIG_FILE": str(path)})
+
+
+def test_environment_wins_over_config_file_on_reload(monkeypatch, tmp_path):
+    environ = {"DISCORD_BOT_TOKEN": "token", "TARGET_CHANNEL_IDS": "10", "OWNER_ID": "1"}
+    _use_config_file(monkeypatch, tmp_path, "OWNER_ID=2\nKEYWORD_REACTIONS=なう:🕒\n", environ)
+
+    fresh = config._load_fresh_config()
+
+    assert fresh.OWNER_ID == 1
+    assert fresh.KEYWORD_REACTIONS == "なう:🕒"
+
+
+def test_key_removed_from_config_file_returns_to_default(monkeypatch, tmp_path):
+    environ = {"DISCORD_BOT_TOKEN": "token", "TARGET_CHANNEL_IDS": "10"}
+    _use_config_file(monkeypatch, tmp_path, "OWNER_ID=3\n", environ)
+    # 起動時の load_dotenv で設定ファイルの値は環境変数に入っている
+    monkeypatch.setenv("KEYWORD_REACTIONS", "わず:✅")
+
+    fresh = config._load_fresh_config()
+
+    assert fresh.OWNER_ID == 3
+    assert fresh.KEYWORD_REACTIONS == "なう:🕒,わず:✅,うぃる:🗓️"
+    assert config.os.environ["KEYWORD_REACTIONS"] == "わず:✅"
+
+
+def test_bot_applies_reloaded_settings_or_keeps_old_ones(bot, monkeypatch, tmp_path):
+    # 再読み込みは Config を書き換えるので、テストの後で元に戻るようにしておく
+    for name in config.RELOADABLE_SETTINGS:
+        monkeypatch.setattr(config.Config, name, getattr(config.Config, name))
+    monkeypatch.setattr(config.Config, "DISCORD_BOT_TOKEN", "token")
+    environ = {"DISCORD_BOT_TOKEN": "token"}
+    _use_config_file(monkeypatch, tmp_path, "TARGET_CHANNEL_IDS=10,11\nKEYWORD_REACTIONS=ねる:💤\nDISPATCH_SHED_THRESHOLD=5\n", environ)
+
+    changed = bot.reload_config()
+
+    assert {"TARGET_CHANNEL_IDS", "KEYWORD_REACTIONS", "DISPATCH_SHED_THRESHOLD"} <= set(changed)
+    assert bot.target_channels == frozenset({10, 11})
+    assert bot.keyword_reactions == {"ねる": "💤"}
+    assert bot.dispatcher.shed_threshold == 5
+
+    _use_config_file(monkeypatch, tmp_path, "TARGET_CHANNEL_IDS=0\nDISPATCH_SHED_THRESHOLD=9\n", environ)
+    with pytest.raises(ValueError):
+        bot.reload_config()
+    assert bot.target_channels == frozenset({10, 11})
+    assert bot.dispatcher.shed_threshold == 5
@@ -0,0 +1,67 @@
+"""スロークエリの EXPLAIN"""
+
+import asyncio
+
+from db_trace import QueryStats, TracedPool
+
+
+class _FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def fetch(self, query, *args):
+        self.pool.explained.append(query)
+        await asyncio.sleep(0)
+        return [("Seq Scan on messages",)]
+
+
+class _FakeAcquire:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def __aenter__(self):
+        return _FakeConnection(self.pool)
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class _FakePool:
+    def __init__(self):
+        self.explained = []
+        self.closed = False
+
+    def acquire(self):
+        return _FakeAcquire(self)
+
+    async def close(self):
+        self.closed = True
+
+
+def test_explain_tasks_are_kept_until_done(run):
+    async def scenario():
+        fake = _FakePool()
+        pool = TracedPool(fake, QueryStats(threshold_ms=0), explain=True)
+        pool._observe("SELECT * FROM messages WHERE user_id = $1", "test", 0.5, (1,))
+        pool._observe("SELECT * FROM messages WHERE user_id = $1", "test", 0.5, (2,))
+        pending = len(pool._explain_tasks)
+        await asyncio.gather(*pool._explain_tasks)
+        await asyncio.sleep(0)
+        return pending, len(pool._explain_tasks), fake.explained
+
+    pending, remaining, explained = run(scenario())
+    assert (pending, remaining) == (1, 0)
+    assert explained == ["EXPLAIN SELECT * FROM messages WHERE user_id = $1"]
+
+
+def test_close_cancels_pending_explains(run):
+    async def scenario():
+        fake = _FakePool()
+        pool = TracedPool(fake, QueryStats(threshold_ms=0), explain=True)
+        pool._observe("SELECT * FROM messages", "test", 0.5, ())
+        tasks = list(pool._explain_tasks)
+        await pool.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return fake.closed, all(task.cancelled() for task in tasks)
+
+    assert run(scenario()) == (True, True)
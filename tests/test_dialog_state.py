@@ -0,0 +1,60 @@
+"""ストレージに置く会話状態と、状態のないユーザーのキャッシュ"""
+
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from dialog_state import StorageDialogStateStore
+
+
+def test_absent_users_are_cached_until_changed(listening_storage, run):
+    store = StorageDialogStateStore(listening_storage, timedelta(minutes=30))
+
+    assert run(store.get(1)) is None
+    assert run(store.get(1)) is None
+    assert (store.hits, store.misses, len(store)) == (1, 1, 1)
+
+    run(store.set(1, {"type": "add_storage"}))
+    assert run(store.get(1)) == {"type": "add_storage"}
+    assert run(store.get(1)) == {"type": "add_storage"}
+    assert len(store) == 0
+
+    run(store.clear(1))
+    assert run(store.get(1)) is None
+    assert len(store) == 1
+
+
+def test_expired_state_is_ignored(listening_storage, run):
+    store = StorageDialogStateStore(listening_storage, timedelta(seconds=-1))
+    run(store.set(1, {"type": "add_storage"}))
+    assert run(store.get(1)) is None
+
+
+def test_cache_disabled_with_zero_size(listening_storage, run):
+    store = StorageDialogStateStore(listening_storage, timedelta(minutes=30), cache_size=0)
+    assert run(store.get(1)) is None
+    assert run(store.get(1)) is None
+    assert (store.hits, store.misses) == (0, 2)
+
+
+def test_other_process_dialog_reaches_cached_absent_user(open_storage, backend, run):
+    if backend == "sqlite":
+        pytest.skip("SQLite は1プロセスでしか使わない")
+    first, second = open_storage(), open_storage()
+    store = StorageDialogStateStore(first, timedelta(minutes=30))
+    other = StorageDialogStateStore(second, timedelta(minutes=30))
+
+    async def scenario():
+        await first.start_change_listener()
+        while not first.changes.reliable:
+            await asyncio.sleep(0.01)
+        assert await store.get(1) is None
+        assert len(store) == 1
+        await other.set(1, {"type": "add_storage"})
+        # 別の接続の書き込みは NOTIFY で届く
+        while len(store):
+            await asyncio.sleep(0.01)
+        return await store.get(1)
+
+    assert run(asyncio.wait_for(scenario(), timeout=10)) == {"type": "add_storage"}
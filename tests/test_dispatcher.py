@@ -0,0 +1,80 @@
+"""低優先度レーンの上限で捨てる処理"""
+
+import asyncio
+
+from dispatcher import UserDispatcher
+
+
+def _dispatcher(low_queue_limit):
+    return UserDispatcher(max_concurrency=1, user_queue_limit=1, shed_threshold=100, low_queue_limit=low_queue_limit)
+
+
+def test_low_lane_keeps_non_sheddable_jobs_over_limit():
+    async def scenario():
+        dispatcher = _dispatcher(low_queue_limit=2)
+        done = []
+
+        async def job(name):
+            done.append(name)
+
+        for name in ("log1", "log2", "log3"):
+            dispatcher.submit_low(job, name)
+        await dispatcher.drain()
+        return done, dispatcher.dropped
+
+    done, dropped = asyncio.run(scenario())
+    assert done == ["log1", "log2", "log3"]
+    assert dropped == 0
+
+
+def test_low_lane_evicts_oldest_sheddable_job_first():
+    async def scenario():
+        dispatcher = _dispatcher(low_queue_limit=2)
+        done = []
+
+        async def job(name):
+            done.append(name)
+
+        dispatcher.submit_low(job, "log1")
+        dispatcher.submit_low(job, "reaction1", sheddable=True)
+        dispatcher.submit_low(job, "log2")
+        dispatcher.submit_low(job, "reaction2", sheddable=True)
+        await dispatcher.drain()
+        return done, dispatcher.dropped
+
+    done, dropped = asyncio.run(scenario())
+    # log2 の投入で reaction1 が捨てられ、reaction2 は捨てられる処理がないので入らない
+    assert done == ["log1", "log2"]
+    assert dropped == 2
+
+
+def test_user_queue_limit_rejects_extra_jobs():
+    async def scenario():
+        dispatcher = _dispatcher(low_queue_limit=10)
+        done = []
+
+        async def job(name):
+            done.append(name)
+
+        dispatcher.submit(1, job, "first")
+        dispatcher.submit(1, job, "second")
+        await dispatcher.drain()
+        return done, dispatcher.rejected
+
+    done, rejected = asyncio.run(scenario())
+    assert done == ["first"]
+    assert rejected == 1
+
+
+def test_rejected_job_leaves_no_empty_queue():
+    async def scenario():
+        dispatcher = UserDispatcher(max_concurrency=1, user_queue_limit=0, shed_threshold=100, low_queue_limit=10)
+
+        async def job():
+            pass
+
+        result = await dispatcher.submit(1, job)
+        await asyncio.wait_for(dispatcher.drain(), timeout=1)
+        return result, dispatcher.rejected
+
+    assert asyncio.run(scenario()) == (None, 1)
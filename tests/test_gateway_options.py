@@ -0,0 +1,30 @@
+"""MEMORY_PROFILE ごとのインテントとキャッシュ、メモリの内訳"""
+
+from config import Config
+from discord_client import current_rss_mb, gateway_options
+
+
+def test_low_profile_trims_intents_and_caches(monkeypatch):
+    monkeypatch.setattr(Config, "MEMORY_PROFILE", "low")
+    monkeypatch.setattr(Config, "MAX_MESSAGES", None)
+    options = gateway_options()
+    intents = options["intents"]
+    assert (intents.guilds, intents.guild_messages, intents.message_content) == (True, True, True)
+    assert not intents.members and not intents.dm_messages and not intents.presences
+    assert options["max_messages"] is None and options["chunk_guilds_at_startup"] is False
+
+
+def test_default_profile_keeps_message_cache_unless_overridden(monkeypatch):
+    monkeypatch.setattr(Config, "MEMORY_PROFILE", "default")
+    monkeypatch.setattr(Config, "MAX_MESSAGES", None)
+    assert "max_messages" not in gateway_options()
+    monkeypatch.setattr(Config, "MAX_MESSAGES", 0)
+    assert gateway_options()["max_messages"] is None
+    monkeypatch.setattr(Config, "MAX_MESSAGES", 200)
+    assert gateway_options()["max_messages"] == 200
+
+
+def test_memory_breakdown_counts_bot_caches(bot):
+    breakdown = bot.memory_breakdown()
+    assert breakdown["dialog_states"] == 0 and breakdown["check_state_cache"] == 0
+    assert current_rss_mb() is None or current_rss_mb() > 0
@@ -0,0 +1,46 @@
+"""/healthz と /readyz"""
+
+import asyncio
+import json
+import time
+
+from health import HealthServer, LoopMonitor
+
+
+def _call(run, handler):
+    response = run(handler(None))
+    return response.status, json.loads(response.text)
+
+
+def test_readyz_follows_gateway_and_storage(bot, run, monkeypatch):
+    server = HealthServer(bot, "127.0.0.1", 0, max_drift_ms=500)
+    status, body = _call(run, server.readyz)
+    assert status == 503 and body["status"] == "unavailable"
+    assert body["storage"]["ready"] is True and body["storage"]["breaker"] == "closed"
+    assert body["gateway"]["latency_ms"] is None
+
+    monkeypatch.setattr(bot, "is_ready", lambda: True)
+    status, body = _call(run, server.readyz)
+    assert status == 200 and body["status"] == "ok"
+
+
+def test_healthz_reports_loop_drift(bot, run):
+    server = HealthServer(bot, "127.0.0.1", 0, max_drift_ms=500)
+    assert _call(run, server.healthz)[0] == 200
+    server.monitor.drifts.append(0.6)
+    status, body = _call(run, server.healthz)
+    assert status == 503 and body["loop"]["drift_max_ms"] == 600.0
+
+
+def test_loop_monitor_measures_blocked_loop(run):
+    async def scenario():
+        monitor = LoopMonitor(interval=0.01)
+        monitor.start()
+        await asyncio.sleep(0.02)
+        # ループを止めて、次に起きるのが遅れるようにする
+        time.sleep(0.1)
+        await asyncio.sleep(0.03)
+        monitor.stop()
+        return monitor.stats()
+
+    assert run(scenario())["drift_max_ms"] >= 50
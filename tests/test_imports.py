@@ -0,0 +1,10 @@
+"""起動に使うモジュールが読み込めること"""
+
+import importlib
+
+import pytest
+
+
+@pytest.mark.parametrize("name", ["main", "discord_client"])
+def test_import(name):
+    importlib.import_module(name)
@@ -0,0 +1,71 @@
+"""変更通知によるプロセス内キャッシュの無効化"""
+
+import asyncio
+
+import pytest
+
+from invalidation import ChangeFeed, KeyedCache
+
+
+def _loader(values, calls):
+    async def load(key):
+        calls.append(key)
+        return values.get(key)
+    return load
+
+
+def test_cache_evicts_changed_key_only(run):
+    feed = ChangeFeed()
+    cache = KeyedCache(feed, "balance_check_state", max_size=10)
+    values, calls = {1: "a", 2: "b"}, []
+    load = _loader(values, calls)
+
+    assert [run(cache.get(key, load)) for key in (1, 2, 1, 2)] == ["a", "b", "a", "b"]
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    values[1] = "c"
+    feed.publish("balance_check_state", 1)
+    feed.publish("user_balances", 2)
+    assert (run(cache.get(1, load)), run(cache.get(2, load))) == ("c", "b")
+    assert calls == [1, 2, 1]
+
+    feed.reset()
+    assert len(cache) == 0
+
+
+def test_cache_skips_values_read_during_a_change(run):
+    feed = ChangeFeed()
+    cache = KeyedCache(feed, "balance_check_state", max_size=10)
+
+    async def load(key):
+        feed.publish("balance_check_state", key)
+        return "古いかもしれない"
+
+    run(cache.get(1, load))
+    assert len(cache) == 0
+
+    feed.reliable = False
+    run(cache.get(1, _loader({1: "a"}, [])))
+    assert len(cache) == 0
+
+
+def test_other_connection_writes_evict_through_notify(open_storage, backend, run):
+    if backend == "sqlite":
+        pytest.skip("LISTEN/NOTIFY は Postgres だけ")
+    storage, other = open_storage(), open_storage()
+    cache = KeyedCache(storage.changes, "balance_check_state", max_size=10)
+
+    async def scenario():
+        assert not storage.changes.reliable
+        await storage.start_change_listener()
+        while not storage.changes.reliable:
+            await asyncio.sleep(0.01)
+        assert await cache.get(1, storage.get_check_state) is None
+        assert len(cache) == 1
+        await other.start_balance_check(1)
+        while len(cache):
+            await asyncio.sleep(0.01)
+        return await cache.get(1, storage.get_check_state)
+
+    state = run(asyncio.wait_for(scenario(), timeout=10))
+    assert state is not None
@@ -0,0 +1,89 @@
+"""定期タスクを期間ごとに1回だけ実行する"""
+
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from benchmarks.fakes import FakeUser
+from jobs import JobRunner
+
+
+def _status(storage, run, job="report"):
+    return [(row["status"], row["attempts"]) for row in run(storage.recent_job_runs(10)) if row["job"] == job]
+
+
+def test_only_one_replica_runs_a_period(open_storage, run):
+    # 別々の接続をそれぞれのプロセスに見立てる
+    first, second = open_storage(), open_storage()
+    started = []
+
+    async def report():
+        started.append(True)
+        await asyncio.sleep(0.05)
+
+    async def scenario():
+        return await asyncio.gather(
+            JobRunner(first, lease=60, owner="a").run("report", "2026-01-05", report),
+            JobRunner(second, lease=60, owner="b").run("report", "2026-01-05", report),
+        )
+
+    assert sorted(run(scenario())) == [False, True]
+    assert len(started) == 1
+    assert _status(first, run) == [("done", 1)]
+    # 成功した期間は再起動しても実行しない
+    assert run(JobRunner(second, lease=60, owner="c").run("report", "2026-01-05", report)) is False
+
+
+def test_failed_or_abandoned_runs_are_taken_over(storage, run):
+    async def broken():
+        raise RuntimeError("送れない")
+
+    async def ok():
+        pass
+
+    with pytest.raises(RuntimeError):
+        run(JobRunner(storage, lease=60, owner="a").run("report", "2026-01-05", broken))
+    assert _status(storage, run) == [("failed", 1)]
+    assert run(JobRunner(storage, lease=60, owner="b").run("report", "2026-01-05", ok)) is True
+    assert _status(storage, run) == [("done", 2)]
+
+    # 生存通知が lease より古い実行は落ちたものとみなす
+    assert run(storage.claim_job_run("report", "2026-01-06", "a", timedelta(seconds=60))) is True
+    assert run(storage.claim_job_run("report", "2026-01-06", "b", timedelta(seconds=60))) is False
+    assert run(storage.claim_job_run("report", "2026-01-06", "b", timedelta(seconds=-1))) is True
+    assert run(storage.heartbeat_job_run("report", "2026-01-06", "a")) is False
+
+
+def test_noon_report_job_finishes_after_delivery(bot, run, monkeypatch):
+    from discord_client import FinanceCog
+
+    cog = FinanceCog(bot)
+    user = FakeUser(1, "ぬし")
+    run(bot.storage.reset_balance(1, "ぬし財布", 1000))
+    released = asyncio.Event()
+    statuses = []
+
+    async def fetch_user(user_id):
+        return user
+
+    async def send(*args, **kwargs):
+        # 送信が終わる前はまだ実行中として残っている
+        statuses.extend(_row["status"] for _row in await bot.storage.recent_job_runs(10))
+        await released.wait()
+        user.dm_count += 1
+
+    monkeypatch.setattr(bot, "fetch_user", fetch_user)
+    user.send = send
+
+    async def scenario():
+        job = asyncio.create_task(bot.jobs.run("daily_balance_report", "2026-01-05", cog._send_daily_balance_report))
+        while not statuses:
+            await asyncio.sleep(0.01)
+        assert not job.done()
+        released.set()
+        return await job
+
+    assert run(asyncio.wait_for(scenario(), timeout=10)) is True
+    assert statuses == ["running"] and user.dm_count == 1
+    assert _status(bot.storage, run, "daily_balance_report") == [("done", 1)]
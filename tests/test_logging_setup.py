@@ -0,0 +1,40 @@
+"""ログの間引きとロガーごとのレベル指定"""
+
+import logging
+
+import logging_setup
+from logging_setup import SamplingFilter, apply_log_levels, parse_log_levels
+
+
+def _record(level=logging.INFO, lineno=10):
+    return logging.LogRecord("sora", level, "sora.py", lineno, "メッセージ %s", ("a",), None)
+
+
+def test_sampling_filter_drops_over_burst_and_reports_count(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(logging_setup.time, "monotonic", lambda: now[0])
+    sampling = SamplingFilter(rate=1.0, burst=2)
+
+    assert [sampling.filter(_record()) for _ in range(4)] == [True, True, False, False]
+    assert sampling.filter(_record(lineno=11))
+    assert sampling.filter(_record(logging.ERROR))
+
+    now[0] += 1.0
+    record = _record()
+    assert sampling.filter(record)
+    assert record.getMessage() == "メッセージ a (同じ箇所のログを2件抑制)"
+
+
+def test_sampling_filter_disabled_with_zero_rate():
+    sampling = SamplingFilter(rate=0, burst=0)
+    assert all(sampling.filter(_record()) for _ in range(10))
+
+
+def test_log_levels_are_parsed_and_reset():
+    assert parse_log_levels("discord:WARNING, storage.sqlite:debug,bad,x:NOPE") == {
+        "discord": logging.WARNING, "storage.sqlite": logging.DEBUG}
+
+    apply_log_levels("sora.test.a:WARNING,sora.test.b:ERROR")
+    apply_log_levels("sora.test.b:INFO", previous="sora.test.a:WARNING,sora.test.b:ERROR")
+    assert logging.getLogger("sora.test.a").level == logging.NOTSET
+    assert logging.getLogger("sora.test.b").level == logging.INFO
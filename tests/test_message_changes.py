@@ -0,0 +1,74 @@
+"""メッセージの編集・削除の反映"""
+
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+START = datetime(2026, 1, 5, tzinfo=timezone.utc)
+END = START + timedelta(days=1)
+
+
+def _contents(storage, run):
+    return [row["content"] for row in run(storage.fetch_users_messages([1], START, END))]
+
+
+def edit(content, minutes):
+    return (100, 1, 10, 1, content, START, START + timedelta(minutes=minutes))
+
+
+def test_newer_edit_wins_and_deleted_messages_stay_deleted(storage, run):
+    run(storage.log_message(100, 1, 10, 1, "はじめ", START))
+
+    assert run(storage.apply_message_edits([edit("2回目", 2)])) == 1
+    assert run(storage.apply_message_edits([edit("1回目", 1)])) == 0
+    assert _contents(storage, run) == ["2回目"]
+
+    # 記録より先に届いた編集も残す
+    run(storage.apply_message_edits([(101, 1, 10, 1, "後から記録", START + timedelta(minutes=5), START + timedelta(minutes=6))]))
+    run(storage.log_message(101, 1, 10, 1, "古い本文", START + timedelta(minutes=5)))
+    assert _contents(storage, run) == ["2回目", "後から記録"]
+
+    deleted_at = START + timedelta(hours=1)
+    assert run(storage.delete_messages([(100, 1, 10, START, deleted_at), (102, 1, 10, START, deleted_at)])) == 2
+    assert run(storage.delete_messages([(100, 1, 10, START, deleted_at)])) == 0
+    assert run(storage.apply_message_edits([edit("削除後", 3)])) == 0
+    # 削除が記録より先に届いても、あとから記録されない
+    run(storage.log_message(102, 1, 10, 1, "消したはず", START))
+    assert _contents(storage, run) == ["後から記録"]
+
+
+def _edit_payload(message_id, content, edited_at):
+    return SimpleNamespace(message_id=message_id, channel_id=10, guild_id=1, data={
+        "content": content, "author": {"id": "1"}, "edited_timestamp": edited_at.isoformat()})
+
+
+def test_bot_buffers_edits_and_deletes_until_flush(bot, run):
+    created_at = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(minutes=10)
+    message_id = discord.utils.time_snowflake(created_at)
+    run(bot.storage.log_message(message_id, 1, 10, 1, "はじめ", created_at))
+
+    run(bot.on_raw_message_edit(_edit_payload(message_id, "直した", created_at + timedelta(minutes=1))))
+    run(bot.on_raw_message_edit(_edit_payload(message_id, "古い編集", created_at + timedelta(seconds=30))))
+    run(bot.flush_message_changes())
+    rows = run(bot.storage.fetch_messages_after(0, datetime.now(timezone.utc), 10))
+    assert [row["content"] for row in rows] == ["直した"]
+
+    run(bot.on_raw_message_delete(SimpleNamespace(message_id=message_id, channel_id=10, guild_id=1)))
+    run(bot.flush_message_changes())
+    assert run(bot.storage.fetch_messages_after(0, datetime.now(timezone.utc), 10)) == []
+
+
+def test_failed_flush_keeps_changes_for_next_round(bot, run, monkeypatch):
+    created_at = datetime.now(timezone.utc).replace(microsecond=0)
+    message_id = discord.utils.time_snowflake(created_at)
+    run(bot.on_raw_message_edit(_edit_payload(message_id, "直した", created_at)))
+
+    async def broken(*args):
+        raise RuntimeError("書けない")
+
+    monkeypatch.setattr(bot.storage, "apply_message_edits", broken)
+    with pytest.raises(RuntimeError):
+        run(bot.flush_message_changes())
+    assert message_id in bot._message_edits
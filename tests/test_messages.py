@@ -0,0 +1,16 @@
+"""複数ユーザーのメッセージをまとめて読むときの1人あたりの上限"""
+
+from datetime import datetime, timedelta, timezone
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def test_fetch_users_messages_caps_rows_per_user(storage, run):
+    for n in range(5):
+        run(storage.log_message(100 + n, 1, 10, 1, f"a{n}", START + timedelta(minutes=n)))
+    run(storage.log_message(200, 1, 10, 2, "b0", START))
+    end = START + timedelta(days=1)
+
+    capped = run(storage.fetch_users_messages([1, 2], START, end, limit_per_user=3))
+    assert [(row["user_id"], row["content"]) for row in capped] == [(1, "a0"), (1, "a1"), (1, "a2"), (2, "b0")]
+    assert len(run(storage.fetch_users_messages([1, 2], START, end))) == 6
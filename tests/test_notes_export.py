@@ -0,0 +1,31 @@
+"""デイリーノートへの追記とチェックポイント"""
+
+from datetime import datetime, timedelta, timezone
+
+from notes_export import NotesExporter
+
+JST = timezone(timedelta(hours=9))
+
+
+def test_export_appends_only_new_rows(storage, run, tmp_path):
+    vault = tmp_path / "vault"
+    exporter = NotesExporter(storage, str(vault), user_name={1: "ぬし"}.get)
+    run(storage.add_activity(1, 10, 1, "作業", datetime(2026, 1, 5, 9, 0, tzinfo=JST), "doing", None))
+    run(storage.add_activity(1, 10, 1, "洗濯", datetime(2026, 1, 5, 20, 0, tzinfo=JST), "todo", None))
+    run(storage.log_message(100, 1, 10, 1, "おはよう\n今日も", datetime(2026, 1, 5, 8, 30, tzinfo=JST)))
+
+    assert run(exporter.export()) == 3
+    note = vault / "2026-01-05.md"
+    assert note.read_text(encoding="utf-8") == (
+        "# 2026-01-05\n\n"
+        "- 08:30 **ぬし** おはよう 今日も\n"
+        "- 09:00 作業（なう）\n"
+        "- [ ] 20:00 洗濯\n")
+
+    with open(note, "a", encoding="utf-8") as f:
+        f.write("手で書いたメモ\n")
+    assert run(exporter.export()) == 0
+
+    run(storage.add_activity(1, 10, 1, "作業", datetime(2026, 1, 5, 11, 0, tzinfo=JST), "done", None))
+    assert run(exporter.export()) == 1
+    assert note.read_text(encoding="utf-8").endswith("手で書いたメモ\n- 11:00 作業（わず）\n")
@@ -0,0 +1,34 @@
+"""on_message から記録とユーザーごとの処理に振り分けること"""
+
+import asyncio
+
+from benchmarks.fakes import FakeMessage, FakeUser
+
+
+def test_message_is_logged_even_when_user_queue_is_full(bot, storage, run):
+    user = FakeUser(3, "隊員")
+    messages = [FakeMessage(user, bot.test_channel, f"雑談{n}") for n in range(3)]
+    bot.dispatcher.user_queue_limit = 1
+    handled = []
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def handle_message(message):
+            await release.wait()
+            handled.append(message.id)
+
+        bot.handle_message = handle_message
+        for message in messages:
+            await bot.on_message(message)
+        release.set()
+        await bot.dispatcher.drain()
+
+    run(scenario())
+
+    # 返事の処理は1件目だけ。記録は3件とも残る
+    assert handled == [messages[0].id]
+    assert bot.dispatcher.rejected == 2
+    start = messages[0].created_at
+    rows = run(storage.fetch_users_messages([user.id], start, start.replace(year=2100)))
+    assert sorted(row["id"] for row in rows) == [message.id for message in messages]
@@ -0,0 +1,99 @@
+"""送信キューのまとめ方と優先度、届いたかどうかの Future"""
+
+import discord
+
+from benchmarks.fakes import FakeChannel, FakeGuild, FakeMessage, FakeUser
+from outbound import LOW, NORMAL, OutboundQueue
+
+
+class _RecordingChannel(FakeChannel):
+    def __init__(self, channel_id, log):
+        super().__init__(channel_id, f"channel{channel_id}", FakeGuild(1, "テスト"))
+        self.log = log
+
+    async def send(self, content=None, **kwargs):
+        self.log.append((self.id, content))
+
+
+class _ClosedDMUser(FakeUser):
+    async def send(self, *args, **kwargs):
+        raise discord.Forbidden(_Response(403), "Cannot send messages to this user")
+
+
+class _Response:
+    def __init__(self, status):
+        self.status = status
+        self.reason = "Forbidden"
+
+
+def _channel():
+    return FakeChannel(10, "general", FakeGuild(1, "テスト"))
+
+
+def test_sends_are_merged_and_sent_by_lane(run):
+    async def scenario():
+        outbound = OutboundQueue(workers=1, low_queue_limit=10)
+        log = []
+        low, normal, high = (_RecordingChannel(channel_id, log) for channel_id in (1, 2, 3))
+        outbound.send(low, "後回し", lane=LOW)
+        outbound.send(normal, "通知", lane=NORMAL)
+        outbound.send(high, "返事1")
+        outbound.send(high, "返事2")
+        await outbound.drain()
+        await outbound.close()
+        return log, outbound.merged
+
+    log, merged = run(scenario())
+    assert log == [(3, "返事1\n返事2"), (2, "通知"), (1, "後回し")]
+    assert merged == 1
+
+
+def test_reactions_to_same_message_are_deduplicated(run):
+    async def scenario():
+        outbound = OutboundQueue(workers=1, low_queue_limit=10)
+        message = FakeMessage(FakeUser(1, "ぬし"), _channel(), "なう")
+        for emoji in ("🕒", "🕒", "✅"):
+            outbound.add_reaction(message, emoji)
+        await outbound.drain()
+        await outbound.close()
+        return message.reactions_added, message.last_reaction
+
+    assert run(scenario()) == (2, "✅")
+
+
+def test_send_resolves_after_delivery(run):
+    async def scenario():
+        outbound = OutboundQueue(workers=1, low_queue_limit=10)
+        user = FakeUser(1, "ぬし")
+        delivered = outbound.send(user, "こんにちは", lane=NORMAL)
+        merged = outbound.send(user, "続き", lane=NORMAL)
+        result = await delivered, await merged
+        await outbound.close()
+        return result, user.dm_count
+
+    assert run(scenario()) == ((True, True), 1)
+
+
+def test_send_resolves_through_fallback(run):
+    async def scenario():
+        outbound = OutboundQueue(workers=1, low_queue_limit=10)
+        channel = _channel()
+        delivered = outbound.send(_ClosedDMUser(1, "ぬし"), embed=discord.Embed(title="レポート"), lane=NORMAL,
+                                  fallback=(channel, "<@1>、DMが送れなかった"))
+        result = await delivered
+        await outbound.close()
+        return result, channel.sent
+
+    assert run(scenario()) == (True, 1)
+
+
+def test_send_resolves_false_when_undeliverable(run):
+    async def scenario():
+        outbound = OutboundQueue(workers=1, low_queue_limit=0)
+        failed = outbound.send(_ClosedDMUser(1, "ぬし"), "こんにちは", lane=NORMAL)
+        dropped = outbound.send(_channel(), "混雑時は省く", lane=LOW)
+        result = await failed, await dropped
+        await outbound.close()
+        return result
+
+    assert run(scenario()) == (False, False)
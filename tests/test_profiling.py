@@ -0,0 +1,50 @@
+"""ハンドラの所要時間とサンプリングプロファイラ"""
+
+import threading
+import time
+
+from dispatcher import UserDispatcher
+from profiling import HandlerTimings, SamplingProfiler
+
+
+def test_handler_timings_sorted_by_total():
+    timings = HandlerTimings()
+    timings.record("handle_message", 0.1)
+    timings.record("handle_message", 0.3)
+    timings.record("log_message", 0.05)
+    assert timings.top(5) == [("handle_message", 2, 0.4, 0.3), ("log_message", 1, 0.05, 0.05)]
+    assert timings.top(1)[0][0] == "handle_message"
+
+
+def test_dispatcher_records_handler_timings(run):
+    async def handle_message(message):
+        pass
+
+    async def scenario():
+        dispatcher = UserDispatcher(max_concurrency=2, user_queue_limit=10, shed_threshold=100, low_queue_limit=10)
+        dispatcher.timings = HandlerTimings()
+        dispatcher.submit(1, handle_message, "a")
+        dispatcher.submit(2, handle_message, "b")
+        await dispatcher.drain()
+        return dispatcher.timings.top(5)
+
+    assert [(name, count) for name, count, _, _ in run(scenario())] == [("handle_message", 2)]
+
+
+def _busy_loop(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+def test_sampling_profiler_writes_folded_stacks(tmp_path):
+    output = tmp_path / "profile.folded"
+    profiler = SamplingProfiler(threading.get_ident(), 0.005, str(output))
+    profiler.start()
+    _busy_loop(0.2)
+    profiler.stop()
+
+    assert profiler.samples > 0
+    assert profiler.top_frames(1)[0][0].startswith("_busy_loop (test_profiling.py:")
+    lines = output.read_text(encoding="utf-8").splitlines()
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in lines) == profiler.samples
@@ -0,0 +1,55 @@
+"""定期取引のスケジュールと、止まっていた間の分をまとめて記録する処理"""
+
+from datetime import datetime
+
+import pytest
+
+from recurring import JST, Schedule
+
+USER_ID = 1
+
+
+def test_schedules():
+    assert Schedule("monthly:31").next_after(datetime(2028, 2, 1, tzinfo=JST)) == datetime(2028, 2, 29, tzinfo=JST)
+    assert Schedule("monthly:25").next_after(datetime(2026, 1, 25, tzinfo=JST)) == datetime(2026, 2, 25, tzinfo=JST)
+    assert Schedule("weekly:mon").next_after(datetime(2026, 1, 5, tzinfo=JST)) == datetime(2026, 1, 12, tzinfo=JST)
+    assert Schedule("30 9 1,15 * *").next_after(datetime(2026, 1, 1, 9, 30, tzinfo=JST)) == datetime(2026, 1, 15, 9, 30, tzinfo=JST)
+    # 日と曜日の両方を指定したらどちらかに合えば実行する
+    assert Schedule("0 0 20 * 1").next_after(datetime(2026, 1, 6, tzinfo=JST)) == datetime(2026, 1, 12, tzinfo=JST)
+    with pytest.raises(ValueError, match="1日に1回"):
+        Schedule("*/5 * * * *")
+    with pytest.raises(ValueError, match="書式"):
+        Schedule("monthly:32")
+
+
+def _runs(runs):
+    return [(run.rule["kind"], run.due_at.astimezone(JST).date().isoformat(), run.error is not None) for run in runs]
+
+
+def test_missed_runs_stop_at_insufficient_balance_and_resume(storage, run):
+    run(storage.reset_balance(USER_ID, "財布", 2500))
+    run(storage.reset_balance(USER_ID, "貯金", 0))
+    run(storage.set_budget(USER_ID, "家賃", 5000))
+    run(storage.add_recurring_rule(USER_ID, "spend", 1000, "財布", "monthly:25", datetime(2026, 1, 25, tzinfo=JST), category="家賃"))
+    run(storage.add_recurring_rule(USER_ID, "transfer", 100, "貯金", "monthly:1", datetime(2026, 2, 1, tzinfo=JST), destination_wallet="財布"))
+    now = datetime(2026, 3, 26, tzinfo=JST)
+
+    # 家賃の3回目で残高が足りない。その回だけ取り消し、同じトランザクションの他の記録は残す
+    runs = run(storage.apply_due_recurring(now))
+    assert _runs(runs) == [
+        ("spend", "2026-01-25", False), ("spend", "2026-02-25", False), ("spend", "2026-03-25", True),
+        ("transfer", "2026-02-01", True),
+    ]
+    assert [(usage.month, usage.after) for usage in runs[1].budgets] == [("2026-02", 1000)]
+    assert run(storage.get_balances(USER_ID)) == {"財布": 500, "貯金": 0}
+
+    # 失敗し続けている間は同じ失敗を返さない
+    assert run(storage.apply_due_recurring(now)) == []
+
+    run(storage.reset_balance(USER_ID, "財布", 1000))
+    run(storage.reset_balance(USER_ID, "貯金", 500))
+    assert _runs(run(storage.apply_due_recurring(now))) == [
+        ("transfer", "2026-02-01", False), ("transfer", "2026-03-01", False), ("spend", "2026-03-25", False)]
+    assert run(storage.get_balances(USER_ID)) == {"財布": 200, "貯金": 300}
+    assert [rule["next_run_at"].astimezone(JST).date().isoformat() for rule in run(storage.list_recurring_rules(USER_ID))] == [
+        "2026-04-01", "2026-04-25"]
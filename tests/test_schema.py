@@ -0,0 +1,28 @@
+"""スキーマの初期化を繰り返しても途中のデータが残ること"""
+
+USER_ID = 1
+
+
+def test_init_schema_keeps_balance_check_in_progress(open_storage, run):
+    storage = open_storage()
+    run(storage.start_balance_check(USER_ID))
+    run(storage.save_check_input(USER_ID, "ぬし財布", 1200, "waiting_for_balance_ぽて財布"))
+    run(storage.close())
+    # ワーカーの再起動と同じく、もう一度初期化する
+    storage = open_storage()
+
+    state = run(storage.get_check_state(USER_ID))
+    assert state["state"] == "waiting_for_balance_ぽて財布"
+    assert state["input_nushi"] == 1200
+
+
+def test_init_schema_adds_missing_check_columns(open_storage, run):
+    storage = open_storage(before_init=[
+        "CREATE TABLE balance_check_state (user_id BIGINT PRIMARY KEY, state TEXT, input_nushi BIGINT)",
+        f"INSERT INTO balance_check_state VALUES ({USER_ID}, 'waiting_for_balance_ぽて財布', 800)",
+    ])
+
+    state = run(storage.get_check_state(USER_ID))
+    assert state["input_nushi"] == 800
+    assert state["input_savings"] is None
+    assert state["last_checked_at"] is None
@@ -0,0 +1,40 @@
+"""シャードを分けるときの設定の検証と、定期タスクを受け持つプロセス"""
+
+import pytest
+
+from config import Config
+
+
+@pytest.fixture
+def valid_config(monkeypatch):
+    monkeypatch.setattr(Config, "DISCORD_BOT_TOKEN", "token")
+    monkeypatch.setattr(Config, "TARGET_CHANNEL_IDS", [10])
+    monkeypatch.setattr(Config, "DATABASE_URL", "postgresql://localhost/sora")
+    monkeypatch.setattr(Config, "SHARD_COUNT", 4)
+    monkeypatch.setattr(Config, "SHARD_IDS", [2, 3])
+    return monkeypatch
+
+
+def test_split_shards_require_postgres(valid_config):
+    valid_config.setattr(Config, "STORAGE_BACKEND", "postgres")
+    Config.validate()
+
+    valid_config.setattr(Config, "STORAGE_BACKEND", "sqlite")
+    with pytest.raises(ValueError, match="sqlite"):
+        Config.validate()
+
+
+def test_shard_ids_must_be_in_range(valid_config):
+    valid_config.setattr(Config, "STORAGE_BACKEND", "postgres")
+    valid_config.setattr(Config, "SHARD_IDS", [4])
+    with pytest.raises(ValueError, match="SHARD_IDS"):
+        Config.validate()
+
+
+def test_only_the_guild_shard_runs_scheduled_tasks(valid_config):
+    from discord_client import SoraBot
+
+    valid_config.setattr(Config, "GUILD_ID", 6 << 22)
+    assert SoraBot.runs_scheduled_tasks.fget(None) is True
+    valid_config.setattr(Config, "GUILD_ID", 1 << 22)
+    assert SoraBot.runs_scheduled_tasks.fget(None) is False
@@ -0,0 +1,30 @@
+"""支出で財布の残高を超えて引き落とさないこと"""
+
+import asyncio
+
+import pytest
+
+from storage import InsufficientBalanceError
+
+USER_ID = 1
+
+
+def test_spend_over_balance_is_rejected_and_keeps_balance(storage, run):
+    run(storage.reset_balance(USER_ID, "ぬし財布", 1000))
+    run(storage.record_spend(USER_ID, "食費", 600, "ぬし財布"))
+    with pytest.raises(InsufficientBalanceError) as excinfo:
+        run(storage.record_spend(USER_ID, "食費", 600, "ぬし財布"))
+
+    assert excinfo.value.balance == 400
+    assert run(storage.get_balances(USER_ID))["ぬし財布"] == 400
+
+
+def test_concurrent_spends_do_not_overdraw(storage, run):
+    run(storage.reset_balance(USER_ID, "ぬし財布", 1000))
+
+    async def spend_all():
+        return await asyncio.gather(*(storage.record_spend(USER_ID, "食費", 300, "ぬし財布") for _ in range(5)), return_exceptions=True)
+
+    results = run(spend_all())
+    assert sum(isinstance(result, InsufficientBalanceError) for result in results) == 2
+    assert run(storage.get_balances(USER_ID))["ぬし財布"] == 100
@@ -0,0 +1,47 @@
+"""収納と備品、会話状態・メタ情報の保存（どのバックエンドでも同じ振る舞い）"""
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from config import Config
+from db_trace import QueryStats
+from storage import DuplicateStorageError, create_storage
+
+
+def test_storages_and_items(storage, run):
+    run(storage.add_storage(1, "テスト", "押し入れ"))
+    with pytest.raises(DuplicateStorageError):
+        run(storage.add_storage(1, "テスト", "押し入れ"))
+    # 別のギルドなら同じ名前でもよい
+    run(storage.add_storage(2, "別のギルド", "押し入れ"))
+
+    storage_id = run(storage.get_storage_id(1, "押し入れ"))
+    assert storage_id is not None and run(storage.get_storage_id(1, "物置")) is None
+    for name in ("掃除機", "扇風機", "掃除機"):
+        run(storage.upsert_item(storage_id, name))
+
+    assert run(storage.list_storage_items(1, "押し入れ")) == ["扇風機", "掃除機"]
+    assert run(storage.find_item_storage(1, "扇風機")) == "押し入れ"
+    assert run(storage.find_item_storage(2, "扇風機")) is None
+
+
+def test_dialog_state_and_meta(storage, run):
+    since = datetime.now(timezone.utc) - timedelta(minutes=1)
+    run(storage.set_dialog_state(1, '{"type": "add_storage"}'))
+    assert run(storage.get_dialog_state(1, since)) == '{"type": "add_storage"}'
+    assert run(storage.get_dialog_state(1, datetime.now(timezone.utc) + timedelta(minutes=1))) is None
+    run(storage.clear_dialog_state(1))
+    assert run(storage.get_dialog_state(1, since)) is None
+
+    assert run(storage.get_meta("command_tree")) is None
+    run(storage.set_meta("command_tree", "a"))
+    run(storage.set_meta("command_tree", "b"))
+    assert run(storage.get_meta("command_tree")) == "b"
+
+
+def test_create_storage_follows_backend_setting(monkeypatch, tmp_path):
+    monkeypatch.setattr(Config, "STORAGE_BACKEND", "sqlite")
+    monkeypatch.setattr(Config, "SQLITE_PATH", str(tmp_path / "sora.db"))
+    storage = create_storage(QueryStats())
+    assert storage.backend == "sqlite" and not storage.is_ready
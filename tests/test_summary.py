@@ -0,0 +1,41 @@
+"""MessageRecord を流して組み立てるまとめの Embed"""
+
+from datetime import datetime, timezone
+
+from summary import MAX_FIELDS, ChannelRef, MessageRecord, build_summary_embed
+
+AT = datetime(2026, 1, 5, 0, 30, tzinfo=timezone.utc)
+
+
+async def _records(channels, per_channel, content="こんにちは", consumed=None):
+    for channel in channels:
+        for n in range(per_channel):
+            if consumed is not None:
+                consumed.append(n)
+            yield MessageRecord(n, channel, 1, "ぬし", content, AT)
+
+
+def test_lines_are_capped_per_channel(run):
+    channels = [ChannelRef(10, "general", 1, "テスト"), ChannelRef(11, "random", 1, "テスト")]
+    embed, count = run(build_summary_embed(_records(channels, 12)))
+    assert count == 24
+    assert embed.description == "**収集件数**: 24件"
+    assert [field.name for field in embed.fields] == ["#general (12件)", "#random (12件)"]
+    assert embed.fields[0].value.startswith("**09:30** ぬし: こんにちは\n")
+    assert embed.fields[0].value.endswith("...他2件")
+
+
+def test_stops_reading_when_embed_is_full(run):
+    channels = [ChannelRef(channel_id, f"ch{channel_id}", 1, "テスト") for channel_id in range(MAX_FIELDS + 5)]
+    consumed = []
+    embed, count = run(build_summary_embed(_records(channels, 3, content="あ" * 90, consumed=consumed)))
+    assert len(embed) <= 6000
+    assert embed.description.endswith("以上（表示しきれない分は省略）")
+    # 上限に達したら残りのレコードは読まない
+    assert len(consumed) < (MAX_FIELDS + 5) * 3
+    assert count == len(consumed) - 1
+
+
+def test_empty_summary(run):
+    embed, count = run(build_summary_embed(_records([], 0)))
+    assert count == 0 and embed.description == "メッセージは見つかりませんでした。"
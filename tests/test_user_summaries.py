@@ -0,0 +1,35 @@
+"""複数人分のまとめを1人1つの Embed にして、1通に入る分ずつに分ける"""
+
+from datetime import datetime, timedelta, timezone
+
+import discord
+
+from summary import MAX_EMBEDS_PER_MESSAGE, paginate_embeds
+
+START = datetime(2026, 1, 5, tzinfo=timezone.utc)
+
+
+def test_pages_respect_embed_count_and_total_length():
+    small = [discord.Embed(title=f"{n}") for n in range(12)]
+    assert [len(page) for page in paginate_embeds(small)] == [MAX_EMBEDS_PER_MESSAGE, 2]
+
+    large = [discord.Embed(title="まとめ", description="あ" * 2500) for _ in range(3)]
+    assert [len(page) for page in paginate_embeds(large)] == [2, 1]
+    assert paginate_embeds([]) == []
+
+
+def test_one_embed_per_user_in_requested_order(bot, run):
+    channel_id = bot.test_channel.id
+    run(bot.storage.log_message(100, 1, channel_id, 1, "おはよう", START + timedelta(hours=1)))
+    run(bot.storage.log_message(101, 1, channel_id, 2, "作業なう", START + timedelta(hours=2)))
+    run(bot.storage.log_message(102, 1, channel_id, 2, f"<@{bot.user.id}> <@1> <@2>", START + timedelta(hours=3)))
+    users = {2: "ぽて", 1: "ぬし", 3: "だれか"}
+
+    pages = run(bot.build_user_summaries(users, START, START + timedelta(days=1), channel_id=channel_id))
+    assert len(pages) == 1
+    assert [embed.title for embed in pages[0]] == ["📝 ぽてさんのまとめ", "📝 ぬしさんのまとめ", "📝 だれかさんのまとめ"]
+    assert [embed.description for embed in pages[0]] == ["**収集件数**: 1件", "**収集件数**: 1件", "メッセージは見つかりませんでした。"]
+    # まとめの依頼そのものは含めない。活動記録のキーワードは外して並べる
+    assert pages[0][0].fields[0].value == "**11:00** ぽて: 作業\n"
+
+    assert run(bot.build_user_summaries({3: "だれか"}, START, START + timedelta(days=1))) == []